@@ -0,0 +1,271 @@
+"""
+Measures how _choose_existing_instances behaves when many clients allocate jobs to the
+same existing instances at the same time. Runs against a local stand-in for the EC2
+alloc DynamoDB table that simulates per-request latency and DynamoDB's conditional
+update and TransactWriteItems semantics, so it doesn't need AWS credentials, e.g.:
+
+    poetry run python build_scripts/benchmark_allocation_contention.py
+
+For each protocol ("per_item" does one conditional update per instance, "transact"
+applies allocations in TransactWriteItems-style chunks like EC2InstanceRegistrar) and
+number of concurrent clients, prints how many jobs were not allocated (i.e. would have
+launched new instances even though there was enough capacity), how many requests we
+made to the table, and how long the allocations took. --spare-capacity controls how much
+more capacity the existing instances have than the clients need in total.
+"""
+
+import argparse
+import asyncio
+import datetime
+import math
+import time
+from typing import Dict, List, Literal, Optional, Sequence, Tuple
+
+import meadowrun.instance_allocation
+from meadowrun.instance_allocation import (
+    InstanceRegistrar,
+    _choose_existing_instances,
+    _InstanceState,
+)
+from meadowrun.instance_selection import CloudInstance, Resources
+from meadowrun.run_job_core import AllocCloudInstancesInternal
+
+_NUM_CLIENTS = [1, 4, 16, 64]
+_RESOURCES_PER_JOB = Resources(2, 1, {})
+# each instance can run 4 jobs
+_INSTANCE_RESOURCES = Resources(8, 4, {})
+_TRANSACT_WRITE_MAX_ITEMS = 100
+
+ProtocolType = Literal["per_item", "transact"]
+
+
+def _times(resources: Resources, n: int) -> Resources:
+    return Resources(resources.memory_gb * n, resources.logical_cpu * n, {})
+
+
+class _LocalAllocTable(InstanceRegistrar[_InstanceState]):
+    """
+    Mimics EC2InstanceRegistrar on top of an in-memory table. Every method that would
+    make a request to DynamoDB sleeps for latency_secs and counts the request.
+    """
+
+    def __init__(self, protocol: ProtocolType, latency_secs: float):
+        self._protocol = protocol
+        self._latency_secs = latency_secs
+        # public_address -> (available resources, last update time)
+        self.items: Dict[str, Tuple[Resources, datetime.datetime]] = {}
+        self.num_requests = 0
+
+    async def _request(self) -> None:
+        self.num_requests += 1
+        await asyncio.sleep(self._latency_secs)
+
+    async def __aenter__(self) -> "_LocalAllocTable":
+        return self
+
+    async def __aexit__(self, exc_typ, exc_val, exc_tb) -> None:
+        pass
+
+    def get_region_name(self) -> str:
+        return "local"
+
+    async def register_instance(
+        self,
+        public_address: str,
+        name: str,
+        resources_available: Resources,
+        running_jobs: List[Tuple[str, Resources]],
+    ) -> None:
+        self.items[public_address] = (
+            resources_available,
+            datetime.datetime.utcnow(),
+        )
+
+    def _read(self, public_addresses: Sequence[str]) -> List[_InstanceState]:
+        return [
+            _InstanceState(public_address, self.items[public_address][0], None)
+            for public_address in public_addresses
+            if public_address in self.items
+        ]
+
+    async def get_registered_instances(
+        self, resources_required: Optional[Resources] = None
+    ) -> List[_InstanceState]:
+        await self._request()
+        return self._read(list(self.items))
+
+    async def get_registered_instances_changed_since(
+        self, since: datetime.datetime
+    ) -> Optional[List[_InstanceState]]:
+        await self._request()
+        return self._read(
+            [
+                public_address
+                for public_address, (_, last_update_time) in self.items.items()
+                if last_update_time >= since
+            ]
+        )
+
+    async def get_registered_instances_by_address(
+        self, public_addresses: Sequence[str]
+    ) -> List[_InstanceState]:
+        await self._request()
+        return self._read(public_addresses)
+
+    async def get_registered_instance(self, public_address: str) -> _InstanceState:
+        raise NotImplementedError()
+
+    def _try_update(
+        self, public_address: str, resources_to_allocate: Resources
+    ) -> Optional[Resources]:
+        """
+        Like the ConditionExpression in EC2InstanceRegistrar, checks that there are
+        enough resources available. Returns the new available resources.
+        """
+        if public_address not in self.items:
+            return None
+        return self.items[public_address][0].subtract(resources_to_allocate)
+
+    async def allocate_jobs_to_instance(
+        self,
+        instance: _InstanceState,
+        resources_allocated_per_job: Resources,
+        new_job_ids: List[str],
+    ) -> bool:
+        await self._request()
+        new_available = self._try_update(
+            instance.public_address,
+            _times(resources_allocated_per_job, len(new_job_ids)),
+        )
+        if new_available is None:
+            return False
+        self.items[instance.public_address] = (
+            new_available,
+            datetime.datetime.utcnow(),
+        )
+        return True
+
+    async def allocate_jobs_to_multiple_instances(
+        self,
+        allocations: Sequence[Tuple[_InstanceState, List[str]]],
+        resources_allocated_per_job: Resources,
+    ) -> List[bool]:
+        if self._protocol == "per_item":
+            return await super().allocate_jobs_to_multiple_instances(
+                allocations, resources_allocated_per_job
+            )
+
+        results = [False] * len(allocations)
+
+        async def allocate_chunk(chunk: List[int]) -> None:
+            while chunk:
+                await self._request()
+                # all or nothing, like TransactWriteItems
+                new_available = [
+                    self._try_update(
+                        allocations[i][0].public_address,
+                        _times(resources_allocated_per_job, len(allocations[i][1])),
+                    )
+                    for i in chunk
+                ]
+                if all(resources is not None for resources in new_available):
+                    now = datetime.datetime.utcnow()
+                    for i, resources in zip(chunk, new_available):
+                        assert resources is not None
+                        self.items[allocations[i][0].public_address] = (
+                            resources,
+                            now,
+                        )
+                        results[i] = True
+                    return
+                chunk = [
+                    i
+                    for i, resources in zip(chunk, new_available)
+                    if resources is not None
+                ]
+
+        await asyncio.gather(
+            *(
+                allocate_chunk(
+                    list(range(i, min(i + _TRANSACT_WRITE_MAX_ITEMS, len(allocations))))
+                )
+                for i in range(0, len(allocations), _TRANSACT_WRITE_MAX_ITEMS)
+            )
+        )
+        return results
+
+    async def deallocate_job_from_instance(
+        self, instance: _InstanceState, job_id: str
+    ) -> bool:
+        raise NotImplementedError()
+
+    async def launch_instances(
+        self, instances_spec: AllocCloudInstancesInternal
+    ) -> List[CloudInstance]:
+        raise NotImplementedError()
+
+
+async def _run_clients(
+    protocol: ProtocolType,
+    num_clients: int,
+    jobs_per_client: int,
+    spare_capacity: float,
+    latency_secs: float,
+) -> Tuple[int, int, float]:
+    """Returns the number of unallocated jobs, number of requests, and runtime"""
+    table = _LocalAllocTable(protocol, latency_secs)
+    num_instances = math.ceil(num_clients * jobs_per_client * (1 + spare_capacity) / 4)
+    for i in range(num_instances):
+        await table.register_instance(f"instance{i}", "", _INSTANCE_RESOURCES, [])
+    meadowrun.instance_allocation._REGISTERED_INSTANCES_CACHE.clear()
+
+    t0 = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            _choose_existing_instances(table, _RESOURCES_PER_JOB, jobs_per_client)
+            for _ in range(num_clients)
+        )
+    )
+    runtime = time.perf_counter() - t0
+
+    num_allocated = sum(
+        len(job_ids) for result in results for job_ids in result.values()
+    )
+    return num_clients * jobs_per_client - num_allocated, table.num_requests, runtime
+
+
+def benchmark(jobs_per_client: int, spare_capacity: float, latency_secs: float) -> None:
+    rows = []
+    for protocol in ("per_item", "transact"):
+        for num_clients in _NUM_CLIENTS:
+            unallocated, num_requests, runtime = asyncio.run(
+                _run_clients(
+                    protocol, num_clients, jobs_per_client, spare_capacity, latency_secs
+                )
+            )
+            rows.append(
+                f"{protocol},{num_clients},{num_clients * jobs_per_client},"
+                f"{unallocated},{num_requests},{runtime * 1000:.1f}"
+            )
+
+    # _choose_existing_instances prints a line for each client, so we print our
+    # results at the end
+    print("protocol,num_clients,num_jobs,unallocated_jobs,requests,runtime_ms")
+    for row in rows:
+        print(row)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs-per-client", type=int, default=20)
+    # e.g. 0.25 means there are 25% more free slots on the existing instances than the
+    # clients need in total. 0 is the worst case for contention
+    parser.add_argument("--spare-capacity", type=float, default=0.25)
+    parser.add_argument("--latency-ms", type=float, default=10)
+    args = parser.parse_args()
+
+    benchmark(args.jobs_per_client, args.spare_capacity, args.latency_ms / 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compares the "exact" and "greedy" solvers in choose_instance_types_for_job on real
+instance type catalogs. Prints the total cost per hour and the runtime for each solver
+for a range of job shapes.
+
+Requires AWS credentials for the EC2 catalog and Azure credentials for the Azure
+catalog, e.g.:
+
+    poetry run python build_scripts/benchmark_instance_selection.py ec2 us-east-2
+    poetry run python build_scripts/benchmark_instance_selection.py azure eastus
+"""
+
+import argparse
+import asyncio
+import time
+from typing import List, Tuple
+
+from meadowrun.instance_selection import (
+    ChosenCloudInstanceType,
+    CloudInstanceType,
+    Resources,
+    SolverType,
+    choose_instance_types_for_job,
+)
+
+# (memory_gb, logical_cpu) per worker
+_RESOURCES_PER_WORKER = [(0.5, 1), (2, 1), (4, 2), (16, 4), (64, 8)]
+_NUM_WORKERS = [1, 3, 17, 53, 200, 1000, 5000]
+_INTERRUPTION_PROBABILITY_THRESHOLDS = [0, 15, 80]
+
+
+async def _get_catalog(cloud_provider: str, region: str) -> List[CloudInstanceType]:
+    if cloud_provider == "ec2":
+        from meadowrun.aws_integration.ec2_pricing import (
+            get_cached_ec2_instance_types,
+        )
+
+        return await get_cached_ec2_instance_types(region)
+    elif cloud_provider == "azure":
+        from meadowrun.azure_integration.azure_vm_pricing import get_cached_vm_types
+
+        return await get_cached_vm_types(region)
+    else:
+        raise ValueError(f"Unexpected cloud provider {cloud_provider}")
+
+
+def _run_solver(
+    solver: SolverType,
+    resources: Resources,
+    num_workers: int,
+    threshold: float,
+    catalog: List[CloudInstanceType],
+) -> Tuple[float, float, List[ChosenCloudInstanceType]]:
+    """Returns cost per hour, runtime in seconds, chosen instance types"""
+    t0 = time.perf_counter()
+    chosen = choose_instance_types_for_job(
+        resources, num_workers, threshold, catalog, solver
+    )
+    runtime = time.perf_counter() - t0
+    cost = sum(
+        instance_type.instance_type.price * instance_type.num_instances
+        for instance_type in chosen
+    )
+    return cost, runtime, chosen
+
+
+def benchmark(cloud_provider: str, region: str) -> None:
+    catalog = asyncio.run(_get_catalog(cloud_provider, region))
+    print(f"{len(catalog)} instance types in {cloud_provider} {region}")
+    print(
+        "memory_gb,logical_cpu,num_workers,threshold,"
+        "greedy_cost,exact_cost,savings_pct,greedy_ms,exact_ms"
+    )
+
+    total_greedy_cost = 0.0
+    total_exact_cost = 0.0
+    for memory_gb, logical_cpu in _RESOURCES_PER_WORKER:
+        resources = Resources(memory_gb, logical_cpu, {})
+        for num_workers in _NUM_WORKERS:
+            for threshold in _INTERRUPTION_PROBABILITY_THRESHOLDS:
+                greedy_cost, greedy_runtime, _ = _run_solver(
+                    "greedy", resources, num_workers, threshold, catalog
+                )
+                exact_cost, exact_runtime, _ = _run_solver(
+                    "exact", resources, num_workers, threshold, catalog
+                )
+                total_greedy_cost += greedy_cost
+                total_exact_cost += exact_cost
+                if greedy_cost > 0:
+                    savings_pct = 100 * (greedy_cost - exact_cost) / greedy_cost
+                else:
+                    savings_pct = 0
+                print(
+                    f"{memory_gb},{logical_cpu},{num_workers},{threshold},"
+                    f"{greedy_cost:.4f},{exact_cost:.4f},{savings_pct:.2f},"
+                    f"{greedy_runtime * 1000:.1f},{exact_runtime * 1000:.1f}"
+                )
+
+    print(f"Total greedy cost: ${total_greedy_cost:.4f}/hr")
+    print(f"Total exact cost: ${total_exact_cost:.4f}/hr")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cloud_provider", choices=["ec2", "azure"])
+    parser.add_argument("region")
+    args = parser.parse_args()
+
+    benchmark(args.cloud_provider, args.region)
+
+
+if __name__ == "__main__":
+    main()
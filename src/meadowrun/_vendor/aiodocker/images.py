@@ -252,6 +252,7 @@ class DockerImages(object):
         labels: Mapping = None,
         stream: Literal[False] = False,
         encoding: str = None,
+        version: Optional[str] = None,
     ) -> Dict[str, Any]:
         pass
 
@@ -272,6 +273,7 @@ class DockerImages(object):
         labels: Mapping = None,
         stream: Literal[True],
         encoding: str = None,
+        version: Optional[str] = None,
     ) -> AsyncIterator[Dict[str, Any]]:
         pass
 
@@ -291,6 +293,7 @@ class DockerImages(object):
         labels: Mapping = None,
         stream: bool = False,
         encoding: str = None,
+        version: Optional[str] = None,
     ) -> Any:
         """
         Build an image given a remote Dockerfile
@@ -307,6 +310,8 @@ class DockerImages(object):
             forcerm: always remove intermediate containers, even upon failure
             labels: arbitrary key/value labels to set on the image
             fileobj: a tar archive compressed or not
+            version: the builder to use, "1" for the classic builder or "2" for
+                BuildKit
         """
         headers = {}
 
@@ -319,6 +324,7 @@ class DockerImages(object):
             "nocache": nocache,
             "forcerm": forcerm,
             "dockerfile": path_dockerfile,
+            "version": version,
         }
 
         if remote is None and fileobj is None:
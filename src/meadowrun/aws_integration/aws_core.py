@@ -1,11 +1,85 @@
 from __future__ import annotations
 
-from typing import Any, Iterable, Optional
+import asyncio
+import concurrent.futures
+import functools
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple, TypeVar
 
 import aiohttp
 import aiohttp.client_exceptions
 import boto3
 
+_T = TypeVar("_T")
+
+
+# boto3 calls block, so from async code we run them on this thread pool rather than on
+# the event loop. The pool is bounded so that e.g. many concurrent run_function calls
+# don't create an unbounded number of threads and connections.
+# TODO aiobotocore would avoid the threads entirely, but it has a different API for
+# everything (and doesn't support boto3 resources), so we only use it for SQS for now
+_BOTO3_MAX_THREADS = 16
+_BOTO3_EXECUTOR: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_BOTO3_EXECUTOR_LOCK = threading.Lock()
+
+# (service_name, region_name) -> client. boto3 clients are thread-safe, and creating
+# them is relatively slow (e.g. they load the service's JSON model), so we share them
+# across the whole process
+_BOTO3_CLIENTS: Dict[Tuple[str, Optional[str]], Any] = {}
+_BOTO3_CLIENTS_LOCK = threading.Lock()
+# boto3 resources are not thread-safe, so we keep a cache of resources per thread
+_BOTO3_RESOURCES = threading.local()
+
+
+async def _run_boto3(func: Callable[..., _T], *args: Any, **kwargs: Any) -> _T:
+    """
+    Runs func(*args, **kwargs) (which presumably makes blocking boto3 calls) on the
+    boto3 thread pool
+    """
+    global _BOTO3_EXECUTOR
+    with _BOTO3_EXECUTOR_LOCK:
+        if _BOTO3_EXECUTOR is None:
+            _BOTO3_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+                _BOTO3_MAX_THREADS, thread_name_prefix="meadowrun-boto3"
+            )
+    return await asyncio.get_running_loop().run_in_executor(
+        _BOTO3_EXECUTOR, functools.partial(func, *args, **kwargs)
+    )
+
+
+def _get_boto3_client(service_name: str, region_name: Optional[str] = None) -> Any:
+    """Like boto3.client, but returns a cached client if possible"""
+    key = (service_name, region_name)
+    client = _BOTO3_CLIENTS.get(key)
+    if client is None:
+        # boto3.client uses the default session which is not thread-safe
+        with _BOTO3_CLIENTS_LOCK:
+            client = _BOTO3_CLIENTS.get(key)
+            if client is None:
+                client = boto3.client(service_name, region_name=region_name)
+                _BOTO3_CLIENTS[key] = client
+    return client
+
+
+def _get_boto3_resource(service_name: str, region_name: Optional[str] = None) -> Any:
+    """
+    Like boto3.resource, but returns a cached resource if possible. The resource should
+    only be used on the current thread
+    """
+    resources: Optional[Dict[Tuple[str, Optional[str]], Any]] = getattr(
+        _BOTO3_RESOURCES, "resources", None
+    )
+    if resources is None:
+        resources = {}
+        _BOTO3_RESOURCES.resources = resources
+    key = (service_name, region_name)
+    resource = resources.get(key)
+    if resource is None:
+        with _BOTO3_CLIENTS_LOCK:
+            resource = boto3.resource(service_name, region_name=region_name)
+        resources[key] = resource
+    return resource
+
 
 def _boto3_paginate(method: Any, **kwargs: Any) -> Iterable[Any]:
     paginator = method.__self__.get_paginator(method.__name__)
@@ -102,4 +176,4 @@ async def _get_current_ip_for_ssh() -> str:
 
 def _get_account_number() -> str:
     # weird that we have to do this to get the account number to construct the ARN
-    return boto3.client("sts").get_caller_identity().get("Account")
+    return _get_boto3_client("sts").get_caller_identity().get("Account")
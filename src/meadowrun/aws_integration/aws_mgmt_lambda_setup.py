@@ -5,7 +5,7 @@ import io
 import os
 import pkgutil
 import zipfile
-from typing import Any, Tuple, Callable, TypeVar
+from typing import Any, Tuple, Callable, TypeVar, Dict, Optional
 
 import boto3
 
@@ -20,12 +20,15 @@ from meadowrun.aws_integration.ec2_alloc_role import (
     _CLEAN_UP_LAMBDA_SCHEDULE_RULE,
     _EC2_ALLOC_LAMBDA_NAME,
     _EC2_ALLOC_LAMBDA_SCHEDULE_RULE,
+    _EC2_ALLOC_ROLE,
     _MANAGEMENT_LAMBDA_ROLE,
     _ensure_ec2_alloc_table_access_policy,
     _ensure_meadowrun_ecr_access_policy,
     _ensure_meadowrun_sqs_access_policy,
 )
 from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
+    _WARM_POOL_POLICY_VARIABLE,
+    WarmPoolPolicy,
     ignore_boto3_error_code,
 )
 
@@ -43,6 +46,20 @@ _LAMBDA_ASSUME_ROLE_POLICY_DOCUMENT = """{
     ]
 }"""
 
+# allows the management lambda to launch EC2 instances that run as the EC2 alloc role
+_PASS_EC2_ALLOC_ROLE_POLICY_DOCUMENT = (
+    """{
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Action": "iam:PassRole",
+            "Resource": "arn:aws:iam::$ACCOUNT_NUMBER:role/$ROLE_NAME"
+        }
+    ]
+}"""
+).replace("$ROLE_NAME", _EC2_ALLOC_ROLE)
+
 
 def _get_zipped_lambda_code() -> bytes:
     """
@@ -102,6 +119,17 @@ def _ensure_management_lambda_role(region_name: str) -> None:
             PolicyArn="arn:aws:iam::aws:policy/AmazonEC2FullAccess",
         )
 
+        # allow launching EC2 instances with the EC2 alloc role for forecast demand
+        # (see adjust_ec2_instances._prelaunch_for_forecast_demand)
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/iam.html#IAM.Client.put_role_policy
+        iam.put_role_policy(
+            RoleName=_MANAGEMENT_LAMBDA_ROLE,
+            PolicyName="meadowrun_pass_ec2_alloc_role",
+            PolicyDocument=_PASS_EC2_ALLOC_ROLE_POLICY_DOCUMENT.replace(
+                "$ACCOUNT_NUMBER", _get_account_number()
+            ),
+        )
+
         # allow deleting SQS queues
         iam.attach_role_policy(
             RoleName=_MANAGEMENT_LAMBDA_ROLE,
@@ -131,10 +159,15 @@ async def _create_management_lambda(
     schedule_rule_name: str,
     schedule_expression: str,
     region_name: str,
+    environment_variables: Optional[Dict[str, str]] = None,
 ) -> None:
     """Creates the ec2 alloc lambda assuming it does not already exist"""
     account_number = _get_account_number()
 
+    optional_args: Dict[str, Any] = {}
+    if environment_variables:
+        optional_args["Environment"] = {"Variables": environment_variables}
+
     # create the lambda
     def create_function_if_not_exists() -> Tuple[bool, None]:
         ignore_boto3_error_code(
@@ -146,6 +179,7 @@ async def _create_management_lambda(
                 Code={"ZipFile": _get_zipped_lambda_code()},
                 Timeout=120,
                 MemorySize=128,  # memory available in MB
+                **optional_args,
             ),
             "ResourceConflictException",
         )
@@ -222,10 +256,12 @@ async def _ensure_management_lambda(
     schedule_rule_name: str,
     schedule_expression: str,
     update_if_exists: bool,
+    environment_variables: Optional[Dict[str, str]] = None,
 ) -> None:
     """
     Create the specified management lambda if it doesn't exist. If update_if_exists is
-    true, updates the code if the lambda already exists.
+    true, updates the code (and environment_variables if they are provided) if the
+    lambda already exists.
 
     Even if this is called with update_if_exists, it is not guaranteed to update the
     code if another process creates the lambda after this function starts executing.
@@ -250,22 +286,42 @@ async def _ensure_management_lambda(
             schedule_rule_name,
             schedule_expression,
             region_name,
+            environment_variables,
         )
         _set_retention_policy_lambda_logs(lambda_name, region_name)
     elif update_if_exists:
         lambda_client.update_function_code(
             FunctionName=lambda_name, ZipFile=_get_zipped_lambda_code()
         )
+        if environment_variables is not None:
+            # we can't update the configuration while the code update is in progress
+            lambda_client.get_waiter("function_updated").wait(FunctionName=lambda_name)
+            lambda_client.update_function_configuration(
+                FunctionName=lambda_name,
+                Environment={"Variables": environment_variables},
+            )
         _set_retention_policy_lambda_logs(lambda_name, region_name)
 
 
-async def ensure_ec2_alloc_lambda(update_if_exists: bool = False) -> None:
+async def ensure_ec2_alloc_lambda(
+    update_if_exists: bool = False, warm_pool_policy: Optional[WarmPoolPolicy] = None
+) -> None:
+    """
+    warm_pool_policy determines how the lambda deals with idle instances. If it is
+    None, an existing lambda will keep its current policy, and a new lambda will use the
+    default policy.
+    """
+    if warm_pool_policy is None:
+        environment_variables = None
+    else:
+        environment_variables = {_WARM_POOL_POLICY_VARIABLE: warm_pool_policy.to_json()}
     await _ensure_management_lambda(
         meadowrun.aws_integration.management_lambdas.adjust_ec2_instances.lambda_handler,  # noqa: E501
         _EC2_ALLOC_LAMBDA_NAME,
         _EC2_ALLOC_LAMBDA_SCHEDULE_RULE,
         "rate(1 minute)",
         update_if_exists,
+        environment_variables,
     )
 
 
@@ -23,6 +23,7 @@ from meadowrun.aws_integration.ec2_ssh_keys import (
     _MEADOWRUN_KEY_PAIR_SECRET_NAME,
 )
 from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
+    _DEMAND_HISTORY_TABLE_NAME,
     _EC2_ALLOC_TABLE_NAME,
     _MEADOWRUN_GENERATED_DOCKER_REPO,
     ignore_boto3_error_code,
@@ -175,6 +176,10 @@ def delete_meadowrun_resources(region_name: str) -> None:
         lambda: dynamodb_client.delete_table(TableName=_EC2_ALLOC_TABLE_NAME),
         "ResourceNotFoundException",
     )
+    ignore_boto3_error_code(
+        lambda: dynamodb_client.delete_table(TableName=_DEMAND_HISTORY_TABLE_NAME),
+        "ResourceNotFoundException",
+    )
 
     ecr_client = boto3.client("ecr", region_name=region_name)
     ignore_boto3_error_code(
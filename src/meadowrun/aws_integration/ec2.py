@@ -1,24 +1,31 @@
 from __future__ import annotations
 
 import asyncio
-import threading
-from typing import Sequence, Tuple, Callable, Optional, Dict, Any, TypeVar
+import dataclasses
+import time
+from typing import Sequence, Tuple, Callable, Optional, Dict, Any, TypeVar, List
 
-import boto3
 import botocore.exceptions
 
 from meadowrun.aws_integration.aws_core import (
+    _get_boto3_client,
+    _get_boto3_resource,
     _get_current_ip_for_ssh,
     _get_default_region_name,
+    _run_boto3,
 )
-from meadowrun.aws_integration.ec2_pricing import _get_ec2_instance_types
+from meadowrun.aws_integration.ec2_pricing import get_cached_ec2_instance_types
 from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
+    _EC2_ALLOC_STOPPED_TIME_TAG,
+    get_create_instances_args,
     ignore_boto3_error_code,
 )
 from meadowrun.instance_selection import (
+    ChosenCloudInstanceType,
     CloudInstance,
     OnDemandOrSpotType,
     Resources,
+    _get_feasible_instance_types,
     choose_instance_types_for_job,
 )
 
@@ -39,8 +46,11 @@ async def ensure_meadowrun_ssh_security_group() -> str:
     Returns the security group id of the _MEADOWRUN_SSH_SECURITY_GROUP
     """
     current_ip_for_ssh = await _get_current_ip_for_ssh()
-    return ensure_security_group(
-        _MEADOWRUN_SSH_SECURITY_GROUP, [(22, 22, f"{current_ip_for_ssh}/32")], []
+    return await _run_boto3(
+        ensure_security_group,
+        _MEADOWRUN_SSH_SECURITY_GROUP,
+        [(22, 22, f"{current_ip_for_ssh}/32")],
+        [],
     )
 
 
@@ -58,7 +68,7 @@ def ensure_security_group(
 
     Returns the id of the security group.
     """
-    ec2_resource = boto3.resource("ec2")
+    ec2_resource = _get_boto3_resource("ec2")
     security_group = _get_ec2_security_group(ec2_resource, group_name)
     if security_group is None:
         security_group = ec2_resource.create_security_group(
@@ -98,14 +108,15 @@ async def _retry_iam_instance_profile(func: Callable[[], _T]) -> _T:
     """
     There is an issue where when you create a new IAM instance profile then launch an
     EC2 instance with that profile, launching the EC2 instance will fail for the first
-    few seconds. This function will retry func for "Invalid IAM Instance Profile" errors
+    few seconds. This function will retry func for "Invalid IAM Instance Profile"
+    errors. func will be run on the boto3 thread pool
     """
     attempts = 7
     seconds_to_wait = 2
 
     for i in range(attempts):
         try:
-            return func()
+            return await _run_boto3(func)
         except botocore.exceptions.ClientError as e:
             if "Error" in e.response:
                 error = e.response["Error"]
@@ -126,6 +137,97 @@ async def _retry_iam_instance_profile(func: Callable[[], _T]) -> _T:
     raise ValueError("This should never happen")
 
 
+# How often to poll describe_instances while we wait for instances to start
+_WAIT_FOR_RUNNING_POLL_SECS = 3
+# Roughly the same as the boto3 instance_running waiter (40 attempts, 15 seconds apart)
+_WAIT_FOR_RUNNING_TIMEOUT_SECS = 600
+
+
+async def _create_ec2_instances(
+    region_name: str,
+    instance_type: str,
+    num_instances: int,
+    ami_id: str,
+    optional_args: Dict[str, Any],
+) -> Sequence[str]:
+    """
+    Launches num_instances of the specified instance type with a single API call.
+    Returns the instance ids. optional_args should come from get_create_instances_args
+    """
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.run_instances
+    # MinCount=MaxCount means we either get all of the instances or none of them
+    instances = await _retry_iam_instance_profile(
+        lambda: _get_boto3_resource("ec2", region_name).create_instances(
+            ImageId=ami_id,
+            MinCount=num_instances,
+            MaxCount=num_instances,
+            InstanceType=instance_type,
+            **optional_args,
+        )
+    )
+    return [instance.id for instance in instances]
+
+
+async def _wait_for_public_dns_names(
+    region_name: str, instance_ids: Sequence[str]
+) -> Dict[str, str]:
+    """
+    Waits for all of the specified instances to be running and have a public dns name.
+    Returns instance_id -> public dns name.
+
+    Rather than having a waiter per instance (each of which would poll
+    describe_instances separately and quickly run into throttling), we poll
+    describe_instances for all of the instances that are still pending at once.
+    """
+    ec2_client = _get_boto3_client("ec2", region_name)
+
+    public_dns_names: Dict[str, str] = {}
+    pending_instance_ids = list(instance_ids)
+    t0 = time.time()
+    while True:
+        # describe_instances is eventually consistent, so it's possible that instances
+        # we just created won't be found yet
+        # https://docs.aws.amazon.com/AWSEC2/latest/APIReference/query-api-troubleshooting.html#eventual-consistency
+        success, response = await _run_boto3(
+            ignore_boto3_error_code,
+            lambda: ec2_client.describe_instances(InstanceIds=pending_instance_ids),
+            "InvalidInstanceID.NotFound",
+        )
+        if success:
+            assert response is not None  # just for mypy
+            for reservation in response["Reservations"]:
+                for instance in reservation["Instances"]:
+                    state = instance["State"]["Name"]
+                    if state == "running":
+                        if not instance.get("PublicDnsName"):
+                            raise ValueError(
+                                "Waited until running, but still no IP address!"
+                            )
+                        public_dns_names[instance["InstanceId"]] = instance[
+                            "PublicDnsName"
+                        ]
+                    elif state != "pending":
+                        raise ValueError(
+                            f"Instance {instance['InstanceId']} is {state} but we were "
+                            "waiting for it to be running"
+                        )
+
+            pending_instance_ids = [
+                instance_id
+                for instance_id in pending_instance_ids
+                if instance_id not in public_dns_names
+            ]
+            if not pending_instance_ids:
+                return public_dns_names
+
+        if time.time() - t0 > _WAIT_FOR_RUNNING_TIMEOUT_SECS:
+            raise ValueError(
+                "Timed out waiting for instances to start: "
+                + ", ".join(pending_instance_ids)
+            )
+        await asyncio.sleep(_WAIT_FOR_RUNNING_POLL_SECS)
+
+
 async def launch_ec2_instance(
     region_name: str,
     instance_type: str,
@@ -147,88 +249,141 @@ async def launch_ec2_instance(
     to launch, as there's no way to tag a spot instance before it's running.
     """
 
-    optional_args: Dict[str, Any] = {
-        # TODO allow users to specify the size of the EBS they need
-        "BlockDeviceMappings": [
-            {
-                "DeviceName": "/dev/sda1",
-                "Ebs": {
-                    "DeleteOnTermination": True,
-                    "VolumeSize": 16,
-                    "VolumeType": "gp2",
-                },
-            }
-        ]
-    }
-    if security_group_ids:
-        optional_args["SecurityGroupIds"] = security_group_ids
-    if iam_role_name:
-        optional_args["IamInstanceProfile"] = {"Name": iam_role_name}
-    if key_name:
-        optional_args["KeyName"] = key_name
-    if user_data:
-        optional_args["UserData"] = user_data
-    if tags:
-        optional_args["TagSpecifications"] = [
-            {
-                "ResourceType": "instance",
-                "Tags": [{"Key": key, "Value": value} for key, value in tags.items()],
-            }
-        ]
+    instance_ids = await _create_ec2_instances(
+        region_name,
+        instance_type,
+        1,
+        ami_id,
+        get_create_instances_args(
+            on_demand_or_spot,
+            security_group_ids,
+            iam_role_name,
+            user_data,
+            key_name,
+            tags,
+        ),
+    )
 
-    if on_demand_or_spot == "on_demand":
-        pass
-    elif on_demand_or_spot == "spot":
-        optional_args["InstanceMarketOptions"] = {"MarketType": "spot"}
+    if wait_for_dns_name:
+        return (await _wait_for_public_dns_names(region_name, instance_ids))[
+            instance_ids[0]
+        ]
     else:
-        raise ValueError(f"Unexpected value for on_demand_or_spot {on_demand_or_spot}")
+        return None
 
-    ec2_resource = boto3.resource("ec2", region_name=region_name)
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.run_instances
-    instance = (
-        await _retry_iam_instance_profile(
-            lambda: ec2_resource.create_instances(
-                ImageId=ami_id,
-                MinCount=1,
-                MaxCount=1,
-                InstanceType=instance_type,
-                **optional_args,
-            )
+
+async def _restart_stopped_instances(
+    region_name: str,
+    resources_required: Resources,
+    num_jobs: int,
+    tags: Optional[Dict[str, str]],
+) -> List[CloudInstance]:
+    """
+    Restarts instances that adjust_ec2_instances stopped (see WarmPoolPolicy) that can
+    run at least one job requiring resources_required, until we have enough capacity for
+    num_jobs jobs or we run out of stopped instances. Only considers instances that have
+    all of the specified tags. Returns the restarted instances, which may provide
+    capacity for fewer than num_jobs.
+
+    Stopped instances are always on-demand instances, and starting an instance takes
+    much less time than launching a new one, so we prefer these to launching new
+    instances regardless of price.
+    """
+    if num_jobs <= 0:
+        return []
+
+    filters = [
+        {"Name": "instance-state-name", "Values": ["stopped"]},
+        {"Name": "tag-key", "Values": [_EC2_ALLOC_STOPPED_TIME_TAG]},
+    ]
+    if tags:
+        filters.extend(
+            {"Name": f"tag:{key}", "Values": [value]} for key, value in tags.items()
+        )
+    stopped_instances = await _run_boto3(
+        lambda: list(
+            _get_boto3_resource("ec2", region_name).instances.filter(Filters=filters)
         )
-    )[0]
+    )
+    if not stopped_instances:
+        return []
+
+    # we only need the on-demand instance types, and we want to know how many jobs each
+    # one can run
+    instance_types = {
+        instance_type.instance_type.name: instance_type
+        for instance_type in _get_feasible_instance_types(
+            resources_required,
+            0,
+            [
+                instance_type
+                for instance_type in await get_cached_ec2_instance_types(region_name)
+                if instance_type.on_demand_or_spot == "on_demand"
+            ],
+        )
+    }
 
-    if wait_for_dns_name:
-        # boto3 doesn't have any async APIs, which means that in order to run more than
-        # one launch_ec2_instance at the same time, we need to have a thread that waits.
-        # We use an asyncio.Future here to make the API async, so from the user
-        # perspective, it feels like this function is async
-
-        # boto3 should be threadsafe:
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/clients.html#multithreading-or-multiprocessing-with-clients
-        instance_running_future: asyncio.Future = asyncio.Future()
-        event_loop = asyncio.get_running_loop()
-
-        def wait_until_running() -> None:
-            try:
-                instance.wait_until_running()
-                event_loop.call_soon_threadsafe(
-                    lambda: instance_running_future.set_result(None)
-                )
-            except Exception as e:
-                exception = e
-                event_loop.call_soon_threadsafe(
-                    lambda: instance_running_future.set_exception(exception)
-                )
-
-        threading.Thread(target=wait_until_running).start()
-        await instance_running_future
-
-        instance.load()
-        if not instance.public_dns_name:
-            raise ValueError("Waited until running, but still no IP address!")
-        return instance.public_dns_name
-    else:
-        return None
+    # prefer the instances that are the cheapest per job we can run on them
+    candidates = sorted(
+        (
+            (instance_types[instance.instance_type].price_per_worker_full, i)
+            for i, instance in enumerate(stopped_instances)
+            if instance.instance_type in instance_types
+        )
+    )
+    chosen: Dict[str, ChosenCloudInstanceType] = {}
+    num_jobs_remaining = num_jobs
+    for _, i in candidates:
+        if num_jobs_remaining <= 0:
+            break
+        instance = stopped_instances[i]
+        instance_type = instance_types[instance.instance_type]
+        chosen[instance.id] = dataclasses.replace(instance_type, num_instances=1)
+        num_jobs_remaining -= instance_type.workers_per_instance_full
+
+    if not chosen:
+        return []
+
+    print(f"Restarting {len(chosen)} stopped instance(s)")
+    # Another client could have chosen the same stopped instances. EC2 only moves an
+    # instance out of the stopped state once, so start_instances is our claim: we only
+    # use the instances whose previous state was stopped. Any others were started by
+    # another client, which will register them and allocate jobs to them.
+    ec2_client = _get_boto3_client("ec2", region_name)
+    response = await _run_boto3(
+        ec2_client.start_instances, InstanceIds=list(chosen.keys())
+    )
+    claimed = {
+        instance["InstanceId"]
+        for instance in response["StartingInstances"]
+        if instance["PreviousState"]["Name"] == "stopped"
+    }
+    if len(claimed) < len(chosen):
+        print(
+            f"{len(chosen) - len(claimed)} of the stopped instance(s) were restarted by"
+            " another client"
+        )
+    chosen = {
+        instance_id: instance_type
+        for instance_id, instance_type in chosen.items()
+        if instance_id in claimed
+    }
+    if not chosen:
+        return []
+
+    await _run_boto3(
+        ec2_client.delete_tags,
+        Resources=list(chosen.keys()),
+        Tags=[{"Key": _EC2_ALLOC_STOPPED_TIME_TAG}],
+    )
+    public_dns_names = await _wait_for_public_dns_names(
+        region_name, list(chosen.keys())
+    )
+
+    return [
+        CloudInstance(public_dns_names[instance_id], "", instance_type)
+        for instance_id, instance_type in chosen.items()
+    ]
 
 
 async def launch_ec2_instances(
@@ -243,6 +398,7 @@ async def launch_ec2_instances(
     user_data: Optional[str] = None,
     key_name: Optional[str] = None,
     tags: Optional[Dict[str, str]] = None,
+    reuse_stopped_instances: bool = False,
 ) -> Sequence[CloudInstance]:
     """
     Launches enough EC2 instances to run num_jobs jobs that each require the specified
@@ -251,16 +407,39 @@ async def launch_ec2_instances(
     of jobs that can run on that instance. The sum of all of the
     workers_per_instance_full will be greater than or equal to the original num_jobs
     parameter.
+
+    We make one create_instances call per chosen instance type, and then wait for all of
+    the instances together.
+
+    If reuse_stopped_instances is True, we first restart any suitable instances that
+    were stopped by adjust_ec2_instances (and have the specified tags), and only launch
+    new instances for the remaining jobs.
     """
 
     if region_name is None:
         region_name = await _get_default_region_name()
 
+    resources_required = Resources(
+        memory_gb_required_per_job, logical_cpu_required_per_job, {}
+    )
+
+    restarted_instances: List[CloudInstance] = []
+    if reuse_stopped_instances:
+        restarted_instances = await _restart_stopped_instances(
+            region_name, resources_required, num_jobs, tags
+        )
+        num_jobs -= sum(
+            instance.instance_type.workers_per_instance_full
+            for instance in restarted_instances
+        )
+        if num_jobs <= 0:
+            return restarted_instances
+
     chosen_instance_types = choose_instance_types_for_job(
-        Resources(memory_gb_required_per_job, logical_cpu_required_per_job, {}),
+        resources_required,
         num_jobs,
         interruption_probability_threshold,
-        await _get_ec2_instance_types(region_name),
+        await get_cached_ec2_instance_types(region_name),
     )
     if len(chosen_instance_types) < 1:
         raise ValueError(
@@ -268,35 +447,43 @@ async def launch_ec2_instances(
             f"memory={memory_gb_required_per_job}, cpu={logical_cpu_required_per_job}"
         )
 
-    public_dns_name_tasks = []
-    chosen_instance_types_repeated = []
-
-    for instance_type in chosen_instance_types:
-        for _ in range(instance_type.num_instances):
-            # should really launch these with a single API call
-            public_dns_name_tasks.append(
-                launch_ec2_instance(
-                    region_name,
-                    instance_type.instance_type.name,
+    # instance_id -> the corresponding ChosenCloudInstanceType
+    instance_ids: Dict[str, ChosenCloudInstanceType] = {}
+    try:
+        for instance_type in chosen_instance_types:
+            for instance_id in await _create_ec2_instances(
+                region_name,
+                instance_type.instance_type.name,
+                instance_type.num_instances,
+                ami_id,
+                get_create_instances_args(
                     instance_type.instance_type.on_demand_or_spot,
-                    ami_id=ami_id,
-                    security_group_ids=security_group_ids,
-                    iam_role_name=iam_role_name,
-                    user_data=user_data,
-                    key_name=key_name,
-                    tags=tags,
-                    wait_for_dns_name=True,
-                )
+                    security_group_ids,
+                    iam_role_name,
+                    user_data,
+                    key_name,
+                    tags,
+                ),
+            ):
+                instance_ids[instance_id] = instance_type
+
+        public_dns_names = await _wait_for_public_dns_names(
+            region_name, list(instance_ids.keys())
+        )
+    except BaseException:
+        # otherwise the instances we've already launched keep running (and costing
+        # money) until adjust_ec2_instances notices that they were never registered
+        if instance_ids:
+            print(f"Terminating {len(instance_ids)} instance(s) we just launched")
+            await _run_boto3(
+                _get_boto3_client("ec2", region_name).terminate_instances,
+                InstanceIds=list(instance_ids.keys()),
             )
-            chosen_instance_types_repeated.append(instance_type)
-
-    public_dns_names = await asyncio.gather(*public_dns_name_tasks)
+        raise
 
-    return [
-        CloudInstance(public_dns_name, "", instance_type)
-        for public_dns_name, instance_type in zip(
-            public_dns_names, chosen_instance_types_repeated
-        )
+    return restarted_instances + [
+        CloudInstance(public_dns_names[instance_id], "", instance_type)
+        for instance_id, instance_type in instance_ids.items()
     ]
 
 
@@ -5,12 +5,18 @@ resources from meadowrun-launched EC2 instances
 
 from __future__ import annotations
 
+import json
 from typing import Any
 
 import boto3
 
-from meadowrun.aws_integration.aws_core import _get_account_number, _iam_role_exists
+from meadowrun.aws_integration.aws_core import (
+    _get_account_number,
+    _get_boto3_client,
+    _iam_role_exists,
+)
 from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
+    _DEMAND_HISTORY_TABLE_NAME,
     _EC2_ALLOC_TABLE_NAME,
     _MEADOWRUN_GENERATED_DOCKER_REPO,
     ignore_boto3_error_code,
@@ -32,7 +38,8 @@ _EC2_ASSUME_ROLE_POLICY_DOCUMENT = """{
     ]
 }"""
 # a policy that grants read/write to the dynamodb table that registers EC2
-# instances/jobs
+# instances/jobs and the demand history table. See also
+# update_ec2_alloc_table_access_policy
 _EC2_ALLOC_TABLE_ACCESS_POLICY_NAME = "meadowrun_ec2_alloc_table_access"
 _EC2_TABLE_ACCESS_POLICY_DOCUMENT = """{
     "Version": "2012-10-17",
@@ -53,11 +60,16 @@ _EC2_TABLE_ACCESS_POLICY_DOCUMENT = """{
                 "dynamodb:Update*",
                 "dynamodb:PutItem"
             ],
-            "Resource": "arn:aws:dynamodb:*:*:table/$TABLE_NAME"
+            "Resource": [
+                "arn:aws:dynamodb:*:*:table/$TABLE_NAME",
+                "arn:aws:dynamodb:*:*:table/$DEMAND_HISTORY_TABLE_NAME"
+            ]
         }
     ]
 }""".replace(
     "$TABLE_NAME", _EC2_ALLOC_TABLE_NAME
+).replace(
+    "$DEMAND_HISTORY_TABLE_NAME", _DEMAND_HISTORY_TABLE_NAME
 )
 # a policy that grants read/write to SQS queues starting with meadowrun*. This is
 # really for grid_task_queue.py functionality
@@ -225,6 +237,44 @@ def _ensure_ec2_alloc_table_access_policy(iam_client: Any) -> str:
     )
 
 
+def update_ec2_alloc_table_access_policy(region_name: str) -> None:
+    """
+    _ensure_ec2_alloc_table_access_policy only creates the policy if it doesn't exist,
+    so installations from before the demand history table existed won't have access to
+    it. This makes _EC2_TABLE_ACCESS_POLICY_DOCUMENT the default version of the policy
+    if it isn't already.
+    """
+    iam = _get_boto3_client("iam", region_name)
+    policy_arn = _ensure_ec2_alloc_table_access_policy(iam)
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/iam.html#IAM.Client.get_policy_version
+    default_version_id = iam.get_policy(PolicyArn=policy_arn)["Policy"][
+        "DefaultVersionId"
+    ]
+    # boto3 returns the document already parsed
+    if iam.get_policy_version(PolicyArn=policy_arn, VersionId=default_version_id)[
+        "PolicyVersion"
+    ]["Document"] == json.loads(_EC2_TABLE_ACCESS_POLICY_DOCUMENT):
+        return
+
+    # a policy can have at most 5 versions, so we might need to delete the oldest
+    # non-default version first
+    versions = iam.list_policy_versions(PolicyArn=policy_arn)["Versions"]
+    if len(versions) >= 5:
+        oldest_version = min(
+            (version for version in versions if not version["IsDefaultVersion"]),
+            key=lambda version: version["CreateDate"],
+        )
+        iam.delete_policy_version(
+            PolicyArn=policy_arn, VersionId=oldest_version["VersionId"]
+        )
+    iam.create_policy_version(
+        PolicyArn=policy_arn,
+        PolicyDocument=_EC2_TABLE_ACCESS_POLICY_DOCUMENT,
+        SetAsDefault=True,
+    )
+
+
 def _ensure_s3_access_policy(iam_client: Any) -> str:
     """Creates a policy that gives permission to list and read meadowrun S3 buckets"""
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/iam.html#IAM.Client.create_policy
@@ -250,7 +300,7 @@ def _ensure_ec2_alloc_role(region_name: str) -> None:
     TODO does not try to update the role if/when we change the policies below in code
     """
 
-    iam = boto3.client("iam", region_name=region_name)
+    iam = _get_boto3_client("iam", region_name)
     if not _iam_role_exists(iam, _EC2_ALLOC_ROLE):
         # create the role
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/iam.html#IAM.ServiceResource.create_role
@@ -1,17 +1,25 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
 import decimal
 from types import TracebackType
-from typing import List, Tuple, Any, Dict, Sequence, Optional, Literal, Type
+from typing import List, Tuple, Any, Dict, Sequence, Optional, Literal, Type, Set
 
-import boto3
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
 
-from meadowrun.aws_integration.aws_core import _get_default_region_name
+from meadowrun.aws_integration.aws_core import (
+    _get_boto3_client,
+    _get_boto3_resource,
+    _get_default_region_name,
+    _run_boto3,
+)
 from meadowrun.aws_integration.ec2 import (
     ensure_meadowrun_ssh_security_group,
     launch_ec2_instances,
 )
+from meadowrun.aws_integration.ec2_pricing import get_cached_ec2_instance_types
 from meadowrun.aws_integration.ec2_alloc_role import (
     _EC2_ALLOC_ROLE_INSTANCE_PROFILE,
     _ensure_ec2_alloc_role,
@@ -20,8 +28,15 @@ from meadowrun.aws_integration.ec2_ssh_keys import (
     MEADOWRUN_KEY_PAIR_NAME,
     ensure_meadowrun_key_pair,
 )
+from meadowrun.aws_integration.management_lambdas.demand_forecast import (
+    _EXPIRES_AT,
+    DemandRecord,
+    PlannedInstanceType,
+)
 from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
     _ALLOCATED_TIME,
+    _DEMAND_HISTORY_TABLE_NAME,
+    _DEMAND_KEY,
     _EC2_ALLOC_TABLE_NAME,
     _EC2_ALLOC_TAG,
     _EC2_ALLOC_TAG_VALUE,
@@ -32,19 +47,34 @@ from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
     _MEMORY_GB_AVAILABLE,
     _PUBLIC_ADDRESS,
     _RUNNING_JOBS,
+    _START_TIME,
     ignore_boto3_error_code,
+    scan_table,
 )
 from meadowrun.instance_allocation import (
     InstanceRegistrar,
     _InstanceState,
-    allocate_jobs_to_instances,
+    allocate_jobs_to_instances_batched,
+)
+from meadowrun.instance_selection import (
+    CloudInstance,
+    Resources,
+    choose_instance_types_for_job,
 )
-from meadowrun.instance_selection import Resources, CloudInstance
 from meadowrun.meadowrun_pb2 import Job
 from meadowrun.run_job_core import AllocCloudInstancesInternal, JobCompletion, SshHost
 
 # SEE ALSO ec2_alloc_stub.py
 
+# DynamoDB's limits on the number of items in a single TransactWriteItems and
+# BatchGetItem request
+_TRANSACT_WRITE_MAX_ITEMS = 100
+_BATCH_GET_MAX_ITEMS = 100
+# TransactWriteItems cancellation reasons that mean that the allocation to that item
+# failed (as opposed to the allocation being fine but cancelled because of other items
+# in the transaction, which is "None")
+_TRANSACT_FAILED_CODES = ("ConditionalCheckFailed", "TransactionConflict")
+
 # AMIs that have meadowrun pre-installed. These are all identical, we just need to
 # replicate into each region.
 _EC2_ALLOC_AMIS = {
@@ -60,6 +90,86 @@ _EC2_ALLOC_AMIS = {
 }
 
 
+def _item_to_available_resources(item: Dict[str, Any]) -> _InstanceState:
+    return _InstanceState(
+        item[_PUBLIC_ADDRESS],
+        Resources(
+            float(item[_MEMORY_GB_AVAILABLE]), int(item[_LOGICAL_CPU_AVAILABLE]), {}
+        ),
+        # This is a bit of hack, but for the EC2InstanceRegistrar, we know that we won't
+        # need the running_jobs in the context that this function is called, so we just
+        # set it to None to save bandwidth/memory/etc.
+        None,
+    )
+
+
+def _get_allocate_update_args(
+    public_address: str, resources_allocated_per_job: Resources, new_job_ids: List[str]
+) -> Dict[str, Any]:
+    """
+    Returns the kwargs for Table.update_item that allocate new_job_ids to the specified
+    instance, failing the ConditionExpression if there are no longer enough resources
+    available
+    """
+    if len(new_job_ids) == 0:
+        raise ValueError("Must provide at least one new_job_ids")
+
+    expression_attribute_names = {}
+    set_expressions = []
+    now = datetime.datetime.utcnow().isoformat()
+    expression_attribute_values: Dict[str, Any] = {
+        ":logical_cpu_to_allocate": decimal.Decimal(
+            resources_allocated_per_job.logical_cpu * len(new_job_ids)
+        ),
+        ":memory_gb_to_allocate": decimal.Decimal(
+            resources_allocated_per_job.memory_gb * len(new_job_ids)
+        ),
+        ":now": now,
+    }
+    attribute_not_exists_expressions = []
+    for i, job_id in enumerate(new_job_ids):
+        # job_ids might not be valid dynamodb identifiers
+        expression_attribute_names[f"#j{i}"] = job_id
+        # add the jobs with their metadata to _RUNNING_JOBS
+        set_expressions.append(f"{_RUNNING_JOBS}.#j{i} = :j{i}")
+        expression_attribute_values[f":j{i}"] = {
+            _LOGICAL_CPU_ALLOCATED: decimal.Decimal(
+                resources_allocated_per_job.logical_cpu
+            ),
+            _MEMORY_GB_ALLOCATED: decimal.Decimal(
+                resources_allocated_per_job.memory_gb
+            ),
+            _ALLOCATED_TIME: now,
+        }
+        # check that the job_id doesn't already exist
+        attribute_not_exists_expressions.append(
+            f"attribute_not_exists({_RUNNING_JOBS}.#j{i})"
+        )
+
+    return dict(
+        Key={_PUBLIC_ADDRESS: public_address},
+        # subtract resources that we're allocating
+        UpdateExpression=(
+            (
+                f"SET {_LOGICAL_CPU_AVAILABLE}="
+                f"{_LOGICAL_CPU_AVAILABLE} - :logical_cpu_to_allocate, "
+                f"{_MEMORY_GB_AVAILABLE}="
+                f"{_MEMORY_GB_AVAILABLE} - :memory_gb_to_allocate, "
+                f"{_LAST_UPDATE_TIME}=:now, "
+            )
+            + ", ".join(set_expressions)
+        ),
+        # Check to make sure the allocation is still valid
+        ConditionExpression=(
+            f"{_LOGICAL_CPU_AVAILABLE} >= :logical_cpu_to_allocate "
+            f"AND {_MEMORY_GB_AVAILABLE} >= :memory_gb_to_allocate "
+            "AND " + " AND ".join(attribute_not_exists_expressions)
+        ),
+        ExpressionAttributeValues=expression_attribute_values,
+        ExpressionAttributeNames=expression_attribute_names,
+    )
+
+
 class EC2InstanceRegistrar(InstanceRegistrar[_InstanceState]):
     """
     The EC2 instance registrar uses a DynamoDB table to keep track of instances and job
@@ -73,7 +183,6 @@ class EC2InstanceRegistrar(InstanceRegistrar[_InstanceState]):
     ):
         self._table_region_name = table_region_name
         self._on_table_missing = on_table_missing
-        self._table: Any = None
 
     async def __aenter__(self) -> EC2InstanceRegistrar:
         """
@@ -86,13 +195,17 @@ class EC2InstanceRegistrar(InstanceRegistrar[_InstanceState]):
         if self._table_region_name is None:
             self._table_region_name = await _get_default_region_name()
 
-        db = boto3.resource("dynamodb", region_name=self._table_region_name)
+        await _run_boto3(self._ensure_table)
+        return self
+
+    def _ensure_table(self) -> None:
+        db = _get_boto3_resource("dynamodb", self._table_region_name)
 
         # this constructor will always succeed, regardless of whether the table already
         # exists or not
-        self._table = db.Table(_EC2_ALLOC_TABLE_NAME)
+        table = db.Table(_EC2_ALLOC_TABLE_NAME)
         success, _ = ignore_boto3_error_code(
-            lambda: self._table.load(), "ResourceNotFoundException"
+            lambda: table.load(), "ResourceNotFoundException"
         )
         if not success:
             # this means the table does not exist
@@ -123,13 +236,21 @@ class EC2InstanceRegistrar(InstanceRegistrar[_InstanceState]):
                     BillingMode="PAY_PER_REQUEST",
                     TableClass="STANDARD",
                 )
-                self._table.wait_until_exists()
+                table.wait_until_exists()
             else:
                 raise ValueError(
                     f"Unexpected value for on_table_missing {self._on_table_missing}"
                 )
 
-        return self
+    def _get_table(self) -> Any:
+        """
+        boto3 resources are not thread-safe, so rather than keeping a Table around, we
+        get the Table for the current thread whenever we need it. Should be called from
+        functions running on the boto3 thread pool.
+        """
+        return _get_boto3_resource("dynamodb", self._table_region_name).Table(
+            _EC2_ALLOC_TABLE_NAME
+        )
 
     async def __aexit__(
         self,
@@ -160,8 +281,9 @@ class EC2InstanceRegistrar(InstanceRegistrar[_InstanceState]):
 
         now = datetime.datetime.utcnow().isoformat()
 
-        success, result = ignore_boto3_error_code(
-            lambda: self._table.put_item(
+        success, result = await _run_boto3(
+            ignore_boto3_error_code,
+            lambda: self._get_table().put_item(
                 Item={
                     # the public address of the EC2 instance
                     _PUBLIC_ADDRESS: public_address,
@@ -211,44 +333,108 @@ class EC2InstanceRegistrar(InstanceRegistrar[_InstanceState]):
                 f"exists, this should never happen!"
             )
 
-    async def get_registered_instances(self) -> List[_InstanceState]:
-        response = self._table.scan(
-            Select="SPECIFIC_ATTRIBUTES",
-            ProjectionExpression=",".join(
-                [_PUBLIC_ADDRESS, _LOGICAL_CPU_AVAILABLE, _MEMORY_GB_AVAILABLE]
-            ),
+    async def get_registered_instances(
+        self, resources_required: Optional[Resources] = None
+    ) -> List[_InstanceState]:
+        scan_args: Dict[str, Any] = {}
+        if resources_required is not None:
+            # This doesn't reduce the read capacity that the scan consumes (DynamoDB
+            # applies filters after reading), but it does mean we don't transfer and
+            # deserialize instances that are too full to be useful to us.
+            # TODO it would be cheaper to hone in on the instances we want via a
+            # secondary index, but we have two dimensions (CPU and memory) to filter on
+            # and an index can only have one sort key
+            scan_args["FilterExpression"] = (
+                f"{_LOGICAL_CPU_AVAILABLE} >= :logical_cpu_required "
+                f"AND {_MEMORY_GB_AVAILABLE} >= :memory_gb_required"
+            )
+            scan_args["ExpressionAttributeValues"] = {
+                ":logical_cpu_required": decimal.Decimal(
+                    resources_required.logical_cpu
+                ),
+                ":memory_gb_required": decimal.Decimal(resources_required.memory_gb),
+            }
+
+        return await self._scan_available_resources(**scan_args)
+
+    async def get_registered_instances_changed_since(
+        self, since: datetime.datetime
+    ) -> Optional[List[_InstanceState]]:
+        # _LAST_UPDATE_TIME is an ISO format string, so string comparison works. Like
+        # the resources_required filter in get_registered_instances, this doesn't reduce
+        # the read capacity that the scan consumes, but it means we only transfer and
+        # deserialize the instances that have changed.
+        # TODO DynamoDB Streams would let us avoid reading the whole table, but each
+        # client would need to keep track of shard iterators
+        return await self._scan_available_resources(
+            FilterExpression=f"{_LAST_UPDATE_TIME} >= :since",
+            ExpressionAttributeValues={":since": since.isoformat()},
         )
 
-        if response.get("LastEvaluatedKey"):
-            # TODO scan maxes out at 1MB of returned data before requiring pagination.
-            # We could implement pagination, but scanning for so much data will cost a
-            # lot of money, so we should eventually add either secondary indexes that
-            # let us hone in on the instances we want (e.g. exclude instances that don't
-            # have enough resources to run our job) or limit the scan to some number of
-            # instances and not do a global optimization
-            raise NotImplementedError(
-                "We don't currently support a very large number of EC2 instances"
+    async def _scan_available_resources(self, **scan_args: Any) -> List[_InstanceState]:
+        items = await _run_boto3(
+            lambda: list(
+                scan_table(
+                    self._get_table(),
+                    Select="SPECIFIC_ATTRIBUTES",
+                    ProjectionExpression=",".join(
+                        [_PUBLIC_ADDRESS, _LOGICAL_CPU_AVAILABLE, _MEMORY_GB_AVAILABLE]
+                    ),
+                    **scan_args,
+                )
             )
+        )
+        return [_item_to_available_resources(item) for item in items]
 
+    async def get_registered_instances_by_address(
+        self, public_addresses: Sequence[str]
+    ) -> List[_InstanceState]:
         return [
-            _InstanceState(
-                item[_PUBLIC_ADDRESS],
-                Resources(
-                    float(item[_MEMORY_GB_AVAILABLE]),
-                    int(item[_LOGICAL_CPU_AVAILABLE]),
-                    {},
-                ),
-                # This is a bit of hack, but for the EC2InstanceRegistrar, we know that
-                # we won't need the running_jobs in the context that this function is
-                # called, so we just set it to None to save bandwidth/memory/etc.
-                None,
+            _item_to_available_resources(item)
+            for chunk in await asyncio.gather(
+                *(
+                    _run_boto3(
+                        self._batch_get_available_resources,
+                        public_addresses[i : i + _BATCH_GET_MAX_ITEMS],
+                    )
+                    for i in range(0, len(public_addresses), _BATCH_GET_MAX_ITEMS)
+                )
             )
-            for item in response["Items"]
+            for item in chunk
         ]
 
+    def _batch_get_available_resources(
+        self, public_addresses: Sequence[str]
+    ) -> List[Dict[str, Any]]:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.ServiceResource.batch_get_item
+        db = _get_boto3_resource("dynamodb", self._table_region_name)
+        request_items: Dict[str, Any] = {
+            _EC2_ALLOC_TABLE_NAME: {
+                "Keys": [
+                    {_PUBLIC_ADDRESS: public_address}
+                    for public_address in public_addresses
+                ],
+                "ProjectionExpression": ",".join(
+                    [_PUBLIC_ADDRESS, _LOGICAL_CPU_AVAILABLE, _MEMORY_GB_AVAILABLE]
+                ),
+                # we're about to retry an allocation based on this read
+                "ConsistentRead": True,
+            }
+        }
+        items = []
+        while request_items:
+            result = db.batch_get_item(RequestItems=request_items)
+            items.extend(result["Responses"].get(_EC2_ALLOC_TABLE_NAME, []))
+            # TODO we should back off if DynamoDB is throttling us
+            request_items = result.get("UnprocessedKeys", {})
+        return items
+
     async def get_registered_instance(self, public_address: str) -> _InstanceState:
-        result = self._table.get_item(
-            Key={_PUBLIC_ADDRESS: public_address}, ProjectionExpression=_RUNNING_JOBS
+        result = await _run_boto3(
+            lambda: self._get_table().get_item(
+                Key={_PUBLIC_ADDRESS: public_address},
+                ProjectionExpression=_RUNNING_JOBS,
+            )
         )
         if "Item" not in result:
             raise ValueError(f"ec2 instance {public_address} was not found")
@@ -267,74 +453,117 @@ class EC2InstanceRegistrar(InstanceRegistrar[_InstanceState]):
         resources_allocated_per_job: Resources,
         new_job_ids: List[str],
     ) -> bool:
-        if len(new_job_ids) == 0:
-            raise ValueError("Must provide at least one new_job_ids")
+        update_args = _get_allocate_update_args(
+            instance.public_address, resources_allocated_per_job, new_job_ids
+        )
+        success, result = await _run_boto3(
+            ignore_boto3_error_code,
+            lambda: self._get_table().update_item(**update_args),
+            "ConditionalCheckFailedException",
+        )
+        return success
 
-        expression_attribute_names = {}
-        set_expressions = []
-        now = datetime.datetime.utcnow().isoformat()
-        expression_attribute_values: Dict[str, Any] = {
-            ":logical_cpu_to_allocate": decimal.Decimal(
-                resources_allocated_per_job.logical_cpu * len(new_job_ids)
-            ),
-            ":memory_gb_to_allocate": decimal.Decimal(
-                resources_allocated_per_job.memory_gb * len(new_job_ids)
-            ),
-            ":now": now,
-        }
-        attribute_not_exists_expressions = []
-        for i, job_id in enumerate(new_job_ids):
-            # job_ids might not be valid dynamodb identifiers
-            expression_attribute_names[f"#j{i}"] = job_id
-            # add the jobs with their metadata to _RUNNING_JOBS
-            set_expressions.append(f"{_RUNNING_JOBS}.#j{i} = :j{i}")
-            expression_attribute_values[f":j{i}"] = {
-                _LOGICAL_CPU_ALLOCATED: decimal.Decimal(
-                    resources_allocated_per_job.logical_cpu
-                ),
-                _MEMORY_GB_ALLOCATED: decimal.Decimal(
-                    resources_allocated_per_job.memory_gb
-                ),
-                _ALLOCATED_TIME: now,
-            }
-            # check that the job_id doesn't already exist
-            attribute_not_exists_expressions.append(
-                f"attribute_not_exists({_RUNNING_JOBS}.#j{i})"
+    async def allocate_jobs_to_multiple_instances(
+        self,
+        allocations: Sequence[Tuple[_InstanceState, List[str]]],
+        resources_allocated_per_job: Resources,
+    ) -> List[bool]:
+        """
+        Uses TransactWriteItems to allocate to up to _TRANSACT_WRITE_MAX_ITEMS instances
+        per request. A transaction fails as a whole if any of its allocations fail, so
+        when that happens we retry the allocations that would have succeeded as a new
+        transaction (without rereading anything), until the remaining allocations
+        succeed or there are none left.
+
+        Transactional writes consume twice the write capacity of normal writes, but the
+        table uses on-demand capacity, and this means that allocating to many instances
+        only takes a few round trips.
+        """
+        update_args = [
+            _get_allocate_update_args(
+                instance.public_address, resources_allocated_per_job, new_job_ids
             )
+            for instance, new_job_ids in allocations
+        ]
+        results = [False] * len(allocations)
 
-        success, result = ignore_boto3_error_code(
-            lambda: self._table.update_item(
-                Key={_PUBLIC_ADDRESS: instance.public_address},
-                # subtract resources that we're allocating
-                UpdateExpression=(
-                    (
-                        f"SET {_LOGICAL_CPU_AVAILABLE}="
-                        f"{_LOGICAL_CPU_AVAILABLE} - :logical_cpu_to_allocate, "
-                        f"{_MEMORY_GB_AVAILABLE}="
-                        f"{_MEMORY_GB_AVAILABLE} - :memory_gb_to_allocate, "
-                        f"{_LAST_UPDATE_TIME}=:now, "
-                    )
-                    + ", ".join(set_expressions)
-                ),
-                # Check to make sure the allocation is still valid
-                ConditionExpression=(
-                    f"{_LOGICAL_CPU_AVAILABLE} >= :logical_cpu_to_allocate "
-                    f"AND {_MEMORY_GB_AVAILABLE} >= :memory_gb_to_allocate "
-                    "AND " + " AND ".join(attribute_not_exists_expressions)
-                ),
-                ExpressionAttributeValues=expression_attribute_values,
-                ExpressionAttributeNames=expression_attribute_names,
-            ),
-            "ConditionalCheckFailedException",
+        async def allocate_chunk(chunk: List[int]) -> None:
+            while chunk:
+                failed = await _run_boto3(
+                    self._transact_update_items, [update_args[i] for i in chunk]
+                )
+                if not failed:
+                    for i in chunk:
+                        results[i] = True
+                    return
+                chunk = [i for j, i in enumerate(chunk) if j not in failed]
+
+        await asyncio.gather(
+            *(
+                allocate_chunk(
+                    list(range(i, min(i + _TRANSACT_WRITE_MAX_ITEMS, len(allocations))))
+                )
+                for i in range(0, len(allocations), _TRANSACT_WRITE_MAX_ITEMS)
+            )
         )
-        return success
+        return results
+
+    def _transact_update_items(self, update_args: List[Dict[str, Any]]) -> Set[int]:
+        """
+        Runs update_args (a list of kwargs for Table.update_item) as a single
+        transaction. Returns an empty set if the transaction succeeded, otherwise the
+        indices of the updates that caused it to be cancelled.
+        """
+        # TransactWriteItems isn't available on the Table resource, so we need to use
+        # the client, which wants serialized values
+        serializer = TypeSerializer()
+        try:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.transact_write_items
+            _get_boto3_client("dynamodb", self._table_region_name).transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": _EC2_ALLOC_TABLE_NAME,
+                            **args,
+                            "Key": {
+                                key: serializer.serialize(value)
+                                for key, value in args["Key"].items()
+                            },
+                            "ExpressionAttributeValues": {
+                                key: serializer.serialize(value)
+                                for key, value in args[
+                                    "ExpressionAttributeValues"
+                                ].items()
+                            },
+                        }
+                    }
+                    for args in update_args
+                ]
+            )
+            return set()
+        except ClientError as e:
+            if (
+                e.response.get("Error", {}).get("Code")
+                != "TransactionCanceledException"
+            ):
+                raise
+            failed = {
+                i
+                for i, reason in enumerate(e.response.get("CancellationReasons", []))
+                if reason.get("Code") in _TRANSACT_FAILED_CODES
+            }
+            if not failed:
+                # e.g. throttling or a validation error
+                raise
+            return failed
 
     async def deallocate_job_from_instance(
         self, instance: _InstanceState, job_id: str
     ) -> bool:
         job = instance.get_running_jobs()[job_id]
-        success, result = ignore_boto3_error_code(
-            lambda: self._table.update_item(
+        success, result = await _run_boto3(
+            ignore_boto3_error_code,
+            lambda: self._get_table().update_item(
                 Key={_PUBLIC_ADDRESS: instance.public_address},
                 UpdateExpression=(
                     f"SET {_LOGICAL_CPU_AVAILABLE}="
@@ -360,16 +589,10 @@ class EC2InstanceRegistrar(InstanceRegistrar[_InstanceState]):
     async def launch_instances(
         self, instances_spec: AllocCloudInstancesInternal
     ) -> Sequence[CloudInstance]:
-        if instances_spec.region_name not in _EC2_ALLOC_AMIS:
-            raise ValueError(
-                f"The meadowrun AMI is not available in {instances_spec.region_name}. "
-                "Please ask the meadowrun maintainers to add support for this region: "
-                "https://github.com/meadowdata/meadowrun/issues"
-            )
-        ami = _EC2_ALLOC_AMIS[instances_spec.region_name]
+        ami = _get_ec2_alloc_ami(instances_spec.region_name)
 
         meadowrun_ssh_security_group_id = await ensure_meadowrun_ssh_security_group()
-        _ensure_ec2_alloc_role(instances_spec.region_name)
+        await _run_boto3(_ensure_ec2_alloc_role, instances_spec.region_name)
 
         return await launch_ec2_instances(
             instances_spec.logical_cpu_required_per_task,
@@ -386,9 +609,143 @@ class EC2InstanceRegistrar(InstanceRegistrar[_InstanceState]):
             # assumes that we've already called ensure_meadowrun_key_pair!
             key_name=MEADOWRUN_KEY_PAIR_NAME,
             tags={_EC2_ALLOC_TAG: _EC2_ALLOC_TAG_VALUE},
+            reuse_stopped_instances=True,
         )
 
 
+def _get_ec2_alloc_ami(region_name: str) -> str:
+    if region_name not in _EC2_ALLOC_AMIS:
+        raise ValueError(
+            f"The meadowrun AMI is not available in {region_name}. Please ask the "
+            "meadowrun maintainers to add support for this region: "
+            "https://github.com/meadowdata/meadowrun/issues"
+        )
+    return _EC2_ALLOC_AMIS[region_name]
+
+
+# region_name -> whether the demand history table exists, so that we only check once per
+# process
+_DEMAND_HISTORY_TABLE_EXISTS: Dict[str, bool] = {}
+
+
+def _demand_history_table_exists(region_name: str) -> bool:
+    if region_name not in _DEMAND_HISTORY_TABLE_EXISTS:
+        success, _ = ignore_boto3_error_code(
+            lambda: _get_boto3_resource("dynamodb", region_name)
+            .Table(_DEMAND_HISTORY_TABLE_NAME)
+            .load(),
+            "ResourceNotFoundException",
+        )
+        _DEMAND_HISTORY_TABLE_EXISTS[region_name] = success
+    return _DEMAND_HISTORY_TABLE_EXISTS[region_name]
+
+
+async def record_demand(
+    region_name: str,
+    demand_key: str,
+    instances_spec: AllocCloudInstancesInternal,
+    start_time: datetime.datetime,
+    duration_secs: float,
+) -> None:
+    """
+    Records the demand from a run_map in the demand history table so that
+    adjust_ec2_instances can launch instances before the next time we expect this
+    run_map to start. See demand_forecast.py. start_time should be a naive datetime in
+    UTC.
+
+    Prelaunching is opt-in (see WarmPoolPolicy.prelaunch_for_forecast_demand), and
+    manage.py install only creates the demand history table when it's enabled, so this
+    does nothing if the table doesn't exist.
+    """
+    if not await _run_boto3(_demand_history_table_exists, region_name):
+        return
+
+    # the instance types we would launch to run this demand from scratch
+    chosen_instance_types = choose_instance_types_for_job(
+        Resources(
+            instances_spec.memory_gb_required_per_task,
+            instances_spec.logical_cpu_required_per_task,
+            {},
+        ),
+        instances_spec.num_concurrent_tasks,
+        instances_spec.interruption_probability_threshold,
+        await get_cached_ec2_instance_types(region_name),
+    )
+
+    item = DemandRecord(
+        demand_key,
+        start_time,
+        duration_secs,
+        instances_spec.num_concurrent_tasks,
+        instances_spec.logical_cpu_required_per_task,
+        instances_spec.memory_gb_required_per_task,
+        instances_spec.interruption_probability_threshold,
+        [
+            PlannedInstanceType(
+                instance_type.instance_type.name,
+                instance_type.instance_type.on_demand_or_spot,
+                instance_type.instance_type.logical_cpu,
+                instance_type.instance_type.memory_gb,
+                instance_type.workers_per_instance_full,
+                instance_type.num_instances,
+            )
+            for instance_type in chosen_instance_types
+        ],
+        _get_ec2_alloc_ami(region_name),
+        [await ensure_meadowrun_ssh_security_group()],
+        _EC2_ALLOC_ROLE_INSTANCE_PROFILE,
+        MEADOWRUN_KEY_PAIR_NAME,
+    ).to_item()
+    await _run_boto3(
+        lambda: _get_boto3_resource("dynamodb", region_name)
+        .Table(_DEMAND_HISTORY_TABLE_NAME)
+        .put_item(Item=item)
+    )
+
+
+def ensure_demand_history_table(region_name: str) -> None:
+    """
+    Creates the demand history table if it doesn't exist. This should only be called
+    if prelaunching is enabled, see record_demand.
+    """
+    db = _get_boto3_resource("dynamodb", region_name)
+    success, _ = ignore_boto3_error_code(
+        lambda: db.Table(_DEMAND_HISTORY_TABLE_NAME).load(),
+        "ResourceNotFoundException",
+    )
+    if not success:
+        _create_demand_history_table(db, region_name)
+    _DEMAND_HISTORY_TABLE_EXISTS[region_name] = True
+
+
+def _create_demand_history_table(db: Any, region_name: str) -> None:
+    """
+    Creates the demand history table. Records are keyed by the demand_key (i.e. the
+    function name) and the start time, and expire automatically
+    """
+    # This could be more robust against ResourceInUseException which would indicate
+    # that someone else created the table at the same time
+    table = db.create_table(
+        TableName=_DEMAND_HISTORY_TABLE_NAME,
+        AttributeDefinitions=[
+            {"AttributeName": _DEMAND_KEY, "AttributeType": "S"},
+            {"AttributeName": _START_TIME, "AttributeType": "S"},
+        ],
+        KeySchema=[
+            {"AttributeName": _DEMAND_KEY, "KeyType": "HASH"},
+            {"AttributeName": _START_TIME, "KeyType": "RANGE"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+        TableClass="STANDARD",
+    )
+    table.wait_until_exists()
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_time_to_live
+    _get_boto3_client("dynamodb", region_name).update_time_to_live(
+        TableName=_DEMAND_HISTORY_TABLE_NAME,
+        TimeToLiveSpecification={"Enabled": True, "AttributeName": _EXPIRES_AT},
+    )
+
+
 async def run_job_ec2_instance_registrar(
     job: Job,
     logical_cpu_required: int,
@@ -398,19 +755,18 @@ async def run_job_ec2_instance_registrar(
 ) -> JobCompletion[Any]:
     """Runs the specified job on EC2. Creates an EC2InstanceRegistrar"""
     region_name = region_name or await _get_default_region_name()
-    pkey = ensure_meadowrun_key_pair(region_name)
-
-    async with EC2InstanceRegistrar(region_name, "create") as instance_registrar:
-        hosts = await allocate_jobs_to_instances(
-            instance_registrar,
-            AllocCloudInstancesInternal(
-                logical_cpu_required,
-                memory_gb_required,
-                interruption_probability_threshold,
-                1,
-                region_name,
-            ),
-        )
+    pkey = await _run_boto3(ensure_meadowrun_key_pair, region_name)
+
+    hosts = await allocate_jobs_to_instances_batched(
+        EC2InstanceRegistrar(region_name, "create"),
+        AllocCloudInstancesInternal(
+            logical_cpu_required,
+            memory_gb_required,
+            interruption_probability_threshold,
+            1,
+            region_name,
+        ),
+    )
 
     fabric_kwargs: Dict[str, Any] = {
         "user": "ubuntu",
@@ -1,16 +1,34 @@
 from __future__ import annotations
 
+import asyncio
 import dataclasses
 import datetime
 import json
 from typing import List, Iterable, Dict, Tuple
 
 import aiohttp
-import boto3
 from pkg_resources import resource_filename
 
-from meadowrun.aws_integration.aws_core import _boto3_paginate
+from meadowrun.aws_integration.aws_core import (
+    _boto3_paginate,
+    _get_boto3_client,
+    _run_boto3,
+)
+from meadowrun.config import EC2_PRICES_UPDATE_SECS
 from meadowrun.instance_selection import CloudInstanceType
+from meadowrun.instance_type_cache import get_cached_instance_types
+
+
+async def get_cached_ec2_instance_types(region_name: str) -> List[CloudInstanceType]:
+    """
+    Same as _get_ec2_instance_types, but uses a local cache that is refreshed every
+    EC2_PRICES_UPDATE_SECS. See instance_type_cache.py
+    """
+    return await get_cached_instance_types(
+        f"ec2-{region_name}",
+        lambda: _get_ec2_instance_types(region_name),
+        EC2_PRICES_UPDATE_SECS,
+    )
 
 
 async def _get_ec2_instance_types(region_name: str) -> List[CloudInstanceType]:
@@ -21,7 +39,7 @@ async def _get_ec2_instance_types(region_name: str) -> List[CloudInstanceType]:
 
     # TODO at some point add cross-region optimization
 
-    result = list(_get_ec2_on_demand_prices(region_name))
+    result = await _run_boto3(lambda: list(_get_ec2_on_demand_prices(region_name)))
     on_demand_instance_types = {
         instance_type.name: instance_type for instance_type in result
     }
@@ -57,7 +75,7 @@ def _get_ec2_on_demand_prices(region_name: str) -> Iterable[CloudInstanceType]:
 
     # us-east-1 is the only region this pricing API is available and the pricing
     # endpoint in us-east-1 has pricing data for all regions.
-    pricing_client = boto3.client("pricing", region_name="us-east-1")
+    pricing_client = _get_boto3_client("pricing", "us-east-1")
 
     filters = [
         # only get prices for the specified region
@@ -201,7 +219,41 @@ async def _get_ec2_spot_prices(
     Returns a dataframe with columns instance_type and price, where price is the latest
     spot price
     """
-    ec2_client = boto3.client("ec2", region_name=region_name)
+    spot_prices, interruption_probabilities = await asyncio.gather(
+        _run_boto3(_get_latest_ec2_spot_prices, region_name),
+        _get_ec2_interruption_probabilities(region_name),
+    )
+
+    # TODO we should consider warning if we get spot prices or interruption
+    # probabilities where we don't have on_demand_prices or spot_prices respectively,
+    # right now we just drop that data
+
+    results = []
+    for instance_type, (price, timestamp) in spot_prices.items():
+        # drop rows where we don't have the corresponding on_demand instance type
+        # information
+        if instance_type in on_demand_instance_types:
+            on_demand_instance_type = on_demand_instance_types[instance_type]
+            results.append(
+                dataclasses.replace(
+                    on_demand_instance_type,
+                    price=price,
+                    # if interruption_probability is missing, just default to 80%
+                    interruption_probability=interruption_probabilities.get(
+                        instance_type, 80
+                    ),
+                    on_demand_or_spot="spot",
+                )
+            )
+
+    return results
+
+
+def _get_latest_ec2_spot_prices(
+    region_name: str,
+) -> Dict[str, Tuple[float, datetime.datetime]]:
+    """Returns instance type -> (latest spot price, timestamp of that price)"""
+    ec2_client = _get_boto3_client("ec2", region_name)
 
     # There doesn't appear to be an API for "give me the latest spot price for each
     # instance type". Instead, there's an API to get the spot price history. We query
@@ -232,32 +284,7 @@ async def _get_ec2_spot_prices(
         ):
             spot_prices[instance_type] = price, timestamp
 
-    # get interruption probabilities
-    interruption_probabilities = await _get_ec2_interruption_probabilities(region_name)
-
-    # TODO we should consider warning if we get spot prices or interruption
-    # probabilities where we don't have on_demand_prices or spot_prices respectively,
-    # right now we just drop that data
-
-    results = []
-    for instance_type, (price, timestamp) in spot_prices.items():
-        # drop rows where we don't have the corresponding on_demand instance type
-        # information
-        if instance_type in on_demand_instance_types:
-            on_demand_instance_type = on_demand_instance_types[instance_type]
-            results.append(
-                dataclasses.replace(
-                    on_demand_instance_type,
-                    price=price,
-                    # if interruption_probability is missing, just default to 80%
-                    interruption_probability=interruption_probabilities.get(
-                        instance_type, 80
-                    ),
-                    on_demand_or_spot="spot",
-                )
-            )
-
-    return results
+    return spot_prices
 
 
 async def _get_ec2_interruption_probabilities(region_name: str) -> Dict[str, float]:
@@ -1,8 +1,8 @@
 import io
 
-import boto3
 import paramiko
 
+from meadowrun.aws_integration.aws_core import _get_boto3_client
 from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
     ignore_boto3_error_code,
 )
@@ -23,8 +23,8 @@ def ensure_meadowrun_key_pair(region_name: str) -> paramiko.PKey:
     constantly?
     """
 
-    ec2_client = boto3.client("ec2", region_name=region_name)
-    secrets_client = boto3.client("secretsmanager", region_name=region_name)
+    ec2_client = _get_boto3_client("ec2", region_name)
+    secrets_client = _get_boto3_client("secretsmanager", region_name)
 
     private_key_text = None
 
@@ -85,7 +85,7 @@ def ensure_meadowrun_key_pair(region_name: str) -> paramiko.PKey:
 
 
 def download_ssh_key(output_path: str, region_name: str) -> None:
-    secrets_client = boto3.client("secretsmanager", region_name=region_name)
+    secrets_client = _get_boto3_client("secretsmanager", region_name)
     key = secrets_client.get_secret_value(SecretId=_MEADOWRUN_KEY_PAIR_SECRET_NAME)[
         "SecretString"
     ]
@@ -1,27 +1,33 @@
 import base64
-
-import boto3
+from typing import Optional, Tuple
 
 from meadowrun.aws_integration.aws_core import (
     _get_account_number,
+    _get_boto3_client,
     _get_default_region_name,
+    _run_boto3,
 )
 from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
     ignore_boto3_error_code,
 )
-from meadowrun.credentials import UsernamePassword
+from meadowrun.credentials import (
+    RawCredentials,
+    UsernamePassword,
+    get_cached_credentials,
+)
 from meadowrun.run_job_core import ContainerRegistryHelper
 
 
-def _get_username_password(region_name: str) -> UsernamePassword:
+def _get_username_password(region_name: str) -> Tuple[UsernamePassword, float]:
     """
-    Returns (username, password) for the ECR default repository. Can be passed to
-    functions in docker_controller.py
+    Returns (username, password) for the ECR default repository, and the time.time()
+    when they expire. Can be passed to functions in docker_controller.py
     """
-    client = boto3.client("ecr", region_name=region_name)
+    client = _get_boto3_client("ecr", region_name)
     response = client.get_authorization_token()
+    authorization_data = response["authorizationData"][0]
     username_password = base64.b64decode(
-        response["authorizationData"][0]["authorizationToken"]
+        authorization_data["authorizationToken"]
     ).decode("utf-8")
     username, sep, password = username_password.partition(":")
     if not sep or not password:
@@ -29,7 +35,24 @@ def _get_username_password(region_name: str) -> UsernamePassword:
             "username_password was not in expected format username:password"
         )
 
-    return UsernamePassword(username, password)
+    return (
+        UsernamePassword(username, password),
+        authorization_data["expiresAt"].timestamp(),
+    )
+
+
+async def _get_cached_username_password(region_name: str) -> UsernamePassword:
+    """
+    Like _get_username_password, but authorization tokens are valid for 12 hours, so
+    there's no need to get a new one for every job
+    """
+
+    async def fetch() -> Tuple[RawCredentials, Optional[float]]:
+        return await _run_boto3(_get_username_password, region_name)
+
+    credentials = await get_cached_credentials(f"ecr:{region_name}", fetch)
+    assert isinstance(credentials, UsernamePassword)
+    return credentials
 
 
 def _ensure_repository(repository: str, region_name: str) -> str:
@@ -38,7 +61,7 @@ def _ensure_repository(repository: str, region_name: str) -> str:
     returns the repository name that can be used with the docker API. Returns e.g.
     012345678901.dkr.ecr.us-east-2.amazonaws.com
     """
-    client = boto3.client("ecr", region_name=region_name)
+    client = _get_boto3_client("ecr", region_name)
     ignore_boto3_error_code(
         lambda: client.create_repository(repositoryName=repository),
         "RepositoryAlreadyExistsException",
@@ -54,7 +77,7 @@ def _does_image_exist(repository: str, tag: str, region_name: str) -> bool:
     successful, but that takes significantly longer, and you also don't know if a
     failure is the result of something else like an authentication issue.
     """
-    client = boto3.client("ecr", region_name=region_name)
+    client = _get_boto3_client("ecr", region_name)
     success, result = ignore_boto3_error_code(
         lambda: client.describe_images(
             repositoryName=repository, imageIds=[{"imageTag": tag}]
@@ -71,11 +94,11 @@ async def get_ecr_helper(
     if region_name == "default":
         region_name = await _get_default_region_name()
 
-    repository_prefix = _ensure_repository(repository, region_name)
+    repository_prefix = await _run_boto3(_ensure_repository, repository, region_name)
 
     return ContainerRegistryHelper(
         True,
-        _get_username_password(region_name),
+        await _get_cached_username_password(region_name),
         f"{repository_prefix}/{repository}:{tag}",
-        _does_image_exist(repository, tag, region_name),
+        await _run_boto3(_does_image_exist, repository, tag, region_name),
     )
@@ -2,14 +2,17 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import datetime
 import functools
 import os
 import pickle
+import time
 import traceback
 import uuid
 from typing import (
     Any,
     Callable,
+    Coroutine,
     Iterable,
     List,
     Optional,
@@ -23,8 +26,11 @@ import itertools
 import aiobotocore.session
 import boto3
 
-from meadowrun.aws_integration.aws_core import _get_default_region_name
-from meadowrun.aws_integration.ec2_instance_allocation import EC2InstanceRegistrar
+from meadowrun.aws_integration.aws_core import _get_default_region_name, _run_boto3
+from meadowrun.aws_integration.ec2_instance_allocation import (
+    EC2InstanceRegistrar,
+    record_demand,
+)
 from meadowrun.aws_integration.ec2_ssh_keys import ensure_meadowrun_key_pair
 from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
     _EC2_ALLOC_TAG,
@@ -417,22 +423,25 @@ async def prepare_ec2_run_map(
     if not region_name:
         region_name = await _get_default_region_name()
 
-    pkey = ensure_meadowrun_key_pair(region_name)
+    pkey = await _run_boto3(ensure_meadowrun_key_pair, region_name)
 
     # create SQS queues and add tasks to the request queue
     queues_future = asyncio.create_task(create_queues_and_add_tasks(region_name, tasks))
 
+    start_time = datetime.datetime.utcnow()
+    t0 = time.perf_counter()
+    instances_spec = AllocCloudInstancesInternal(
+        logical_cpu_required_per_task,
+        memory_gb_required_per_task,
+        interruption_probability_threshold,
+        num_concurrent_tasks,
+        region_name,
+    )
+
     # get hosts
     async with EC2InstanceRegistrar(region_name, "create") as instance_registrar:
         allocated_hosts = await allocate_jobs_to_instances(
-            instance_registrar,
-            AllocCloudInstancesInternal(
-                logical_cpu_required_per_task,
-                memory_gb_required_per_task,
-                interruption_probability_threshold,
-                num_concurrent_tasks,
-                region_name,
-            ),
+            instance_registrar, instances_spec
         )
 
     request_queue, result_queue = await queues_future
@@ -444,5 +453,46 @@ async def prepare_ec2_run_map(
             worker_loop, function, request_queue, result_queue, region_name
         ),
         {"user": "ubuntu", "connect_kwargs": {"pkey": pkey}},
-        get_results(result_queue, region_name, len(tasks)),
+        _record_demand_after(
+            get_results(result_queue, region_name, len(tasks)),
+            _get_demand_key(function),
+            instances_spec,
+            start_time,
+            t0,
+        ),
     )
+
+
+def _get_demand_key(function: Callable[[_T], _U]) -> str:
+    """Identifies a run_map in the demand history, see demand_forecast.py"""
+    return (
+        f"{getattr(function, '__module__', '')}."
+        f"{getattr(function, '__qualname__', 'lambda')}"
+    )
+
+
+async def _record_demand_after(
+    results: Coroutine[Any, Any, List[Any]],
+    demand_key: str,
+    instances_spec: AllocCloudInstancesInternal,
+    start_time: datetime.datetime,
+    t0: float,
+) -> List[Any]:
+    """
+    Awaits results, and then records the demand from this run_map if prelaunching is
+    enabled (see record_demand). Failing to record demand should never cause the
+    run_map to fail, so we just print a warning.
+    """
+    result = await results
+    try:
+        await record_demand(
+            instances_spec.region_name,
+            demand_key,
+            instances_spec,
+            start_time,
+            time.perf_counter() - t0,
+        )
+    except Exception:
+        print("Warning, unable to record demand for this run_map:")
+        traceback.print_exc()
+    return result
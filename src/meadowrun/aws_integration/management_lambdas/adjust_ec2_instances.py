@@ -3,29 +3,56 @@ This code will run in the generic AWS Lambda environment, so it should not impor
 code outside this folder.
 """
 import datetime
+import decimal
+import math
 import os
-from typing import Dict, Tuple, Any, Iterable
+from typing import Dict, Tuple, Any, Iterable, List, Optional, cast
 
 import boto3
+import botocore.exceptions
 
+from meadowrun.aws_integration.management_lambdas.demand_forecast import (
+    DailyScheduleForecaster,
+    DemandForecaster,
+    DemandRecord,
+    PlannedInstanceType,
+)
 from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
+    _DEMAND_HISTORY_TABLE_NAME,
+    _EC2_ALLOC_STOPPED_TIME_TAG,
     _EC2_ALLOC_TABLE_NAME,
     _EC2_ALLOC_TAG,
     _EC2_ALLOC_TAG_VALUE,
     _LAST_UPDATE_TIME,
+    _LOGICAL_CPU_AVAILABLE,
+    _MEMORY_GB_AVAILABLE,
     _PUBLIC_ADDRESS,
     _RUNNING_JOBS,
+    _START_TIME,
+    _WARM_POOL_POLICY_VARIABLE,
+    WarmPoolPolicy,
+    get_create_instances_args,
     ignore_boto3_error_code,
+    scan_table,
 )
 
 
-# Terminate instances if they haven't run any jobs in the last 30 seconds
+# Terminate instances if they haven't run any jobs in the last 30 seconds. Can be
+# overridden with a WarmPoolPolicy
 _TERMINATE_INSTANCES_IF_IDLE_FOR = datetime.timedelta(seconds=30)
 # If we see instances running that aren't registered, we assume there is something wrong
 # and they need to be terminated. However, it's possible that we happen to query between
 # when an instance is launched and when it's registered. So for the first 30 seconds
 # after an instance is launched, we don't terminate it even if it's not registered.
 _LAUNCH_REGISTER_DELAY = datetime.timedelta(minutes=5)
+# The longest we'll wait for prelaunched instances to start across all forecasts in a
+# single run. This needs to stay well under the lambda's timeout (see
+# _create_management_lambda). Instances that aren't running by then won't get
+# registered, and _deregister_and_terminate_instances will clean them up after
+# _LAUNCH_REGISTER_DELAY
+_WAIT_FOR_PRELAUNCHED_INSTANCES = datetime.timedelta(seconds=60)
+# How often to poll EC2 while waiting for prelaunched instances to start
+_WAIT_FOR_PRELAUNCHED_INSTANCES_DELAY_SECS = 5
 
 
 def _get_ec2_alloc_table(region_name: str) -> Any:
@@ -48,25 +75,18 @@ def _get_registered_ec2_instances(
     this instance, number of currently running jobs)}
     """
 
-    response = _get_ec2_alloc_table(region_name).scan(
-        Select="SPECIFIC_ATTRIBUTES",
-        ProjectionExpression=",".join(
-            [_PUBLIC_ADDRESS, _LAST_UPDATE_TIME, _RUNNING_JOBS]
-        ),
-    )
-
-    # see comment on ec2_alloc._get_ec2_instances
-    if response.get("LastEvaluatedKey"):
-        raise NotImplementedError(
-            "We don't currently support a very large number of EC2 instances"
-        )
-
     return {
         item[_PUBLIC_ADDRESS]: (
             datetime.datetime.fromisoformat(item[_LAST_UPDATE_TIME]),
             len(item[_RUNNING_JOBS]),
         )
-        for item in response["Items"]
+        for item in scan_table(
+            _get_ec2_alloc_table(region_name),
+            Select="SPECIFIC_ATTRIBUTES",
+            ProjectionExpression=",".join(
+                [_PUBLIC_ADDRESS, _LAST_UPDATE_TIME, _RUNNING_JOBS]
+            ),
+        )
     }
 
 
@@ -104,9 +124,21 @@ _NON_TERMINATED_EC2_STATES = [
 
 
 def adjust(region_name: str) -> None:
+    warm_pool_policy_json = os.environ.get(_WARM_POOL_POLICY_VARIABLE)
+    if warm_pool_policy_json:
+        warm_pool_policy = WarmPoolPolicy.from_json(warm_pool_policy_json)
+    else:
+        warm_pool_policy = WarmPoolPolicy()
     _deregister_and_terminate_instances(
-        region_name, _TERMINATE_INSTANCES_IF_IDLE_FOR, _LAUNCH_REGISTER_DELAY
+        region_name,
+        _TERMINATE_INSTANCES_IF_IDLE_FOR,
+        _LAUNCH_REGISTER_DELAY,
+        warm_pool_policy,
     )
+    if warm_pool_policy.prelaunch_for_forecast_demand:
+        _prelaunch_for_forecast_demand(
+            region_name, DailyScheduleForecaster(), warm_pool_policy.prelaunch_hold_for
+        )
     # TODO this should also launch instances based on pre-provisioning policy
 
 
@@ -129,30 +161,53 @@ def _get_running_instances(ec2_resource: Any) -> Iterable[Any]:
     )
 
 
+def _get_tag(instance: Any, key: str) -> Optional[str]:
+    """Gets the value of the specified tag on a boto3 EC2 Instance"""
+    for tag in instance.tags or ():
+        if tag["Key"] == key:
+            return tag["Value"]
+    return None
+
+
 def _deregister_and_terminate_instances(
     region_name: str,
     terminate_instances_if_idle_for: datetime.timedelta,
     launch_register_delay: datetime.timedelta = _LAUNCH_REGISTER_DELAY,
+    warm_pool_policy: Optional[WarmPoolPolicy] = None,
 ) -> None:
     """
     1. Compares running vs registered instances and terminates/deregisters instances
     to get running/registered instances back in sync
-    2. Terminates and deregisters idle instances
+    2. Terminates (or stops) and deregisters idle instances, according to
+    warm_pool_policy. terminate_instances_if_idle_for is used as the idle timeout if
+    warm_pool_policy doesn't specify one.
+    3. Terminates instances that have been stopped for too long
     """
+    if warm_pool_policy is None:
+        warm_pool_policy = WarmPoolPolicy()
 
-    # by "running" here we mean anything that's not terminated
-    running_instances = {
-        instance.public_dns_name: instance
-        for instance in _get_non_terminated_instances(
-            boto3.resource("ec2", region_name=region_name)
-        )
-    }
+    # by "running" here we mean anything that's not terminated, except for instances
+    # that we stopped on purpose (i.e. the warm pool), which don't have a public address
+    running_instances = {}
+    stopped_instances = []
+    for instance in _get_non_terminated_instances(
+        boto3.resource("ec2", region_name=region_name)
+    ):
+        if instance.state["Name"] in ("stopping", "stopped") and _get_tag(
+            instance, _EC2_ALLOC_STOPPED_TIME_TAG
+        ):
+            stopped_instances.append(instance)
+        else:
+            running_instances[instance.public_dns_name] = instance
 
     registered_instances = _get_registered_ec2_instances(region_name)
 
     now = datetime.datetime.utcnow()
     now_with_timezone = datetime.datetime.now(datetime.timezone.utc)
 
+    # public_address -> last_updated for instances that have been idle long enough to
+    # shut down
+    idle_instances = []
     for public_address, (last_updated, num_jobs) in registered_instances.items():
         if public_address not in running_instances:
             print(
@@ -160,14 +215,49 @@ def _deregister_and_terminate_instances(
                 f" will deregister it"
             )
             _deregister_ec2_instance(public_address, False, region_name)
-        elif num_jobs == 0 and (now - last_updated) > terminate_instances_if_idle_for:
-            success = _deregister_ec2_instance(public_address, True, region_name)
-            if success:
+        elif num_jobs == 0 and (now - last_updated) > warm_pool_policy.get_idle_timeout(
+            running_instances[public_address].instance_type,
+            terminate_instances_if_idle_for,
+        ):
+            idle_instances.append((last_updated, public_address))
+
+    # shut down the instances that have been idle the longest first, and keep at least
+    # min_warm_instances registered
+    num_warm_instances = sum(
+        1
+        for public_address in registered_instances
+        if public_address in running_instances
+    )
+    idle_instances.sort()
+    for last_updated, public_address in idle_instances:
+        if num_warm_instances <= warm_pool_policy.min_warm_instances:
+            break
+
+        success = _deregister_ec2_instance(public_address, True, region_name)
+        if success:
+            num_warm_instances -= 1
+            instance = running_instances[public_address]
+            # we can't stop spot instances that weren't launched as persistent
+            if (
+                warm_pool_policy.stop_instead_of_terminate
+                and instance.instance_lifecycle != "spot"
+            ):
+                print(
+                    f"{public_address} is not running any jobs and has not run anything"
+                    f" since {last_updated} so we will deregister and stop it"
+                )
+                instance.create_tags(
+                    Tags=[
+                        {"Key": _EC2_ALLOC_STOPPED_TIME_TAG, "Value": now.isoformat()}
+                    ]
+                )
+                instance.stop()
+            else:
                 print(
                     f"{public_address} is not running any jobs and has not run anything"
                     f" since {last_updated} so we will deregister and terminate it"
                 )
-                running_instances[public_address].terminate()
+                instance.terminate()
 
     for public_address, instance in running_instances.items():
         if (
@@ -180,6 +270,228 @@ def _deregister_and_terminate_instances(
             )
             instance.terminate()
 
+    for instance in stopped_instances:
+        stopped_time = datetime.datetime.fromisoformat(
+            # we check that this tag exists above
+            cast(str, _get_tag(instance, _EC2_ALLOC_STOPPED_TIME_TAG))
+        )
+        if now - stopped_time > warm_pool_policy.terminate_stopped_after:
+            print(
+                f"{instance.id} has been stopped since {stopped_time}, will terminate"
+            )
+            instance.terminate()
+
+
+def _get_demand_history(
+    region_name: str, since: datetime.datetime
+) -> List[DemandRecord]:
+    """Gets all demand records for run_maps that started after since"""
+    db = boto3.resource("dynamodb", region_name=region_name)
+    table = db.Table(_DEMAND_HISTORY_TABLE_NAME)
+    success, items = ignore_boto3_error_code(
+        lambda: list(
+            scan_table(
+                table,
+                FilterExpression=f"{_START_TIME} >= :since",
+                ExpressionAttributeValues={":since": since.isoformat()},
+            )
+        ),
+        "ResourceNotFoundException",
+    )
+    if not success:
+        # no run_maps have been recorded yet
+        return []
+    assert items is not None  # just for mypy
+    return [DemandRecord.from_item(item) for item in items]
+
+
+def _get_available_resources(region_name: str) -> List[List[float]]:
+    """Returns [logical_cpu_available, memory_gb_available] for each instance"""
+    return [
+        [float(item[_LOGICAL_CPU_AVAILABLE]), float(item[_MEMORY_GB_AVAILABLE])]
+        for item in scan_table(
+            _get_ec2_alloc_table(region_name),
+            Select="SPECIFIC_ATTRIBUTES",
+            ProjectionExpression=",".join(
+                [_LOGICAL_CPU_AVAILABLE, _MEMORY_GB_AVAILABLE]
+            ),
+        )
+    ]
+
+
+def _launch_planned_instances(
+    region_name: str,
+    demand: DemandRecord,
+    num_workers: int,
+    wait_until: datetime.datetime,
+) -> List[Tuple[str, PlannedInstanceType]]:
+    """
+    Launches enough instances from demand.instance_types for num_workers workers and
+    waits until wait_until (utc) for them to start. Returns [(public_address,
+    instance_type)] for the instances that are running, which might not be all of the
+    instances we launched.
+    """
+    ec2_resource = boto3.resource("ec2", region_name=region_name)
+    ec2_client = boto3.client("ec2", region_name=region_name)
+
+    instance_ids: Dict[str, PlannedInstanceType] = {}
+    for instance_type in demand.instance_types:
+        if num_workers <= 0:
+            break
+        num_instances = min(
+            instance_type.num_instances,
+            math.ceil(num_workers / instance_type.workers_per_instance),
+        )
+        num_workers -= num_instances * instance_type.workers_per_instance
+        for instance in ec2_resource.create_instances(
+            ImageId=demand.ami_id,
+            MinCount=num_instances,
+            MaxCount=num_instances,
+            InstanceType=instance_type.name,
+            **get_create_instances_args(
+                instance_type.on_demand_or_spot,
+                demand.security_group_ids,
+                demand.iam_role_name,
+                None,
+                demand.key_name,
+                {_EC2_ALLOC_TAG: _EC2_ALLOC_TAG_VALUE},
+            ),
+        ):
+            instance_ids[instance.id] = instance_type
+
+    if not instance_ids:
+        return []
+
+    # the default instance_running waiter can wait for 10 minutes, which is much longer
+    # than the lambda timeout, so we limit the number of attempts based on wait_until
+    max_attempts = max(
+        1,
+        int(
+            (wait_until - datetime.datetime.utcnow()).total_seconds()
+            // _WAIT_FOR_PRELAUNCHED_INSTANCES_DELAY_SECS
+        ),
+    )
+    try:
+        ec2_client.get_waiter("instance_running").wait(
+            InstanceIds=list(instance_ids),
+            WaiterConfig={
+                "Delay": _WAIT_FOR_PRELAUNCHED_INSTANCES_DELAY_SECS,
+                "MaxAttempts": max_attempts,
+            },
+        )
+    except botocore.exceptions.WaiterError:
+        print(
+            "Not all prelaunched instances started in time, only registering the ones "
+            "that are running"
+        )
+
+    response = ec2_client.describe_instances(InstanceIds=list(instance_ids))
+    return [
+        (instance["PublicDnsName"], instance_ids[instance["InstanceId"]])
+        for reservation in response["Reservations"]
+        for instance in reservation["Instances"]
+        # instances that aren't running yet don't have a public address
+        if instance["State"]["Name"] == "running" and instance["PublicDnsName"]
+    ]
+
+
+def _register_prelaunched_instance(
+    region_name: str,
+    public_address: str,
+    instance_type: PlannedInstanceType,
+    hold_until: datetime.datetime,
+) -> None:
+    """
+    Same as EC2InstanceRegistrar.register_instance with no running jobs, except that we
+    set _LAST_UPDATE_TIME to hold_until, which is in the future, so that
+    _deregister_and_terminate_instances won't consider the instance idle until after
+    hold_until
+    """
+    _get_ec2_alloc_table(region_name).put_item(
+        Item={
+            _PUBLIC_ADDRESS: public_address,
+            _LOGICAL_CPU_AVAILABLE: decimal.Decimal(str(instance_type.logical_cpu)),
+            _MEMORY_GB_AVAILABLE: decimal.Decimal(str(instance_type.memory_gb)),
+            _RUNNING_JOBS: {},
+            _LAST_UPDATE_TIME: hold_until.isoformat(),
+        },
+        ConditionExpression=f"attribute_not_exists({_PUBLIC_ADDRESS})",
+    )
+
+
+def _prelaunch_for_forecast_demand(
+    region_name: str,
+    forecaster: DemandForecaster,
+    hold_for: datetime.timedelta,
+    now: Optional[datetime.datetime] = None,
+) -> None:
+    """
+    Launches and registers instances for run_maps that forecaster expects to start soon,
+    if there isn't already enough available capacity on the registered instances.
+    Prelaunched instances are kept until hold_for after the expected start time.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    forecasts = forecaster.forecast(
+        _get_demand_history(region_name, now - forecaster.get_lookback()), now
+    )
+    if not forecasts:
+        return
+
+    wait_until = datetime.datetime.utcnow() + _WAIT_FOR_PRELAUNCHED_INSTANCES
+    available_resources = _get_available_resources(region_name)
+    for forecast in forecasts:
+        demand = forecast.demand
+
+        # "reserve" capacity on existing instances for this forecast, so that two
+        # forecasts don't count on the same capacity
+        num_workers_needed = demand.num_workers
+        for resources in available_resources:
+            if num_workers_needed <= 0:
+                break
+            num_workers = min(
+                num_workers_needed,
+                math.floor(
+                    min(
+                        resources[0] / demand.logical_cpu_per_worker,
+                        resources[1] / demand.memory_gb_per_worker,
+                    )
+                ),
+            )
+            if num_workers > 0:
+                resources[0] -= num_workers * demand.logical_cpu_per_worker
+                resources[1] -= num_workers * demand.memory_gb_per_worker
+                num_workers_needed -= num_workers
+
+        if num_workers_needed <= 0:
+            continue
+
+        print(
+            f"Expecting {demand.demand_key} to start at {forecast.expected_start_time} "
+            f"with {demand.num_workers} workers, launching instances for "
+            f"{num_workers_needed} workers"
+        )
+        for public_address, instance_type in _launch_planned_instances(
+            region_name, demand, num_workers_needed, wait_until
+        ):
+            _register_prelaunched_instance(
+                region_name,
+                public_address,
+                instance_type,
+                forecast.expected_start_time + hold_for,
+            )
+            # whatever this forecast doesn't need is available for the next forecast
+            num_workers = min(num_workers_needed, instance_type.workers_per_instance)
+            num_workers_needed -= num_workers
+            available_resources.append(
+                [
+                    instance_type.logical_cpu
+                    - num_workers * demand.logical_cpu_per_worker,
+                    instance_type.memory_gb - num_workers * demand.memory_gb_per_worker,
+                ]
+            )
+
 
 def terminate_all_instances(region_name: str) -> None:
     """
@@ -0,0 +1,367 @@
+"""
+Records the demand from each run_map (how many workers, how many resources per worker,
+how long it ran) and forecasts future demand from that history, so that
+adjust_ec2_instances can launch instances shortly before a run_map is expected to start.
+Many batch workloads run on a schedule, so even a simple forecaster can save users from
+waiting for instances to launch.
+
+Forecasters are pluggable (see DemandForecaster) and should only depend on the history
+they're given, so that they can be evaluated offline against a recorded history with
+evaluate_forecaster.
+
+This code will run in the generic AWS Lambda environment, so it should not import any
+code outside this folder.
+"""
+
+from __future__ import annotations
+
+import abc
+import dataclasses
+import datetime
+import decimal
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
+    _DEMAND_KEY,
+    _START_TIME,
+)
+
+# DynamoDB will automatically delete demand records after this long (the _EXPIRES_AT
+# attribute is the table's time to live attribute)
+DEMAND_HISTORY_RETENTION = datetime.timedelta(days=30)
+_EXPIRES_AT = "expires_at"
+
+_SECONDS_PER_DAY = 24 * 60 * 60
+
+
+@dataclasses.dataclass(frozen=True)
+class PlannedInstanceType:
+    """
+    An instance type and how many of that instance type we would launch to run a
+    DemandRecord's demand from scratch
+    """
+
+    name: str
+    # an OnDemandOrSpotType
+    on_demand_or_spot: str
+    logical_cpu: float
+    memory_gb: float
+    workers_per_instance: int
+    num_instances: int
+
+
+@dataclasses.dataclass(frozen=True)
+class DemandRecord:
+    """
+    The demand from a single run_map. start_time is a naive datetime in UTC.
+
+    instance_types and the remaining fields describe how to launch instances for this
+    demand, so that adjust_ec2_instances can launch instances without needing pricing
+    data or any other client-side state.
+    """
+
+    demand_key: str
+    start_time: datetime.datetime
+    duration_secs: float
+    num_workers: int
+    logical_cpu_per_worker: float
+    memory_gb_per_worker: float
+    interruption_probability_threshold: float
+
+    instance_types: List[PlannedInstanceType]
+    ami_id: str
+    security_group_ids: List[str]
+    iam_role_name: Optional[str]
+    key_name: Optional[str]
+
+    def to_item(self) -> Dict[str, Any]:
+        """Returns an item for the demand history table"""
+        return {
+            _DEMAND_KEY: self.demand_key,
+            _START_TIME: self.start_time.isoformat(),
+            "duration_secs": _to_decimal(self.duration_secs),
+            "num_workers": self.num_workers,
+            "logical_cpu_per_worker": _to_decimal(self.logical_cpu_per_worker),
+            "memory_gb_per_worker": _to_decimal(self.memory_gb_per_worker),
+            "interruption_probability_threshold": _to_decimal(
+                self.interruption_probability_threshold
+            ),
+            "instance_types": [
+                {
+                    "name": instance_type.name,
+                    "on_demand_or_spot": instance_type.on_demand_or_spot,
+                    "logical_cpu": _to_decimal(instance_type.logical_cpu),
+                    "memory_gb": _to_decimal(instance_type.memory_gb),
+                    "workers_per_instance": instance_type.workers_per_instance,
+                    "num_instances": instance_type.num_instances,
+                }
+                for instance_type in self.instance_types
+            ],
+            "ami_id": self.ami_id,
+            "security_group_ids": self.security_group_ids,
+            "iam_role_name": self.iam_role_name,
+            "key_name": self.key_name,
+            _EXPIRES_AT: int(
+                (
+                    self.start_time
+                    + DEMAND_HISTORY_RETENTION
+                    - datetime.datetime(1970, 1, 1)
+                ).total_seconds()
+            ),
+        }
+
+    @classmethod
+    def from_item(cls, item: Dict[str, Any]) -> DemandRecord:
+        """The inverse of to_item"""
+        return cls(
+            item[_DEMAND_KEY],
+            datetime.datetime.fromisoformat(item[_START_TIME]),
+            float(item["duration_secs"]),
+            int(item["num_workers"]),
+            float(item["logical_cpu_per_worker"]),
+            float(item["memory_gb_per_worker"]),
+            float(item["interruption_probability_threshold"]),
+            [
+                PlannedInstanceType(
+                    instance_type["name"],
+                    instance_type["on_demand_or_spot"],
+                    float(instance_type["logical_cpu"]),
+                    float(instance_type["memory_gb"]),
+                    int(instance_type["workers_per_instance"]),
+                    int(instance_type["num_instances"]),
+                )
+                for instance_type in item["instance_types"]
+            ],
+            item["ami_id"],
+            list(item["security_group_ids"]),
+            item.get("iam_role_name"),
+            item.get("key_name"),
+        )
+
+
+def _to_decimal(value: float) -> decimal.Decimal:
+    # boto3 doesn't accept floats for DynamoDB numbers. Going via str avoids getting
+    # e.g. Decimal('0.1000000000000000055511151231257827021181583404541015625')
+    return decimal.Decimal(str(value))
+
+
+@dataclasses.dataclass(frozen=True)
+class DemandForecast:
+    """A run_map that we expect to start at expected_start_time"""
+
+    expected_start_time: datetime.datetime
+    # We will try to have enough capacity to run this demand
+    demand: DemandRecord
+
+
+class DemandForecaster(abc.ABC):
+    """
+    Predicts which run_maps will start soon based on the demand history.
+    adjust_ec2_instances calls forecast periodically and launches instances for each
+    DemandForecast (unless there's already enough idle capacity).
+    """
+
+    @abc.abstractmethod
+    def get_lookback(self) -> datetime.timedelta:
+        """How much history forecast needs"""
+        pass
+
+    @abc.abstractmethod
+    def forecast(
+        self, history: Sequence[DemandRecord], now: datetime.datetime
+    ) -> List[DemandForecast]:
+        """
+        history will contain all records that started between now - get_lookback() and
+        now. Should return the run_maps that we expect to start soon, i.e. soon enough
+        that we should launch instances for them now.
+        """
+        pass
+
+
+def _seconds_since_midnight(t: datetime.datetime) -> float:
+    return t.hour * 3600 + t.minute * 60 + t.second + t.microsecond / 1_000_000
+
+
+def _time_of_day_distance(t1: datetime.datetime, t2: datetime.datetime) -> float:
+    """The number of seconds between the times of day of t1 and t2, ignoring dates"""
+    difference = abs(_seconds_since_midnight(t1) - _seconds_since_midnight(t2))
+    return min(difference, _SECONDS_PER_DAY - difference)
+
+
+def _next_same_time_of_day(
+    t: datetime.datetime, now: datetime.datetime
+) -> datetime.datetime:
+    """Returns the first datetime after now that has the same time of day as t"""
+    result = datetime.datetime.combine(now.date(), t.time())
+    if result <= now:
+        result += datetime.timedelta(days=1)
+    return result
+
+
+class DailyScheduleForecaster(DemandForecaster):
+    """
+    Expects a run_map to start at the same time of day as it has on at least
+    min_occurrences of the last lookback_days days (give or take tolerance). Forecasts
+    run_maps lead_time in advance, which should be enough time to launch instances.
+
+    For the demand, uses the largest (by number of workers) of the matching run_maps.
+
+    TODO this doesn't understand weekly schedules, e.g. a job that only runs on weekdays
+    will be forecast on Saturday morning if it ran on enough days in the previous week
+    """
+
+    def __init__(
+        self,
+        lead_time: datetime.timedelta = datetime.timedelta(minutes=5),
+        lookback_days: int = 7,
+        min_occurrences: int = 3,
+        tolerance: datetime.timedelta = datetime.timedelta(minutes=10),
+    ):
+        self._lead_time = lead_time
+        self._lookback_days = lookback_days
+        self._min_occurrences = min_occurrences
+        self._tolerance = tolerance
+
+    def get_lookback(self) -> datetime.timedelta:
+        return datetime.timedelta(days=self._lookback_days)
+
+    def forecast(
+        self, history: Sequence[DemandRecord], now: datetime.datetime
+    ) -> List[DemandForecast]:
+        records_by_key: Dict[str, List[DemandRecord]] = {}
+        for record in history:
+            if now - self.get_lookback() <= record.start_time <= now:
+                records_by_key.setdefault(record.demand_key, []).append(record)
+
+        tolerance_secs = self._tolerance.total_seconds()
+        results = []
+        for records in records_by_key.values():
+            # the next time we might expect each of these run_maps to start again
+            candidates = sorted(
+                expected_start_time
+                for expected_start_time in (
+                    _next_same_time_of_day(record.start_time, now) for record in records
+                )
+                if expected_start_time - now <= self._lead_time
+            )
+
+            for expected_start_time in candidates:
+                # if this run_map already started "today", we shouldn't forecast it
+                # again
+                if any(
+                    abs((record.start_time - expected_start_time).total_seconds())
+                    <= tolerance_secs
+                    for record in records
+                ):
+                    continue
+
+                similar_records = [
+                    record
+                    for record in records
+                    if _time_of_day_distance(record.start_time, expected_start_time)
+                    <= tolerance_secs
+                ]
+                if (
+                    len({record.start_time.date() for record in similar_records})
+                    >= self._min_occurrences
+                ):
+                    results.append(
+                        DemandForecast(
+                            expected_start_time,
+                            max(
+                                similar_records,
+                                key=lambda record: (
+                                    record.num_workers,
+                                    record.start_time,
+                                ),
+                            ),
+                        )
+                    )
+                    # one forecast per demand_key at a time is plenty
+                    break
+
+        return results
+
+
+@dataclasses.dataclass(frozen=True)
+class ForecastEvaluation:
+    # run_maps that were forecast before they started
+    num_forecast: int
+    # run_maps that were not forecast
+    num_missed: int
+    # forecasts for run_maps that didn't happen
+    num_false_alarms: int
+
+
+def evaluate_forecaster(
+    forecaster: DemandForecaster,
+    trace: Sequence[DemandRecord],
+    step: datetime.timedelta = datetime.timedelta(minutes=1),
+    match_tolerance: datetime.timedelta = datetime.timedelta(minutes=15),
+) -> ForecastEvaluation:
+    """
+    Replays trace (e.g. a demand history exported from the demand history table),
+    calling forecaster every step the same way that adjust_ec2_instances would, and
+    compares the forecasts to the run_maps that actually happened. A run_map counts as
+    forecast if a forecast with the same demand_key was made before the run_map started
+    with an expected_start_time within match_tolerance of the actual start time.
+    """
+    if not trace:
+        return ForecastEvaluation(0, 0, 0)
+
+    trace = sorted(trace, key=lambda record: record.start_time)
+
+    # (demand_key, expected_start_time)
+    forecasts: Set[Tuple[str, datetime.datetime]] = set()
+    lookback = forecaster.get_lookback()
+    history_start = 0
+    history_end = 0
+    now = trace[0].start_time
+    end = trace[-1].start_time + step
+    while now <= end:
+        while history_end < len(trace) and trace[history_end].start_time <= now:
+            history_end += 1
+        while (
+            history_start < history_end
+            and trace[history_start].start_time < now - lookback
+        ):
+            history_start += 1
+
+        for forecast in forecaster.forecast(trace[history_start:history_end], now):
+            # only count forecasts made before the run_map starts
+            if forecast.expected_start_time > now:
+                forecasts.add(
+                    (forecast.demand.demand_key, forecast.expected_start_time)
+                )
+
+        now += step
+
+    # the same run_map will usually get forecast repeatedly (once per step) as its start
+    # time approaches, possibly with slightly different expected start times, so we
+    # match every forecast within match_tolerance of an actual run_map to that run_map
+    num_forecast = 0
+    matched_forecasts = set()
+    for record in trace:
+        matches = [
+            (demand_key, expected_start_time)
+            for demand_key, expected_start_time in forecasts
+            if demand_key == record.demand_key
+            and abs(expected_start_time - record.start_time) <= match_tolerance
+        ]
+        if matches:
+            num_forecast += 1
+            matched_forecasts.update(matches)
+
+    # similarly, collapse forecasts for the same demand_key within match_tolerance of
+    # each other into a single false alarm
+    num_false_alarms = 0
+    last_false_alarm: Dict[str, datetime.datetime] = {}
+    for demand_key, expected_start_time in sorted(forecasts - matched_forecasts):
+        if (
+            demand_key not in last_false_alarm
+            or expected_start_time - last_false_alarm[demand_key] > match_tolerance
+        ):
+            num_false_alarms += 1
+            last_false_alarm[demand_key] = expected_start_time
+
+    return ForecastEvaluation(num_forecast, len(trace) - num_forecast, num_false_alarms)
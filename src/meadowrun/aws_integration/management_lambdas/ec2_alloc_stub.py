@@ -7,7 +7,21 @@ should not refer to any outside code
 """
 from __future__ import annotations
 
-from typing import Callable, Tuple, Optional, TypeVar, Union, Set
+import dataclasses
+import datetime
+import json
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import botocore.exceptions
 
@@ -29,13 +43,134 @@ _LAST_UPDATE_TIME = "last_update_time"
 _RUNNING_JOBS = "running_jobs"
 _JOB_ID = "job_id"
 
+# a dynamodb table that records the demand (number of workers, resources per worker,
+# etc.) of each run_map so that adjust_ec2_instances can launch instances ahead of
+# predictable demand. See demand_forecast.py
+_DEMAND_HISTORY_TABLE_NAME = "_meadowrun_demand_history_table"
+
+# names of keys in the demand history table
+_DEMAND_KEY = "demand_key"
+_START_TIME = "start_time"
+
 # A tag for EC2 instances that are created using ec2_alloc
 _EC2_ALLOC_TAG = "meadowrun_ec2_alloc"
 _EC2_ALLOC_TAG_VALUE = "TRUE"
+# A tag for EC2 instances that have been stopped (rather than terminated) by
+# adjust_ec2_instances because of WarmPoolPolicy.stop_instead_of_terminate. The value is
+# the time the instance was stopped as an isoformat string.
+_EC2_ALLOC_STOPPED_TIME_TAG = "meadowrun_stopped_time"
+
+# the environment variable that tells the adjust_ec2_instances lambda what
+# WarmPoolPolicy to use
+_WARM_POOL_POLICY_VARIABLE = "MEADOWRUN_WARM_POOL_POLICY"
 
 _MEADOWRUN_GENERATED_DOCKER_REPO = "meadowrun_generated"
 
 
+@dataclasses.dataclass(frozen=True)
+class WarmPoolPolicy:
+    """
+    Determines what adjust_ec2_instances does with idle instances.
+
+    idle_timeout: deregister and terminate instances that haven't run a job for this
+    long. None means use adjust_ec2_instances._TERMINATE_INSTANCES_IF_IDLE_FOR
+    idle_timeout_per_instance_type: overrides idle_timeout for specific instance types,
+    e.g. {"c5.large": datetime.timedelta(minutes=10)}
+    min_warm_instances: never shut down idle instances if that would leave fewer than
+    this many registered instances
+    stop_instead_of_terminate: stop idle on-demand instances instead of terminating
+    them. Stopped instances can be restarted (see ec2.launch_ec2_instances) much faster
+    than launching a new instance. Spot instances are always terminated.
+    terminate_stopped_after: terminate stopped instances that haven't been restarted
+    after this long. We don't pay for stopped instances, but we do pay for their disks.
+    prelaunch_for_forecast_demand: launch instances shortly before run_maps that are
+    expected to start based on the demand history (see demand_forecast.py)
+    prelaunch_hold_for: instances launched for forecast demand are kept for this long
+    after the time the run_map was expected to start, even if they're idle
+    """
+
+    idle_timeout: Optional[datetime.timedelta] = None
+    idle_timeout_per_instance_type: Dict[str, datetime.timedelta] = dataclasses.field(
+        default_factory=dict
+    )
+    min_warm_instances: int = 0
+    stop_instead_of_terminate: bool = False
+    terminate_stopped_after: datetime.timedelta = datetime.timedelta(days=1)
+    prelaunch_for_forecast_demand: bool = False
+    prelaunch_hold_for: datetime.timedelta = datetime.timedelta(minutes=10)
+
+    def get_idle_timeout(
+        self, instance_type: str, default: datetime.timedelta
+    ) -> datetime.timedelta:
+        if instance_type in self.idle_timeout_per_instance_type:
+            return self.idle_timeout_per_instance_type[instance_type]
+        if self.idle_timeout is not None:
+            return self.idle_timeout
+        return default
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "idle_timeout_secs": (
+                    None
+                    if self.idle_timeout is None
+                    else self.idle_timeout.total_seconds()
+                ),
+                "idle_timeout_secs_per_instance_type": {
+                    instance_type: timeout.total_seconds()
+                    for instance_type, timeout in (
+                        self.idle_timeout_per_instance_type.items()
+                    )
+                },
+                "min_warm_instances": self.min_warm_instances,
+                "stop_instead_of_terminate": self.stop_instead_of_terminate,
+                "terminate_stopped_after_secs": (
+                    self.terminate_stopped_after.total_seconds()
+                ),
+                "prelaunch_for_forecast_demand": self.prelaunch_for_forecast_demand,
+                "prelaunch_hold_for_secs": self.prelaunch_hold_for.total_seconds(),
+            }
+        )
+
+    @classmethod
+    def from_json(cls, s: str) -> WarmPoolPolicy:
+        """
+        The inverse of to_json. Any missing keys will get the default value, e.g.
+        '{"min_warm_instances": 2}' is valid
+        """
+        data = json.loads(s)
+        default = cls()
+        idle_timeout_secs = data.get("idle_timeout_secs")
+        return cls(
+            None
+            if idle_timeout_secs is None
+            else datetime.timedelta(seconds=idle_timeout_secs),
+            {
+                instance_type: datetime.timedelta(seconds=timeout_secs)
+                for instance_type, timeout_secs in data.get(
+                    "idle_timeout_secs_per_instance_type", {}
+                ).items()
+            },
+            data.get("min_warm_instances", default.min_warm_instances),
+            data.get("stop_instead_of_terminate", default.stop_instead_of_terminate),
+            datetime.timedelta(
+                seconds=data.get(
+                    "terminate_stopped_after_secs",
+                    default.terminate_stopped_after.total_seconds(),
+                )
+            ),
+            data.get(
+                "prelaunch_for_forecast_demand", default.prelaunch_for_forecast_demand
+            ),
+            datetime.timedelta(
+                seconds=data.get(
+                    "prelaunch_hold_for_secs",
+                    default.prelaunch_hold_for.total_seconds(),
+                )
+            ),
+        )
+
+
 def ignore_boto3_error_code(
     func: Callable[[], _T], error_code: Union[str, Set[str]]
 ) -> Tuple[bool, Optional[_T]]:
@@ -57,3 +192,70 @@ def ignore_boto3_error_code(
                 return False, None
 
         raise
+
+
+def scan_table(table: Any, **scan_kwargs: Any) -> Iterable[Dict[str, Any]]:
+    """
+    Calls scan on a boto3 DynamoDB Table resource with scan_kwargs and yields all of the
+    items, following LastEvaluatedKey as needed. A single scan call maxes out at 1MB of
+    returned data before requiring pagination.
+    """
+    response = table.scan(**scan_kwargs)
+    yield from response["Items"]
+    while response.get("LastEvaluatedKey"):
+        response = table.scan(
+            ExclusiveStartKey=response["LastEvaluatedKey"], **scan_kwargs
+        )
+        yield from response["Items"]
+
+
+def get_create_instances_args(
+    on_demand_or_spot: str,
+    security_group_ids: Optional[Sequence[str]],
+    iam_role_name: Optional[str],
+    user_data: Optional[str],
+    key_name: Optional[str],
+    tags: Optional[Dict[str, str]],
+) -> Dict[str, Any]:
+    """
+    Returns the optional arguments to ec2_resource.create_instances for the specified
+    options. on_demand_or_spot is an OnDemandOrSpotType. This is used by ec2.py and by
+    adjust_ec2_instances when it launches instances ahead of forecast demand.
+    """
+    optional_args: Dict[str, Any] = {
+        # TODO allow users to specify the size of the EBS they need
+        "BlockDeviceMappings": [
+            {
+                "DeviceName": "/dev/sda1",
+                "Ebs": {
+                    "DeleteOnTermination": True,
+                    "VolumeSize": 16,
+                    "VolumeType": "gp2",
+                },
+            }
+        ]
+    }
+    if security_group_ids:
+        optional_args["SecurityGroupIds"] = security_group_ids
+    if iam_role_name:
+        optional_args["IamInstanceProfile"] = {"Name": iam_role_name}
+    if key_name:
+        optional_args["KeyName"] = key_name
+    if user_data:
+        optional_args["UserData"] = user_data
+    if tags:
+        optional_args["TagSpecifications"] = [
+            {
+                "ResourceType": "instance",
+                "Tags": [{"Key": key, "Value": value} for key, value in tags.items()],
+            }
+        ]
+
+    if on_demand_or_spot == "on_demand":
+        pass
+    elif on_demand_or_spot == "spot":
+        optional_args["InstanceMarketOptions"] = {"MarketType": "spot"}
+    else:
+        raise ValueError(f"Unexpected value for on_demand_or_spot {on_demand_or_spot}")
+
+    return optional_args
@@ -1,18 +1,62 @@
-import hashlib
-from typing import Dict, List, Optional, Tuple
+import asyncio
+import datetime
+import os
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 import uuid
 
 import boto3
 from botocore.exceptions import ClientError
 
-from meadowrun.aws_integration.aws_core import _get_default_region_name
+from meadowrun.aws_integration.aws_core import (
+    _get_boto3_client,
+    _get_default_region_name,
+    _run_boto3,
+)
+from meadowrun.local_code import (
+    get_manifest_hash,
+    hash_file,
+    read_manifest,
+    serialize_manifest,
+)
 
 BUCKET_PREFIX = "meadowrun"
 
+_DEFAULT_EXPIRE_DAYS = 14
+# Individual files from manifests created by local_code.create_manifest are stored under
+# _BLOB_PREFIX, keyed by the hash of their contents. The manifests themselves are
+# stored under _MANIFEST_PREFIX, keyed by the manifest hash.
+_BLOB_PREFIX = "blobs/"
+_MANIFEST_PREFIX = "manifests/"
+# The bucket's lifecycle policy deletes objects _DEFAULT_EXPIRE_DAYS after they were
+# last written, so we don't want to rely on a blob that might be deleted while a job
+# that needs it is still starting up. Blobs older than this get uploaded again, which
+# resets their expiration.
+_REUPLOAD_BLOBS_OLDER_THAN = datetime.timedelta(days=_DEFAULT_EXPIRE_DAYS / 2)
+
+# Files bigger than _MULTIPART_THRESHOLD are uploaded with a multipart upload, in parts
+# of _PART_SIZE. Downloads always use ranged GETs of _PART_SIZE. At most
+# _MAX_CONCURRENT_REQUESTS parts/files are transferred at the same time by each call to
+# the functions in this module.
+_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+_PART_SIZE = 8 * 1024 * 1024
+_MAX_CONCURRENT_REQUESTS = 8
+# Objects uploaded by this module have the blake2b hash of their contents in their
+# metadata under this key so that downloads can be verified
+_DIGEST_METADATA_KEY = "blake2b"
+
+# region_name -> bucket name, so that we only need to list buckets once per process
+_BUCKET_NAMES: Dict[str, str] = {}
+# bucket name -> {digest: last modified time} for the blobs in that bucket, so that we
+# only need to list the blobs once per process rather than on every
+# ensure_manifest_uploaded. We add blobs that we upload ourselves. Blobs uploaded by
+# other processes after we list the bucket will just get uploaded again, which is
+# harmless.
+_BLOB_LAST_MODIFIED: Dict[str, Dict[str, datetime.datetime]] = {}
+
 
 def ensure_bucket(
     region_name: str,
-    expire_days: int = 14,
+    expire_days: int = _DEFAULT_EXPIRE_DAYS,
 ) -> str:
     """Create an S3 bucket in a specified region if it does not exist yet.
 
@@ -31,14 +75,17 @@ def ensure_bucket(
         policy.
     :return: the full bucket name
     """
+    if region_name in _BUCKET_NAMES:
+        return _BUCKET_NAMES[region_name]
 
-    s3 = boto3.client("s3", region_name=region_name)
+    s3 = _get_boto3_client("s3", region_name)
 
     # s3 bucket names must be globally unique accross all acounts and regions.
     prefix = f"{BUCKET_PREFIX}-{region_name}"
     response = s3.list_buckets()
     for existing_bucket in response["Buckets"]:
         if existing_bucket["Name"].startswith(prefix):
+            _BUCKET_NAMES[region_name] = existing_bucket["Name"]
             return existing_bucket["Name"]
 
     location = {"LocationConstraint": region_name}
@@ -60,34 +107,45 @@ def ensure_bucket(
             ]
         ),
     )
+    _BUCKET_NAMES[region_name] = bucket_name
     return bucket_name
 
 
 async def ensure_uploaded(
     file_path: str, region_name: Optional[str] = None
 ) -> Tuple[str, str]:
-
+    """
+    Uploads file_path to the meadowrun bucket (if it isn't already there) using the
+    hash of its contents as the key. Returns the bucket name and key.
+    """
     if region_name is None:
         region_name = await _get_default_region_name()
 
-    s3 = boto3.client("s3", region_name=region_name)
+    s3 = _get_boto3_client("s3", region_name)
 
-    hasher = hashlib.blake2b()
-    with open(file_path, "rb") as file:
-        buf = file.read()
-        hasher.update(buf)
-    digest = hasher.hexdigest()
+    # hash_file reads the file in chunks, and we run it on a thread so that we don't
+    # block the event loop for large files
+    digest = await asyncio.get_running_loop().run_in_executor(
+        None, hash_file, file_path
+    )
 
-    bucket_name = ensure_bucket(region_name)
+    bucket_name = await _run_boto3(ensure_bucket, region_name)
     try:
-        s3.head_object(Bucket=bucket_name, Key=digest)
+        await _run_boto3(s3.head_object, Bucket=bucket_name, Key=digest)
         return bucket_name, digest
     except ClientError as error:
         if not error.response["Error"]["Code"] == "404":
             raise error
 
     # doesn't exist, need to upload it
-    s3.upload_file(Filename=file_path, Bucket=bucket_name, Key=digest)
+    await _upload_file(
+        s3,
+        file_path,
+        bucket_name,
+        digest,
+        digest,
+        asyncio.Semaphore(_MAX_CONCURRENT_REQUESTS),
+    )
     return bucket_name, digest
 
 
@@ -96,13 +154,285 @@ async def download_file(
     object_name: str,
     file_name: str,
     region_name: Optional[str] = None,
+    expected_digest: Optional[str] = None,
 ) -> None:
+    """
+    Downloads an object to file_name. If expected_digest is None, we verify the
+    download against the hash in the object's metadata if it was uploaded by this
+    module.
+    """
     if region_name is None:
         region_name = await _get_default_region_name()
 
-    s3 = boto3.client("s3", region_name=region_name)
+    s3 = _get_boto3_client("s3", region_name)
+
+    await _download_file(
+        s3,
+        bucket_name,
+        object_name,
+        file_name,
+        expected_digest,
+        asyncio.Semaphore(_MAX_CONCURRENT_REQUESTS),
+    )
+
+
+async def _upload_file(
+    s3: Any,
+    file_path: str,
+    bucket_name: str,
+    key: str,
+    digest: str,
+    semaphore: asyncio.Semaphore,
+) -> None:
+    """
+    Uploads file_path to key, in concurrent parts if the file is large. digest should
+    be the hash_file of file_path, and is stored in the object's metadata. Never reads
+    more than _PART_SIZE of the file into memory per concurrent request.
+    """
+    metadata = {_DIGEST_METADATA_KEY: digest}
+    size = os.path.getsize(file_path)
+
+    if size <= _MULTIPART_THRESHOLD:
+
+        def put_object() -> None:
+            with open(file_path, "rb") as f:
+                s3.put_object(Bucket=bucket_name, Key=key, Body=f, Metadata=metadata)
+
+        async with semaphore:
+            await _run_boto3(put_object)
+        return
+
+    upload_id = (
+        await _run_boto3(
+            s3.create_multipart_upload, Bucket=bucket_name, Key=key, Metadata=metadata
+        )
+    )["UploadId"]
+
+    def upload_part(part_number: int, offset: int) -> str:
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            body = f.read(_PART_SIZE)
+        return s3.upload_part(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )["ETag"]
+
+    async def upload_part_limited(part_number: int, offset: int) -> str:
+        async with semaphore:
+            return await _run_boto3(upload_part, part_number, offset)
+
+    try:
+        # part numbers start at 1
+        etags = await asyncio.gather(
+            *(
+                upload_part_limited(i + 1, offset)
+                for i, offset in enumerate(range(0, size, _PART_SIZE))
+            )
+        )
+        await _run_boto3(
+            s3.complete_multipart_upload,
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"ETag": etag, "PartNumber": i + 1} for i, etag in enumerate(etags)
+                ]
+            },
+        )
+    except BaseException:
+        # otherwise S3 keeps (and charges for) the parts that were uploaded
+        await _run_boto3(
+            s3.abort_multipart_upload, Bucket=bucket_name, Key=key, UploadId=upload_id
+        )
+        raise
+
+
+async def _download_file(
+    s3: Any,
+    bucket_name: str,
+    key: str,
+    file_name: str,
+    expected_digest: Optional[str],
+    semaphore: asyncio.Semaphore,
+) -> None:
+    """
+    Downloads key to file_name with concurrent ranged GETs, and verifies the contents
+    against expected_digest (or the digest in the object's metadata if expected_digest
+    is None). The file is downloaded to a temporary name and then renamed so that a
+    partially downloaded or corrupted file is never visible under file_name.
+    """
+    loop = asyncio.get_running_loop()
+
+    head = await _run_boto3(s3.head_object, Bucket=bucket_name, Key=key)
+    size = head["ContentLength"]
+    if expected_digest is None:
+        expected_digest = head.get("Metadata", {}).get(_DIGEST_METADATA_KEY)
+
+    temp_path = f"{file_name}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.truncate(size)
+
+    def download_range(start: int) -> None:
+        end = min(start + _PART_SIZE, size) - 1
+        body = s3.get_object(
+            Bucket=bucket_name,
+            Key=key,
+            Range=f"bytes={start}-{end}",
+            # make sure all of the ranges come from the same version of the object
+            IfMatch=head["ETag"],
+        )["Body"].read()
+        with open(temp_path, "r+b") as f:
+            f.seek(start)
+            f.write(body)
 
-    s3.download_file(bucket_name, object_name, file_name)
+    async def download_range_limited(start: int) -> None:
+        async with semaphore:
+            await _run_boto3(download_range, start)
+
+    try:
+        await asyncio.gather(
+            *(download_range_limited(start) for start in range(0, size, _PART_SIZE))
+        )
+        if expected_digest is not None:
+            actual_digest = await loop.run_in_executor(None, hash_file, temp_path)
+            if actual_digest != expected_digest:
+                raise ValueError(
+                    f"Downloaded s3://{bucket_name}/{key} but its contents have hash "
+                    f"{actual_digest} rather than the expected {expected_digest}"
+                )
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    os.replace(temp_path, file_name)
+
+
+async def ensure_manifest_uploaded(
+    manifest_path: str, region_name: Optional[str] = None
+) -> Tuple[str, str]:
+    """
+    Uploads a manifest created by local_code.create_manifest as well as any files it
+    refers to that aren't already in the bucket. Returns the bucket name and key of the
+    uploaded manifest, which can be passed to deployment_manager via a CodeZipFile with
+    an s3 URL.
+    """
+    if region_name is None:
+        region_name = await _get_default_region_name()
+
+    s3 = _get_boto3_client("s3", region_name)
+    bucket_name = await _run_boto3(ensure_bucket, region_name)
+
+    files, sources = read_manifest(manifest_path)
+    manifest_key = f"{_MANIFEST_PREFIX}{get_manifest_hash(files)}.json"
+
+    existing_blobs = await _run_boto3(_get_recent_blobs, s3, bucket_name)
+    missing_blobs = [
+        digest for digest in set(files.values()) if digest not in existing_blobs
+    ]
+    if missing_blobs:
+        print(f"Uploading {len(missing_blobs)} changed files")
+        # the blobs' last modified times will be at least this
+        upload_start = datetime.datetime.now(datetime.timezone.utc)
+        semaphore = asyncio.Semaphore(_MAX_CONCURRENT_REQUESTS)
+        await asyncio.gather(
+            *(
+                _upload_file(
+                    s3,
+                    sources[digest],
+                    bucket_name,
+                    f"{_BLOB_PREFIX}{digest}",
+                    digest,
+                    semaphore,
+                )
+                for digest in missing_blobs
+            )
+        )
+        _BLOB_LAST_MODIFIED.setdefault(bucket_name, {}).update(
+            (digest, upload_start) for digest in missing_blobs
+        )
+
+    # The manifest is small, so we always upload it, which also resets its expiration.
+    # The remote side doesn't need (and shouldn't see) our local paths, so we leave out
+    # sources
+    await _run_boto3(
+        s3.put_object,
+        Bucket=bucket_name,
+        Key=manifest_key,
+        Body=serialize_manifest(files).encode("utf-8"),
+    )
+    return bucket_name, manifest_key
+
+
+def _get_recent_blobs(s3: Any, bucket_name: str) -> Set[str]:
+    """
+    Returns the hashes of the blobs in the bucket that aren't in danger of being deleted
+    by the lifecycle policy soon. Only lists the bucket the first time it's called for
+    each bucket, see _BLOB_LAST_MODIFIED.
+    """
+    if bucket_name not in _BLOB_LAST_MODIFIED:
+        last_modified: Dict[str, datetime.datetime] = {}
+        for page in s3.get_paginator("list_objects_v2").paginate(
+            Bucket=bucket_name, Prefix=_BLOB_PREFIX
+        ):
+            for obj in page.get("Contents", ()):
+                last_modified[obj["Key"][len(_BLOB_PREFIX) :]] = obj["LastModified"]
+        _BLOB_LAST_MODIFIED[bucket_name] = last_modified
+
+    # we need to check this every time, as blobs we've listed in the past can get close
+    # to expiring in a long-running process
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - _REUPLOAD_BLOBS_OLDER_THAN
+    return {
+        digest
+        for digest, last_modified in _BLOB_LAST_MODIFIED[bucket_name].items()
+        if last_modified >= cutoff
+    }
+
+
+async def download_blobs(
+    bucket_name: str,
+    digests: Iterable[str],
+    destination_folder: str,
+    region_name: Optional[str] = None,
+) -> None:
+    """
+    Downloads blobs uploaded by ensure_manifest_uploaded into destination_folder/digest,
+    verifying that each blob's contents match its digest.
+    """
+    if region_name is None:
+        region_name = await _get_default_region_name()
+
+    s3 = _get_boto3_client("s3", region_name)
+    semaphore = asyncio.Semaphore(_MAX_CONCURRENT_REQUESTS)
+    await asyncio.gather(
+        *(
+            _download_file(
+                s3,
+                bucket_name,
+                f"{_BLOB_PREFIX}{digest}",
+                os.path.join(destination_folder, digest),
+                digest,
+                semaphore,
+            )
+            for digest in digests
+        )
+    )
+
+
+async def download_object(
+    bucket_name: str, object_name: str, region_name: Optional[str] = None
+) -> bytes:
+    """Returns the contents of a (small) object"""
+    if region_name is None:
+        region_name = await _get_default_region_name()
+
+    s3 = _get_boto3_client("s3", region_name)
+    return await _run_boto3(
+        lambda: s3.get_object(Bucket=bucket_name, Key=object_name)["Body"].read()
+    )
 
 
 def delete_all_buckets(region_name: str) -> None:
@@ -117,6 +447,7 @@ def delete_all_buckets(region_name: str) -> None:
             break
     else:
         return
+    _BUCKET_NAMES.pop(region_name, None)
 
     # easier to work with resource now
     s3 = boto3.resource("s3", region_name=region_name)
@@ -1,5 +1,7 @@
 """See ecr.py"""
 
+from typing import Optional, Tuple
+
 from meadowrun.azure_integration.azure_meadowrun_core import (
     ensure_meadowrun_resource_group,
     get_default_location,
@@ -22,7 +24,11 @@ from meadowrun.azure_integration.mgmt_functions.azure_constants import (
     CONTAINER_IMAGE,
     meadowrun_container_registry_name,
 )
-from meadowrun.credentials import UsernamePassword
+from meadowrun.credentials import (
+    RawCredentials,
+    UsernamePassword,
+    get_cached_credentials,
+)
 from meadowrun.run_job_core import ContainerRegistryHelper
 
 
@@ -68,6 +74,20 @@ async def _get_username_password(registry_name: str) -> UsernamePassword:
     return UsernamePassword(_EMPTY_GUID, await get_acr_token(registry_name, "refresh"))
 
 
+async def _get_cached_username_password(registry_name: str) -> UsernamePassword:
+    """
+    Like _get_username_password, but caches the credentials for
+    CREDENTIALS_CACHE_SECS
+    """
+
+    async def fetch() -> Tuple[RawCredentials, Optional[float]]:
+        return await _get_username_password(registry_name), None
+
+    credentials = await get_cached_credentials(f"acr:{registry_name}", fetch)
+    assert isinstance(credentials, UsernamePassword)
+    return credentials
+
+
 async def _does_image_exist(registry_name: str, repository: str, tag: str) -> bool:
     try:
         return any(
@@ -95,7 +115,7 @@ async def get_acr_helper(
 
     return ContainerRegistryHelper(
         True,
-        await _get_username_password(registry_name),
+        await _get_cached_username_password(registry_name),
         f"{repository_prefix}/{repository}:{tag}",
         await _does_image_exist(registry_name, repository, tag),
     )
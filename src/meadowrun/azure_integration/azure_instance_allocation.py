@@ -1,8 +1,8 @@
 from __future__ import annotations
 
+import asyncio
 import dataclasses
 import datetime
-import json
 from types import TracebackType
 from typing import Tuple, List, Optional, Sequence, Literal, Type, Any, Dict
 
@@ -18,9 +18,12 @@ from meadowrun.azure_integration.mgmt_functions.azure.azure_exceptions import (
     ResourceNotFoundError,
 )
 from meadowrun.azure_integration.mgmt_functions.azure.azure_storage_api import (
+    TABLE_BATCH_MAX_OPERATIONS,
     StorageAccount,
+    TableBatchOperation,
     azure_table_api,
     azure_table_api_paged,
+    azure_table_batch,
     table_key_url,
 )
 from meadowrun.azure_integration.mgmt_functions.azure_constants import (
@@ -30,15 +33,15 @@ from meadowrun.azure_integration.mgmt_functions.azure_constants import (
     LOGICAL_CPU_AVAILABLE,
     MEMORY_GB_ALLOCATED,
     MEMORY_GB_AVAILABLE,
-    RUNNING_JOBS,
-    SINGLE_PARTITION_KEY,
+    NUM_RUNNING_JOBS,
+    VM_CAPACITY_ROW_KEY,
     VM_NAME,
 )
 from meadowrun.azure_integration.mgmt_functions.vm_adjust import VM_ALLOC_TABLE_NAME
 from meadowrun.instance_allocation import (
     _InstanceState,
     InstanceRegistrar,
-    allocate_jobs_to_instances,
+    allocate_jobs_to_instances_batched,
 )
 from meadowrun.instance_selection import Resources, CloudInstance
 from meadowrun.meadowrun_pb2 import Job
@@ -48,11 +51,84 @@ from meadowrun.run_job_core import AllocCloudInstancesInternal, JobCompletion, S
 @dataclasses.dataclass
 class AzureVMInstanceState(_InstanceState):
     name: str
-    # See https://microsoft.github.io/AzureTipsAndTricks/blog/tip88.html
+    # The etag of the VM's capacity row (see VM_CAPACITY_ROW_KEY). See
+    # https://microsoft.github.io/AzureTipsAndTricks/blog/tip88.html
     etag: str
+    num_running_jobs: int
+
+
+# The columns on the capacity row that we need to populate AzureVMInstanceState
+_CAPACITY_COLUMNS = [
+    "PartitionKey",
+    VM_NAME,
+    LOGICAL_CPU_AVAILABLE,
+    MEMORY_GB_AVAILABLE,
+    NUM_RUNNING_JOBS,
+]
+# Deallocating a job doesn't depend on what else is running on the VM, so if our view of
+# the VM's capacity row is out of date, we just read it again and retry, up to this many
+# times
+_MAX_DEALLOCATE_ATTEMPTS = 10
+# Inserts don't need to return the entity we just inserted
+_INSERT_HEADERS = {"Prefer": "return-no-content"}
+
+
+def _capacity_item_to_instance_state(
+    item: Dict[str, Any], running_jobs: Optional[Dict[str, Dict[str, Any]]]
+) -> AzureVMInstanceState:
+    return AzureVMInstanceState(
+        item["PartitionKey"],
+        Resources(
+            float(item[MEMORY_GB_AVAILABLE]), int(item[LOGICAL_CPU_AVAILABLE]), {}
+        ),
+        running_jobs,
+        item[VM_NAME],
+        item["odata.etag"],
+        int(item[NUM_RUNNING_JOBS]),
+    )
+
+
+def _insert_job_row(
+    public_address: str, job_id: str, allocated_resources: Resources, now: str
+) -> TableBatchOperation:
+    # https://docs.microsoft.com/en-us/rest/api/storageservices/insert-entity
+    return TableBatchOperation(
+        "POST",
+        VM_ALLOC_TABLE_NAME,
+        {
+            "PartitionKey": public_address,
+            "RowKey": job_id,
+            LOGICAL_CPU_ALLOCATED: allocated_resources.logical_cpu,
+            MEMORY_GB_ALLOCATED: allocated_resources.memory_gb,
+            ALLOCATED_TIME: now,
+        },
+        _INSERT_HEADERS,
+    )
+
+
+def _merge_capacity_row(
+    public_address: str, columns: Dict[str, Any], if_match: str
+) -> TableBatchOperation:
+    # https://docs.microsoft.com/en-us/rest/api/storageservices/merge-entity
+    return TableBatchOperation(
+        "MERGE",
+        table_key_url(VM_ALLOC_TABLE_NAME, public_address, VM_CAPACITY_ROW_KEY),
+        columns,
+        {"If-Match": if_match},
+    )
 
 
 class AzureInstanceRegistrar(InstanceRegistrar[AzureVMInstanceState]):
+    """
+    Each VM gets its own partition in VM_ALLOC_TABLE_NAME, with a capacity row that has
+    the VM's available resources and number of running jobs, and a row for each job
+    running on the VM (see VM_CAPACITY_ROW_KEY). Allocating or deallocating jobs is a
+    single entity group transaction that updates the capacity row (with an etag check)
+    and inserts/deletes just the rows for those jobs, so it only sends the jobs that
+    changed, and workers deallocating jobs on the same VM don't need to rewrite each
+    other's jobs. Listing VMs only reads the capacity rows.
+    """
+
     def __init__(
         self, table_location: str, on_table_missing: Literal["create", "raise"]
     ):
@@ -93,31 +169,30 @@ class AzureInstanceRegistrar(InstanceRegistrar[AzureVMInstanceState]):
             )
 
         now = datetime.datetime.utcnow().isoformat()
+        # See EC2InstanceRegistrar.register_instance for more details on the schema
+        capacity_row = TableBatchOperation(
+            "POST",  # inserts rather than replace/update
+            VM_ALLOC_TABLE_NAME,
+            {
+                "PartitionKey": public_address,
+                "RowKey": VM_CAPACITY_ROW_KEY,
+                VM_NAME: name,
+                LOGICAL_CPU_AVAILABLE: resources_available.logical_cpu,
+                MEMORY_GB_AVAILABLE: resources_available.memory_gb,
+                NUM_RUNNING_JOBS: len(running_jobs),
+                LAST_UPDATE_TIME: now,
+            },
+            _INSERT_HEADERS,
+        )
+        job_rows = [
+            _insert_job_row(public_address, job_id, allocated_resources, now)
+            for job_id, allocated_resources in running_jobs
+        ]
+
         try:
-            # See EC2InstanceRegistrar.register_instance for more details on the schema
-            # https://docs.microsoft.com/en-us/rest/api/storageservices/insert-entity
-            await azure_table_api(
-                "POST",  # inserts rather than replace/update
+            await azure_table_batch(
                 self._storage_account,
-                VM_ALLOC_TABLE_NAME,
-                json_content={
-                    "PartitionKey": SINGLE_PARTITION_KEY,
-                    "RowKey": public_address,
-                    VM_NAME: name,
-                    LOGICAL_CPU_AVAILABLE: resources_available.logical_cpu,
-                    MEMORY_GB_AVAILABLE: resources_available.memory_gb,
-                    RUNNING_JOBS: json.dumps(
-                        {
-                            job_id: {
-                                LOGICAL_CPU_ALLOCATED: allocated_resources.logical_cpu,
-                                MEMORY_GB_ALLOCATED: allocated_resources.memory_gb,
-                                ALLOCATED_TIME: now,
-                            }
-                            for job_id, allocated_resources in running_jobs
-                        }
-                    ),
-                    LAST_UPDATE_TIME: now,
-                },
+                [capacity_row] + job_rows[: TABLE_BATCH_MAX_OPERATIONS - 1],
             )
         except ResourceExistsError:
             # It's possible that an existing EC2 instance crashed unexpectedly, the
@@ -127,93 +202,167 @@ class AzureInstanceRegistrar(InstanceRegistrar[AzureVMInstanceState]):
                 f"Tried to register a VM {public_address} but it already exists,"
                 " this should never happen!"
             )
+        await self._insert_remaining_job_rows(
+            public_address, job_rows[TABLE_BATCH_MAX_OPERATIONS - 1 :], now
+        )
+
+    async def _insert_remaining_job_rows(
+        self, public_address: str, job_rows: List[TableBatchOperation], now: str
+    ) -> None:
+        """
+        When we register or allocate more jobs than fit in a single entity group
+        transaction, the first transaction updates the capacity row for all of the jobs
+        and inserts as many job rows as it can, and then we insert the rest of the job
+        rows here. Each transaction also touches the capacity row so that it fails if
+        the VM has been deregistered in the meantime, rather than leaving behind job
+        rows without a capacity row.
+        """
+        assert self._storage_account is not None
+        chunk_size = TABLE_BATCH_MAX_OPERATIONS - 1
+        for i in range(0, len(job_rows), chunk_size):
+            await azure_table_batch(
+                self._storage_account,
+                [_merge_capacity_row(public_address, {LAST_UPDATE_TIME: now}, "*")]
+                + job_rows[i : i + chunk_size],
+            )
 
-    async def get_registered_instances(self) -> List[AzureVMInstanceState]:
+    async def get_registered_instances(
+        self, resources_required: Optional[Resources] = None
+    ) -> List[AzureVMInstanceState]:
         """
-        For the AzureInstanceRegistrar, we always populate all the fields on
-        AzureVMInstanceState because we will need them in allocate_jobs_to_instance and
-        deallocate_job_from_instance
+        For the AzureInstanceRegistrar, we only read the capacity rows, so we populate
+        available_resources but not running_jobs. allocate_jobs_to_instance doesn't need
+        running_jobs, as job id collisions are detected by the insert of the job's row.
+
+        We ignore resources_required. Azure Tables can store our _AVAILABLE columns as
+        either Edm.Int32 or Edm.Double depending on the values we register, and $filter
+        comparisons don't reliably match across those types, so we don't try to filter
+        on the server.
         """
+        return await self._query_instances(None)
+
+    async def get_registered_instances_changed_since(
+        self, since: datetime.datetime
+    ) -> Optional[List[AzureVMInstanceState]]:
+        # Timestamp is maintained by the server, so unlike LAST_UPDATE_TIME it doesn't
+        # depend on the clocks of the machines that update the table. Every allocation
+        # and deallocation updates the capacity row, so its Timestamp changes whenever
+        # the VM's available resources change
+        return await self._query_instances(
+            f"Timestamp ge datetime'{since.isoformat()}Z'"
+        )
+
+    async def _query_instances(
+        self, additional_filter: Optional[str]
+    ) -> List[AzureVMInstanceState]:
         if self._storage_account is None:
             raise ValueError(
                 "Tried to use AzureInstanceRegistrar without calling __aenter__"
             )
 
+        # This scans across all of the partitions, but only the capacity rows (and only
+        # the columns we need from them) are sent back to us
+        query_filter = f"RowKey eq '{VM_CAPACITY_ROW_KEY}'"
+        if additional_filter is not None:
+            query_filter = f"{query_filter} and {additional_filter}"
+
         # https://docs.microsoft.com/en-us/rest/api/storageservices/query-entities
         return [
-            AzureVMInstanceState(
-                item["RowKey"],
-                Resources(
-                    float(item[MEMORY_GB_AVAILABLE]),
-                    int(item[LOGICAL_CPU_AVAILABLE]),
-                    {},
-                ),
-                json.loads(item[RUNNING_JOBS]),
-                item[VM_NAME],
-                item["odata.etag"],
-            )
+            _capacity_item_to_instance_state(item, None)
             async for page in azure_table_api_paged(
                 "GET",
                 self._storage_account,
                 VM_ALLOC_TABLE_NAME,
                 query_parameters={
-                    "$select": ",".join(
-                        [
-                            "RowKey",
-                            LOGICAL_CPU_AVAILABLE,
-                            MEMORY_GB_AVAILABLE,
-                            RUNNING_JOBS,
-                            VM_NAME,
-                        ]
-                    ),
+                    "$filter": query_filter,
+                    "$select": ",".join(_CAPACITY_COLUMNS),
                 },
             )
             for item in page["value"]
         ]
 
+    async def _get_capacity_row(
+        self, public_address: str
+    ) -> Optional[AzureVMInstanceState]:
+        """
+        Returns the VM with running_jobs not populated, or None if the VM is not
+        registered
+        """
+        assert self._storage_account is not None
+        try:
+            item = await azure_table_api(
+                "GET",
+                self._storage_account,
+                table_key_url(VM_ALLOC_TABLE_NAME, public_address, VM_CAPACITY_ROW_KEY),
+                query_parameters={"$select": ",".join(_CAPACITY_COLUMNS)},
+            )
+        except ResourceNotFoundError:
+            return None
+        return _capacity_item_to_instance_state(item, None)
+
+    async def get_registered_instances_by_address(
+        self, public_addresses: Sequence[str]
+    ) -> List[AzureVMInstanceState]:
+        if self._storage_account is None:
+            raise ValueError(
+                "Tried to use AzureInstanceRegistrar without calling __aenter__"
+            )
+
+        # Azure Tables doesn't have a batch get, and a $filter can only have 15
+        # comparisons, so we just get each VM's capacity row concurrently
+        return [
+            instance
+            for instance in await asyncio.gather(
+                *(
+                    self._get_capacity_row(public_address)
+                    for public_address in public_addresses
+                )
+            )
+            if instance is not None
+        ]
+
     async def get_registered_instance(
         self, public_address: str
     ) -> AzureVMInstanceState:
         """
-        For the AzureInstanceRegistrar, we always populate all the fields on
-        AzureVMInstanceState because we will need them in allocate_jobs_to_instance and
-        deallocate_job_from_instance
+        For the AzureInstanceRegistrar, we populate all the fields on
+        AzureVMInstanceState, including running_jobs from the VM's job rows
         """
         if self._storage_account is None:
             raise ValueError(
                 "Tried to use AzureInstanceRegistrar without calling __aenter__"
             )
 
-        try:
-            item = await azure_table_api(
+        # the capacity row and the job rows are all in the VM's partition
+        partition_key = public_address.replace("'", "''")
+        items = [
+            item
+            async for page in azure_table_api_paged(
                 "GET",
                 self._storage_account,
-                table_key_url(
-                    VM_ALLOC_TABLE_NAME, SINGLE_PARTITION_KEY, public_address
-                ),
-                query_parameters={
-                    "$select": ",".join(
-                        [
-                            "RowKey",
-                            LOGICAL_CPU_AVAILABLE,
-                            MEMORY_GB_AVAILABLE,
-                            RUNNING_JOBS,
-                            VM_NAME,
-                        ]
-                    )
-                },
+                VM_ALLOC_TABLE_NAME,
+                query_parameters={"$filter": f"PartitionKey eq '{partition_key}'"},
             )
-        except ResourceNotFoundError:
+            for item in page["value"]
+        ]
+
+        capacity_items = [
+            item for item in items if item["RowKey"] == VM_CAPACITY_ROW_KEY
+        ]
+        if not capacity_items:
             raise ValueError(f"VM {public_address} was not found")
 
-        return AzureVMInstanceState(
-            item["RowKey"],
-            Resources(
-                float(item[MEMORY_GB_AVAILABLE]), int(item[LOGICAL_CPU_AVAILABLE]), {}
-            ),
-            json.loads(item[RUNNING_JOBS]),
-            item[VM_NAME],
-            item["odata.etag"],
+        return _capacity_item_to_instance_state(
+            capacity_items[0],
+            {
+                item["RowKey"]: {
+                    LOGICAL_CPU_ALLOCATED: item[LOGICAL_CPU_ALLOCATED],
+                    MEMORY_GB_ALLOCATED: item[MEMORY_GB_ALLOCATED],
+                    ALLOCATED_TIME: item[ALLOCATED_TIME],
+                }
+                for item in items
+                if item["RowKey"] != VM_CAPACITY_ROW_KEY
+            },
         )
 
     async def allocate_jobs_to_instance(
@@ -232,17 +381,12 @@ class AzureInstanceRegistrar(InstanceRegistrar[AzureVMInstanceState]):
         if len(new_job_ids) == 0:
             raise ValueError("Must provide at least one new_job_ids")
 
-        new_running_jobs = instance.get_running_jobs().copy()
-        for job_id in new_job_ids:
-            if job_id in instance.get_running_jobs():
-                # TODO this should probably be an exception?
-                return False
-
-            new_running_jobs[job_id] = {
-                LOGICAL_CPU_ALLOCATED: resources_allocated_per_job.logical_cpu,
-                MEMORY_GB_ALLOCATED: resources_allocated_per_job.memory_gb,
-                ALLOCATED_TIME: now,
-            }
+        job_rows = [
+            _insert_job_row(
+                instance.public_address, job_id, resources_allocated_per_job, now
+            )
+            for job_id in new_job_ids
+        ]
 
         new_logical_cpu_available = (
             instance.get_available_resources().logical_cpu
@@ -254,27 +398,43 @@ class AzureInstanceRegistrar(InstanceRegistrar[AzureVMInstanceState]):
         )
 
         try:
-            # https://docs.microsoft.com/en-us/rest/api/storageservices/update-entity2
-            await azure_table_api(
-                "PUT",  # replace rather than merge
+            # The capacity row update covers all of the new jobs, so once this
+            # succeeds, the resources are allocated, even if there are more job rows to
+            # insert
+            await azure_table_batch(
                 self._storage_account,
-                table_key_url(
-                    VM_ALLOC_TABLE_NAME, SINGLE_PARTITION_KEY, instance.public_address
-                ),
-                json_content={
-                    VM_NAME: instance.name,
-                    LOGICAL_CPU_AVAILABLE: new_logical_cpu_available,
-                    MEMORY_GB_AVAILABLE: new_memory_gb_available,
-                    RUNNING_JOBS: json.dumps(new_running_jobs),
-                    LAST_UPDATE_TIME: now,
-                },
-                additional_headers={"If-Match": instance.etag},
+                [
+                    _merge_capacity_row(
+                        instance.public_address,
+                        {
+                            LOGICAL_CPU_AVAILABLE: new_logical_cpu_available,
+                            MEMORY_GB_AVAILABLE: new_memory_gb_available,
+                            NUM_RUNNING_JOBS: instance.num_running_jobs
+                            + len(new_job_ids),
+                            LAST_UPDATE_TIME: now,
+                        },
+                        instance.etag,
+                    )
+                ]
+                + job_rows[: TABLE_BATCH_MAX_OPERATIONS - 1],
             )
-            return True
         except ResourceModifiedError:
             # this is how the API indicates that the etag does not match, i.e. the
             # optimistic concurrency check failed
             return False
+        except ResourceExistsError:
+            # one of the job ids is already in use on this VM
+            # TODO this should probably be an exception?
+            return False
+        except ResourceNotFoundError:
+            # the VM was deregistered after we read it (instance might come from a
+            # cached view, see _get_registered_instances_cached)
+            return False
+
+        await self._insert_remaining_job_rows(
+            instance.public_address, job_rows[TABLE_BATCH_MAX_OPERATIONS - 1 :], now
+        )
+        return True
 
     async def deallocate_job_from_instance(
         self, instance: AzureVMInstanceState, job_id: str
@@ -288,38 +448,55 @@ class AzureInstanceRegistrar(InstanceRegistrar[AzureVMInstanceState]):
             return False
 
         job = instance.get_running_jobs()[job_id]
-        new_logical_cpu_available = (
-            instance.get_available_resources().logical_cpu + job[LOGICAL_CPU_ALLOCATED]
-        )
-        new_memory_gb_available = (
-            instance.get_available_resources().memory_gb + job[MEMORY_GB_ALLOCATED]
-        )
-        new_running_jobs = instance.get_running_jobs().copy()
-        del new_running_jobs[job_id]
         now = datetime.datetime.utcnow().isoformat()
+        vm: Optional[AzureVMInstanceState] = instance
+        for _ in range(_MAX_DEALLOCATE_ATTEMPTS):
+            if vm is None:
+                # the VM has been deregistered
+                return False
 
-        try:
-            # https://docs.microsoft.com/en-us/rest/api/storageservices/update-entity2
-            await azure_table_api(
-                "PUT",
-                self._storage_account,
-                table_key_url(
-                    VM_ALLOC_TABLE_NAME, SINGLE_PARTITION_KEY, instance.public_address
-                ),
-                json_content={
-                    VM_NAME: instance.name,
-                    LOGICAL_CPU_AVAILABLE: new_logical_cpu_available,
-                    MEMORY_GB_AVAILABLE: new_memory_gb_available,
-                    RUNNING_JOBS: json.dumps(new_running_jobs),
-                    LAST_UPDATE_TIME: now,
-                },
-                additional_headers={"If-Match": instance.etag},
-            )
-            return True
-        except ResourceModifiedError:
-            # this is how the API indicates that the etag does not match, i.e. the
-            # optimistic concurrency check failed
-            return False
+            try:
+                await azure_table_batch(
+                    self._storage_account,
+                    [
+                        # https://docs.microsoft.com/en-us/rest/api/storageservices/delete-entity1
+                        TableBatchOperation(
+                            "DELETE",
+                            table_key_url(
+                                VM_ALLOC_TABLE_NAME, instance.public_address, job_id
+                            ),
+                            additional_headers={"If-Match": "*"},
+                        ),
+                        _merge_capacity_row(
+                            instance.public_address,
+                            {
+                                LOGICAL_CPU_AVAILABLE: (
+                                    vm.get_available_resources().logical_cpu
+                                    + job[LOGICAL_CPU_ALLOCATED]
+                                ),
+                                MEMORY_GB_AVAILABLE: (
+                                    vm.get_available_resources().memory_gb
+                                    + job[MEMORY_GB_ALLOCATED]
+                                ),
+                                NUM_RUNNING_JOBS: vm.num_running_jobs - 1,
+                                LAST_UPDATE_TIME: now,
+                            },
+                            vm.etag,
+                        ),
+                    ],
+                )
+                return True
+            except ResourceModifiedError:
+                # Something else changed the VM's capacity row since we read it. The
+                # job row is still there, so we just need a fresh read of the capacity
+                # row
+                vm = await self._get_capacity_row(instance.public_address)
+            except ResourceNotFoundError:
+                # the job's row doesn't exist, i.e. it has already been deallocated, or
+                # the VM has been deregistered
+                return False
+
+        return False
 
     async def launch_instances(
         self, instances_spec: AllocCloudInstancesInternal
@@ -345,13 +522,12 @@ async def run_job_azure_vm_instance_registrar(
         location = get_default_location()
     pkey, public_key = await ensure_meadowrun_key_pair(location)
 
-    async with AzureInstanceRegistrar(location, "create") as instance_registrar:
-        hosts = await allocate_jobs_to_instances(
-            instance_registrar,
-            AllocCloudInstancesInternal(
-                logical_cpu_required, memory_gb_required, eviction_rate, 1, location
-            ),
-        )
+    hosts = await allocate_jobs_to_instances_batched(
+        AzureInstanceRegistrar(location, "create"),
+        AllocCloudInstancesInternal(
+            logical_cpu_required, memory_gb_required, eviction_rate, 1, location
+        ),
+    )
 
     fabric_kwargs: Dict[str, Any] = {
         "user": "meadowrunuser",
@@ -6,11 +6,13 @@ from meadowrun.azure_integration.azure_meadowrun_core import get_subscription_id
 from meadowrun.azure_integration.mgmt_functions.azure.azure_rest_api import (
     azure_rest_api_paged,
 )
+from meadowrun.config import AZURE_PRICES_UPDATE_SECS
 from meadowrun.instance_selection import (
     CloudInstanceType,
     ON_DEMAND_OR_SPOT_VALUES,
     OnDemandOrSpotType,
 )
+from meadowrun.instance_type_cache import get_cached_instance_types
 
 _RELEVANT_CAPABILITIES = {"HyperVGenerations", "vCPUsAvailable", "vCPUs", "MemoryGB"}
 
@@ -267,3 +269,13 @@ async def get_vm_types(location: str) -> List[CloudInstanceType]:
                 )
 
     return results
+
+
+async def get_cached_vm_types(location: str) -> List[CloudInstanceType]:
+    """
+    Same as get_vm_types, but uses a local cache that is refreshed every
+    AZURE_PRICES_UPDATE_SECS. See instance_type_cache.py
+    """
+    return await get_cached_instance_types(
+        f"azure-{location}", lambda: get_vm_types(location), AZURE_PRICES_UPDATE_SECS
+    )
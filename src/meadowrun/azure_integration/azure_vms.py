@@ -9,7 +9,7 @@ from meadowrun.azure_integration.azure_meadowrun_core import (
     ensure_meadowrun_resource_group,
     get_default_location,
 )
-from meadowrun.azure_integration.azure_vm_pricing import get_vm_types
+from meadowrun.azure_integration.azure_vm_pricing import get_cached_vm_types
 from meadowrun.azure_integration.mgmt_functions.azure.azure_exceptions import (
     ResourceNotFoundError,
 )
@@ -29,6 +29,9 @@ _MEADOWRUN_VIRTUAL_NETWORK_NAME = "Meadowrun-vnet"
 _MEADOWRUN_SUBNET_NAME = "Meadowrun-subnet"
 _MEADOWRUN_USERNAME = "meadowrunuser"
 
+# The maximum number of VMs that launch_vms will provision concurrently
+_MAX_CONCURRENT_VM_PROVISIONS = 10
+
 
 # To get this ID, first create an image by manually running the equivalent of
 # build_ami.py in Azure. (TODO should write a script for this.) This requires creating a
@@ -174,6 +177,8 @@ async def _provision_vm(
     vm_size: str,
     on_demand_or_spot: OnDemandOrSpotType,
     ssh_public_key_data: str,
+    resource_group_path: str,
+    meadowrun_identity_id: str,
 ) -> Tuple[str, str]:
     """
     Based on
@@ -185,10 +190,10 @@ async def _provision_vm(
     ~/.ssh/authorized_keys, e.g. "ssh-rsa: ...". Azure does seem to have a feature for
     storing SSH public keys for reuse, but there doesn't seem to be a way to reference
     them from the VM API.
-    """
 
-    resource_group_path = await ensure_meadowrun_resource_group(location)
-    meadowrun_identity_id, _ = await _ensure_managed_identity(location)
+    resource_group_path and meadowrun_identity_id should come from
+    ensure_meadowrun_resource_group and _ensure_managed_identity respectively.
+    """
 
     vm_name = str(uuid.uuid4())
 
@@ -310,7 +315,7 @@ async def launch_vms(
         Resources(memory_gb_required_per_job, logical_cpu_required_per_job, {}),
         num_jobs,
         eviction_rate,
-        await get_vm_types(location),
+        await get_cached_vm_types(location),
     )
     if len(chosen_instance_types) < 1:
         raise ValueError(
@@ -318,17 +323,38 @@ async def launch_vms(
             f"memory={memory_gb_required_per_job}, cpu={logical_cpu_required_per_job}"
         )
 
+    # these are the same for every VM, so there's no need to check them for each VM
+    resource_group_path = await ensure_meadowrun_resource_group(location)
+    meadowrun_identity_id, _ = await _ensure_managed_identity(location)
+
+    # Provisioning a VM means creating a public IP address, a NIC, and the VM itself,
+    # and then polling for all of those to complete. If we do this for too many VMs at
+    # once we'll get throttled by the Azure APIs, so we limit how many VMs we provision
+    # at the same time.
+    semaphore = asyncio.Semaphore(_MAX_CONCURRENT_VM_PROVISIONS)
+
+    async def provision_vm_bounded(
+        vm_size: str, on_demand_or_spot: OnDemandOrSpotType
+    ) -> Tuple[str, str]:
+        async with semaphore:
+            return await _provision_vm(
+                location,
+                vm_size,
+                on_demand_or_spot,
+                ssh_public_key_data,
+                resource_group_path,
+                meadowrun_identity_id,
+            )
+
     vm_detail_tasks = []
     chosen_instance_types_repeated = []
 
     for instance_type in chosen_instance_types:
         for _ in range(instance_type.num_instances):
             vm_detail_tasks.append(
-                _provision_vm(
-                    location,
+                provision_vm_bounded(
                     instance_type.instance_type.name,
                     instance_type.instance_type.on_demand_or_spot,
-                    ssh_public_key_data,
                 )
             )
             chosen_instance_types_repeated.append(instance_type)
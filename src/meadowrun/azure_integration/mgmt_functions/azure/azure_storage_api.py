@@ -3,13 +3,23 @@ import dataclasses
 import datetime
 import hashlib
 import hmac
+import json
+import uuid
 import xml.dom.minidom
-from typing import Optional, Dict, Any, Sequence, AsyncIterator
+from typing import Optional, Dict, Any, Sequence, AsyncIterator, List, Tuple
 
 import aiohttp
 import multidict
 
-from .azure_exceptions import raise_for_status
+from .azure_exceptions import (
+    AzureRestApiError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+    _exception_type_from_code,
+    _get_code_and_message_from_json,
+    raise_for_status,
+)
 from .azure_rest_api import _return_response_json
 
 
@@ -155,6 +165,185 @@ async def azure_table_api_paged(
             page_parameters = _get_page_parameters(response.headers)
 
 
+# An entity group transaction can have at most 100 operations
+TABLE_BATCH_MAX_OPERATIONS = 100
+
+
+@dataclasses.dataclass(frozen=True)
+class TableBatchOperation:
+    """
+    One operation in an azure_table_batch. method, url_path, json_content, and
+    additional_headers are the same as what we would pass to azure_table_api for the
+    equivalent single request, e.g. ("MERGE", table_key_url(...), {...},
+    {"If-Match": etag}).
+    """
+
+    method: str
+    url_path: str
+    json_content: Any = None
+    additional_headers: Optional[Dict[str, str]] = None
+
+
+def _get_table_batch_body(
+    storage_account: StorageAccount,
+    operations: Sequence[TableBatchOperation],
+    batch_boundary: str,
+    changeset_boundary: str,
+) -> str:
+    lines = [
+        f"--{batch_boundary}",
+        f"Content-Type: multipart/mixed; boundary={changeset_boundary}",
+        "",
+    ]
+    for i, operation in enumerate(operations):
+        lines.extend(
+            [
+                f"--{changeset_boundary}",
+                "Content-Type: application/http",
+                "Content-Transfer-Encoding: binary",
+                "",
+                f"{operation.method} https://{storage_account.name}.table.core.windows."
+                f"net/{operation.url_path} HTTP/1.1",
+                f"Content-ID: {i + 1}",
+                "Accept: application/json;odata=minimalmetadata",
+                "DataServiceVersion: 3.0",
+            ]
+        )
+        if operation.additional_headers:
+            lines.extend(
+                f"{key}: {value}" for key, value in operation.additional_headers.items()
+            )
+        if operation.json_content is not None:
+            lines.extend(
+                [
+                    "Content-Type: application/json",
+                    "",
+                    json.dumps(operation.json_content),
+                ]
+            )
+        else:
+            lines.append("")
+    lines.extend([f"--{changeset_boundary}--", f"--{batch_boundary}--", ""])
+    return "\r\n".join(lines)
+
+
+def _parse_table_batch_response(
+    response_text: str,
+) -> List[Tuple[int, Dict[str, str], str]]:
+    """
+    Returns (status, headers, body) for each response in the body of a $batch response.
+    Header names are lowercased.
+
+    The body is a multipart/mixed document, but rather than fully parsing it, we just
+    look for the HTTP status lines of the responses to the individual operations, which
+    are followed by their headers, a blank line, and their body
+    """
+    results = []
+    lines = response_text.splitlines()
+    i = 0
+    while i < len(lines):
+        if not lines[i].startswith("HTTP/1.1 "):
+            i += 1
+            continue
+
+        status = int(lines[i].split(" ")[1])
+        i += 1
+        headers = {}
+        while i < len(lines) and lines[i]:
+            key, _, value = lines[i].partition(":")
+            headers[key.strip().lower()] = value.strip()
+            i += 1
+        body_lines = []
+        while i < len(lines) and not lines[i].startswith("--"):
+            body_lines.append(lines[i])
+            i += 1
+        results.append((status, headers, "\n".join(body_lines).strip()))
+
+    return results
+
+
+# we use these if _exception_type_from_code doesn't recognize the error code in the
+# response
+_TABLE_BATCH_STATUS_EXCEPTIONS = {
+    404: ResourceNotFoundError,
+    409: ResourceExistsError,
+    412: ResourceModifiedError,
+}
+
+
+def _get_table_batch_results(
+    response_text: str, num_operations: int
+) -> List[Optional[str]]:
+    """See azure_table_batch"""
+    responses = _parse_table_batch_response(response_text)
+
+    # If any operation fails, the response only contains the response for that
+    # operation
+    for status, headers, body in responses:
+        if status >= 400:
+            code, message = None, None
+            try:
+                code, message = _get_code_and_message_from_json(json.loads(body))
+            except Exception:
+                pass
+            exception_type = _exception_type_from_code(code)
+            if exception_type is AzureRestApiError:
+                exception_type = _TABLE_BATCH_STATUS_EXCEPTIONS.get(
+                    status, AzureRestApiError
+                )
+            raise exception_type(status, code, message if message else body)
+
+    if len(responses) != num_operations:
+        raise ValueError(
+            f"Expected {num_operations} responses from $batch but got {len(responses)}:"
+            f" {response_text}"
+        )
+
+    return [headers.get("etag") for _, headers, _ in responses]
+
+
+async def azure_table_batch(
+    storage_account: StorageAccount, operations: Sequence[TableBatchOperation]
+) -> List[Optional[str]]:
+    """
+    Runs operations as an entity group transaction, i.e. either all of the operations
+    succeed or none of them do. All of the operations must be on entities in the same
+    table and partition, there can be at most TABLE_BATCH_MAX_OPERATIONS of them, and
+    each entity can only be in one operation. Inserts should include a "Prefer:
+    return-no-content" header.
+
+    If any of the operations fail, raises the same exception that azure_table_api would
+    have raised for that operation, e.g. ResourceModifiedError if an If-Match condition
+    failed. Otherwise, returns the new etag of each entity (None for deletes).
+
+    https://docs.microsoft.com/en-us/rest/api/storageservices/performing-entity-group-transactions
+    """
+    if len(operations) == 0:
+        return []
+    if len(operations) > TABLE_BATCH_MAX_OPERATIONS:
+        raise ValueError(
+            f"An entity group transaction can have at most {TABLE_BATCH_MAX_OPERATIONS}"
+            f" operations, but {len(operations)} were requested"
+        )
+
+    batch_boundary = f"batch_{uuid.uuid4()}"
+    changeset_boundary = f"changeset_{uuid.uuid4()}"
+    url_path = "$batch"
+    headers = _get_default_table_api_headers(storage_account, url_path)
+    headers["Content-Type"] = f"multipart/mixed; boundary={batch_boundary}"
+    headers["MaxDataServiceVersion"] = "3.0;NetFx"
+    async with aiohttp.request(
+        "POST",
+        f"https://{storage_account.name}.table.core.windows.net/{url_path}",
+        headers=headers,
+        data=_get_table_batch_body(
+            storage_account, operations, batch_boundary, changeset_boundary
+        ).encode("utf-8"),
+    ) as response:
+        await raise_for_status(response)
+        return _get_table_batch_results(await response.text(), len(operations))
+
+
 def _replace_linear_whitespace(s: str) -> str:
     return s.replace("\n", " ").replace("\r", " ").replace("\t", " ")
 
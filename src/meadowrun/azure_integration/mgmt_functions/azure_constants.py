@@ -29,9 +29,13 @@ LOGICAL_CPU_ALLOCATED = "logical_cpu_allocated"
 LOGICAL_CPU_AVAILABLE = "logical_cpu_available"
 MEMORY_GB_ALLOCATED = "memory_gb_allocated"
 MEMORY_GB_AVAILABLE = "memory_gb_available"
-RUNNING_JOBS = "running_jobs"
-SINGLE_PARTITION_KEY = "_"
+NUM_RUNNING_JOBS = "num_running_jobs"
 VM_NAME = "vm_name"
+# In VM_ALLOC_TABLE_NAME, each VM has its own partition, i.e. the PartitionKey is the
+# VM's public address. The row with this RowKey has the VM's available resources and
+# the number of jobs running on it, and each job running on the VM has its own row with
+# the job id as the RowKey. Job ids are UUIDs, so they can't collide with this.
+VM_CAPACITY_ROW_KEY = "_capacity"
 
 
 MEADOWRUN_STORAGE_ACCOUNT_VARIABLE = "MEADOWRUN_STORAGE_ACCOUNT"
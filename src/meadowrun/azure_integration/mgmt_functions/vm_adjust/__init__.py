@@ -7,11 +7,10 @@ uploaded to the Azure function). We use relative imports which will work both in
 import asyncio
 import dataclasses
 import datetime
-import json
 import logging
 from typing import Optional, Sequence, List
 
-from ..azure.azure_exceptions import ResourceModifiedError
+from ..azure.azure_exceptions import ResourceModifiedError, ResourceNotFoundError
 from ..azure.azure_rest_api import (
     azure_rest_api_paged,
     azure_rest_api_poll,
@@ -19,16 +18,19 @@ from ..azure.azure_rest_api import (
     wait_for_poll,
 )
 from ..azure.azure_storage_api import (
+    TABLE_BATCH_MAX_OPERATIONS,
     StorageAccount,
+    TableBatchOperation,
     azure_table_api,
     azure_table_api_paged,
+    azure_table_batch,
     table_key_url,
 )
 from ..azure_constants import (
     LAST_UPDATE_TIME,
-    RUNNING_JOBS,
-    SINGLE_PARTITION_KEY,
+    NUM_RUNNING_JOBS,
     VM_ALLOC_TABLE_NAME,
+    VM_CAPACITY_ROW_KEY,
     VM_NAME,
 )
 from ..mgmt_functions_shared import get_resource_group_path, get_storage_account
@@ -60,12 +62,15 @@ class ExistingVM:
 async def _get_registered_vms(
     storage_account: StorageAccount,
 ) -> Sequence[RegisteredVM]:
-    """Gets instances registered by AzureInstanceRegistrars"""
+    """
+    Gets instances registered by AzureInstanceRegistrars. We only need to read the
+    capacity rows (see VM_CAPACITY_ROW_KEY), not the rows for each job.
+    """
     return [
         RegisteredVM(
-            item["RowKey"],
+            item["PartitionKey"],
             datetime.datetime.fromisoformat(item[LAST_UPDATE_TIME]),
-            len(json.loads(item[RUNNING_JOBS])),
+            int(item[NUM_RUNNING_JOBS]),
             item[VM_NAME],
             item["odata.etag"],
         )
@@ -74,7 +79,10 @@ async def _get_registered_vms(
             storage_account,
             VM_ALLOC_TABLE_NAME,
             query_parameters={
-                "$select": ",".join(["RowKey", RUNNING_JOBS, LAST_UPDATE_TIME, VM_NAME])
+                "$filter": f"RowKey eq '{VM_CAPACITY_ROW_KEY}'",
+                "$select": ",".join(
+                    ["PartitionKey", NUM_RUNNING_JOBS, LAST_UPDATE_TIME, VM_NAME]
+                ),
             },
         )
         for item in page["value"]
@@ -86,25 +94,74 @@ async def _deregister_vm(
 ) -> bool:
     """
     Deregisters a VM. If etag is None, deregisters unconditionally. If etag is provided,
-    only deregisters if the etag matches. Returns False if the etag does not match (i.e.
-    optimistic concurrency check failed). Returns True if successful.
+    only deregisters if the etag of the VM's capacity row matches. Returns False if the
+    etag does not match (i.e. optimistic concurrency check failed). Returns True if
+    successful.
     """
     if etag is not None:
-        if_match = etag
-    else:
-        if_match = "*"
+        # Every allocation and deallocation updates the capacity row, so if the etag
+        # matches, nothing has been allocated since the caller read the capacity row.
+        # The caller should only do this if NUM_RUNNING_JOBS was 0, in which case there
+        # aren't any job rows to delete.
+        try:
+            await azure_table_api(
+                "DELETE",
+                storage_account,
+                table_key_url(VM_ALLOC_TABLE_NAME, public_address, VM_CAPACITY_ROW_KEY),
+                additional_headers={"If-Match": etag},
+            )
+            return True
+        except ResourceModifiedError:
+            # this is how the API indicates that the etag does not match
+            return False
 
+    # Delete the capacity row first, which means any allocations/deallocations that
+    # happen from now on will fail, and then delete the job rows
     try:
         await azure_table_api(
             "DELETE",
             storage_account,
-            table_key_url(VM_ALLOC_TABLE_NAME, SINGLE_PARTITION_KEY, public_address),
-            additional_headers={"If-Match": if_match},
+            table_key_url(VM_ALLOC_TABLE_NAME, public_address, VM_CAPACITY_ROW_KEY),
+            additional_headers={"If-Match": "*"},
         )
-        return True
-    except ResourceModifiedError:
-        # this is how the API indicates that the etag does not match
-        return False
+    except ResourceNotFoundError:
+        pass
+
+    partition_key = public_address.replace("'", "''")
+    while True:
+        job_row_keys = [
+            item["RowKey"]
+            async for page in azure_table_api_paged(
+                "GET",
+                storage_account,
+                VM_ALLOC_TABLE_NAME,
+                query_parameters={
+                    "$filter": f"PartitionKey eq '{partition_key}'",
+                    "$select": "RowKey",
+                },
+            )
+            for item in page["value"]
+        ]
+        if not job_row_keys:
+            return True
+
+        for i in range(0, len(job_row_keys), TABLE_BATCH_MAX_OPERATIONS):
+            try:
+                await azure_table_batch(
+                    storage_account,
+                    [
+                        TableBatchOperation(
+                            "DELETE",
+                            table_key_url(VM_ALLOC_TABLE_NAME, public_address, row_key),
+                            additional_headers={"If-Match": "*"},
+                        )
+                        for row_key in job_row_keys[i : i + TABLE_BATCH_MAX_OPERATIONS]
+                    ],
+                )
+            except ResourceNotFoundError:
+                # a job row was deleted after we read it, we'll pick up any remaining
+                # rows on the next query
+                pass
 
 
 async def _get_all_vms(resource_group_path: str) -> Sequence[ExistingVM]:
@@ -1,7 +1,10 @@
 import asyncio
 import json
 import os
-from typing import List, Optional, Tuple
+import shutil
+from typing import Dict, List, Optional, Set, Tuple
+
+import filelock
 
 
 class CondaMissingException(Exception):
@@ -10,8 +13,13 @@ class CondaMissingException(Exception):
     pass
 
 
-async def _run(args: List[str]) -> Tuple[str, str]:
-    """Runs a conda command in an external process. Returns stdout, stderr."""
+async def _run(
+    args: List[str], env_overrides: Optional[Dict[str, str]] = None
+) -> Tuple[str, str]:
+    """
+    Runs a conda command in an external process. Returns stdout, stderr. env_overrides
+    will be added to the current process' environment variables.
+    """
 
     if "CONDA_EXE" not in os.environ:
         raise CondaMissingException(
@@ -20,6 +28,8 @@ async def _run(args: List[str]) -> Tuple[str, str]:
 
     conda = os.environ["CONDA_EXE"]
     env = os.environ.copy()
+    if env_overrides:
+        env.update(env_overrides)
 
     p = await asyncio.create_subprocess_exec(
         conda,
@@ -41,12 +51,31 @@ async def _run(args: List[str]) -> Tuple[str, str]:
     return stdout.decode(), stderr.decode()
 
 
-async def env_export(name_or_path: Optional[str] = None) -> str:
+# The line that marks a spec as an explicit list of package URLs, as generated by
+# `conda list --explicit`
+EXPLICIT_SPEC_MARKER = "@EXPLICIT"
+
+
+def is_explicit_spec(spec: str) -> bool:
+    """
+    Returns True if spec is an explicit spec (see `conda list --explicit`) rather than
+    an environment.yml file. Explicit specs can be installed without running the
+    solver.
+    """
+    return any(line.strip() == EXPLICIT_SPEC_MARKER for line in spec.splitlines())
+
+
+async def env_export(name_or_path: Optional[str] = None, explicit: bool = False) -> str:
     """Runs `conda env export` on the conda environment with the given name, and returns the
     results.
 
     :param name: name or full path to the conda environment - if None, tries to use the
         currently activated conda environment.
+    :param explicit: if True, returns an explicit spec from `conda list --explicit`
+        instead, which lists the exact URL and md5 of every package, so that the
+        environment can be recreated without solving. Explicit specs can't include pip
+        packages, so if the environment has any pip packages, we fall back to
+        `conda env export`.
     :return: Output of the conda env export command.
     """
     if name_or_path is None:
@@ -81,7 +110,240 @@ async def env_export(name_or_path: Optional[str] = None) -> str:
                 else:
                     raise ValueError(f"Conda environment {name_or_path} not found.")
 
+    if explicit:
+        out, _ = await _run(["list", "--json", "-p", env_path])
+        if any(package.get("channel") == "pypi" for package in json.loads(out)):
+            print(
+                f"Conda environment {env_path} has pip packages, so it can't be "
+                "exported as an explicit spec. Using conda env export instead."
+            )
+        else:
+            out, _ = await _run(["list", "--explicit", "--md5", "-p", env_path])
+            return out
+
     # TODO: see https://github.com/conda/conda/issues/5253
-    # there is also conda list --explicit/--export
     out, _ = await _run(["env", "export", "-p", env_path])
     return out
+
+
+# Written into a cached environment once it has been created successfully
+_ENVIRONMENT_COMPLETE_MARKER = ".meadowrun_complete"
+_ENVIRONMENT_LOCK_TIMEOUT_SECS = 30 * 60
+# The full spec hash makes for a very long path, and conda environments don't work with
+# very long prefixes
+_ENVIRONMENT_NAME_LENGTH = 32
+
+
+async def get_cached_environment(
+    path_to_spec: str, spec_hash: str, environments_folder: str
+) -> str:
+    """
+    Creates a conda environment from the environment.yml file or explicit spec (see
+    is_explicit_spec) at path_to_spec in environments_folder, unless we've already
+    created an environment with the same spec_hash, and returns the path to the
+    environment's python interpreter.
+
+    This is an alternative to turning the spec into a container (see
+    deployment_manager.compile_environment_spec_to_container). All environments share
+    a package cache in environments_folder, and conda hard links files from the package
+    cache into each environment, so additional environments with similar packages are
+    cheap.
+
+    Conda environments can't be moved after they've been created, so we create them in
+    place, holding a lock, and mark them as complete at the end. An environment that
+    exists but isn't marked as complete must be left over from a failed attempt, and
+    gets recreated.
+    """
+    prefix = os.path.join(environments_folder, spec_hash[:_ENVIRONMENT_NAME_LENGTH])
+    if os.name == "nt":
+        interpreter_path = os.path.join(prefix, "python.exe")
+    else:
+        interpreter_path = os.path.join(prefix, "bin", "python")
+    marker_path = os.path.join(prefix, _ENVIRONMENT_COMPLETE_MARKER)
+
+    if os.path.exists(marker_path):
+        return interpreter_path
+
+    with filelock.FileLock(f"{prefix}.lock", _ENVIRONMENT_LOCK_TIMEOUT_SECS):
+        # another process might have created the environment while we were waiting
+        if os.path.exists(marker_path):
+            return interpreter_path
+
+        shutil.rmtree(prefix, ignore_errors=True)
+        with open(path_to_spec, "r", encoding="utf-8") as f:
+            spec = f.read()
+        env_overrides = {"CONDA_PKGS_DIRS": os.path.join(environments_folder, "pkgs")}
+
+        if is_explicit_spec(spec):
+            packages = set(get_explicit_packages(spec))
+            if not await _create_environment_incrementally(
+                environments_folder, prefix, packages, env_overrides
+            ):
+                print(f"Creating conda environment {prefix}")
+                # installs exactly the listed packages without solving
+                await _run(
+                    ["create", "--quiet", "--yes", "--file", path_to_spec]
+                    + ["--prefix", prefix],
+                    env_overrides,
+                )
+            # record the packages so that future environments can be created from this
+            # one, see _create_environment_incrementally
+            marker_contents = "\n".join(sorted(packages))
+        else:
+            print(f"Creating conda environment {prefix}")
+            await _run(
+                ["env", "create", "--quiet", "--file", path_to_spec]
+                + ["--prefix", prefix],
+                env_overrides,
+            )
+            marker_contents = ""
+
+        with open(marker_path, "w", encoding="utf-8") as f:
+            f.write(marker_contents)
+
+    return interpreter_path
+
+
+def get_explicit_packages(spec: str) -> List[str]:
+    """
+    Returns the package URLs (possibly with #md5 suffixes) in an explicit spec (see
+    is_explicit_spec) in the order they appear in the spec
+    """
+    lines = [line.strip() for line in spec.splitlines()]
+    start = lines.index(EXPLICIT_SPEC_MARKER) + 1
+    return [line for line in lines[start:] if line and not line.startswith("#")]
+
+
+# When we build a docker image for an explicit spec, we install these packages and
+# everything they depend on in a separate base layer, so that images for different
+# environments that share e.g. the same python and numpy can share that layer.
+_BASE_LAYER_PACKAGES = {"python", "numpy", "scipy", "pandas"}
+
+
+def split_explicit_spec(spec: str) -> Tuple[List[str], List[str]]:
+    """
+    Splits the packages in an explicit spec into (base packages, remaining packages)
+    where base packages can be installed first on their own, see _BASE_LAYER_PACKAGES.
+    conda list --explicit lists packages in dependency order, so base packages is
+    everything up to and including the last package in _BASE_LAYER_PACKAGES. Returns
+    an empty list for base packages if there aren't any _BASE_LAYER_PACKAGES.
+
+    TODO this means that the base layer will also include any packages that happen to
+    be listed before the last base layer package, even if they aren't dependencies of
+    any base layer package, which makes it less likely that the base layer can be
+    shared.
+    """
+    packages = get_explicit_packages(spec)
+    split = 0
+    for i, package in enumerate(packages):
+        if _get_package_name(package) in _BASE_LAYER_PACKAGES:
+            split = i + 1
+    return packages[:split], packages[split:]
+
+
+def _get_package_name(package_url: str) -> str:
+    """
+    Package files are named like <name>-<version>-<build>.tar.bz2 (or .conda), e.g.
+    https://conda.anaconda.org/conda-forge/linux-64/python-3.9.13-h2660328_0.tar.bz2
+    """
+    file_name = package_url.split("#", 1)[0].rsplit("/", 1)[-1]
+    return file_name.rsplit("-", 2)[0]
+
+
+# We only create environments incrementally if the nearest environment needs fewer than
+# this fraction of the new environment's packages to be changed. Otherwise, it's
+# probably simpler to create the environment from scratch.
+_MAX_INCREMENTAL_CHANGES_FRACTION = 0.5
+
+
+def _find_nearest_environment(
+    environments_folder: str, packages: Set[str]
+) -> Optional[Tuple[str, Set[str]]]:
+    """
+    Returns the prefix and packages of the completed environment created from an
+    explicit spec in environments_folder that requires the fewest package changes to
+    get to packages
+    """
+    result = None
+    min_changes = len(packages) * _MAX_INCREMENTAL_CHANGES_FRACTION
+    for name in os.listdir(environments_folder):
+        marker_path = os.path.join(
+            environments_folder, name, _ENVIRONMENT_COMPLETE_MARKER
+        )
+        try:
+            with open(marker_path, "r", encoding="utf-8") as f:
+                existing_packages = set(f.read().split())
+        except OSError:
+            continue
+        if not existing_packages:
+            # not created from an explicit spec
+            continue
+        changes = len(packages.symmetric_difference(existing_packages))
+        if changes < min_changes:
+            result = os.path.join(environments_folder, name), existing_packages
+            min_changes = changes
+    return result
+
+
+async def _create_environment_incrementally(
+    environments_folder: str,
+    prefix: str,
+    packages: Set[str],
+    env_overrides: Dict[str, str],
+) -> bool:
+    """
+    Tries to create an environment at prefix with exactly packages (a set of package
+    URLs) by cloning the nearest existing environment and then removing/installing just
+    the packages that are different. Like creating an environment from an explicit
+    spec, this never runs the solver. Returns False if there's no environment that's
+    close enough or if something goes wrong, in which case the caller should create the
+    environment from scratch.
+    """
+    nearest = _find_nearest_environment(environments_folder, packages)
+    if nearest is None:
+        return False
+    nearest_prefix, nearest_packages = nearest
+
+    to_install = packages - nearest_packages
+    # We remove every package that's changing, including packages that are just
+    # changing versions, so that we don't depend on conda replacing the old versions
+    to_remove = (
+        {_get_package_name(package) for package in nearest_packages - packages}
+        .union(_get_package_name(package) for package in to_install)
+        .intersection(_get_package_name(package) for package in nearest_packages)
+    )
+
+    print(
+        f"Creating conda environment {prefix} from {nearest_prefix}: removing "
+        f"{len(to_remove)} and installing {len(to_install)} packages"
+    )
+    try:
+        await _run(
+            ["create", "--quiet", "--yes", "--offline", "--clone", nearest_prefix]
+            + ["--prefix", prefix],
+            env_overrides,
+        )
+        if to_remove:
+            # --force removes just these packages without touching their dependencies
+            await _run(
+                ["remove", "--quiet", "--yes", "--force", "--prefix", prefix]
+                + sorted(to_remove),
+                env_overrides,
+            )
+        if to_install:
+            spec_path = f"{prefix}.explicit.txt"
+            with open(spec_path, "w", encoding="utf-8") as f:
+                f.write("\n".join([EXPLICIT_SPEC_MARKER, *sorted(to_install)]))
+            try:
+                await _run(
+                    ["install", "--quiet", "--yes", "--file", spec_path]
+                    + ["--prefix", prefix],
+                    env_overrides,
+                )
+            finally:
+                os.remove(spec_path)
+        return True
+    except ValueError as e:
+        print(f"Unable to create {prefix} incrementally, creating from scratch: {e}")
+        shutil.rmtree(prefix, ignore_errors=True)
+        return False
@@ -26,6 +26,31 @@ DEFAULT_PRIORITY = 100
 DEFAULT_INTERRUPTION_PROBABILITY_THRESHOLD = 15
 
 
+# Set this environment variable on the machine that runs jobs (i.e. where
+# run_job_local.run_local runs) to "native" to run jobs that specify a conda environment
+# in a conda environment created on that machine, rather than in a container. See
+# deployment_manager.compile_environment_spec_to_interpreter
+MEADOWRUN_CONDA_ENVIRONMENTS = "MEADOWRUN_CONDA_ENVIRONMENTS"
+CONDA_ENVIRONMENTS_NATIVE = "native"
+
+# Set this environment variable on the machine that runs jobs to a number of seconds to
+# run containerized jobs in long-lived "warm" containers with docker exec rather than
+# starting a new container for each job. Warm containers are removed after they've been
+# idle for this many seconds. See docker_controller.get_warm_container
+MEADOWRUN_WARM_CONTAINER_IDLE_TIMEOUT_SECS = (
+    "MEADOWRUN_WARM_CONTAINER_IDLE_TIMEOUT_SECS"
+)
+
+# Set this environment variable on the machine that runs jobs to "gzip" to compress job
+# log files. The log file names will end in .gz
+MEADOWRUN_LOG_COMPRESSION = "MEADOWRUN_LOG_COMPRESSION"
+LOG_COMPRESSION_GZIP = "gzip"
+# Set this environment variable on the machine that runs jobs to limit how many bytes
+# per second of job output get mirrored to stdout. The log files always get all of the
+# output. See log_pump.LogPump
+MEADOWRUN_LOG_CONSOLE_MAX_BYTES_PER_SEC = "MEADOWRUN_LOG_CONSOLE_MAX_BYTES_PER_SEC"
+
+
 # names of environment variables to communicate with the child process
 
 # Will be set in child processes launched by an agent, gives the pid of the agent that
@@ -35,3 +60,31 @@ MEADOWRUN_AGENT_PID = "MEADOWRUN_AGENT_PID"
 
 # specifies how often EC2 prices should get updated
 EC2_PRICES_UPDATE_SECS = 60 * 30  # 30 minutes
+# specifies how often Azure prices should get updated. Our Azure pricing data is
+# precompiled and doesn't change very often
+AZURE_PRICES_UPDATE_SECS = 60 * 60 * 6  # 6 hours
+# If cached prices are older than *_PRICES_UPDATE_SECS but younger than this, we'll use
+# the cached prices while we refresh them in the background. Otherwise we will wait for
+# new prices. See instance_type_cache.py
+INSTANCE_TYPES_MAX_STALE_SECS = 60 * 60 * 24  # 1 day
+# how long to wait for another process that is refreshing cached prices
+INSTANCE_TYPES_CACHE_LOCK_TIMEOUT_SECS = 5 * 60
+
+# Clients keep a cached view of the instances registered in an InstanceRegistrar and
+# usually just ask for the instances that have changed since the last time they looked.
+# This specifies how often to re-read all of the registered instances regardless. See
+# instance_allocation._get_registered_instances_cached
+REGISTERED_INSTANCES_FULL_REFRESH_SECS = 60
+
+# Requests to allocate jobs to instances that come in within this many seconds of each
+# other (e.g. from many concurrent run_function calls) are combined into a single
+# allocation. See instance_allocation.allocate_jobs_to_instances_batched
+ALLOCATION_BATCH_WINDOW_SECS = 0.05
+
+# how long to cache credentials that don't have an expiration time (e.g. secrets from
+# AWS Secrets Manager). This is also how long it can take for a rotated secret to be
+# picked up. See credentials.get_cached_credentials
+CREDENTIALS_CACHE_SECS = 5 * 60  # 5 minutes
+# cached credentials that will expire within this many seconds get refreshed in the
+# background
+CREDENTIALS_REFRESH_AHEAD_SECS = 60
@@ -19,28 +19,43 @@ IAM role is used to restrict access to an AWS secret, then this is not good beca
 job then gets full access to that AWS secret.
 
 TODO actually encrypt the credentials as we send them over?
+
+Getting credentials from a source usually requires a network round trip (and e.g. AWS
+Secrets Manager will throttle us if every job on a busy machine does this), so we cache
+credentials on each machine, see get_cached_credentials.
 """
 from __future__ import annotations
 
 import abc
+import asyncio
 import dataclasses
+import hashlib
 import json
-from typing import Union, Optional, Dict, List, Tuple
+import os
+import time
+import traceback
+from typing import Awaitable, Callable, Union, Optional, Dict, List, Tuple
 
-import boto3
+import filelock
 from typing_extensions import Literal
 
 import meadowrun.docker_controller
-from meadowrun.aws_integration.aws_core import _get_default_region_name
+from meadowrun.aws_integration.aws_core import (
+    _get_boto3_client,
+    _get_default_region_name,
+    _run_boto3,
+)
 from meadowrun.azure_integration.mgmt_functions.azure.azure_rest_api import (
     azure_rest_api,
 )
+from meadowrun.config import CREDENTIALS_CACHE_SECS, CREDENTIALS_REFRESH_AHEAD_SECS
 from meadowrun.meadowrun_pb2 import (
     AwsSecret,
     AzureSecret,
     Credentials,
     ServerAvailableFile,
 )
+from meadowrun.shared import get_default_cache_folder
 
 # Represents a way to get credentials
 CredentialsSource = Union[AwsSecret, AzureSecret, ServerAvailableFile]
@@ -88,14 +103,15 @@ class SshKey(RawCredentials):
 
 async def _get_credentials_from_source(source: CredentialsSource) -> RawCredentials:
     if isinstance(source, AwsSecret):
-        # TODO not sure if it's better to try to reuse a client/session or just create a
-        #  new one each time? This seems related:
-        #  https://github.com/boto/botocore/issues/619
         secret = json.loads(
-            boto3.client(
-                service_name="secretsmanager",
-                region_name=await _get_default_region_name(),
-            ).get_secret_value(SecretId=source.secret_name)["SecretString"]
+            (
+                await _run_boto3(
+                    _get_boto3_client(
+                        "secretsmanager", await _get_default_region_name()
+                    ).get_secret_value,
+                    SecretId=source.secret_name,
+                )
+            )["SecretString"]
         )
         if source.credentials_type == Credentials.Type.USERNAME_PASSWORD:
             return UsernamePassword(secret["username"], secret["password"])
@@ -141,6 +157,210 @@ async def _get_credentials_from_source(source: CredentialsSource) -> RawCredenti
         raise ValueError(f"Unknown type of credentials source {type(source)}")
 
 
+# increment this if the format of the cache files changes
+_CACHE_FORMAT_VERSION = 1
+_LOCK_POLL_INTERVAL_SECS = 0.1
+
+
+@dataclasses.dataclass(frozen=True)
+class _CachedCredentials:
+    # as returned by time.time()
+    expires_at: float
+    credentials: RawCredentials
+
+
+# Maps from cache file path to the credentials we've most recently read from or written
+# to that file, so that we don't need to read the file every time
+_CACHED_CREDENTIALS: Dict[str, _CachedCredentials] = {}
+# Maps from cache file path to the task that is currently refreshing it. Makes sure that
+# only one coroutine in this process at a time refreshes a particular set of credentials
+_REFRESHES: Dict[str, asyncio.Task[_CachedCredentials]] = {}
+
+
+def _credentials_to_json(credentials: RawCredentials) -> Dict[str, str]:
+    if isinstance(credentials, UsernamePassword):
+        return {
+            "type": "username_password",
+            "username": credentials.username,
+            "password": credentials.password,
+        }
+    elif isinstance(credentials, SshKey):
+        return {"type": "ssh_key", "private_key": credentials.private_key}
+    else:
+        raise ValueError(f"Unknown type of credentials {type(credentials)}")
+
+
+def _credentials_from_json(data: Dict[str, str]) -> RawCredentials:
+    if data["type"] == "username_password":
+        return UsernamePassword(data["username"], data["password"])
+    elif data["type"] == "ssh_key":
+        return SshKey(data["private_key"])
+    else:
+        raise ValueError(f"Unknown type of credentials {data['type']}")
+
+
+def _read_credentials_cache(path: str) -> Optional[_CachedCredentials]:
+    """Returns None if the cache file doesn't exist or can't be read for any reason"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data["version"] != _CACHE_FORMAT_VERSION:
+            return None
+        return _CachedCredentials(
+            data["expires_at"], _credentials_from_json(data["credentials"])
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_credentials_cache(path: str, cached: _CachedCredentials) -> None:
+    """
+    Writes atomically so that readers never see a partially written file. The file is
+    only readable by the current user, as it contains secrets
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(
+        os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+        "w",
+        encoding="utf-8",
+    ) as f:
+        json.dump(
+            {
+                "version": _CACHE_FORMAT_VERSION,
+                "expires_at": cached.expires_at,
+                "credentials": _credentials_to_json(cached.credentials),
+            },
+            f,
+        )
+    os.replace(temp_path, path)
+
+
+async def _refresh_credentials(
+    path: str,
+    fetch: Callable[[], Awaitable[Tuple[RawCredentials, Optional[float]]]],
+    ttl_secs: float,
+    refresh_ahead_secs: float,
+) -> _CachedCredentials:
+    """
+    Fetches new credentials and writes them to the cache. If another process is already
+    doing this, waits for it to finish and uses that process' result.
+    """
+    # FileLock.acquire blocks the event loop, so we poll for the lock instead
+    file_lock = filelock.FileLock(f"{path}.lock")
+    while True:
+        try:
+            file_lock.acquire(timeout=0)
+            break
+        except filelock.Timeout:
+            await asyncio.sleep(_LOCK_POLL_INTERVAL_SECS)
+
+    try:
+        # someone else might have refreshed the credentials while we were waiting for
+        # the lock
+        cached = _read_credentials_cache(path)
+        if cached is None or time.time() >= cached.expires_at - refresh_ahead_secs:
+            credentials, expires_at = await fetch()
+            if expires_at is None:
+                expires_at = time.time() + ttl_secs
+            cached = _CachedCredentials(expires_at, credentials)
+            _write_credentials_cache(path, cached)
+        _CACHED_CREDENTIALS[path] = cached
+        return cached
+    finally:
+        file_lock.release()
+
+
+def _get_refresh_task(
+    path: str,
+    fetch: Callable[[], Awaitable[Tuple[RawCredentials, Optional[float]]]],
+    ttl_secs: float,
+    refresh_ahead_secs: float,
+) -> asyncio.Task[_CachedCredentials]:
+    task = _REFRESHES.get(path)
+    if task is None:
+        task = asyncio.create_task(
+            _refresh_credentials(path, fetch, ttl_secs, refresh_ahead_secs)
+        )
+        _REFRESHES[path] = task
+
+        def on_done(t: asyncio.Task[_CachedCredentials]) -> None:
+            if _REFRESHES.get(path) is t:
+                del _REFRESHES[path]
+
+        task.add_done_callback(on_done)
+    return task
+
+
+def _log_background_refresh_failure(task: asyncio.Task[_CachedCredentials]) -> None:
+    # also makes sure that asyncio doesn't complain that the exception was never
+    # retrieved
+    if task.cancelled():
+        return
+    e = task.exception()
+    if e is not None:
+        print("Warning, unable to refresh cached credentials:")
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+
+async def get_cached_credentials(
+    cache_key: str,
+    fetch: Callable[[], Awaitable[Tuple[RawCredentials, Optional[float]]]],
+    ttl_secs: float = CREDENTIALS_CACHE_SECS,
+    refresh_ahead_secs: float = CREDENTIALS_REFRESH_AHEAD_SECS,
+    cache_folder: Optional[str] = None,
+) -> RawCredentials:
+    """
+    Returns the credentials identified by cache_key, using fetch to get them if
+    necessary. fetch should return (credentials, expires_at) where expires_at is the
+    time.time() when the credentials expire, or None if the credentials don't have an
+    expiration time, in which case we cache them for ttl_secs.
+
+    The cache is shared across all processes on this machine. If the cached credentials
+    will expire within refresh_ahead_secs, we return them immediately but kick off a
+    background task to refresh them for the next caller. Once they've expired, we wait
+    for new credentials.
+    """
+    if cache_folder is None:
+        cache_folder = os.path.join(get_default_cache_folder(), "credentials")
+    os.makedirs(cache_folder, mode=0o700, exist_ok=True)
+    # makedirs doesn't change the mode if the folder already exists, and the mode is
+    # affected by the umask
+    os.chmod(cache_folder, 0o700)
+    path = os.path.join(
+        cache_folder,
+        hashlib.blake2b(cache_key.encode("utf-8"), digest_size=16).hexdigest()
+        + ".json",
+    )
+
+    cached = _CACHED_CREDENTIALS.get(path)
+    if cached is None:
+        cached = _read_credentials_cache(path)
+        if cached is not None:
+            _CACHED_CREDENTIALS[path] = cached
+
+    if cached is not None:
+        now = time.time()
+        if now < cached.expires_at - refresh_ahead_secs:
+            return cached.credentials
+        if now < cached.expires_at:
+            if path not in _REFRESHES:
+                _get_refresh_task(
+                    path, fetch, ttl_secs, refresh_ahead_secs
+                ).add_done_callback(_log_background_refresh_failure)
+            return cached.credentials
+
+    return (
+        await _get_refresh_task(path, fetch, ttl_secs, refresh_ahead_secs)
+    ).credentials
+
+
+def _get_cache_key(source: CredentialsSource) -> str:
+    return (
+        f"{type(source).__name__}:"
+        f"{source.SerializeToString(deterministic=True).hex()}"
+    )
+
+
 async def get_matching_credentials(
     service: Credentials.Service.ValueType,
     service_url_to_match: str,
@@ -162,11 +382,20 @@ async def get_matching_credentials(
         key=lambda c: len(c[0]),
         default=None,
     )
-    if source is not None:
-        return await _get_credentials_from_source(source[1])
-    else:
+    if source is None:
         return None
 
+    credentials_source = source[1]
+    if isinstance(credentials_source, ServerAvailableFile):
+        # reading a local file is cheap, and there's no reason to make a copy of the
+        # credentials
+        return await _get_credentials_from_source(credentials_source)
+
+    async def fetch() -> Tuple[RawCredentials, Optional[float]]:
+        return await _get_credentials_from_source(credentials_source), None
+
+    return await get_cached_credentials(_get_cache_key(credentials_source), fetch)
+
 
 async def get_docker_credentials(
     repository: str, credentials_dict: CredentialsDict
@@ -3,15 +3,26 @@
 import asyncio.subprocess
 import hashlib
 import os
+import re
 import shutil
 import tempfile
 import urllib.parse
 import zipfile
-from typing import List, Optional, Sequence, Tuple, Union
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import filelock
 
 from meadowrun._vendor.aiodocker import exceptions as aiodocker_exceptions
+from meadowrun import conda, local_code
 from meadowrun.aws_integration import s3
 from meadowrun.aws_integration.ecr import (
     get_ecr_helper,
@@ -24,6 +35,7 @@ from meadowrun.credentials import RawCredentials, SshKey
 from meadowrun.docker_controller import (
     _does_digest_exist_locally,
     build_image,
+    image_lock,
     pull_image,
     push_image,
 )
@@ -33,6 +45,7 @@ from meadowrun.meadowrun_pb2 import (
     EnvironmentType,
     Job,
     ServerAvailableContainer,
+    ServerAvailableInterpreter,
 )
 from meadowrun.run_job_core import CloudProviderType, ContainerRegistryHelper
 
@@ -138,6 +151,7 @@ async def get_code_paths(
             job.git_repo_commit.commit,
             job.git_repo_commit.path_to_source,
             credentials,
+            _get_additional_git_paths(job),
         )
     elif case == "git_repo_branch":
         # warning this is not reproducible!!! should ideally be resolved on the
@@ -151,6 +165,7 @@ async def get_code_paths(
             f"origin/{job.git_repo_branch.branch}",
             job.git_repo_branch.path_to_source,
             credentials,
+            _get_additional_git_paths(job),
         )
     elif case == "code_zip_file":
         return (
@@ -163,6 +178,16 @@ async def get_code_paths(
         raise ValueError(f"Unrecognized code_deployment {case}")
 
 
+def _get_additional_git_paths(job: Job) -> List[str]:
+    """
+    Returns paths other than path_to_source in the git repo that the job needs, i.e.
+    the environment spec if there is one
+    """
+    if job.WhichOneof("interpreter_deployment") == "environment_spec_in_code":
+        return [job.environment_spec_in_code.path_to_spec]
+    return []
+
+
 def _get_git_repo_local_clone_name(repo_url: str) -> str:
     """Gets a name to use for cloning the specified URL locally"""
 
@@ -189,8 +214,17 @@ async def _get_git_code_paths(
     revision_spec: str,
     path_to_source: str,
     credentials: Optional[RawCredentials],
+    additional_paths: Sequence[str] = (),
 ) -> Tuple[Sequence[str], str]:
-    """Returns code_paths for GitRepoCommit"""
+    """
+    Returns code_paths for GitRepoCommit. If path_to_source is specified, the local
+    copy will only contain path_to_source and additional_paths (e.g. the environment
+    spec), otherwise the local copy will contain the whole repo.
+
+    The local clone is a partial clone (see git clone --filter) so that we only
+    download the files (blobs) we need for the local copies we create, and if
+    revision_spec is a commit hash that we already have, we don't fetch at all.
+    """
 
     local_clone_name = _get_git_repo_local_clone_name(repo_url)
     with filelock.FileLock(
@@ -201,70 +235,437 @@ async def _get_git_code_paths(
         local_path = os.path.join(git_repos_folder, local_clone_name)
 
         if os.path.exists(local_path):
-            _ = await _run_git(["fetch"], local_path, credentials)
+            # commits are immutable, so if we already have the commit there's no need
+            # to fetch. Branches (e.g. origin/main) always need to be fetched
+            if not (
+                _is_commit_hash(revision_spec)
+                and await _has_git_commit(local_path, revision_spec)
+            ):
+                _ = await _run_git(["fetch"], local_path, credentials)
         else:
             # TODO do something with output?
             temp_path = f"{local_path}_{os.getpid()}"
+            # We never need a working tree, see _materialize_git_commit. --filter
+            # means we initially only get commits and trees, and we'll fetch the blobs
+            # we need later. If the server doesn't support partial clones, git will
+            # just ignore --filter and get everything.
             _ = await _run_git(
-                ["clone", repo_url, temp_path], git_repos_folder, credentials
+                [
+                    "clone",
+                    "--no-checkout",
+                    "--filter=blob:none",
+                    repo_url,
+                    temp_path,
+                ],
+                git_repos_folder,
+                credentials,
             )
             os.rename(temp_path, local_path)
 
         # TODO we should (maybe) prevent very ambiguous specifications like HEAD
         out, err = await _run_git(["rev-parse", revision_spec], local_path, credentials)
         commit_hash = out.strip()
-        # TODO do something with output?
-        # get and checkout the specified hash
-        _ = await _run_git(["checkout", commit_hash], local_path, credentials)
 
-        # copy the specified version of this repo from local_path into
-        # local_copy_path
+    # The lock only needs to cover updating the local clone's object database. Git
+    # supports reading objects while another process is fetching, so jobs for
+    # different commits can create their local copies concurrently.
 
-        local_copy_path = os.path.join(
-            local_copies_folder, local_clone_name + "_" + commit_hash
+    if path_to_source:
+        sparse_paths: Optional[List[str]] = sorted({path_to_source, *additional_paths})
+    else:
+        sparse_paths = None
+
+    # it's important that it's impossible to create a scenario where different
+    # local_clone.local_name + commit_hash (+ sparse_paths) can result in identical
+    # strings
+    local_copy_name = local_clone_name + "_" + commit_hash
+    if sparse_paths is not None:
+        sparse_paths_hash = hashlib.blake2b(
+            "\0".join(sparse_paths).encode("utf-8"), digest_size=8
+        ).hexdigest()
+        local_copy_name += "_" + sparse_paths_hash
+    local_copy_path = os.path.join(local_copies_folder, local_copy_name)
+    if not os.path.exists(local_copy_path):
+        await _materialize_git_commit(
+            local_path,
+            commit_hash,
+            os.path.join(local_copies_folder, "git_blobs"),
+            local_copy_path,
+            sparse_paths,
+            credentials,
         )
 
-        # it's important that it's impossible to create a scenario where different
-        # local_clone.local_name + commit_hash can result in identical strings
-        if not os.path.exists(local_copy_path):
-            # TODO really we should do the whole thing where we hash each file/folder
-            # and create symlinks so that we don't end up with tons of copies of
-            # identical files
-            shutil.copytree(local_path, local_copy_path)
+    # TODO raise a friendlier exception if this path doesn't exist
+    return [os.path.join(local_copy_path, path_to_source)], local_copy_path
+
+
+async def _materialize_git_commit(
+    local_path: str,
+    commit_hash: str,
+    blobs_folder: str,
+    local_copy_path: str,
+    sparse_paths: Optional[Sequence[str]],
+    credentials: Optional[RawCredentials],
+) -> None:
+    """
+    Creates a copy of the files in commit_hash (without the .git folder) at
+    local_copy_path. If sparse_paths is not None, only includes those paths. Each file
+    is stored once in blobs_folder, named after its git blob hash, and hard linked into
+    local_copy_path, so that commits that share most of their files don't take up much
+    additional space, and we only need to read (and, for partial clones, fetch) files
+    that have changed out of the git object database.
+
+    As with _assemble_manifest, this means that jobs that modify their code files will
+    modify them for other jobs as well.
+    """
+    ls_tree_args = ["ls-tree", "-r", "-z", commit_hash]
+    if sparse_paths is not None:
+        ls_tree_args.extend(["--", *sparse_paths])
+    out, _ = await _run_git(ls_tree_args, local_path, None)
+    # (path, blob hash, mode)
+    entries = []
+    for line in out.split("\0"):
+        if not line:
+            continue
+        info, path = line.split("\t", 1)
+        mode, object_type, object_hash = info.split(" ")
+        # TODO submodules (object_type == "commit") are not supported
+        if object_type == "blob":
+            entries.append((path, object_hash, mode))
+
+    os.makedirs(blobs_folder, exist_ok=True)
+    missing_blobs = {
+        object_hash
+        for _, object_hash, mode in entries
+        if not os.path.exists(
+            os.path.join(blobs_folder, _get_git_blob_name(object_hash, mode))
+        )
+    }
+    if missing_blobs:
+        await _fetch_missing_git_blobs(
+            local_path, commit_hash, missing_blobs, credentials
+        )
+        await _write_git_blobs(local_path, missing_blobs, blobs_folder)
+        # executable files need their own copy of the blob, as hard links share
+        # permissions
+        for _, object_hash, mode in entries:
+            if mode == _GIT_EXECUTABLE_MODE:
+                executable_path = os.path.join(
+                    blobs_folder, _get_git_blob_name(object_hash, mode)
+                )
+                if not os.path.exists(executable_path):
+                    temp_path = f"{executable_path}.{os.getpid()}.tmp"
+                    shutil.copyfile(os.path.join(blobs_folder, object_hash), temp_path)
+                    os.chmod(temp_path, os.stat(temp_path).st_mode | 0o111)
+                    os.replace(temp_path, executable_path)
+
+    temp_folder = f"{local_copy_path}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    for path, object_hash, mode in entries:
+        destination = os.path.join(temp_folder, path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        blob_path = os.path.join(blobs_folder, _get_git_blob_name(object_hash, mode))
+        if mode == _GIT_SYMLINK_MODE:
+            with open(blob_path, "r", encoding="utf-8") as f:
+                os.symlink(f.read(), destination)
+        else:
+            _link_or_copy(blob_path, destination, True)
+    _rename_folder_into_place(temp_folder, local_copy_path)
+
+
+def _is_commit_hash(revision_spec: str) -> bool:
+    return re.fullmatch("[0-9a-f]{4,40}", revision_spec) is not None
+
+
+def _get_git_env_without_lazy_fetch() -> Dict[str, str]:
+    # By default, reading an object that's missing from a partial clone makes git fetch
+    # it from the remote, without our credentials and one object at a time. Instead,
+    # we want to find out that it's missing, see _fetch_missing_git_blobs.
+    # GIT_NO_LAZY_FETCH is only supported by git 2.44 and later, older versions will
+    # still lazily fetch.
+    env = os.environ.copy()
+    env["GIT_NO_LAZY_FETCH"] = "1"
+    return env
+
+
+async def _has_git_commit(local_path: str, commit_hash: str) -> bool:
+    p = await asyncio.create_subprocess_exec(
+        "git",
+        "cat-file",
+        "-e",
+        f"{commit_hash}^{{commit}}",
+        cwd=local_path,
+        env=_get_git_env_without_lazy_fetch(),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    return await p.wait() == 0
+
 
-        # TODO raise a friendlier exception if this path doesn't exist
-        return [os.path.join(local_copy_path, path_to_source)], local_copy_path
+# the maximum number of blobs to request in a single git fetch to avoid command lines
+# that are too long
+_MAX_BLOBS_PER_FETCH = 1000
+
+
+async def _fetch_missing_git_blobs(
+    local_path: str,
+    commit_hash: str,
+    object_hashes: Iterable[str],
+    credentials: Optional[RawCredentials],
+) -> None:
+    """
+    In a partial clone, fetches any of object_hashes (which must be reachable from
+    commit_hash) that we don't have yet. This is equivalent to what git does lazily,
+    but in a few requests rather than one per object.
+    """
+    out, _ = await _run_git(
+        ["rev-list", "--objects", "--no-walk", "--missing=print", commit_hash],
+        local_path,
+        None,
+    )
+    # missing objects are printed as ?<hash>
+    missing = {line[1:] for line in out.splitlines() if line.startswith("?")}
+    to_fetch = sorted(missing.intersection(object_hashes))
+    for i in range(0, len(to_fetch), _MAX_BLOBS_PER_FETCH):
+        # these are the same arguments git uses when it lazily fetches objects
+        _ = await _run_git(
+            [
+                "-c",
+                "fetch.negotiationAlgorithm=noop",
+                "fetch",
+                "origin",
+                "--no-tags",
+                "--no-write-fetch-head",
+                "--recurse-submodules=no",
+                "--filter=blob:none",
+                *to_fetch[i : i + _MAX_BLOBS_PER_FETCH],
+            ],
+            local_path,
+            credentials,
+        )
+
+
+_GIT_EXECUTABLE_MODE = "100755"
+_GIT_SYMLINK_MODE = "120000"
+
+
+def _get_git_blob_name(object_hash: str, mode: str) -> str:
+    if mode == _GIT_EXECUTABLE_MODE:
+        return object_hash + ".x"
+    return object_hash
+
+
+async def _write_git_blobs(
+    local_path: str, object_hashes: Iterable[str], blobs_folder: str
+) -> None:
+    """
+    Writes the contents of each git blob in object_hashes to blobs_folder/object_hash.
+    Uses a single git cat-file --batch process and streams its output so that we
+    never have more than one file in memory at a time.
+    """
+    object_hashes = list(object_hashes)
+    p = await asyncio.create_subprocess_exec(
+        "git",
+        "cat-file",
+        "--batch",
+        cwd=local_path,
+        env=_get_git_env_without_lazy_fetch(),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    assert p.stdin is not None and p.stdout is not None
+
+    async def write_input() -> None:
+        assert p.stdin is not None
+        for object_hash in object_hashes:
+            p.stdin.write(f"{object_hash}\n".encode("utf-8"))
+            await p.stdin.drain()
+        p.stdin.close()
+
+    input_task = asyncio.create_task(write_input())
+    try:
+        for _ in object_hashes:
+            # each object is output as "<hash> <type> <size>\n<contents>\n"
+            header = (await p.stdout.readline()).decode("utf-8").split()
+            if len(header) != 3:
+                raise ValueError(f"Unexpected output from git cat-file: {header}")
+            object_hash, _, size = header
+            contents = await p.stdout.readexactly(int(size))
+            await p.stdout.readexactly(1)
+
+            blob_path = os.path.join(blobs_folder, object_hash)
+            temp_path = f"{blob_path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(contents)
+            os.replace(temp_path, blob_path)
+        await input_task
+    finally:
+        if p.returncode is None:
+            input_task.cancel()
+            p.kill()
+        await p.wait()
 
 
 async def _get_zip_file_code_paths(
     local_copies_folder: str, zip_file_url: str, code_paths: Sequence[str]
 ) -> List[str]:
     decoded_url = urllib.parse.urlparse(zip_file_url)
+    if decoded_url.scheme == "file" and decoded_url.path.endswith(
+        local_code.MANIFEST_SUFFIX
+    ):
+        files, sources = local_code.read_manifest(decoded_url.path)
+        # we copy rather than link local files, as the user might edit them while the
+        # job is running
+        extracted_folder = _assemble_manifest(
+            local_copies_folder, files, sources.__getitem__, False
+        )
+        return [os.path.join(extracted_folder, zip_path) for zip_path in code_paths]
+
     if decoded_url.scheme == "file":
-        with zipfile.ZipFile(decoded_url.path) as zip_file:
-            extracted_folder = os.path.splitext(os.path.basename(decoded_url.path))[0]
-            zip_file.extractall(os.path.join(local_copies_folder, extracted_folder))
-        return [
-            os.path.join(local_copies_folder, extracted_folder, zip_path)
-            for zip_path in code_paths
-        ]
+        # Zip files get a new name every time they're created, so we name the extracted
+        # folder after the zip file's contents so that we can reuse it (and any
+        # bytecode that gets written into it) if the code hasn't changed
+        extracted_folder = os.path.join(
+            local_copies_folder, local_code.hash_file(decoded_url.path)
+        )
+        _extract_zip_file(decoded_url.path, extracted_folder)
+        return [os.path.join(extracted_folder, zip_path) for zip_path in code_paths]
 
     if decoded_url.scheme == "s3":
         bucket_name = decoded_url.netloc
         object_name = decoded_url.path.lstrip("/")
+
+        if object_name.startswith(s3._MANIFEST_PREFIX):
+            extracted_folder = await _get_s3_manifest(
+                local_copies_folder, bucket_name, object_name
+            )
+            return [os.path.join(extracted_folder, zip_path) for zip_path in code_paths]
+
         extracted_folder = os.path.join(local_copies_folder, object_name)
 
         if not os.path.exists(extracted_folder):
             zip_file_path = extracted_folder + ".zip"
-            await s3.download_file(bucket_name, object_name, zip_file_path)
-            with zipfile.ZipFile(zip_file_path) as zip_file:
-                zip_file.extractall(os.path.join(local_copies_folder, extracted_folder))
+            # zip files are uploaded with their hash as the key
+            await s3.download_file(
+                bucket_name, object_name, zip_file_path, expected_digest=object_name
+            )
+            _extract_zip_file(zip_file_path, extracted_folder)
 
         return [os.path.join(extracted_folder, zip_path) for zip_path in code_paths]
 
     raise ValueError(f"Unknown URL scheme in {zip_file_url}")
 
 
+def _link_or_copy(source: str, destination: str, link: bool) -> None:
+    if link:
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            # e.g. the file system doesn't support hard links
+            pass
+    shutil.copyfile(source, destination)
+
+
+def _rename_folder_into_place(temp_folder: str, final_folder: str) -> None:
+    try:
+        os.rename(temp_folder, final_folder)
+    except OSError:
+        # another job probably created the same folder at the same time
+        if not os.path.exists(final_folder):
+            raise
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+def _extract_zip_file(zip_file_path: str, extracted_folder: str) -> None:
+    """
+    Extracts zip_file_path into extracted_folder unless extracted_folder already
+    exists. Extracts under a temporary name and renames at the end so that concurrent
+    jobs never see a partially extracted folder.
+    """
+    if os.path.exists(extracted_folder):
+        return
+
+    temp_folder = f"{extracted_folder}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    with zipfile.ZipFile(zip_file_path) as zip_file:
+        zip_file.extractall(temp_folder)
+    _rename_folder_into_place(temp_folder, extracted_folder)
+
+
+async def _get_s3_manifest(
+    local_copies_folder: str, bucket_name: str, object_name: str
+) -> str:
+    """
+    Downloads a manifest uploaded by s3.ensure_manifest_uploaded and any files in it
+    that we don't already have, and returns a folder that has the manifest's files
+    """
+    files, _ = local_code.parse_manifest(
+        (await s3.download_object(bucket_name, object_name)).decode("utf-8")
+    )
+
+    # Files are kept in blobs_folder, keyed by their hashes, so that we only download
+    # files that have changed since the last job
+    blobs_folder = os.path.join(local_copies_folder, "blobs")
+    os.makedirs(blobs_folder, exist_ok=True)
+    missing_blobs = {
+        digest
+        for digest in files.values()
+        if not os.path.exists(os.path.join(blobs_folder, digest))
+    }
+    if missing_blobs:
+        # download_blobs verifies the hash of each blob
+        await s3.download_blobs(bucket_name, missing_blobs, blobs_folder)
+
+    return _assemble_manifest(
+        local_copies_folder,
+        files,
+        lambda digest: os.path.join(blobs_folder, digest),
+        True,
+    )
+
+
+def _assemble_manifest(
+    local_copies_folder: str,
+    files: Dict[str, str],
+    get_source: Callable[[str], str],
+    link: bool,
+) -> str:
+    """
+    Creates a folder in local_copies_folder with files laid out as specified by the
+    manifest's files ({/-separated path in the "zip file": hash}). get_source returns
+    the path of an existing file with the specified hash. Returns the path to the
+    folder.
+
+    The folder's name is the manifest hash, so if a folder for the same manifest already
+    exists we just reuse it. Otherwise we assemble it under a temporary name and rename
+    it at the end so that concurrent jobs never see a partially assembled folder.
+
+    If link is True, we hard link to the sources rather than copying them. Hard links
+    mean that a job that modifies its code files will modify them for other jobs as
+    well, but that is already the case for zip files, as jobs with the same zip file
+    share the same extracted folder.
+    """
+    extracted_folder = os.path.join(
+        local_copies_folder, local_code.get_manifest_hash(files)
+    )
+    if os.path.exists(extracted_folder):
+        return extracted_folder
+
+    temp_folder = f"{extracted_folder}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    for zip_path, digest in files.items():
+        # paths in the manifest are always /-separated, see local_code.create_manifest
+        destination = os.path.join(temp_folder, *zip_path.split("/"))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        _link_or_copy(get_source(digest), destination, link)
+
+    _rename_folder_into_place(temp_folder, extracted_folder)
+
+    return extracted_folder
+
+
 async def compile_environment_spec_to_container(
     environment_spec: Union[EnvironmentSpecInCode, EnvironmentSpec],
     interpreter_spec_path: str,
@@ -275,8 +676,8 @@ async def compile_environment_spec_to_container(
     available locally (as per the returned ServerAvailableContainer), and also cached in
     ECR.
 
-    TODO we should also consider creating conda environments locally rather than always
-    making a container for them, that might be more efficient.
+    See also compile_environment_spec_to_interpreter, which creates conda environments
+    locally rather than making a container for them.
     """
     if environment_spec.environment_type == EnvironmentType.CONDA:
         path_to_spec, spec_hash = _get_path_and_hash(
@@ -323,22 +724,23 @@ async def compile_environment_spec_to_container(
                 )
 
         # the image doesn't exist locally or in ECR, so build it ourselves and cache it
-        # in ECR
-        spec_filename = os.path.basename(path_to_spec)
-        docker_file_path = os.path.join(
-            os.path.dirname(__file__), "docker_files", "CondaDockerfile"
-        )
-        await build_image(
-            [(docker_file_path, "Dockerfile"), (path_to_spec, spec_filename)],
-            helper.image_name,
-            {"ENV_FILE": spec_filename},
-        )
+        # in ECR. Only one process on this machine builds the image, the others wait
+        # for it and then just use the image that was built.
+        async with image_lock(helper.image_name):
+            if await _does_digest_exist_locally(helper.image_name):
+                return result
+
+            with tempfile.TemporaryDirectory() as temp_folder:
+                files, buildargs = _get_conda_docker_build_context(
+                    path_to_spec, temp_folder
+                )
+                await build_image(files, helper.image_name, buildargs, buildkit=True)
 
         # try to push the image so that we can reuse it later
         # TODO this should really happen asynchronously as it takes a long time and
         # isn't critical.
-        # TODO we should also somehow avoid multiple processes on the same (or even on
-        # different machines) building the identical image at the same time.
+        # TODO we should also somehow avoid multiple machines building the identical
+        # image at the same time.
         if helper.should_push:
             try:
                 await push_image(helper.image_name, helper.username_password)
@@ -355,14 +757,95 @@ async def compile_environment_spec_to_container(
         )
 
 
+def _get_conda_docker_build_context(
+    path_to_spec: str, temp_folder: str
+) -> Tuple[List[Tuple[str, str]], Dict[str, str]]:
+    """
+    Returns the files and buildargs for building a docker image for the conda spec at
+    path_to_spec (see build_image). Explicit specs are installed in two layers if
+    possible, see CondaLayeredDockerfile. Any files we need to generate are written to
+    temp_folder.
+    """
+    spec_filename = os.path.basename(path_to_spec)
+    with open(path_to_spec, "r", encoding="utf-8") as f:
+        spec = f.read()
+
+    files = [(path_to_spec, spec_filename)]
+    if conda.is_explicit_spec(spec):
+        base_packages, other_packages = conda.split_explicit_spec(spec)
+        if base_packages and other_packages:
+            docker_file_name = "CondaLayeredDockerfile"
+            base_spec_path = os.path.join(temp_folder, "base_explicit.txt")
+            other_spec_path = os.path.join(temp_folder, spec_filename)
+            for path, packages in (
+                (base_spec_path, base_packages),
+                (other_spec_path, other_packages),
+            ):
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write("\n".join([conda.EXPLICIT_SPEC_MARKER, *packages]))
+            files = [
+                (base_spec_path, "base_explicit.txt"),
+                (other_spec_path, spec_filename),
+            ]
+        else:
+            # installs exactly the listed packages without solving
+            docker_file_name = "CondaExplicitDockerfile"
+    else:
+        docker_file_name = "CondaDockerfile"
+
+    docker_file_path = os.path.join(
+        os.path.dirname(__file__), "docker_files", docker_file_name
+    )
+    return [(docker_file_path, "Dockerfile")] + files, {"ENV_FILE": spec_filename}
+
+
+async def compile_environment_spec_to_interpreter(
+    environment_spec: Union[EnvironmentSpecInCode, EnvironmentSpec],
+    interpreter_spec_path: str,
+    environments_folder: str,
+) -> ServerAvailableInterpreter:
+    """
+    Turns e.g. a conda_environment.yml file into a conda environment in
+    environments_folder, which avoids building/pulling a container and starting it for
+    each job. Environments are cached based on the hash of the (normalized) spec.
+    """
+    if environment_spec.environment_type == EnvironmentType.CONDA:
+        path_to_spec, spec_hash = _get_path_and_hash(
+            environment_spec, interpreter_spec_path
+        )
+        return ServerAvailableInterpreter(
+            interpreter_path=await conda.get_cached_environment(
+                path_to_spec, spec_hash, environments_folder
+            )
+        )
+    else:
+        raise ValueError(
+            f"Unexpected environment_type {environment_spec.environment_type}"
+        )
+
+
+def _normalize_conda_spec(spec: bytes) -> bytes:
+    """
+    Removes the parts of a conda spec that don't affect the environment we create, so
+    that e.g. the same environment exported from two different machines will have the
+    same hash. For environment.yml files, that's the top-level name and prefix, which we
+    ignore. For explicit specs, that's comments, which include e.g. the date the spec
+    was generated.
+    """
+    lines = [line for line in spec.decode("utf-8").splitlines() if line.strip()]
+    if conda.is_explicit_spec(spec.decode("utf-8")):
+        lines = [line for line in lines if not line.startswith("#")]
+    else:
+        lines = [line for line in lines if not line.startswith(("name:", "prefix:"))]
+    return "\n".join(lines).encode("utf-8")
+
+
 def _get_path_and_hash(
     environment_spec: Union[EnvironmentSpecInCode, EnvironmentSpec],
     interpreter_spec_path: str,
 ) -> Tuple[str, str]:
     def hash_spec(it: bytes) -> str:
-        # TODO probably better to exclude the name and prefix in the file as those
-        # are ignored
-        return hashlib.blake2b(it, digest_size=64).hexdigest()
+        return hashlib.blake2b(_normalize_conda_spec(it), digest_size=64).hexdigest()
 
     if isinstance(environment_spec, EnvironmentSpecInCode):
         # in this case, interpreter_spec_path is a path to the root of the place where
@@ -377,8 +860,13 @@ def _get_path_and_hash(
         # in this case, interpreter_spec_path is a path to where we save the spec for
         # later processing.
         spec_hash = hash_spec(environment_spec.spec.encode("UTF-8"))
+        # conda env create requires a .yml extension
+        if conda.is_explicit_spec(environment_spec.spec):
+            extension = "txt"
+        else:
+            extension = "yml"
         path_to_spec = os.path.join(
-            interpreter_spec_path, f"conda_env_spec_{spec_hash}.yml"
+            interpreter_spec_path, f"conda_env_spec_{spec_hash}.{extension}"
         )
         with open(path_to_spec, "w") as env_spec:
             env_spec.write(environment_spec.spec)
@@ -23,19 +23,42 @@ Normal usage is e.g. `docker pull [repository]:[tag]` or `docker pull
 """
 from __future__ import annotations
 
+import argparse
 import asyncio
+import asyncio.subprocess
+import contextlib
 import hashlib
-import io
+import json
+import os
+import sys
 import tarfile
+import tempfile
+import time
 import urllib.parse
 import urllib.request
-from typing import Tuple, Optional, List, Dict, Iterable
+import weakref
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncIterator,
+    BinaryIO,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
 from meadowrun._vendor import aiodocker
 from meadowrun._vendor.aiodocker import containers as aiodocker_containers
+from meadowrun._vendor.aiodocker import execs as aiodocker_execs
+from meadowrun._vendor.aiodocker import stream as aiodocker_stream
 import aiohttp
+import filelock
 
 import meadowrun.credentials
+from meadowrun.shared import EventLoopLocks, get_default_cache_folder
 
 # When no registry domain is specified, docker assumes this as the registry domain.
 # I.e. `docker pull python:latest` is equivalent to `docker pull
@@ -259,18 +282,173 @@ async def get_latest_digest_from_registry(
     # TODO test case where image doesn't exist
 
 
-async def _does_digest_exist_locally(image: str) -> bool:
+# aiodocker.Docker objects hold an aiohttp session (i.e. a connection pool), which is
+# tied to the event loop it was created on, so we keep one client per event loop rather
+# than creating a new client for every call. The client (via its session) references
+# its event loop, so we can't key on the event loop itself (e.g. with a
+# WeakKeyDictionary), as that would keep every event loop alive forever. Instead, we
+# key on id(loop) and keep a weak reference to the loop so that we can tell when an
+# entry is stale (the loop has been closed or collected, and its id might be reused).
+# Entries should normally be removed via close_client/docker_client_scope.
+_CLIENTS: Dict[
+    int, Tuple["weakref.ReferenceType[asyncio.AbstractEventLoop]", aiodocker.Docker]
+] = {}
+# id(loop) -> number of open docker_client_scopes on that loop
+_CLIENT_SCOPES: Dict[int, int] = {}
+
+
+def _remove_stale_clients() -> None:
+    """
+    Forgets clients for event loops that have been closed without calling close_client.
+    These clients can't be closed properly anymore, but this at least lets the event
+    loops get garbage collected.
+    """
+    for loop_id, (loop_ref, _) in list(_CLIENTS.items()):
+        loop = loop_ref()
+        if loop is None or loop.is_closed():
+            del _CLIENTS[loop_id]
+            _CLIENT_SCOPES.pop(loop_id, None)
+
+
+def _get_client() -> aiodocker.Docker:
+    """
+    Returns the shared docker client for the current event loop. Callers should not
+    close this client, see close_client.
+    """
+    loop = asyncio.get_running_loop()
+    entry = _CLIENTS.get(id(loop))
+    if entry is not None and entry[0]() is loop and not entry[1].session.closed:
+        return entry[1]
+
+    _remove_stale_clients()
+    client = aiodocker.Docker()
+    _CLIENTS[id(loop)] = weakref.ref(loop), client
+    return client
+
+
+async def close_client() -> None:
+    """
+    Closes the shared docker client for the current event loop if there is one. This
+    should be called before the event loop is closed, e.g. at the end of the function
+    passed to asyncio.run
+    """
+    loop = asyncio.get_running_loop()
+    entry = _CLIENTS.get(id(loop))
+    if entry is not None and entry[0]() is loop:
+        del _CLIENTS[id(loop)]
+        await entry[1].close()
+
+
+@contextlib.asynccontextmanager
+async def docker_client_scope() -> AsyncIterator[None]:
+    """
+    Closes the shared docker client for the current event loop when the last
+    docker_client_scope on the event loop exits. This is for code like LocalHost.run_job
+    that doesn't own the event loop and might run concurrently with other jobs on the
+    same event loop, so it can't just call close_client when it's done.
+    """
+    loop_id = id(asyncio.get_running_loop())
+    _CLIENT_SCOPES[loop_id] = _CLIENT_SCOPES.get(loop_id, 0) + 1
+    try:
+        yield
+    finally:
+        _CLIENT_SCOPES[loop_id] -= 1
+        if _CLIENT_SCOPES[loop_id] == 0:
+            del _CLIENT_SCOPES[loop_id]
+            await close_client()
+
+
+# Caches the results of inspecting images that exist locally (by image name). An
+# image referenced by digest (e.g. python@sha256:...) never changes, but a tag can be
+# pulled/built again by another process, so we only cache those for a short time. We
+# never cache the fact that an image doesn't exist, as it could be pulled/built at any
+# time.
+_IMAGE_METADATA: Dict[str, Tuple[float, Mapping[str, Any]]] = {}
+_TAG_METADATA_CACHE_SECS = 60
+
+
+def _invalidate_image_metadata(image: str) -> None:
+    _IMAGE_METADATA.pop(image, None)
+
+
+async def _inspect_image(image: str) -> Optional[Mapping[str, Any]]:
+    """
+    Returns the result of docker inspect for image if it exists locally, otherwise None
+    """
+    cached = _IMAGE_METADATA.get(image)
+    if cached is not None:
+        cached_time, metadata = cached
+        if "@" in image or time.time() - cached_time < _TAG_METADATA_CACHE_SECS:
+            return metadata
+
     # This seems to be the best option for asking if an image with the specified image
     # exists locally--call inspect and then see whether we get a 404 or not. We assume
     # that calling list would be less efficient when there are many images.
     try:
-        async with aiodocker.Docker() as client:
-            await client.images.inspect(image)
-        return True
+        metadata = await _get_client().images.inspect(image)
     except aiodocker.DockerError as e:
         if e.status == 404:
-            return False
+            _invalidate_image_metadata(image)
+            return None
         raise
+    _IMAGE_METADATA[image] = time.time(), metadata
+    return metadata
+
+
+async def _does_digest_exist_locally(image: str) -> bool:
+    return await _inspect_image(image) is not None
+
+
+# In-process locks for _host_lock
+_HOST_LOCKS = EventLoopLocks()
+_HOST_LOCK_POLL_INTERVAL_SECS = 0.5
+
+
+@contextlib.asynccontextmanager
+async def _host_lock(name: str) -> AsyncIterator[None]:
+    """
+    Makes sure that only one coroutine on this machine (across all processes) at a time
+    holds the lock for name. Not reentrant.
+    """
+    # FileLock.acquire blocks, and two FileLocks on the same file in the same process
+    # would just block the event loop forever, so we first make sure that only one
+    # coroutine in this process is trying to get the file lock, and then poll for it
+    # without blocking
+    lock = _HOST_LOCKS.get(name)
+    async with lock:
+        lock_folder = os.path.join(get_default_cache_folder(), "docker_locks")
+        os.makedirs(lock_folder, exist_ok=True)
+        file_lock = filelock.FileLock(
+            os.path.join(
+                lock_folder,
+                hashlib.blake2b(name.encode("utf-8"), digest_size=16).hexdigest()
+                + ".lock",
+            )
+        )
+        while True:
+            try:
+                file_lock.acquire(timeout=0)
+                break
+            except filelock.Timeout:
+                await asyncio.sleep(_HOST_LOCK_POLL_INTERVAL_SECS)
+        try:
+            yield
+        finally:
+            file_lock.release()
+
+
+def image_lock(image: str) -> AsyncContextManager[None]:
+    """
+    Makes sure that only one coroutine on this machine (across all processes) at a time
+    pulls or builds image. E.g. when many workers start on a new instance at the same
+    time, only one of them should pull the image, and the others should wait for that
+    pull to finish. Callers should check whether the image exists locally again after
+    acquiring the lock.
+
+    This is not reentrant, i.e. don't call pull_image while holding the lock for the
+    same image.
+    """
+    return _host_lock(f"image:{image}")
 
 
 async def pull_image(
@@ -284,8 +462,15 @@ async def pull_image(
     # Not clear why, but it's much faster to do this check--you would think that docker
     # does or should do this when run/pull is called, but it doesn't seem to. If
     # client.images.pull on an image that already exists becomes significantly faster in
-    # the future, we could remove this entire if block
-    if not await _does_digest_exist_locally(image):
+    # the future, we could remove this check
+    if await _does_digest_exist_locally(image):
+        return
+
+    async with image_lock(image):
+        # another process might have pulled the image while we were waiting for the
+        # lock
+        if await _does_digest_exist_locally(image):
+            return
 
         # construct the auth parameter as aiodocker expects it
         if credentials is None:
@@ -302,8 +487,8 @@ async def pull_image(
 
         # pull the image
         print(f"Pulling docker image {image}")
-        async with aiodocker.Docker() as client:
-            statuses = await client.images.pull(image, auth=auth)
+        statuses = await _get_client().images.pull(image, auth=auth)
+        _invalidate_image_metadata(image)
 
         # double check just in case that the digest is actually there
         if not await _does_digest_exist_locally(image):
@@ -315,65 +500,85 @@ async def pull_image(
             print(f"Successfully pulled docker image {image}")
 
 
+def _write_build_context(
+    files: Iterable[Tuple[str, str]], context_file: BinaryIO
+) -> None:
+    with tarfile.TarFile(fileobj=context_file, mode="w") as tar_file:
+        for local_path, archive_path in files:
+            tar_file.add(local_path, archive_path)
+    context_file.seek(0)
+
+
 async def build_image(
-    files: Iterable[Tuple[str, str]], tag: str, buildargs: Dict[str, str]
+    files: Iterable[Tuple[str, str]],
+    tag: str,
+    buildargs: Dict[str, str],
+    buildkit: bool = False,
 ) -> None:
     """
     Builds a docker image locally. files is an iterable of (local file path, path in
     docker workspace). buildargs is a docker concept. The resulting image will be tagged
     with tag.
+
+    If buildkit is True, the image is built with BuildKit, which is required for
+    Dockerfiles that use e.g. RUN --mount=type=cache. BuildKit reports progress in a
+    binary format, so in that case we don't print the build output.
     """
-    with io.BytesIO() as tar_file_bytes:
-        with tarfile.TarFile(fileobj=tar_file_bytes, mode="w") as tar_file:
-            for local_path, archive_path in files:
-                tar_file.add(local_path, archive_path)
-
-            tar_file_bytes.seek(0)
-
-            async with aiodocker.Docker() as client:
-                async for line in client.images.build(
-                    fileobj=tar_file_bytes,
-                    tag=tag,
-                    buildargs=buildargs,
-                    # aiodocker requires that we provide an encoding, but it doesn't
-                    # seem to actually be necessary
-                    encoding="none",
-                    stream=True,
-                ):
-                    if "stream" in line:
-                        print(line["stream"], end="")
-                    if "errorDetail" in line:
-                        raise ValueError(
-                            f"Error building docker image: f{line['errorDetail']}"
-                        )
+    # We write the build context to a temporary file rather than holding it in memory,
+    # as build contexts can be large (e.g. if they contain code). The tar file gets
+    # written in a thread and then streamed to docker in chunks.
+    with tempfile.TemporaryFile() as context_file:
+        await asyncio.get_running_loop().run_in_executor(
+            None, _write_build_context, files, context_file
+        )
+
+        if buildkit:
+            print(f"Building docker image {tag} with BuildKit")
+
+        async for line in _get_client().images.build(
+            fileobj=context_file,
+            tag=tag,
+            buildargs=buildargs,
+            # aiodocker requires that we provide an encoding, but it doesn't seem to
+            # actually be necessary
+            encoding="none",
+            stream=True,
+            version="2" if buildkit else None,
+        ):
+            if "stream" in line:
+                print(line["stream"], end="")
+            if "errorDetail" in line:
+                raise ValueError(f"Error building docker image: f{line['errorDetail']}")
+
+        # tag now refers to the image we just built
+        _invalidate_image_metadata(tag)
 
 
 async def push_image(
     image: str, credentials: Optional[meadowrun.credentials.RawCredentials]
 ) -> None:
     """Equivalent to calling docker push [image]"""
-    async with aiodocker.Docker() as client:
-        # construct the auth parameter as aiodocker expects it
-        if credentials is None:
-            auth = None
-        elif isinstance(credentials, meadowrun.credentials.UsernamePassword):
-            domain, _ = get_registry_domain(image)
-            auth = {
-                "username": credentials.username,
-                "password": credentials.password,
-                "serveraddress": domain,
-            }
-        else:
-            raise ValueError(f"Unexpected type of credentials {type(credentials)}")
+    # construct the auth parameter as aiodocker expects it
+    if credentials is None:
+        auth = None
+    elif isinstance(credentials, meadowrun.credentials.UsernamePassword):
+        domain, _ = get_registry_domain(image)
+        auth = {
+            "username": credentials.username,
+            "password": credentials.password,
+            "serveraddress": domain,
+        }
+    else:
+        raise ValueError(f"Unexpected type of credentials {type(credentials)}")
 
-        prev_status = None
-        async for line in client.images.push(image, auth=auth, stream=True):
-            if "status" in line:
-                if line["status"] != prev_status:
-                    print(line["status"])
-                    prev_status = line["status"]
-            if "errorDetail" in line:
-                raise ValueError(f"Error building docker image: f{line['errorDetail']}")
+    prev_status = None
+    async for line in _get_client().images.push(image, auth=auth, stream=True):
+        if "status" in line:
+            if line["status"] != prev_status:
+                print(line["status"])
+                prev_status = line["status"]
+        if "errorDetail" in line:
+            raise ValueError(f"Error building docker image: f{line['errorDetail']}")
 
 
 async def run_container(
@@ -381,7 +586,7 @@ async def run_container(
     cmd: List[str],
     environment_variables: Dict[str, str],
     binds: List[Tuple[str, str]],
-) -> Tuple[aiodocker_containers.DockerContainer, aiodocker.Docker]:
+) -> aiodocker_containers.DockerContainer:
     """
     Runs a docker container. Examples of parameters:
     - image: python:latest
@@ -390,47 +595,269 @@ async def run_container(
     - binds: [("/path/on/host1", "/path/in/container1"), ...]
 
     Returns when the container has successfully been launched. Returns a DockerContainer
-    which has a wait method for waiting until the container completes, and a Docker
-    client which needs to be closed.
+    which has a wait method for waiting until the container completes. The container
+    uses the shared docker client for this event loop, so there's nothing to close.
 
     Usage example:
 
-    container, client = await run(...)
-    try:
-        # the container has been launched
-        await container.wait()
-        # now the container has finished running
-    finally:
-        await client.__aexit__(None, None, None)
+    container = await run_container(...)
+    # the container has been launched
+    await container.wait()
+    # now the container has finished running
     """
 
     # Now actually run the container. For documentation on the config object:
     # https://docs.docker.com/engine/api/v1.41/#operation/ContainerCreate
-    client = await aiodocker.Docker().__aenter__()
-    container = await client.containers.run(
+    return await _get_client().containers.run(
         {
             "Image": image,
             "Cmd": cmd,
             "Env": [f"{key}={value}" for key, value in environment_variables.items()],
-            "HostConfig": {
-                "Binds": [
-                    f"{path_on_host}:{path_in_container}"
-                    for path_on_host, path_in_container in binds
-                ],
-                # Docker for Windows and Mac automatically enable containers to access
-                # the host with host.docker.internal, but we need to add this flag for
-                # Linux machines to use this (not supported in Linux at all before
-                # Docker v20.10). This is mostly for tests, so we include it and it
-                # shouldn't cause problems even if it doesn't work. See more at
-                # agent._prepare_py_grid's discussion of replacing localhost for the
-                # coordinator address. Also:
-                # https://stackoverflow.com/questions/31324981/how-to-access-host-port-from-docker-container/43541732#43541732
-                "ExtraHosts": ["host.docker.internal:host-gateway"],
-            },
+            "HostConfig": _get_host_config(binds),
         }
     )
 
-    return container, client
+
+def _get_host_config(binds: List[Tuple[str, str]]) -> Dict[str, Any]:
+    return {
+        "Binds": [
+            f"{path_on_host}:{path_in_container}"
+            for path_on_host, path_in_container in binds
+        ],
+        # Docker for Windows and Mac automatically enable containers to access the host
+        # with host.docker.internal, but we need to add this flag for Linux machines to
+        # use this (not supported in Linux at all before Docker v20.10). This is mostly
+        # for tests, so we include it and it shouldn't cause problems even if it doesn't
+        # work. See more at agent._prepare_py_grid's discussion of replacing localhost
+        # for the coordinator address. Also:
+        # https://stackoverflow.com/questions/31324981/how-to-access-host-port-from-docker-container/43541732#43541732
+        "ExtraHosts": ["host.docker.internal:host-gateway"],
+    }
+
+
+# Warm containers are long-lived containers that we run jobs in with docker exec, which
+# avoids creating/starting/removing a container for every job. Warm containers have
+# this label, and the value is the key that identifies the image and binds of the
+# container (see _get_warm_container_key). Jobs run in separate processes, so we find
+# warm containers by asking docker rather than keeping track of them in memory.
+_WARM_CONTAINER_LABEL = "meadowrun.warm_container"
+
+
+def _get_warm_container_key(image: str, binds: List[Tuple[str, str]]) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(image.encode("utf-8"))
+    for path_on_host, path_in_container in sorted(binds):
+        hasher.update(b"\0" + path_on_host.encode("utf-8"))
+        hasher.update(b"\0" + path_in_container.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _touch_warm_container(container_id: str) -> None:
+    """
+    Records that a warm container was just used. Docker doesn't keep track of when a
+    container was last exec-ed into, so we keep track of it with the mtime of a file.
+    """
+    folder = os.path.join(get_default_cache_folder(), "warm_containers")
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, container_id), "w", encoding="utf-8"):
+        pass
+
+
+def _get_warm_container_last_used(container_id: str) -> float:
+    try:
+        return os.path.getmtime(
+            os.path.join(get_default_cache_folder(), "warm_containers", container_id)
+        )
+    except FileNotFoundError:
+        return 0
+
+
+async def get_warm_container(
+    image: str, binds: List[Tuple[str, str]]
+) -> aiodocker_containers.DockerContainer:
+    """
+    Returns a running container for image with binds (see run_container), starting one
+    if there isn't one already. The container doesn't do anything on its own, use
+    exec_in_container to run commands in it, and then call release_warm_container.
+    Multiple jobs can run in the same warm container at the same time.
+    """
+    key = _get_warm_container_key(image, binds)
+    client = _get_client()
+    # evict_idle_warm_containers takes the same lock, so it can't remove the container
+    # we choose here before we record that we're using it
+    async with _host_lock(f"warm_container:{key}"):
+        containers = await client.containers.list(
+            filters=json.dumps(
+                {"label": [f"{_WARM_CONTAINER_LABEL}={key}"], "status": ["running"]}
+            )
+        )
+        if containers:
+            container = containers[0]
+        else:
+            print(f"Starting warm container for {image}")
+            container = await client.containers.run(
+                {
+                    "Image": image,
+                    # keeps the container running until we remove it
+                    "Cmd": ["tail", "-f", "/dev/null"],
+                    "Labels": {_WARM_CONTAINER_LABEL: key},
+                    "HostConfig": _get_host_config(binds),
+                }
+            )
+        _touch_warm_container(container.id)
+    return container
+
+
+async def exec_in_container(
+    container: aiodocker_containers.DockerContainer,
+    cmd: List[str],
+    environment_variables: Dict[str, str],
+) -> Tuple[aiodocker_execs.Exec, aiodocker_stream.Stream]:
+    """
+    Equivalent to docker exec. environment_variables take precedence over the
+    environment variables defined in the image, like with run_container.
+
+    Returns when the command has started. Returns the Exec, which can be inspected to
+    get the ExitCode once the command has finished, and the Stream of its output, which
+    must be closed.
+    """
+    execute = await container.exec(cmd, environment=environment_variables)
+    stream = execute.start(detach=False)
+    # starts the command
+    await stream.__aenter__()
+    return execute, stream
+
+
+async def release_warm_container(container_id: str, idle_timeout_secs: float) -> None:
+    """
+    Should be called when a job that ran in a warm container (see get_warm_container)
+    completes. Also removes any warm containers that have been idle for longer than
+    idle_timeout_secs, and makes sure the remaining warm containers will be removed once
+    they've been idle for idle_timeout_secs (see _start_warm_container_sweeper).
+    """
+    _touch_warm_container(container_id)
+    if await evict_idle_warm_containers(idle_timeout_secs) > 0:
+        await _start_warm_container_sweeper(idle_timeout_secs)
+
+
+async def _has_running_execs(container: aiodocker_containers.DockerContainer) -> bool:
+    client = _get_client()
+    for exec_id in (await container.show()).get("ExecIDs") or ():
+        try:
+            if (await client.containers.exec(exec_id).inspect())["Running"]:
+                return True
+        except aiodocker.DockerError as e:
+            # exec instances can get cleaned up at any time
+            if e.status != 404:
+                raise
+    return False
+
+
+async def _list_warm_containers() -> List[aiodocker_containers.DockerContainer]:
+    return await _get_client().containers.list(
+        all=True, filters=json.dumps({"label": [_WARM_CONTAINER_LABEL]})
+    )
+
+
+async def evict_idle_warm_containers(idle_timeout_secs: float) -> int:
+    """
+    Removes warm containers that have not been used for idle_timeout_secs and aren't
+    running any jobs. Returns the number of warm containers that are left.
+    """
+    num_remaining = 0
+    for container in await _list_warm_containers():
+        key = container["Labels"][_WARM_CONTAINER_LABEL]
+        if time.time() - _get_warm_container_last_used(container.id) <= (
+            idle_timeout_secs
+        ):
+            num_remaining += 1
+            continue
+
+        async with _host_lock(f"warm_container:{key}"):
+            # check again now that we have the lock
+            if time.time() - _get_warm_container_last_used(
+                container.id
+            ) <= idle_timeout_secs or await _has_running_execs(container):
+                num_remaining += 1
+                continue
+            print(f"Removing idle warm container {container.id}")
+            try:
+                await container.delete(force=True)
+            except aiodocker.DockerError as e:
+                # another process might have removed it already
+                if e.status != 404:
+                    raise
+            try:
+                os.remove(
+                    os.path.join(
+                        get_default_cache_folder(), "warm_containers", container.id
+                    )
+                )
+            except FileNotFoundError:
+                pass
+
+    return num_remaining
+
+
+def _get_warm_container_sweeper_lock() -> filelock.FileLock:
+    lock_folder = os.path.join(get_default_cache_folder(), "docker_locks")
+    os.makedirs(lock_folder, exist_ok=True)
+    return filelock.FileLock(os.path.join(lock_folder, "warm_container_sweeper.lock"))
+
+
+async def _start_warm_container_sweeper(idle_timeout_secs: float) -> None:
+    """
+    evict_idle_warm_containers only runs when a job finishes, so without this, nothing
+    would remove the last warm container once it has been idle for idle_timeout_secs.
+    This makes sure that there's a process running _sweep_warm_containers. Like
+    deallocate_jobs in run_job_local_main, the sweeper is a separate process so that it
+    keeps running after the current process exits.
+    """
+    lock = _get_warm_container_sweeper_lock()
+    try:
+        lock.acquire(timeout=0)
+    except filelock.Timeout:
+        # there's already a sweeper running
+        return
+    lock.release()
+
+    await asyncio.subprocess.create_subprocess_exec(
+        sys.executable,
+        __file__,
+        "--idle-timeout-secs",
+        str(idle_timeout_secs),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+async def _sweep_warm_containers(
+    idle_timeout_secs: float, poll_interval_secs: float
+) -> None:
+    """
+    Calls evict_idle_warm_containers every poll_interval_secs until there are no warm
+    containers left. Only one process at a time on this machine does this, if another
+    process is already sweeping, returns immediately.
+    """
+    lock = _get_warm_container_sweeper_lock()
+    while True:
+        try:
+            lock.acquire(timeout=0)
+        except filelock.Timeout:
+            return
+        try:
+            while await evict_idle_warm_containers(idle_timeout_secs) > 0:
+                await asyncio.sleep(poll_interval_secs)
+        finally:
+            lock.release()
+
+        # A warm container might have been released after our last check but before we
+        # released the lock, in which case _start_warm_container_sweeper would have
+        # seen that we were still running, so we need to check one more time
+        if not await _list_warm_containers():
+            return
 
 
 async def get_image_environment_variables(image: str) -> Optional[List[str]]:
@@ -438,15 +865,19 @@ async def get_image_environment_variables(image: str) -> Optional[List[str]]:
     Returns a list of strings like ["PATH=/foo/bar", "PYTHON_VERSION=3.9.7"] for the
     image that we have locally.
     """
-    async with aiodocker.Docker() as client:
-        return (await client.images.inspect(image))["ContainerConfig"]["Env"]
+    metadata = await _inspect_image(image)
+    if metadata is None:
+        raise ValueError(f"Image {image} does not exist locally")
+    return metadata["ContainerConfig"]["Env"]
 
 
 async def delete_image(image: str) -> None:
     """Deletes the specified image, used for testing"""
+    # image might be an image id, which could correspond to any of the image names we
+    # have cached
+    _IMAGE_METADATA.clear()
     try:
-        async with aiodocker.Docker() as client:
-            await client.images.delete(image, force=True)
+        await _get_client().images.delete(image, force=True)
     except aiodocker.DockerError as e:
         # ignore failures saying the image doesn't exist
         if e.status != 404:
@@ -458,22 +889,34 @@ async def delete_images_from_repository(repository: str) -> None:
     Deletes all images repository@<digest> or a tag repository:<tag>. Warning: deletes
     images even if there are other labels pointing to those images. Used for testing.
     """
-    async with aiodocker.Docker() as client:
-        delete_tasks = []
-        for image in await client.images.list():
-            if (
-                image["RepoDigests"]
-                and any(
-                    digest.startswith(f"{repository}@")
-                    for digest in image["RepoDigests"]
-                )
-            ) or (
-                image["RepoTags"]
-                and any(tag.startswith(f"{repository}:") for tag in image["RepoTags"])
-            ):
-                image_id = image["Id"]
-                print(f"Will delete image id: {image_id}")
-                delete_tasks.append(delete_image(image_id))
-
-        if delete_tasks:
-            await asyncio.wait(delete_tasks)
+    delete_tasks = []
+    for image in await _get_client().images.list():
+        if (
+            image["RepoDigests"]
+            and any(
+                digest.startswith(f"{repository}@") for digest in image["RepoDigests"]
+            )
+        ) or (
+            image["RepoTags"]
+            and any(tag.startswith(f"{repository}:") for tag in image["RepoTags"])
+        ):
+            image_id = image["Id"]
+            print(f"Will delete image id: {image_id}")
+            delete_tasks.append(delete_image(image_id))
+
+    if delete_tasks:
+        await asyncio.wait(delete_tasks)
+
+
+async def _warm_container_sweeper_main(idle_timeout_secs: float) -> None:
+    try:
+        await _sweep_warm_containers(idle_timeout_secs, max(idle_timeout_secs / 2, 1))
+    finally:
+        await close_client()
+
+
+if __name__ == "__main__":
+    # see _start_warm_container_sweeper
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--idle-timeout-secs", type=float, required=True)
+    asyncio.run(_warm_container_sweeper_main(parser.parse_args().idle_timeout_secs))
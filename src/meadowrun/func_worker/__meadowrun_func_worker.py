@@ -9,11 +9,66 @@ Lots of parallels to grid_worker.py
 
 import importlib  # available in python 3.1+
 import argparse  # available in python 3.2+
+import os
 import pickle
+import struct
 import traceback
-
-
-def main():
+from typing import Any, BinaryIO, List  # available in python 3.5+
+
+# When --result-buffers-path is specified, out-of-band buffers (e.g. the data in numpy
+# arrays) at least this big get written to that file rather than into the result pickle
+_MIN_OUT_OF_BAND_BUFFER_SIZE = 64 * 1024
+# Buffers in the result buffers file start at multiples of this, so that e.g. numpy
+# arrays backed by them are aligned
+_BUFFER_ALIGNMENT = 64
+
+
+def _dump_with_out_of_band_buffers(
+    result: Any, f: BinaryIO, protocol: int, buffers_path: str
+) -> None:
+    """
+    Pickles result to f, but writes large buffers to buffers_path. buffers_path should
+    be in shared memory (e.g. /dev/shm) so that the caller can map the file and unpickle
+    the buffers without copying them (see run_job_local._load_result). The file has the
+    number of buffers and then the (offset, length) of each buffer as 8-byte
+    little-endian integers, followed by the buffers. If there are no large buffers, we
+    don't create the file.
+    """
+    buffers: List[memoryview] = []
+
+    def buffer_callback(buffer: pickle.PickleBuffer) -> bool:
+        # returning True means the buffer gets pickled in-band as usual
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # not contiguous
+            return True
+        if raw.nbytes < _MIN_OUT_OF_BAND_BUFFER_SIZE:
+            return True
+        buffers.append(raw)
+        return False
+
+    pickle.dump(result, f, protocol=protocol, buffer_callback=buffer_callback)
+    if not buffers:
+        return
+
+    header = [len(buffers)]
+    position = 8 + 16 * len(buffers)
+    for buffer in buffers:
+        position += -position % _BUFFER_ALIGNMENT
+        header.extend((position, buffer.nbytes))
+        position += buffer.nbytes
+
+    # only readable by the current user
+    fd = os.open(buffers_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as buffers_file:
+        buffers_file.write(struct.pack(f"<{len(header)}Q", *header))
+        for i, buffer in enumerate(buffers):
+            buffers_file.write(b"\0" * (header[1 + 2 * i] - buffers_file.tell()))
+            buffers_file.write(buffer)
+
+
+def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--module-name")
     parser.add_argument("--function-name")
@@ -21,6 +76,7 @@ def main():
     parser.add_argument("--has-pickled-function", action="store_true")
     parser.add_argument("--has-pickled-arguments", action="store_true")
     parser.add_argument("--result-highest-pickle-protocol", type=int, required=True)
+    parser.add_argument("--result-buffers-path")
 
     args = parser.parse_args()
 
@@ -85,7 +141,13 @@ def main():
         with open(state_filename, "w", encoding="utf-8") as state_text_writer:
             state_text_writer.write("SUCCEEDED")
         with open(result_filename, "wb") as f:
-            pickle.dump(result, f, protocol=result_pickle_protocol)
+            # out-of-band buffers were introduced in pickle protocol 5
+            if args.result_buffers_path and result_pickle_protocol >= 5:
+                _dump_with_out_of_band_buffers(
+                    result, f, result_pickle_protocol, args.result_buffers_path
+                )
+            else:
+                pickle.dump(result, f, protocol=result_pickle_protocol)
 
 
 if __name__ == "__main__":
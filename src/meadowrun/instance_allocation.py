@@ -1,17 +1,35 @@
 from __future__ import annotations
 
 import abc
+import asyncio
 import dataclasses
+import datetime
+import heapq
+import random
 import uuid
 from types import TracebackType
-from typing import List, Tuple, Dict, Any, Optional, Sequence, Type, TypeVar, Generic
+from typing import (
+    List,
+    Tuple,
+    Dict,
+    Any,
+    Optional,
+    Sequence,
+    Set,
+    Type,
+    TypeVar,
+    Generic,
+)
 
+from meadowrun.config import (
+    ALLOCATION_BATCH_WINDOW_SECS,
+    REGISTERED_INSTANCES_FULL_REFRESH_SECS,
+)
 from meadowrun.instance_selection import (
     CloudInstance,
     Resources,
     remaining_resources_sort_key,
 )
-from meadowrun.shared import assert_is_not_none
 from meadowrun.run_job_core import AllocCloudInstancesInternal
 
 
@@ -99,14 +117,55 @@ class InstanceRegistrar(abc.ABC, Generic[_TInstanceState]):
         pass
 
     @abc.abstractmethod
-    async def get_registered_instances(self) -> List[_TInstanceState]:
+    async def get_registered_instances(
+        self, resources_required: Optional[Resources] = None
+    ) -> List[_TInstanceState]:
         """
         Gets all registered instances. Must have available_resources populated.
         running_jobs is optional depending on whether the corresponding implementation
         of allocate_jobs_to_instance will need it.
+
+        resources_required is a hint--if it is provided, implementations can (but don't
+        have to) leave out instances that don't have enough available resources to run
+        even a single job that requires resources_required.
         """
         pass
 
+    async def get_registered_instances_changed_since(
+        self, since: datetime.datetime
+    ) -> Optional[List[_TInstanceState]]:
+        """
+        Gets the registered instances that have been registered or updated (i.e. had
+        jobs allocated/deallocated) since the specified time (a naive datetime in UTC).
+        The same fields must be populated as for get_registered_instances. Instances
+        that have been deregistered will not be returned.
+
+        This lets _get_registered_instances_cached refresh a cached view of the
+        registered instances without reading every instance. Implementations that can't
+        do this more cheaply than get_registered_instances should return None.
+        """
+        return None
+
+    async def get_registered_instances_by_address(
+        self, public_addresses: Sequence[str]
+    ) -> List[_TInstanceState]:
+        """
+        Gets the current state of just the specified registered instances. The same
+        fields must be populated as for get_registered_instances. Instances that are not
+        registered will be left out of the result.
+
+        _choose_existing_instances uses this to get fresh reads of the instances where
+        allocate_jobs_to_multiple_instances failed. The default implementation reads
+        every registered instance, implementations should override this if they can
+        read specific instances more cheaply.
+        """
+        public_addresses_set = set(public_addresses)
+        return [
+            instance
+            for instance in await self.get_registered_instances()
+            if instance.public_address in public_addresses_set
+        ]
+
     @abc.abstractmethod
     async def get_registered_instance(self, public_address: str) -> _TInstanceState:
         """
@@ -138,6 +197,33 @@ class InstanceRegistrar(abc.ABC, Generic[_TInstanceState]):
         """
         pass
 
+    async def allocate_jobs_to_multiple_instances(
+        self,
+        allocations: Sequence[Tuple[_TInstanceState, List[str]]],
+        resources_allocated_per_job: Resources,
+    ) -> List[bool]:
+        """
+        allocations is [(instance, new_job_ids)]. Equivalent to calling
+        allocate_jobs_to_instance for each allocation, and returns whether each
+        allocation succeeded. The instances must be distinct.
+
+        Implementations can override this to make fewer round trips, e.g. by applying
+        the allocations in atomic chunks. Each allocation must still succeed or fail
+        independently from the point of view of the caller, i.e. if a chunk fails
+        because of some of its allocations, the rest of the allocations in that chunk
+        should be retried.
+        """
+        return list(
+            await asyncio.gather(
+                *(
+                    self.allocate_jobs_to_instance(
+                        instance, resources_allocated_per_job, new_job_ids
+                    )
+                    for instance, new_job_ids in allocations
+                )
+            )
+        )
+
     @abc.abstractmethod
     async def deallocate_job_from_instance(
         self, instance: _TInstanceState, job_id: str
@@ -162,6 +248,118 @@ class InstanceRegistrar(abc.ABC, Generic[_TInstanceState]):
         pass
 
 
+@dataclasses.dataclass
+class _RegisteredInstancesCache:
+    # naive datetimes in UTC
+    full_refresh_time: datetime.datetime
+    refresh_time: datetime.datetime
+    instances: Dict[str, _InstanceState]
+
+
+# Cached views of the registered instances, keyed by (type of InstanceRegistrar, region
+# name, memory_gb required, logical_cpu required). A client that submits many jobs would
+# otherwise need to read every registered instance for every job
+_REGISTERED_INSTANCES_CACHE: Dict[
+    Tuple[str, str, float, float], _RegisteredInstancesCache
+] = {}
+# Updates are (usually) timestamped using the clock of the machine making the update, so
+# we ask for changes from a bit before our last refresh in case other clocks are behind
+_CLOCK_SKEW_MARGIN = datetime.timedelta(seconds=30)
+
+
+def _registered_instances_cache_key(
+    instance_registrar: InstanceRegistrar, resources_required: Resources
+) -> Tuple[str, str, float, float]:
+    return (
+        type(instance_registrar).__name__,
+        instance_registrar.get_region_name(),
+        resources_required.memory_gb,
+        resources_required.logical_cpu,
+    )
+
+
+async def _get_registered_instances_cached(
+    instance_registrar: InstanceRegistrar, resources_required: Resources
+) -> List[_InstanceState]:
+    """
+    Like instance_registrar.get_registered_instances, but keeps a cached view of the
+    registered instances, and only asks the InstanceRegistrar for the instances that
+    have changed since the last time we refreshed the view.
+
+    The view can be out of date, e.g. it will still have instances that have been
+    deregistered until the next full refresh. That's okay because
+    allocate_jobs_to_instance has an optimistic concurrency check, so an out of date
+    view just means that an allocation fails, and then we fix the view with
+    _refresh_registered_instances_cached.
+    """
+    key = _registered_instances_cache_key(instance_registrar, resources_required)
+    now = datetime.datetime.utcnow()
+    cached = _REGISTERED_INSTANCES_CACHE.get(key)
+    if (
+        cached is not None
+        and (now - cached.full_refresh_time).total_seconds()
+        < REGISTERED_INSTANCES_FULL_REFRESH_SECS
+    ):
+        changed_instances = (
+            await instance_registrar.get_registered_instances_changed_since(
+                cached.refresh_time - _CLOCK_SKEW_MARGIN
+            )
+        )
+        if changed_instances is not None:
+            cached.refresh_time = now
+            for instance in changed_instances:
+                cached.instances[instance.public_address] = instance
+            # changed_instances isn't filtered by resources_required
+            return [
+                instance
+                for instance in cached.instances.values()
+                if instance.get_available_resources().subtract(resources_required)
+                is not None
+            ]
+
+    instances = await instance_registrar.get_registered_instances(resources_required)
+    _REGISTERED_INSTANCES_CACHE[key] = _RegisteredInstancesCache(
+        now, now, {instance.public_address: instance for instance in instances}
+    )
+    return instances
+
+
+async def _refresh_registered_instances_cached(
+    instance_registrar: InstanceRegistrar,
+    resources_required: Resources,
+    public_addresses: Sequence[str],
+) -> List[_InstanceState]:
+    """
+    Gets fresh reads of just the specified instances (e.g. because an allocation to them
+    failed), updates the cached view from _get_registered_instances_cached with them,
+    and returns the ones that have room for resources_required.
+    """
+    instances = await instance_registrar.get_registered_instances_by_address(
+        public_addresses
+    )
+
+    cached = _REGISTERED_INSTANCES_CACHE.get(
+        _registered_instances_cache_key(instance_registrar, resources_required)
+    )
+    if cached is not None:
+        # instances that weren't returned have been deregistered
+        for public_address in public_addresses:
+            cached.instances.pop(public_address, None)
+        for instance in instances:
+            cached.instances[instance.public_address] = instance
+
+    return [
+        instance
+        for instance in instances
+        if instance.get_available_resources().subtract(resources_required) is not None
+    ]
+
+
+# How many times _choose_existing_instances will try to allocate jobs before giving up
+# on the remaining jobs
+_MAX_ALLOCATION_ATTEMPTS = 5
+
+
 @dataclasses.dataclass
 class _InstanceWithProposedJobs:
     """Just used in _choose_existing_instances"""
@@ -189,82 +387,122 @@ async def _choose_existing_instances(
     # {public_address: [job_ids]}
     allocated_jobs: Dict[str, List[str]] = {}
 
-    # try to allocate a maximum of 3 times. We will retry if there's an optimistic
-    # concurrency issue (i.e. someone else allocates to an instance at the same time
-    # as us). Failing just means that we're unable to allocate the jobs.
-    i = 0
-    all_success = False
-    while i < 3 and not all_success:
-        instances = [
+    instances = await _get_registered_instances_cached(
+        instance_registrar, resources_required_per_job
+    )
+
+    # We will retry if there's an optimistic concurrency issue (i.e. someone else
+    # allocates to an instance at the same time as us). Each retry only re-plans the
+    # jobs that failed to allocate, using fresh reads of just the instances where the
+    # allocation failed, so retrying is cheap and we only give up (and launch new
+    # instances) if we keep losing races. Failing just means that we're unable to
+    # allocate the jobs.
+    for _ in range(_MAX_ALLOCATION_ATTEMPTS):
+        proposed_instances = [
             _InstanceWithProposedJobs(instance, [], instance.get_available_resources())
-            for instance in await instance_registrar.get_registered_instances()
+            for instance in instances
         ]
 
-        sort_keys = [
-            remaining_resources_sort_key(
+        # A heap of (sort_key, tie_breaker, index into proposed_instances). Including
+        # the index means we never need to compare _InstanceWithProposedJobs.
+        # Instances that can't run even one job are dropped up front.
+        #
+        # Ties are broken randomly. Otherwise concurrent clients with the same view of
+        # the registered instances would all choose the same instances, only one of
+        # them would win each time, and the rest would keep retrying on the same
+        # instances.
+        heap: List[Tuple[Tuple[int, Optional[Tuple[float, float]]], float, int]] = []
+        for index, instance in enumerate(proposed_instances):
+            sort_key = remaining_resources_sort_key(
                 instance.proposed_available_resources, resources_required_per_job
             )
-            for instance in instances
-        ]
+            if sort_key[0] == 0:
+                heap.append((sort_key, random.random(), index))
+        heapq.heapify(heap)
 
         # these represent proposed allocations--they are not actually allocated
         # until we update InstanceRegistrar
         num_jobs_proposed = 0
 
-        if sort_keys:
+        while heap and num_jobs_allocated + num_jobs_proposed < num_jobs:
+            # choose the instance that will have the fewest resources left over
+            _, _, chosen_index = heapq.heappop(heap)
+            chosen_instance = proposed_instances[chosen_index]
+
+            # Allocating a job to an instance can only decrease its sort key, which
+            # means that the chosen instance will keep being the best choice until it
+            # can't fit any more jobs. So rather than pushing it back onto the heap
+            # after every job, we just keep allocating jobs to it until it's full. This
+            # makes the whole loop O(jobs + instances * log(instances)) instead of
+            # O(jobs * instances)
             while num_jobs_allocated + num_jobs_proposed < num_jobs:
-                # choose an instance
-                chosen_index = min(range(len(sort_keys)), key=lambda i: sort_keys[i])
-                # if the indicator is 1, that means none of the instances can run our
-                # job
-                if sort_keys[chosen_index][0] == 1:
+                remaining_resources = (
+                    chosen_instance.proposed_available_resources.subtract(
+                        resources_required_per_job
+                    )
+                )
+                if remaining_resources is None:
                     break
 
                 # we successfully chose an instance!
-                chosen_instance = instances[chosen_index]
                 chosen_instance.proposed_jobs.append(str(uuid.uuid4()))
                 num_jobs_proposed += 1
-
                 # decrease the agent's available_resources
-                chosen_instance.proposed_available_resources = assert_is_not_none(
-                    (
-                        chosen_instance.proposed_available_resources.subtract(
-                            resources_required_per_job
-                        )
-                    )
-                )
-                # decrease the sort key for the chosen agent
-                sort_keys[chosen_index] = remaining_resources_sort_key(
-                    chosen_instance.proposed_available_resources,
-                    resources_required_per_job,
-                )
+                chosen_instance.proposed_available_resources = remaining_resources
+
+        if num_jobs_proposed == 0:
+            break
 
         # now that we've chosen which instance(s) will run our job(s), try to actually
         # get the allocation in the InstanceRegistrar. This could fail if another
         # process is trying to do an allocation at the same time as us so the instances
         # we've chosen actually don't have enough resources (even though they did at the
         # top of this function).
-        all_success = True
-        for instance in instances:
-            if instance.proposed_jobs:
-                success = await instance_registrar.allocate_jobs_to_instance(
-                    # it's very important to pass the orig_instance
-                    # here--allocate_jobs_to_instance can rely on available_resources
-                    # being correct and we want the original one, not the
-                    # proposed_available_resources that we've modified.
-                    instance.orig_instance,
-                    resources_required_per_job,
-                    instance.proposed_jobs,
-                )
-                if success:
-                    allocated_jobs.setdefault(
-                        instance.orig_instance.public_address, []
-                    ).extend(instance.proposed_jobs)
-                    num_jobs_allocated += len(instance.proposed_jobs)
-                else:
-                    all_success = False
-
-        i += 1
+        to_allocate = [
+            instance for instance in proposed_instances if instance.proposed_jobs
+        ]
+        results = await instance_registrar.allocate_jobs_to_multiple_instances(
+            # it's very important to pass the orig_instance here--the InstanceRegistrar
+            # can rely on available_resources being correct and we want the original
+            # one, not the proposed_available_resources that we've modified.
+            [
+                (instance.orig_instance, instance.proposed_jobs)
+                for instance in to_allocate
+            ],
+            resources_required_per_job,
+        )
+        failed_addresses = []
+        for instance, success in zip(to_allocate, results):
+            if success:
+                allocated_jobs.setdefault(
+                    instance.orig_instance.public_address, []
+                ).extend(instance.proposed_jobs)
+                num_jobs_allocated += len(instance.proposed_jobs)
+            else:
+                failed_addresses.append(instance.orig_instance.public_address)
+
+        if not failed_addresses:
+            break
+
+        # For the instances where the allocation succeeded, we know what's left on
+        # them (unless someone else allocated to them in the meantime, or the
+        # InstanceRegistrar's concurrency check is based on something else like
+        # AzureVMInstanceState.etag, in which case we'll find out on the next attempt).
+        # For the instances where the allocation failed, our view is out of date, so we
+        # get fresh reads of just those.
+        failed_addresses_set = set(failed_addresses)
+        instances = [
+            dataclasses.replace(
+                instance.orig_instance,
+                available_resources=instance.proposed_available_resources,
+            )
+            if instance.proposed_jobs
+            else instance.orig_instance
+            for instance in proposed_instances
+            if instance.orig_instance.public_address not in failed_addresses_set
+        ] + await _refresh_registered_instances_cached(
+            instance_registrar, resources_required_per_job, failed_addresses
+        )
 
     if num_jobs == 1:
         if num_jobs_allocated == 0:
@@ -410,3 +648,116 @@ async def allocate_jobs_to_instances(
         )
 
     return allocated
+
+
+@dataclasses.dataclass
+class _AllocationBatch:
+    """See allocate_jobs_to_instances_batched"""
+
+    instance_registrar: InstanceRegistrar
+    alloc_cloud_instances: AllocCloudInstancesInternal
+    # (number of jobs requested, future for the {public_address: [job_ids]})
+    requests: List[Tuple[int, asyncio.Future[Dict[str, List[str]]]]]
+
+
+# Batches that are still accepting requests, keyed by (type of InstanceRegistrar,
+# alloc_cloud_instances with num_concurrent_tasks=0)
+_ALLOCATION_BATCHES: Dict[
+    Tuple[str, AllocCloudInstancesInternal], _AllocationBatch
+] = {}
+# Keeps references to the tasks running batches so that they don't get garbage collected
+# before they finish
+_ALLOCATION_BATCH_TASKS: Set[asyncio.Task[None]] = set()
+
+
+async def _run_allocation_batch(
+    key: Tuple[str, AllocCloudInstancesInternal], batch: _AllocationBatch
+) -> None:
+    try:
+        try:
+            await asyncio.sleep(ALLOCATION_BATCH_WINDOW_SECS)
+        finally:
+            # any requests that come in after this point will go into a new batch. We
+            # also need to do this if we get cancelled, otherwise new requests would get
+            # added to this batch and never complete
+            if _ALLOCATION_BATCHES.get(key) is batch:
+                del _ALLOCATION_BATCHES[key]
+
+        async with batch.instance_registrar as instance_registrar:
+            allocated = await allocate_jobs_to_instances(
+                instance_registrar,
+                dataclasses.replace(
+                    batch.alloc_cloud_instances,
+                    num_concurrent_tasks=sum(
+                        num_jobs for num_jobs, _ in batch.requests
+                    ),
+                ),
+            )
+    except asyncio.CancelledError:
+        # the callers weren't cancelled, so they shouldn't see a CancelledError
+        for _, future in batch.requests:
+            if not future.done():
+                future.set_exception(
+                    ValueError(
+                        "The batch that was allocating these jobs to instances was "
+                        "cancelled"
+                    )
+                )
+        raise
+    except Exception as e:
+        for _, future in batch.requests:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    # Hand out the job ids in order, so that each request's jobs are spread across as
+    # few instances as possible. If a caller was cancelled while waiting, its jobs stay
+    # allocated until deallocate_jobs cleans them up, the same as if the caller crashed
+    # right after allocating
+    all_jobs = [
+        (public_address, job_id)
+        for public_address, job_ids in allocated.items()
+        for job_id in job_ids
+    ]
+    i = 0
+    for num_jobs, future in batch.requests:
+        result: Dict[str, List[str]] = {}
+        for public_address, job_id in all_jobs[i : i + num_jobs]:
+            result.setdefault(public_address, []).append(job_id)
+        i += num_jobs
+        if not future.done():
+            future.set_result(result)
+
+
+async def allocate_jobs_to_instances_batched(
+    instance_registrar: InstanceRegistrar,
+    alloc_cloud_instances: AllocCloudInstancesInternal,
+) -> Dict[str, List[str]]:
+    """
+    Like allocate_jobs_to_instances, but combines requests that come in within
+    ALLOCATION_BATCH_WINDOW_SECS of each other for the same kind of InstanceRegistrar
+    and the same requirements into a single call to allocate_jobs_to_instances. E.g. if
+    a user calls run_function many times concurrently, we'll make one decision about
+    which existing instances to use and what new instances to launch, rather than having
+    each call compete for the same existing instances and launch its own instances.
+
+    instance_registrar should not be entered yet--the batch will enter the
+    instance_registrar from the first request in the batch.
+    """
+    key = (
+        type(instance_registrar).__name__,
+        dataclasses.replace(alloc_cloud_instances, num_concurrent_tasks=0),
+    )
+    batch = _ALLOCATION_BATCHES.get(key)
+    if batch is None:
+        batch = _AllocationBatch(instance_registrar, alloc_cloud_instances, [])
+        _ALLOCATION_BATCHES[key] = batch
+        task = asyncio.create_task(_run_allocation_batch(key, batch))
+        _ALLOCATION_BATCH_TASKS.add(task)
+        task.add_done_callback(_ALLOCATION_BATCH_TASKS.discard)
+
+    future: asyncio.Future[
+        Dict[str, List[str]]
+    ] = asyncio.get_running_loop().create_future()
+    batch.requests.append((alloc_cloud_instances.num_concurrent_tasks, future))
+    return await future
@@ -147,11 +147,28 @@ class CloudInstance:
     instance_type: ChosenCloudInstanceType
 
 
+# The exact solver fills in a table with one entry per worker, and each entry looks at
+# every distinct number of workers-per-instance in the instance type catalog. If that
+# would take more than this many steps, we fall back to the greedy algorithm.
+_EXACT_SOLVER_MAX_STEPS = 5_000_000
+
+# Used by both solvers: instance types whose price per worker is within half a penny per
+# hour of each other are considered to be the same price, and then instance types whose
+# interruption probabilities are within 1% of each other are considered to be equally
+# likely to be interrupted.
+# TODO maybe the rounding should be configurable?
+_PRICE_PER_WORKER_TOLERANCE = 0.005
+_INTERRUPTION_PROBABILITY_TOLERANCE = 1
+
+SolverType = Literal["exact", "greedy"]
+
+
 def choose_instance_types_for_job(
     resources_required: Resources,
     num_workers_to_allocate: int,
     interruption_probability_threshold: float,
     original_instance_types: List[CloudInstanceType],
+    solver: SolverType = "exact",
 ) -> List[ChosenCloudInstanceType]:
     """
     This chooses how many of which instance types we should launch for a job with 1 or
@@ -165,12 +182,46 @@ def choose_instance_types_for_job(
     instance types (it seems that interruptions are more likely to happen at the same
     time on the same instance types).
 
+    solver="exact" finds the cheapest combination of instances that covers
+    num_workers_to_allocate (see _choose_instance_types_exact). If the problem is too
+    big for the exact solver, or solver="greedy", we use a faster greedy algorithm which
+    can over-provision, e.g. allocating a whole extra machine for the last few workers.
+
     TODO we should maybe have an option where e.g. if you want to allocate 53 workers
      worth of capacity for a 100-task job, it makes more sense to allocate e.g. 55 or 60
      workers worth of capacity rather than allocating a little machine for the last 3
      workers of capacity
     """
 
+    instance_types = _get_feasible_instance_types(
+        resources_required,
+        interruption_probability_threshold,
+        original_instance_types,
+    )
+
+    # no instance types can run even one worker
+    if len(instance_types) == 0:
+        return []
+
+    if solver == "exact":
+        result = _choose_instance_types_exact(instance_types, num_workers_to_allocate)
+        if result is not None:
+            return result
+    elif solver != "greedy":
+        raise ValueError(f"Unexpected value for solver {solver}")
+
+    return _choose_instance_types_greedy(instance_types, num_workers_to_allocate)
+
+
+def _get_feasible_instance_types(
+    resources_required: Resources,
+    interruption_probability_threshold: float,
+    original_instance_types: List[CloudInstanceType],
+) -> List[ChosenCloudInstanceType]:
+    """
+    Returns a ChosenCloudInstanceType with num_instances=0 for each instance type that
+    can run at least one worker and is within interruption_probability_threshold
+    """
     instance_types = []
 
     for orig_instance_type in original_instance_types:
@@ -205,10 +256,116 @@ def choose_instance_types_for_job(
                     )
                 )
 
-    # no instance types can run even one worker
-    if len(instance_types) == 0:
+    return instance_types
+
+
+def _choose_instance_types_exact(
+    instance_types: List[ChosenCloudInstanceType], num_workers_to_allocate: int
+) -> Optional[List[ChosenCloudInstanceType]]:
+    """
+    Finds the cheapest set of instances that can run at least num_workers_to_allocate
+    workers. This is an unbounded covering knapsack problem, which we solve with dynamic
+    programming over the number of workers.
+
+    Returns None if the problem is too big to solve in a reasonable amount of time.
+    Modifies num_instances on instance_types.
+    """
+
+    # nothing to do, and min(workers_per_instance_full, 0) would give us options with 0
+    # workers, which we can't compute a price per worker for
+    if num_workers_to_allocate <= 0:
         return []
 
+    # If an instance type can fit more workers than we need, it's equivalent to an
+    # instance type that fits exactly the number of workers we need. For each
+    # (effective) number of workers per instance, only the cheapest instance types are
+    # interesting. Out of those, we prefer the ones with the lowest interruption
+    # probability, and then we'll diversify across whatever instance types are left.
+    by_workers: Dict[int, List[ChosenCloudInstanceType]] = {}
+    for instance_type in instance_types:
+        by_workers.setdefault(
+            min(instance_type.workers_per_instance_full, num_workers_to_allocate), []
+        ).append(instance_type)
+
+    options: List[Tuple[int, float, List[ChosenCloudInstanceType]]] = []
+    for workers, candidates in by_workers.items():
+        best_price = min(candidate.instance_type.price for candidate in candidates)
+        best = [
+            candidate
+            for candidate in candidates
+            if (candidate.instance_type.price - best_price) / workers
+            < _PRICE_PER_WORKER_TOLERANCE
+        ]
+        best_interruption_probability = min(
+            candidate.instance_type.interruption_probability for candidate in best
+        )
+        best = [
+            candidate
+            for candidate in best
+            if candidate.instance_type.interruption_probability
+            - best_interruption_probability
+            < _INTERRUPTION_PROBABILITY_TOLERANCE
+        ]
+        options.append((workers, best_price, best))
+    # iterating from largest to smallest means that when two combinations cost the same
+    # we'll prefer the one with fewer instances
+    options.sort(key=lambda option: option[0], reverse=True)
+    # we can drop any option where there's another option that fits more workers for
+    # the same price or less
+    undominated_options: List[Tuple[int, float, List[ChosenCloudInstanceType]]] = []
+    for option in options:
+        if not undominated_options or option[1] < undominated_options[-1][1]:
+            undominated_options.append(option)
+    options = undominated_options
+
+    if num_workers_to_allocate * len(options) > _EXACT_SOLVER_MAX_STEPS:
+        return None
+
+    # min_cost[n] is the cheapest way to get capacity for at least n workers, and
+    # last_option[n] is the index into options of the last instance type we added to
+    # get that cost.
+    min_cost = [0.0] * (num_workers_to_allocate + 1)
+    last_option = [-1] * (num_workers_to_allocate + 1)
+    for n in range(1, num_workers_to_allocate + 1):
+        best_cost = math.inf
+        best_option = -1
+        for i, (workers, price, _) in enumerate(options):
+            cost = min_cost[max(n - workers, 0)] + price
+            # the epsilon avoids preferring a combination because of floating point
+            # noise
+            if cost < best_cost - 1e-9:
+                best_cost = cost
+                best_option = i
+        min_cost[n] = best_cost
+        last_option[n] = best_option
+
+    num_instances_per_option = [0] * len(options)
+    n = num_workers_to_allocate
+    while n > 0:
+        num_instances_per_option[last_option[n]] += 1
+        n = max(n - options[last_option[n]][0], 0)
+
+    # Round-robin across the equivalent instance types for each option. As in the greedy
+    # algorithm, we want diversity because instances of the same type are more likely
+    # to get interrupted at the same time.
+    for (_, _, candidates), num_instances in zip(options, num_instances_per_option):
+        for i in range(num_instances):
+            candidates[i % len(candidates)].num_instances += 1
+
+    return [
+        instance_type
+        for instance_type in instance_types
+        if instance_type.num_instances > 0
+    ]
+
+
+def _choose_instance_types_greedy(
+    instance_types: List[ChosenCloudInstanceType], num_workers_to_allocate: int
+) -> List[ChosenCloudInstanceType]:
+    """
+    Greedily adds whatever instance type is currently cheapest per worker until we have
+    enough workers. Modifies num_instances on instance_types.
+    """
     while num_workers_to_allocate > 0:
         # for larger instances, there might not be enough num_workers_to_allocate to
         # make it "worth it" to use that larger instance because we won't need enough
@@ -230,14 +387,14 @@ def choose_instance_types_for_job(
         # are multiple instance types that have the same price per worker (or are within
         # half a penny per hour), then take the ones that have the lowest probability of
         # interruption (within 1%)
-        # TODO maybe the rounding should be configurable?
         best_price_per_worker = min(
             instance_type.price_per_worker_current for instance_type in instance_types
         )
         best = [
             instance_type
             for instance_type in instance_types
-            if instance_type.price_per_worker_current - best_price_per_worker < 0.005
+            if instance_type.price_per_worker_current - best_price_per_worker
+            < _PRICE_PER_WORKER_TOLERANCE
         ]
         best_interruption_probability = min(
             instance_type.instance_type.interruption_probability
@@ -248,7 +405,7 @@ def choose_instance_types_for_job(
             for instance_type in best
             if instance_type.instance_type.interruption_probability
             - best_interruption_probability
-            < 1
+            < _INTERRUPTION_PROBABILITY_TOLERANCE
         ]
 
         # At this point, best is the set of instance types that are the cheapest and
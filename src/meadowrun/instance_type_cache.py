@@ -0,0 +1,210 @@
+"""
+A local, on-disk cache for instance type catalogs (i.e. the output of
+_get_ec2_instance_types and get_vm_types). Getting these catalogs from scratch requires
+paging through pricing APIs, spot price history, etc. which can take tens of seconds.
+
+The cache is a folder with one JSON file per catalog (e.g. per cloud provider + region).
+It is shared across processes: writes are atomic, and we use a file lock so that only
+one process at a time fetches a new catalog for a particular key.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+import traceback
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+import filelock
+
+from meadowrun.config import (
+    INSTANCE_TYPES_CACHE_LOCK_TIMEOUT_SECS,
+    INSTANCE_TYPES_MAX_STALE_SECS,
+)
+from meadowrun.instance_selection import CloudInstanceType
+from meadowrun.shared import EventLoopLocks, get_default_cache_folder
+
+# increment this if the format of the cache files changes
+_CACHE_FORMAT_VERSION = 1
+
+# Keeps references to background refresh tasks so that they don't get garbage collected
+# before they finish
+_BACKGROUND_REFRESHES: Set[asyncio.Task[None]] = set()
+
+# In-process locks for _refresh_cache, by cache file path
+_REFRESH_LOCKS = EventLoopLocks()
+_LOCK_POLL_INTERVAL_SECS = 0.1
+
+
+def _read_cache(path: str) -> Optional[Tuple[float, List[CloudInstanceType]]]:
+    """
+    Returns (the time the catalog was fetched, the catalog). Returns None if the cache
+    file doesn't exist or can't be read for any reason
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data["version"] != _CACHE_FORMAT_VERSION:
+            return None
+        # Each instance type is stored as a list of its fields rather than a dict to
+        # keep the file small--catalogs have thousands of entries
+        return data["updated"], [
+            CloudInstanceType(
+                name,
+                memory_gb,
+                logical_cpu,
+                price,
+                interruption_probability,
+                on_demand_or_spot,
+            )
+            for (
+                name,
+                memory_gb,
+                logical_cpu,
+                price,
+                interruption_probability,
+                on_demand_or_spot,
+            ) in data["instance_types"]
+        ]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_cache(path: str, instance_types: List[CloudInstanceType]) -> None:
+    """Writes atomically so that readers never see a partially written file"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "version": _CACHE_FORMAT_VERSION,
+                "updated": time.time(),
+                "instance_types": [
+                    [
+                        instance_type.name,
+                        instance_type.memory_gb,
+                        instance_type.logical_cpu,
+                        instance_type.price,
+                        instance_type.interruption_probability,
+                        instance_type.on_demand_or_spot,
+                    ]
+                    for instance_type in instance_types
+                ],
+            },
+            f,
+            separators=(",", ":"),
+        )
+    os.replace(temp_path, path)
+
+
+async def _refresh_cache(
+    path: str,
+    get_instance_types: Callable[[], Awaitable[List[CloudInstanceType]]],
+    max_age_secs: float,
+    lock_timeout_secs: float,
+) -> List[CloudInstanceType]:
+    """
+    Fetches a new catalog and writes it to the cache. If another process (or coroutine
+    in this process) is already doing this, waits for up to lock_timeout_secs for it to
+    finish, and then uses that result. Raises filelock.Timeout if we time out.
+    """
+    # FileLock.acquire blocks the event loop, and two FileLocks on the same file in the
+    # same process would just block each other, so like docker_controller._host_lock,
+    # we first make sure that only one coroutine in this process is trying to get the
+    # file lock, and then poll for it without blocking
+    deadline = time.monotonic() + lock_timeout_secs
+    lock = _REFRESH_LOCKS.get(path)
+    if lock_timeout_secs <= 0:
+        # asyncio.wait_for with a timeout of 0 would never acquire the lock
+        if lock.locked():
+            raise filelock.Timeout(f"{path}.lock")
+        await lock.acquire()
+    else:
+        try:
+            await asyncio.wait_for(lock.acquire(), lock_timeout_secs)
+        except asyncio.TimeoutError:
+            raise filelock.Timeout(f"{path}.lock")
+
+    try:
+        file_lock = filelock.FileLock(f"{path}.lock")
+        while True:
+            try:
+                file_lock.acquire(timeout=0)
+                break
+            except filelock.Timeout:
+                remaining_secs = deadline - time.monotonic()
+                if remaining_secs <= 0:
+                    raise
+                await asyncio.sleep(min(_LOCK_POLL_INTERVAL_SECS, remaining_secs))
+
+        try:
+            # someone else might have refreshed the cache while we were waiting for the
+            # lock
+            cached = _read_cache(path)
+            if cached is not None and time.time() - cached[0] < max_age_secs:
+                return cached[1]
+
+            instance_types = await get_instance_types()
+            _write_cache(path, instance_types)
+            return instance_types
+        finally:
+            file_lock.release()
+    finally:
+        lock.release()
+
+
+async def _refresh_cache_in_background(
+    path: str,
+    get_instance_types: Callable[[], Awaitable[List[CloudInstanceType]]],
+    max_age_secs: float,
+) -> None:
+    try:
+        # a timeout of 0 means that if another process is already refreshing the cache,
+        # we just let them do it
+        await _refresh_cache(path, get_instance_types, max_age_secs, 0)
+    except filelock.Timeout:
+        pass
+    except Exception:
+        print("Warning, unable to refresh cached instance types:")
+        traceback.print_exc()
+
+
+async def get_cached_instance_types(
+    cache_key: str,
+    get_instance_types: Callable[[], Awaitable[List[CloudInstanceType]]],
+    max_age_secs: float,
+    max_stale_secs: float = INSTANCE_TYPES_MAX_STALE_SECS,
+    cache_folder: Optional[str] = None,
+) -> List[CloudInstanceType]:
+    """
+    Returns the instance type catalog identified by cache_key (e.g. ec2-us-east-2),
+    using get_instance_types to fetch it if necessary.
+
+    If the cached catalog is younger than max_age_secs, we just return it. If it's older
+    than that but younger than max_stale_secs, we still return the cached catalog
+    immediately, but kick off a background task to refresh it for the next caller
+    (stale-while-revalidate). Otherwise, we wait for a new catalog.
+    """
+    if cache_folder is None:
+        cache_folder = get_default_cache_folder()
+    os.makedirs(cache_folder, exist_ok=True)
+    path = os.path.join(cache_folder, f"{cache_key}.json")
+
+    cached = _read_cache(path)
+    if cached is not None:
+        updated, instance_types = cached
+        age = time.time() - updated
+        if age < max_age_secs:
+            return instance_types
+        if age < max_stale_secs:
+            task = asyncio.create_task(
+                _refresh_cache_in_background(path, get_instance_types, max_age_secs)
+            )
+            _BACKGROUND_REFRESHES.add(task)
+            task.add_done_callback(_BACKGROUND_REFRESHES.discard)
+            return instance_types
+
+    return await _refresh_cache(
+        path, get_instance_types, max_age_secs, INSTANCE_TYPES_CACHE_LOCK_TIMEOUT_SECS
+    )
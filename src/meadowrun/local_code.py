@@ -1,9 +1,23 @@
+import hashlib
+import json
 import os
+import posixpath
+import py_compile
 from os.path import realpath, join, splitext
 import sys
 import uuid
 import zipfile
-from typing import Dict, Iterable, List, Set, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from meadowrun.shared import get_default_cache_folder
+
+# Files written by create_manifest end with this suffix, see CodeZipFile
+MANIFEST_SUFFIX = ".manifest.json"
+# increment this if the format of the manifest or the hash cache changes
+_MANIFEST_VERSION = 1
+_HASH_CACHE_FILE_NAME = "local_code_hashes.json"
+# create_manifest keeps compiled bytecode in this folder next to the hash cache
+_BYTECODE_CACHE_FOLDER_NAME = "bytecode"
 
 
 def zip(
@@ -26,21 +40,254 @@ def zip(
     # building, so this is not currently a bottleneck.
     zip_file_path = join(working_dir, str(uuid.uuid4()) + ".zip")
     with zipfile.ZipFile(zip_file_path, "w") as zip_file:
-        for real_path, zip_path in real_paths_to_zip_paths.items():
-            for (dirpath, _, filenames) in os.walk(real_path):
-                for filename in filenames:
-                    ext = splitext(filename)[1]
-                    if ext in extensions:
-                        full = join(dirpath, filename)
-                        full_zip = full.replace(real_path, zip_path, 1)
-                        zip_file.write(
-                            full,
-                            full_zip,
-                        )
+        for full, full_zip in _iter_files_to_zip(real_paths_to_zip_paths, extensions):
+            zip_file.write(
+                full,
+                full_zip,
+            )
 
     return zip_file_path, zip_paths
 
 
+def _iter_files_to_zip(
+    real_paths_to_zip_paths: Dict[str, str], extensions: Iterable[str]
+) -> Iterable[Tuple[str, str]]:
+    """Yields (real path, path in the zip file) for each file that we should zip"""
+    for real_path, zip_path in real_paths_to_zip_paths.items():
+        for (dirpath, _, filenames) in os.walk(real_path):
+            for filename in filenames:
+                ext = splitext(filename)[1]
+                if ext in extensions:
+                    full = join(dirpath, filename)
+                    full_zip = full.replace(real_path, zip_path, 1)
+                    yield full, full_zip
+
+
+def create_manifest(
+    working_dir: str,
+    include_sys_path: bool = True,
+    additional_paths: Iterable[str] = tuple(),
+    extensions: Iterable[str] = (".py",),
+    hash_cache_path: Optional[str] = None,
+    include_bytecode: bool = False,
+) -> Tuple[str, List[str]]:
+    """
+    An alternative to zip that makes it possible to only upload files that have changed.
+    Rather than writing a zip file, writes a manifest file to working_dir that maps each
+    file's path "in the zip file" to a hash of its contents. Returns the path to the
+    manifest file and the paths in the "zip file" that should be added to sys.path, just
+    like zip.
+
+    The manifest also records the local path for each hash, so that the files
+    themselves can be uploaded (see s3.ensure_manifest_uploaded) or copied (see
+    deployment_manager._get_zip_file_code_paths) as needed.
+
+    To avoid reading every file every time, we cache hashes in hash_cache_path (by
+    default in the meadowrun cache folder), keyed on each file's path, modification time
+    and size.
+
+    If include_bytecode is True, the manifest will also include a __pycache__ .pyc file
+    for each .py file compiled by the current interpreter, so that the remote side
+    doesn't need to compile the code on every first import. The .pyc files are
+    hash-based (see PEP 552) rather than timestamp-based, so they are valid regardless
+    of the modification times of the files on the remote side, and compiling the same
+    source always produces the same .pyc file, which means they are only uploaded when
+    the source changes. If the remote interpreter is a different version of Python,
+    they will just be ignored.
+    """
+    paths_to_zip = _get_paths_to_zip(additional_paths, include_sys_path)
+    if not paths_to_zip:
+        raise ValueError("No paths to zip")
+
+    real_paths_to_zip_paths, zip_paths = _consolidate_paths_to_zip(paths_to_zip)
+
+    if hash_cache_path is None:
+        hash_cache_path = join(get_default_cache_folder(), _HASH_CACHE_FILE_NAME)
+    hash_cache = _read_hash_cache(hash_cache_path)
+    # we only keep entries for files we've seen this time, or that aren't under any of
+    # the folders we walked (presumably from a different project)
+    new_hash_cache = {
+        path: entry
+        for path, entry in hash_cache.items()
+        if not any(path.startswith(real_path) for real_path in real_paths_to_zip_paths)
+    }
+
+    def get_digest(path: str) -> str:
+        stat = os.stat(path)
+        entry = hash_cache.get(path)
+        if (
+            entry is not None
+            and entry[0] == stat.st_mtime_ns
+            and entry[1] == stat.st_size
+        ):
+            digest = entry[2]
+        else:
+            digest = hash_file(path)
+        new_hash_cache[path] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    bytecode_cache_folder = join(
+        os.path.dirname(hash_cache_path), _BYTECODE_CACHE_FOLDER_NAME
+    )
+    files = {}
+    sources = {}
+    for full, full_zip in _iter_files_to_zip(real_paths_to_zip_paths, extensions):
+        # Like paths in zip files, paths in the manifest always use / as the separator
+        # so that e.g. a manifest created on Windows can be assembled on Linux (see
+        # deployment_manager._assemble_manifest)
+        path_in_manifest = full_zip.replace(os.sep, "/")
+        digest = get_digest(full)
+        files[path_in_manifest] = digest
+        sources[digest] = full
+
+        if include_bytecode and splitext(full)[1] == ".py":
+            bytecode_path = _get_bytecode(full, digest, bytecode_cache_folder)
+            if bytecode_path is not None:
+                bytecode_digest = get_digest(bytecode_path)
+                files[_get_bytecode_manifest_path(path_in_manifest)] = bytecode_digest
+                sources[bytecode_digest] = bytecode_path
+
+    _write_hash_cache(hash_cache_path, new_hash_cache)
+
+    manifest_path = join(working_dir, get_manifest_hash(files) + MANIFEST_SUFFIX)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        f.write(serialize_manifest(files, sources))
+
+    return manifest_path, zip_paths
+
+
+def _get_bytecode_manifest_path(path_in_manifest: str) -> str:
+    """
+    The equivalent of importlib.util.cache_from_source, but ignores
+    sys.pycache_prefix, as the remote side will look for the .pyc file in __pycache__.
+    path_in_manifest and the result are /-separated, see create_manifest
+    """
+    folder, file_name = posixpath.split(path_in_manifest)
+    return posixpath.join(
+        folder,
+        "__pycache__",
+        f"{splitext(file_name)[0]}.{sys.implementation.cache_tag}.pyc",
+    )
+
+
+def _get_bytecode(
+    source_path: str, digest: str, bytecode_cache_folder: str
+) -> Optional[str]:
+    """
+    Returns the path to a .pyc file for source_path (which has the hash digest) in
+    bytecode_cache_folder, compiling it if we haven't compiled a file with the same
+    contents before. Returns None if the file can't be compiled, e.g. because it has a
+    syntax error--the remote side will just get the same error as it would have without
+    the .pyc file.
+
+    TODO nothing ever cleans up bytecode_cache_folder
+    """
+    bytecode_path = join(
+        bytecode_cache_folder, f"{digest}.{sys.implementation.cache_tag}.pyc"
+    )
+    if not os.path.exists(bytecode_path):
+        os.makedirs(bytecode_cache_folder, exist_ok=True)
+        temp_path = f"{bytecode_path}.{os.getpid()}.tmp"
+        try:
+            # The .pyc file records dfile as the file name of the code, but the import
+            # system replaces that with the actual path when it loads the .pyc file.
+            # Using just the file name means files with the same contents (e.g. empty
+            # __init__.py files) can share the same .pyc file
+            py_compile.compile(
+                source_path,
+                cfile=temp_path,
+                dfile=os.path.basename(source_path),
+                doraise=True,
+                invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+            )
+        except py_compile.PyCompileError:
+            return None
+        os.replace(temp_path, bytecode_path)
+    return bytecode_path
+
+
+def get_manifest_hash(files: Dict[str, str]) -> str:
+    """
+    files is {path in the "zip file": hash of the contents}. Returns a hash that
+    identifies this set of files
+    """
+    return hashlib.blake2b(
+        json.dumps(files, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def serialize_manifest(
+    files: Dict[str, str], sources: Optional[Dict[str, str]] = None
+) -> str:
+    """The inverse of parse_manifest"""
+    manifest: Dict[str, Any] = {"version": _MANIFEST_VERSION, "files": files}
+    if sources is not None:
+        manifest["sources"] = sources
+    return json.dumps(manifest)
+
+
+def parse_manifest(manifest: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """See read_manifest"""
+    parsed = json.loads(manifest)
+    if parsed["version"] != _MANIFEST_VERSION:
+        raise ValueError(
+            f"Unexpected manifest version {parsed['version']}, the client and server "
+            "may be running different versions of meadowrun"
+        )
+    return parsed["files"], parsed.get("sources", {})
+
+
+def read_manifest(manifest_path: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Reads a manifest written by create_manifest. Returns files ({/-separated path in
+    the "zip file": hash}) and sources ({hash: local path}). sources will be empty for
+    manifests that have been uploaded by s3.ensure_manifest_uploaded.
+    """
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return parse_manifest(f.read())
+
+
+def hash_file(path: str) -> str:
+    """Returns the hash that create_manifest uses for the contents of path"""
+    hasher = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _read_hash_cache(path: str) -> Dict[str, List]:
+    """
+    Returns {local path: [st_mtime_ns, st_size, hash]}. Returns an empty dict if the
+    cache doesn't exist or can't be read
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data["version"] != _MANIFEST_VERSION:
+            return {}
+        return data["hashes"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def _write_hash_cache(path: str, hash_cache: Dict[str, List]) -> None:
+    """
+    Writes atomically so that readers never see a partially written file. If two
+    processes write the cache at the same time, the last one wins, which is fine for a
+    cache.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"version": _MANIFEST_VERSION, "hashes": hash_cache},
+            f,
+            separators=(",", ":"),
+        )
+    os.replace(temp_path, path)
+
+
 def _get_paths_to_zip(paths_to_zip: Iterable[str], include_sys_path: bool) -> List[str]:
     paths_to_zip = [realpath(path) for path in paths_to_zip]
     if include_sys_path:
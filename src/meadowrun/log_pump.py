@@ -0,0 +1,162 @@
+"""
+Copies the output of a job to its log file and mirrors it to this process' stdout.
+Jobs can produce a lot of output, so rather than writing each line as it comes in, we
+buffer the output and write it in large chunks on a thread, so that the event loop stays
+responsive and we read from the job's pipe fast enough that the job doesn't get slowed
+down by back-pressure.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import gzip
+import os
+import sys
+import time
+from typing import IO, List, Optional, Union
+
+from meadowrun.config import MEADOWRUN_LOG_CONSOLE_MAX_BYTES_PER_SEC
+
+# The size of the chunks we read from the job's output and write to the log file
+LOG_CHUNK_SIZE = 64 * 1024
+# Output is written at least this often, even if we haven't filled up a chunk yet
+_FLUSH_INTERVAL_SECS = 0.2
+
+
+class LogPump:
+    """
+    Usage:
+
+    async with LogPump(log_file_name) as log_pump:
+        async for data in job_output:
+            await log_pump.write(data)
+
+    If log_file_name ends with .gz, the log file will be gzip compressed.
+
+    If console_max_bytes_per_sec is set, we will mirror at most that many bytes per
+    second to stdout on average (the log file always gets all of the output). Once we
+    exceed the limit, we skip chunks of output until we're under the limit again, so
+    the console shows a sample of the output rather than falling further and further
+    behind.
+    """
+
+    def __init__(
+        self, log_file_name: str, console_max_bytes_per_sec: Optional[float] = None
+    ):
+        self._log_file_name = log_file_name
+        self._console_max_bytes_per_sec = console_max_bytes_per_sec
+
+        self._log_file: Union[IO[bytes], gzip.GzipFile, None] = None
+        self._buffer: List[bytes] = []
+        self._buffered_bytes = 0
+        self._console_buffer: List[bytes] = []
+        # makes sure flushes happen one at a time and in order
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = asyncio.Event()
+
+        # for the console rate limit, a token bucket that holds up to a second's worth
+        # of bytes
+        self._console_allowance = console_max_bytes_per_sec or 0.0
+        self._console_allowance_updated = time.monotonic()
+        self._console_skipped_bytes = 0
+
+    async def __aenter__(self) -> LogPump:
+        if self._log_file_name.endswith(".gz"):
+            self._log_file = gzip.open(self._log_file_name, "wb")
+        else:
+            self._log_file = open(self._log_file_name, "wb")
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:  # type: ignore
+        # We don't cancel _flush_task, as that could leave a write running on a thread
+        # while we start another one
+        self._closing.set()
+        if self._flush_task is not None:
+            await self._flush_task
+        try:
+            await self.flush()
+        finally:
+            if self._console_skipped_bytes:
+                self._console_buffer.append(self._get_skipped_message())
+                await self.flush()
+            if self._log_file is not None:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._log_file.close
+                )
+
+    async def write(self, data: bytes) -> None:
+        self._buffer.append(data)
+        self._buffered_bytes += len(data)
+        self._write_console(data)
+        if self._buffered_bytes >= LOG_CHUNK_SIZE:
+            await self.flush()
+
+    def _write_console(self, data: bytes) -> None:
+        if self._console_max_bytes_per_sec is None:
+            self._console_buffer.append(data)
+            return
+
+        now = time.monotonic()
+        self._console_allowance = min(
+            self._console_max_bytes_per_sec,
+            self._console_allowance
+            + (now - self._console_allowance_updated) * self._console_max_bytes_per_sec,
+        )
+        self._console_allowance_updated = now
+        if len(data) <= self._console_allowance:
+            if self._console_skipped_bytes:
+                self._console_buffer.append(self._get_skipped_message())
+                self._console_skipped_bytes = 0
+            self._console_buffer.append(data)
+            self._console_allowance -= len(data)
+        else:
+            self._console_skipped_bytes += len(data)
+
+    def _get_skipped_message(self) -> bytes:
+        return (
+            f"\n[{self._console_skipped_bytes} bytes of output not shown, see "
+            f"{self._log_file_name}]\n"
+        ).encode("utf-8")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._buffer and not self._console_buffer:
+                return
+            data = b"".join(self._buffer)
+            console_data = b"".join(self._console_buffer)
+            self._buffer.clear()
+            self._buffered_bytes = 0
+            self._console_buffer.clear()
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._write_sync, data, console_data
+            )
+
+    def _write_sync(self, data: bytes, console_data: bytes) -> None:
+        assert self._log_file is not None
+        if data:
+            self._log_file.write(data)
+            self._log_file.flush()
+        if console_data:
+            sys.stdout.buffer.write(console_data)
+            sys.stdout.buffer.flush()
+
+    async def _flush_periodically(self) -> None:
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), _FLUSH_INTERVAL_SECS)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+
+def open_log_pump(log_file_name: str) -> LogPump:
+    """
+    Returns a LogPump for log_file_name, configured based on the environment variables
+    on this machine (see MEADOWRUN_LOG_CONSOLE_MAX_BYTES_PER_SEC)
+    """
+    console_max_bytes_per_sec = os.environ.get(MEADOWRUN_LOG_CONSOLE_MAX_BYTES_PER_SEC)
+    return LogPump(
+        log_file_name,
+        float(console_max_bytes_per_sec) if console_max_bytes_per_sec else None,
+    )
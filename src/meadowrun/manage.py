@@ -12,8 +12,12 @@ from meadowrun.aws_integration.aws_mgmt_lambda_setup import (
 from meadowrun.aws_integration.aws_uninstall import delete_meadowrun_resources
 from meadowrun.aws_integration.ec2_alloc_role import (
     grant_permission_to_secret,
+    update_ec2_alloc_table_access_policy,
     _ensure_ec2_alloc_role,
 )
+from meadowrun.aws_integration.ec2_instance_allocation import (
+    ensure_demand_history_table,
+)
 from meadowrun.aws_integration.ec2_ssh_keys import (
     download_ssh_key as ec2_download_ssh_key,
 )
@@ -25,6 +29,9 @@ from meadowrun.aws_integration.management_lambdas.clean_up import (
     delete_old_task_queues as aws_delete_old_task_queues,
     delete_unused_images as aws_delete_unused_images,
 )
+from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
+    WarmPoolPolicy,
+)
 from meadowrun.azure_integration.azure_meadowrun_core import (
     delete_meadowrun_resource_group,
     ensure_meadowrun_resource_group,
@@ -76,12 +83,20 @@ async def async_main(cloud_provider: CloudProviderType) -> None:
     else:
         raise ValueError(f"Unexpected value for cloud_provider {cloud_provider}")
 
-    subparsers.add_parser(
+    install_parser = subparsers.add_parser(
         "install",
         help=f"Does one-time setup of {lambdas} that automatically periodically clean "
         "up unused temporary resources. Must be re-run when meadowrun is updated "
         f"so that {lambdas} pick up updated code.",
     )
+    if cloud_provider == "EC2":
+        install_parser.add_argument(
+            "--warm-pool-policy",
+            help="A JSON object that determines how idle EC2 instances are retained, "
+            'e.g. \'{"idle_timeout_secs": 300, "min_warm_instances": 1, '
+            '"stop_instead_of_terminate": true}\'. See WarmPoolPolicy for all options. '
+            "If this is not provided, the existing policy is kept.",
+        )
 
     subparsers.add_parser(
         "uninstall",
@@ -128,9 +143,20 @@ async def async_main(cloud_provider: CloudProviderType) -> None:
     if args.command == "install":
         print(f"Creating {lambdas} for cleaning up meadowrun resources")
         if cloud_provider == "EC2":
-            await ensure_ec2_alloc_lambda(True)
+            if args.warm_pool_policy:
+                warm_pool_policy = WarmPoolPolicy.from_json(args.warm_pool_policy)
+            else:
+                warm_pool_policy = None
+            await ensure_ec2_alloc_lambda(True, warm_pool_policy)
             await ensure_clean_up_lambda(True)
             _ensure_ec2_alloc_role(region_name)
+            if (
+                warm_pool_policy is not None
+                and warm_pool_policy.prelaunch_for_forecast_demand
+            ):
+                # run_maps only record their demand if this table exists
+                update_ec2_alloc_table_access_policy(region_name)
+                ensure_demand_history_table(region_name)
         elif cloud_provider == "AzureVM":
             await create_or_update_mgmt_function(get_default_location())
         else:
@@ -162,7 +188,14 @@ async def async_main(cloud_provider: CloudProviderType) -> None:
         if cloud_provider == "EC2":
             if args.clean_active:
                 terminate_all_instances(region_name)
-            _deregister_and_terminate_instances(region_name, datetime.timedelta.min)
+            # also terminate any instances that were stopped for a warm pool
+            _deregister_and_terminate_instances(
+                region_name,
+                datetime.timedelta.min,
+                warm_pool_policy=WarmPoolPolicy(
+                    terminate_stopped_after=datetime.timedelta.min
+                ),
+            )
         elif cloud_provider == "AzureVM":
             resource_group_path = await ensure_meadowrun_resource_group(region_name)
             storage_account = await ensure_meadowrun_storage_account(
@@ -121,18 +121,25 @@ class Deployment:
             )
         interpreter = EnvironmentSpec(
             environment_type=EnvironmentType.CONDA,
-            spec=await env_export(conda_env),
+            # an explicit spec means we don't need to run the solver on the remote
+            # side, and we'll get exactly the same packages
+            spec=await env_export(conda_env, explicit=True),
         )
 
         code: CodeDeployment = ServerAvailableFolder(code_paths=[])
         # annoyingly, this tmp dir now gets deleted in run_local when the file
         # has been uploaded/unpacked depending on the Host implementation
         tmp_dir = tempfile.mkdtemp()
-        zip_file_path, zip_paths = local_code.zip(
-            tmp_dir, include_sys_path, additional_paths
+        # rather than a zip file, we create a manifest so that we only need to upload
+        # files that have changed since the last time
+        # We include bytecode compiled by this interpreter, which will usually be the
+        # same version of python as the remote environment, as the remote environment
+        # mirrors the local conda environment.
+        manifest_path, zip_paths = local_code.create_manifest(
+            tmp_dir, include_sys_path, additional_paths, include_bytecode=True
         )
 
-        url = urllib.parse.urlunparse(("file", "", zip_file_path, "", "", ""))
+        url = urllib.parse.urlunparse(("file", "", manifest_path, "", "", ""))
         code = CodeZipFile(url=url, code_paths=zip_paths)
 
         return cls(interpreter, code, environment_variables, [])
@@ -161,7 +168,9 @@ class Deployment:
             conda_yml_file: a file (relative to the repo, note that this IGNORES
                 `path_to_source`) file generated by `conda env export`, e.g.
                 `envs/myenv.yml`. This file will be used to generate the environment to
-                run in.
+                run in. This can also be an explicit spec generated by
+                `conda list --explicit`, which is faster to create and fully
+                reproducible, as it doesn't require running the conda solver.
             environment_variables: e.g. `{"PYTHONHASHSEED": "0"}`. These environment
                 variables will be set in the remote environment
             ssh_key_aws_secret: The name of an AWS secret that contains the contents
@@ -334,6 +343,9 @@ async def _prepare_code_deployment(
     code_deploy: Union[CodeDeployment, VersionedCodeDeployment],
     target: _DeploymentTarget,
 ) -> Union[CodeDeployment, VersionedCodeDeployment]:
+    if isinstance(code_deploy, GitRepoBranch):
+        return await _resolve_git_branch(code_deploy)
+
     if not isinstance(code_deploy, CodeZipFile):
         return code_deploy
 
@@ -344,7 +356,10 @@ async def _prepare_code_deployment(
         file_url = urllib.parse.urlparse(code_deploy.url)
         if file_url.scheme != "file":
             raise ValueError(f"Expected file URI: {code_deploy.url}")
-        bucket_name, object_name = await s3.ensure_uploaded(file_url.path)
+        if file_url.path.endswith(local_code.MANIFEST_SUFFIX):
+            bucket_name, object_name = await s3.ensure_manifest_uploaded(file_url.path)
+        else:
+            bucket_name, object_name = await s3.ensure_uploaded(file_url.path)
         s3_url = urllib.parse.urlunparse(("s3", bucket_name, object_name, "", "", ""))
         code_deploy.url = s3_url
         shutil.rmtree(os.path.dirname(file_url.path), ignore_errors=True)
@@ -355,6 +370,53 @@ async def _prepare_code_deployment(
         raise ValueError(f"Unexpected value for target {target}")
 
 
+_GIT_LS_REMOTE_TIMEOUT_SECS = 30
+
+
+async def _resolve_git_branch(
+    code_deploy: GitRepoBranch,
+) -> Union[GitRepoBranch, GitRepoCommit]:
+    """
+    Turns a GitRepoBranch into a GitRepoCommit by looking up the branch's current
+    commit with git ls-remote. This means that all of the workers in a run_map get the
+    same commit, and the remote side can use its existing local copy of the commit
+    without fetching. If we can't look up the branch (e.g. git isn't installed, or only
+    the remote side has credentials for the repo), we just return the GitRepoBranch,
+    and the remote side will resolve the branch itself.
+    """
+    try:
+        p = await asyncio.create_subprocess_exec(
+            "git",
+            "ls-remote",
+            code_deploy.repo_url,
+            f"refs/heads/{code_deploy.branch}",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # don't prompt for a username/password
+            env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(
+                p.communicate(), _GIT_LS_REMOTE_TIMEOUT_SECS
+            )
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()
+            return code_deploy
+    except OSError:
+        return code_deploy
+
+    lines = stdout.decode("utf-8").splitlines()
+    if p.returncode != 0 or len(lines) != 1:
+        return code_deploy
+
+    return GitRepoCommit(
+        repo_url=code_deploy.repo_url,
+        commit=lines[0].split()[0],
+        path_to_source=code_deploy.path_to_source,
+    )
+
+
 @dataclasses.dataclass(frozen=True)
 class AllocCloudInstance(Host):
     """
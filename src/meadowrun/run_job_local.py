@@ -4,12 +4,15 @@ import asyncio
 import asyncio.subprocess
 import dataclasses
 import itertools
+import mmap
 import os
 import os.path
 import pathlib
 import pickle
 import shutil
+import struct
 import sys
+import tempfile
 import traceback
 from typing import (
     Any,
@@ -20,17 +23,24 @@ from typing import (
     Optional,
     Sequence,
     Tuple,
+    Union,
 )
 
 from typing_extensions import Literal
 
-from meadowrun._vendor import aiodocker
 from meadowrun._vendor.aiodocker import containers as aiodocker_containers
+from meadowrun._vendor.aiodocker import execs as aiodocker_execs
+from meadowrun._vendor.aiodocker import stream as aiodocker_stream
 from meadowrun.config import (
+    CONDA_ENVIRONMENTS_NATIVE,
+    LOG_COMPRESSION_GZIP,
     MEADOWRUN_AGENT_PID,
     MEADOWRUN_CODE_MOUNT_LINUX,
+    MEADOWRUN_CONDA_ENVIRONMENTS,
     MEADOWRUN_INTERPRETER,
     MEADOWRUN_IO_MOUNT_LINUX,
+    MEADOWRUN_LOG_COMPRESSION,
+    MEADOWRUN_WARM_CONTAINER_IDLE_TIMEOUT_SECS,
 )
 from meadowrun.credentials import (
     CredentialsDict,
@@ -40,13 +50,19 @@ from meadowrun.credentials import (
 )
 from meadowrun.deployment_manager import (
     compile_environment_spec_to_container,
+    compile_environment_spec_to_interpreter,
     get_code_paths,
 )
 from meadowrun.docker_controller import (
-    run_container,
+    docker_client_scope,
+    exec_in_container,
     get_image_environment_variables,
+    get_warm_container,
     pull_image,
+    release_warm_container,
+    run_container,
 )
+from meadowrun.log_pump import LOG_CHUNK_SIZE, open_log_pump
 from meadowrun.meadowrun_pb2 import (
     Credentials,
     Job,
@@ -115,6 +131,19 @@ def _io_file_container_binds(
     ]
 
 
+def _is_in_io_folder_bind(io_folder: str, bind: Tuple[str, str]) -> bool:
+    """
+    Returns True if bind (e.g. from _io_file_container_binds) is already covered by
+    binding all of io_folder to MEADOWRUN_IO_MOUNT_LINUX
+    """
+    path_on_host, path_in_container = bind
+    return (
+        os.path.normpath(os.path.dirname(path_on_host)) == os.path.normpath(io_folder)
+        and path_in_container
+        == f"{MEADOWRUN_IO_MOUNT_LINUX}/{os.path.basename(path_on_host)}"
+    )
+
+
 def _prepare_py_command(
     job: Job, io_folder: str, is_container: bool
 ) -> _JobSpecTransformed:
@@ -227,12 +256,17 @@ def _prepare_function_arguments(
 
 
 def _prepare_py_function(
-    job: Job, io_folder: str, is_container: bool
+    job: Job,
+    io_folder: str,
+    is_container: bool,
+    result_buffers_path: Optional[str] = None,
 ) -> _JobSpecTransformed:
     """
     Creates files in io_folder for the child process to use and returns
     _JobSpecTransformed. We use __meadowrun_func_worker to start the function in the
     child process.
+
+    result_buffers_path is ignored for containers, see run_local.
     """
 
     io_files = [
@@ -260,6 +294,8 @@ def _prepare_py_function(
         "--io-path",
         io_path_container,
     ]
+    if result_buffers_path is not None and not is_container:
+        command_line.extend(["--result-buffers-path", result_buffers_path])
 
     command_line_for_function, io_files_for_function = _prepare_function(
         job.job_id, job.py_function, io_folder
@@ -404,10 +440,13 @@ async def _non_container_job_continuation(
         # wait for the process to finish
         # TODO add an optional timeout
 
-        with open(log_file_name, "wb") as log_file:
-            async for line in process.stdout:  # type: ignore
-                log_file.write(line)
-                sys.stdout.buffer.write(line)
+        # read in chunks rather than lines, see log_pump
+        async with open_log_pump(log_file_name) as log_pump:
+            while True:
+                data = await process.stdout.read(LOG_CHUNK_SIZE)  # type: ignore
+                if not data:
+                    break
+                await log_pump.write(data)
         returncode = await process.wait()
         return _completed_job_state(
             job_spec_type,
@@ -444,6 +483,10 @@ async def _launch_container_job(
 
     Assumes that the container image has been pulled to this machine already.
 
+    If MEADOWRUN_WARM_CONTAINER_IDLE_TIMEOUT_SECS is set, runs the job in a warm
+    container (see docker_controller.get_warm_container) rather than starting a new
+    container.
+
     Returns (container_id, continuation), see _launch_job for how to use the
     continuation.
     """
@@ -487,6 +530,47 @@ async def _launch_container_job(
             itertools.chain(mounted_code_paths, existing_python_path)
         )
 
+    warm_container_idle_timeout = os.environ.get(
+        MEADOWRUN_WARM_CONTAINER_IDLE_TIMEOUT_SECS
+    )
+    if warm_container_idle_timeout:
+        # The binds are fixed when the warm container is created, so rather than
+        # binding the files for this job, we bind the whole io_folder. The files for
+        # this job end up at the same paths in the container. We still need any other
+        # binds, e.g. for __meadowrun_func_worker.py
+        binds.append((io_folder, MEADOWRUN_IO_MOUNT_LINUX))
+        binds.extend(
+            bind
+            for bind in job_spec_transformed.container_binds
+            if not _is_in_io_folder_bind(io_folder, bind)
+        )
+        container = await get_warm_container(container_image_name, binds)
+
+        print(
+            f"Running in warm container {container.id} ({job_spec_type}): "
+            f"{' '.join(job_spec_transformed.command_line)}; "
+            f"container image={container_image_name}; PYTHONPATH="
+            f"{job_spec_transformed.environment_variables.get('PYTHONPATH')} "
+            f"log_file_name={log_file_name}"
+        )
+        execute, stream = await exec_in_container(
+            container,
+            # json serializer needs a real list, not a protobuf fake list
+            job_spec_transformed.command_line,
+            job_spec_transformed.environment_variables,
+        )
+        return container.id, _exec_job_continuation(
+            container.id,
+            float(warm_container_idle_timeout),
+            execute,
+            stream,
+            job_spec_type,
+            job.job_id,
+            io_folder,
+            job.result_highest_pickle_protocol,
+            log_file_name,
+        )
+
     # now, expose any files we need for communication with the container
     binds.extend(job_spec_transformed.container_binds)
 
@@ -499,7 +583,7 @@ async def _launch_container_job(
         f"log_file_name={log_file_name}"
     )
 
-    container, docker_client = await run_container(
+    container = await run_container(
         container_image_name,
         # json serializer needs a real list, not a protobuf fake list
         job_spec_transformed.command_line,
@@ -508,7 +592,6 @@ async def _launch_container_job(
     )
     return container.id, _container_job_continuation(
         container,
-        docker_client,
         job_spec_type,
         job.job_id,
         io_folder,
@@ -519,7 +602,6 @@ async def _launch_container_job(
 
 async def _container_job_continuation(
     container: aiodocker_containers.DockerContainer,
-    docker_client: aiodocker.Docker,
     job_spec_type: Literal["py_command", "py_function"],
     job_id: str,
     io_folder: str,
@@ -530,8 +612,6 @@ async def _container_job_continuation(
     Writes the container's logs to log_file_name, waits for the container to finish, and
     then returns a ProcessState indicating the state of this container when it
     finished.
-
-    docker_client just needs to be closed when the container process has completed.
     """
     try:
         # Docker appears to have an objection to having a log driver that can produce
@@ -539,10 +619,9 @@ async def _container_job_continuation(
         # that in a hacky way here.
         # TODO figure out overall strategy for logging, maybe eventually implement our
         #  own plain text/whatever log driver for docker.
-        with open(log_file_name, "w", encoding="utf-8") as f:
+        async with open_log_pump(log_file_name) as log_pump:
             async for line in container.log(stdout=True, stderr=True, follow=True):
-                print(line, end="")
-                f.write(line)
+                await log_pump.write(line.encode("utf-8"))
 
         wait_result = await container.wait()
         # as per https://docs.docker.com/engine/api/v1.41/#operation/ContainerWait we
@@ -568,8 +647,58 @@ async def _container_job_continuation(
             state=ProcessStateEnum.ERROR_GETTING_STATE,
             pickled_result=pickle_exception(e, result_highest_pickle_protocol),
         )
+
+
+async def _exec_job_continuation(
+    container_id: str,
+    warm_container_idle_timeout_secs: float,
+    execute: aiodocker_execs.Exec,
+    stream: aiodocker_stream.Stream,
+    job_spec_type: Literal["py_command", "py_function"],
+    job_id: str,
+    io_folder: str,
+    result_highest_pickle_protocol: int,
+    log_file_name: str,
+) -> ProcessState:
+    """
+    Like _container_job_continuation, but for jobs that were started in a warm container
+    with exec_in_container
+    """
+    try:
+        try:
+            async with open_log_pump(log_file_name) as log_pump:
+                while True:
+                    message = await stream.read_out()
+                    if message is None:
+                        break
+                    await log_pump.write(message.data)
+        finally:
+            await stream.close()
+
+        # as per https://docs.docker.com/engine/api/v1.41/#operation/ExecInspect we can
+        # get the return code from the result
+        return_code = (await execute.inspect())["ExitCode"]
+
+        return _completed_job_state(
+            job_spec_type,
+            job_id,
+            io_folder,
+            log_file_name,
+            return_code,
+            None,
+            container_id,
+        )
+    except Exception as e:
+        # there was an exception while trying to get the final ProcessState
+        return ProcessState(
+            state=ProcessStateEnum.ERROR_GETTING_STATE,
+            pickled_result=pickle_exception(e, result_highest_pickle_protocol),
+        )
     finally:
-        await docker_client.__aexit__(None, None, None)
+        try:
+            await release_warm_container(container_id, warm_container_idle_timeout_secs)
+        except Exception as e:
+            print(f"Warning, unable to clean up idle warm containers: {e}")
 
 
 def _completed_job_state(
@@ -650,11 +779,12 @@ def _get_default_working_folder() -> str:
 
 def _set_up_working_folder(
     working_folder: Optional[str],
-) -> Tuple[str, str, str, str, str]:
+) -> Tuple[str, str, str, str, str, str]:
     """
     Sets the working_folder to a default if it's not set, creates the necessary
     subfolders, gets a machine-wide lock on the working folder, then returns io_folder,
-    job_logs_folder, git_repos_folder, local_copies_folder
+    job_logs_folder, git_repos_folder, local_copies_folder, misc_folder,
+    environments_folder
     """
 
     if not working_folder:
@@ -674,12 +804,16 @@ def _set_up_working_folder(
     local_copies_folder = os.path.join(working_folder, "local_copies")
     # misc folder for e.g. storing environment export files sent from local machine
     misc_folder = os.path.join(working_folder, "misc")
+    # holds conda environments and their package cache, see
+    # compile_environment_spec_to_interpreter
+    environments_folder = os.path.join(working_folder, "conda_envs")
 
     os.makedirs(io_folder, exist_ok=True)
     os.makedirs(job_logs_folder, exist_ok=True)
     os.makedirs(git_repos_folder, exist_ok=True)
     os.makedirs(local_copies_folder, exist_ok=True)
     os.makedirs(misc_folder, exist_ok=True)
+    os.makedirs(environments_folder, exist_ok=True)
 
     return (
         io_folder,
@@ -687,6 +821,7 @@ def _set_up_working_folder(
         git_repos_folder,
         local_copies_folder,
         misc_folder,
+        environments_folder,
     )
 
 
@@ -757,11 +892,16 @@ async def run_local(
     job: Job,
     working_folder: Optional[str] = None,
     cloud: Optional[Tuple[CloudProviderType, str]] = None,
+    result_buffers_path: Optional[str] = None,
 ) -> Tuple[ProcessState, Optional[asyncio.Task[ProcessState]]]:
     """
     Runs a job locally using the specified working_folder (or uses the default). Meant
     to be called on the "server" where the client is calling e.g. run_function.
 
+    If result_buffers_path is specified, for py_functions that don't run in a container,
+    large buffers in the result (e.g. numpy arrays) get written to result_buffers_path
+    rather than pickled_result, and the result should be unpickled with _load_result.
+
     Returns a tuple of (initial job state, continuation).
 
     The initial ProcessState will either be RUNNING or RUN_REQUEST_FAILED. If the
@@ -782,6 +922,7 @@ async def run_local(
         git_repos_folder,
         local_copies_folder,
         misc_folder,
+        environments_folder,
     ) = _set_up_working_folder(working_folder)
 
     # unpickle credentials if necessary
@@ -796,9 +937,13 @@ async def run_local(
             git_repos_folder, local_copies_folder, job, code_deployment_credentials
         )
 
-        # next, if we have a environment_spec_in_code, turn into a container
+        # next, if we have a environment_spec_in_code, turn into a container (or a
+        # locally created environment)
 
         interpreter_deployment = job.WhichOneof("interpreter_deployment")
+        native_environments = (
+            os.environ.get(MEADOWRUN_CONDA_ENVIRONMENTS) == CONDA_ENVIRONMENTS_NATIVE
+        )
 
         if interpreter_deployment == "environment_spec_in_code":
             if interpreter_spec_path is None:
@@ -806,21 +951,38 @@ async def run_local(
                     "Cannot specify environment_spec_in_code and not provide any code "
                     "paths"
                 )
-            job.server_available_container.CopyFrom(
-                await compile_environment_spec_to_container(
-                    job.environment_spec_in_code, interpreter_spec_path, cloud
+            if native_environments:
+                job.server_available_interpreter.CopyFrom(
+                    await compile_environment_spec_to_interpreter(
+                        job.environment_spec_in_code,
+                        interpreter_spec_path,
+                        environments_folder,
+                    )
                 )
-            )
-            interpreter_deployment = "server_available_container"
+                interpreter_deployment = "server_available_interpreter"
+            else:
+                job.server_available_container.CopyFrom(
+                    await compile_environment_spec_to_container(
+                        job.environment_spec_in_code, interpreter_spec_path, cloud
+                    )
+                )
+                interpreter_deployment = "server_available_container"
 
         if interpreter_deployment == "environment_spec":
-
-            job.server_available_container.CopyFrom(
-                await compile_environment_spec_to_container(
-                    job.environment_spec, misc_folder, cloud
+            if native_environments:
+                job.server_available_interpreter.CopyFrom(
+                    await compile_environment_spec_to_interpreter(
+                        job.environment_spec, misc_folder, environments_folder
+                    )
                 )
-            )
-            interpreter_deployment = "server_available_container"
+                interpreter_deployment = "server_available_interpreter"
+            else:
+                job.server_available_container.CopyFrom(
+                    await compile_environment_spec_to_container(
+                        job.environment_spec, misc_folder, cloud
+                    )
+                )
+                interpreter_deployment = "server_available_container"
 
         # then decide if we're running in a container or not
 
@@ -839,7 +1001,9 @@ async def run_local(
         if job_spec_type == "py_command":
             job_spec_transformed = _prepare_py_command(job, io_folder, is_container)
         elif job_spec_type == "py_function":
-            job_spec_transformed = _prepare_py_function(job, io_folder, is_container)
+            job_spec_transformed = _prepare_py_function(
+                job, io_folder, is_container, result_buffers_path
+            )
         else:
             raise ValueError(f"Unknown job_spec {job_spec_type}")
 
@@ -865,6 +1029,8 @@ async def run_local(
             job_logs_folder,
             f"{job.job_friendly_name}.{job.job_id}.log",
         )
+        if os.environ.get(MEADOWRUN_LOG_COMPRESSION) == LOG_COMPRESSION_GZIP:
+            log_file_name += ".gz"
 
         # next we need to launch the job depending on how we've specified the
         # interpreter
@@ -943,21 +1109,33 @@ async def run_local(
 @dataclasses.dataclass(frozen=True)
 class LocalHost(Host):
     async def run_job(self, job: Job) -> JobCompletion[Any]:
-        initial_update, continuation = await run_local(job)
-        if (
-            initial_update.state != ProcessState.ProcessStateEnum.RUNNING
-            or continuation is None
-        ):
-            result = initial_update
-        else:
-            result = await continuation
+        result_buffers_path = _get_result_buffers_path(job.job_id)
+        try:
+            # we don't own the event loop, so we can't just close the docker client
+            # when we're done, other jobs might still be using it
+            async with docker_client_scope():
+                initial_update, continuation = await run_local(
+                    job, result_buffers_path=result_buffers_path
+                )
+                if (
+                    initial_update.state != ProcessState.ProcessStateEnum.RUNNING
+                    or continuation is None
+                ):
+                    result = initial_update
+                else:
+                    result = await continuation
+        except BaseException:
+            _remove_if_exists(result_buffers_path)
+            raise
 
         if result.state == ProcessState.ProcessStateEnum.SUCCEEDED:
             job_spec_type = job.WhichOneof("job_spec")
             # we must have a result from functions, in other cases we can optionally
             # have a result
             if job_spec_type == "py_function" or result.pickled_result:
-                unpickled_result = pickle.loads(result.pickled_result)
+                unpickled_result = _load_result(
+                    result.pickled_result, result_buffers_path
+                )
             else:
                 unpickled_result = None
 
@@ -969,4 +1147,62 @@ class LocalHost(Host):
                 "localhost",
             )
         else:
+            _remove_if_exists(result_buffers_path)
             raise MeadowrunException(result)
+
+
+def _get_result_buffers_path(job_id: str) -> str:
+    # /dev/shm is backed by memory on Linux. Elsewhere, we fall back to the temp folder,
+    # which still lets us map the file rather than reading it into memory
+    if os.path.isdir("/dev/shm"):
+        folder = "/dev/shm"
+    else:
+        folder = tempfile.gettempdir()
+    return os.path.join(folder, f"meadowrun_{job_id}.result_buffers")
+
+
+def _remove_if_exists(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _load_result(pickled_result: bytes, result_buffers_path: str) -> Any:
+    """
+    Unpickles a result written by __meadowrun_func_worker with --result-buffers-path
+    (see _dump_with_out_of_band_buffers there). The large buffers in the result (e.g.
+    the data for numpy arrays) will refer directly to the mapped result buffers file
+    rather than being copied (except on Windows, see below).
+    """
+    try:
+        buffers_file = open(result_buffers_path, "rb")
+    except FileNotFoundError:
+        # there weren't any large buffers (or the result was pickled with a protocol
+        # older than 5, which means we're on python 3.7 and can't use buffers anyway)
+        return pickle.loads(pickled_result)
+
+    mapped: Union[mmap.mmap, bytearray]
+    with buffers_file:
+        if sys.platform == "win32":
+            # Windows doesn't let us delete a file while it's mapped, so we have to
+            # read it into memory instead. This is still better than having the buffers
+            # in the pickled result, which requires copying them when unpickling
+            mapped = bytearray(buffers_file.read())
+        else:
+            # ACCESS_COPY means that the result is writable, but writes don't go back
+            # to the file
+            mapped = mmap.mmap(buffers_file.fileno(), 0, access=mmap.ACCESS_COPY)
+    # on Linux/macOS, the mapping stays valid after we delete the file
+    os.remove(result_buffers_path)
+
+    (num_buffers,) = struct.unpack_from("<Q", mapped, 0)
+    header = struct.unpack_from(f"<{2 * num_buffers}Q", mapped, 8)
+    view = memoryview(mapped)
+    return pickle.loads(
+        pickled_result,
+        buffers=[
+            view[offset : offset + length]
+            for offset, length in zip(header[::2], header[1::2])
+        ],
+    )
@@ -10,6 +10,7 @@ import os
 import sys
 from typing import Optional, Tuple
 
+import meadowrun.docker_controller
 import meadowrun.run_job_local
 from meadowrun.meadowrun_pb2 import ProcessState, Job
 from meadowrun.run_job_core import CloudProvider, CloudProviderType
@@ -69,12 +70,25 @@ async def main_async(
         )
 
 
+async def _main_async_and_close_client(
+    job_id: str,
+    working_folder: str,
+    cloud: Optional[Tuple[CloudProviderType, str]],
+) -> None:
+    try:
+        await main_async(job_id, working_folder, cloud)
+    finally:
+        # the shared docker client has to be closed before asyncio.run closes the
+        # event loop
+        await meadowrun.docker_controller.close_client()
+
+
 def main(
     job_id: str,
     working_folder: str,
     cloud: Optional[Tuple[CloudProviderType, str]],
 ) -> None:
-    asyncio.run(main_async(job_id, working_folder, cloud))
+    asyncio.run(_main_async_and_close_client(job_id, working_folder, cloud))
 
 
 def command_line_main() -> None:
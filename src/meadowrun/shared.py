@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import asyncio
+import os
 import pickle
 import traceback
-from typing import Optional, TypeVar
+import weakref
+from typing import Dict, Optional, Tuple, TypeVar
 
 from meadowrun.meadowrun_pb2 import ProcessState
 
@@ -36,3 +39,59 @@ def assert_is_not_none(resources: Optional[_T]) -> _T:
     """A helper for mypy"""
     assert resources is not None
     return resources
+
+
+def get_default_cache_folder() -> str:
+    """
+    A folder for local caches (e.g. instance type catalogs, hashes of local code files)
+    that are shared across processes on the client (or on a host, e.g. docker image
+    locks)
+    """
+    # same idea as run_job_local._get_default_working_folder
+    if os.name == "nt":
+        return os.path.join(os.environ["USERPROFILE"], "meadowrun", "cache")
+    elif os.name == "posix":
+        return os.path.join(os.environ["HOME"], "meadowrun", "cache")
+    else:
+        raise ValueError(f"Unexpected os.name {os.name}")
+
+
+class EventLoopLocks:
+    """
+    asyncio.Locks by name, with a separate set of locks for each event loop. An
+    asyncio.Lock can only be used on one event loop (on Python 3.9 it's bound to the
+    event loop that is current when it's created, on later versions to the first event
+    loop it waits on), so a module-level dictionary of locks breaks as soon as a process
+    calls asyncio.run more than once.
+    """
+
+    def __init__(self) -> None:
+        # id(loop) -> (weak reference to the loop, {name: lock}). The locks reference
+        # their event loop, so we can't key on the event loop itself (see
+        # docker_controller._CLIENTS)
+        self._locks: Dict[
+            int,
+            Tuple[
+                weakref.ReferenceType[asyncio.AbstractEventLoop],
+                Dict[str, asyncio.Lock],
+            ],
+        ] = {}
+
+    def get(self, name: str) -> asyncio.Lock:
+        """Returns the lock for name on the current event loop"""
+        loop = asyncio.get_running_loop()
+        entry = self._locks.get(id(loop))
+        if entry is None or entry[0]() is not loop:
+            # forget the locks for event loops that have been closed
+            for loop_id, (loop_ref, _) in list(self._locks.items()):
+                other_loop = loop_ref()
+                if other_loop is None or other_loop.is_closed():
+                    self._locks.pop(loop_id, None)
+            entry = weakref.ref(loop), {}
+            self._locks[id(loop)] = entry
+
+        lock = entry[1].get(name)
+        if lock is None:
+            lock = asyncio.Lock()
+            entry[1][name] = lock
+        return lock
@@ -0,0 +1,330 @@
+"""
+In-memory stand-ins for the parts of the boto3 EC2 and S3 APIs that meadowrun uses, so
+that code that manages instances and artifacts can be tested without AWS credentials.
+Use FakeEc2.resource and FakeEc2.client in place of boto3.resource("ec2") and
+boto3.client("ec2"), and FakeS3.client in place of boto3.client("s3"), e.g. with
+mocker.patch.
+"""
+
+import datetime
+import hashlib
+import io
+import itertools
+import threading
+from typing import Any, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+
+class FakeEc2Instance:
+    """Mimics a boto3 EC2 Instance resource"""
+
+    def __init__(
+        self,
+        instance_id: str,
+        instance_type: str,
+        state: str,
+        launch_time: datetime.datetime,
+        tags: Dict[str, str],
+        instance_lifecycle: Optional[str],
+    ):
+        self.id = instance_id
+        self.instance_type = instance_type
+        self.state = {"Name": state}
+        self.launch_time = launch_time
+        self.tags = [{"Key": key, "Value": value} for key, value in tags.items()]
+        self.instance_lifecycle = instance_lifecycle
+
+    @property
+    def public_dns_name(self) -> str:
+        # like EC2, only running instances have a public address
+        if self.state["Name"] == "running":
+            return f"{self.id}.compute.example.com"
+        return ""
+
+    def get_tags(self) -> Dict[str, str]:
+        return {tag["Key"]: tag["Value"] for tag in self.tags}
+
+    def create_tags(self, Tags: List[Dict[str, str]]) -> None:
+        tags = self.get_tags()
+        tags.update({tag["Key"]: tag["Value"] for tag in Tags})
+        self.tags = [{"Key": key, "Value": value} for key, value in tags.items()]
+
+    def delete_tags(self, Tags: List[Dict[str, str]]) -> None:
+        keys = {tag["Key"] for tag in Tags}
+        self.tags = [tag for tag in self.tags if tag["Key"] not in keys]
+
+    def stop(self) -> None:
+        self.state = {"Name": "stopped"}
+
+    def start(self) -> None:
+        self.state = {"Name": "running"}
+
+    def terminate(self) -> None:
+        self.state = {"Name": "terminated"}
+
+    def _matches(self, filter_: Dict[str, Any]) -> bool:
+        name, values = filter_["Name"], filter_["Values"]
+        if name == "instance-state-name":
+            return self.state["Name"] in values
+        elif name == "tag-key":
+            return any(key in values for key in self.get_tags())
+        elif name.startswith("tag:"):
+            return self.get_tags().get(name[len("tag:") :]) in values
+        else:
+            raise NotImplementedError(f"Filter {name} is not supported")
+
+
+class _FakeInstanceCollection:
+    def __init__(self, ec2: "FakeEc2"):
+        self._ec2 = ec2
+
+    def filter(self, Filters: List[Dict[str, Any]]) -> List[FakeEc2Instance]:
+        return [
+            instance
+            for instance in self._ec2.instances.values()
+            if all(instance._matches(filter_) for filter_ in Filters)
+        ]
+
+
+class _FakeEc2Resource:
+    def __init__(self, ec2: "FakeEc2"):
+        self.instances = _FakeInstanceCollection(ec2)
+        self._ec2 = ec2
+
+    def create_instances(
+        self, ImageId: str, MinCount: int, MaxCount: int, InstanceType: str, **kwargs
+    ) -> List[FakeEc2Instance]:
+        tags = {}
+        for tag_specification in kwargs.get("TagSpecifications", ()):
+            tags.update({tag["Key"]: tag["Value"] for tag in tag_specification["Tags"]})
+        if "InstanceMarketOptions" in kwargs:
+            instance_lifecycle: Optional[str] = "spot"
+        else:
+            instance_lifecycle = None
+        return [
+            self._ec2.add_instance(InstanceType, "running", tags, instance_lifecycle)
+            for _ in range(MaxCount)
+        ]
+
+
+class _FakeEc2Client:
+    def __init__(self, ec2: "FakeEc2"):
+        self._ec2 = ec2
+
+    def describe_instances(self, InstanceIds: List[str]) -> Dict[str, Any]:
+        return {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "InstanceId": instance_id,
+                            "State": self._ec2.instances[instance_id].state,
+                            "PublicDnsName": self._ec2.instances[
+                                instance_id
+                            ].public_dns_name,
+                        }
+                        for instance_id in InstanceIds
+                    ]
+                }
+            ]
+        }
+
+    def get_waiter(self, waiter_name: str) -> Any:
+        # instances in the stand-in start immediately, so there's nothing to wait for
+        class _Waiter:
+            def wait(self, **kwargs: Any) -> None:
+                pass
+
+        return _Waiter()
+
+    def start_instances(self, InstanceIds: List[str]) -> Dict[str, Any]:
+        starting_instances = []
+        for instance_id in InstanceIds:
+            instance = self._ec2.instances[instance_id]
+            previous_state = instance.state
+            instance.start()
+            starting_instances.append(
+                {
+                    "InstanceId": instance_id,
+                    "CurrentState": instance.state,
+                    "PreviousState": previous_state,
+                }
+            )
+        return {"StartingInstances": starting_instances}
+
+    def terminate_instances(self, InstanceIds: List[str]) -> None:
+        for instance_id in InstanceIds:
+            self._ec2.instances[instance_id].terminate()
+
+    def delete_tags(self, Resources: List[str], Tags: List[Dict[str, str]]) -> None:
+        for instance_id in Resources:
+            self._ec2.instances[instance_id].delete_tags(Tags)
+
+
+class FakeEc2:
+    """Holds the state of all of the fake instances in a single region"""
+
+    def __init__(self) -> None:
+        self.instances: Dict[str, FakeEc2Instance] = {}
+        self._ids = itertools.count()
+
+    def add_instance(
+        self,
+        instance_type: str,
+        state: str = "running",
+        tags: Optional[Dict[str, str]] = None,
+        instance_lifecycle: Optional[str] = None,
+        launch_time: Optional[datetime.datetime] = None,
+    ) -> FakeEc2Instance:
+        instance_id = f"i-{next(self._ids):017x}"
+        if launch_time is None:
+            launch_time = datetime.datetime.now(datetime.timezone.utc)
+        instance = FakeEc2Instance(
+            instance_id,
+            instance_type,
+            state,
+            launch_time,
+            tags or {},
+            instance_lifecycle,
+        )
+        self.instances[instance_id] = instance
+        return instance
+
+    def resource(self, service_name: str, region_name: Optional[str] = None) -> Any:
+        assert service_name == "ec2"
+        return _FakeEc2Resource(self)
+
+    def client(self, service_name: str, region_name: Optional[str] = None) -> Any:
+        assert service_name == "ec2"
+        return _FakeEc2Client(self)
+
+
+class _FakeS3Object:
+    def __init__(self, body: bytes, metadata: Dict[str, str]):
+        self.body = body
+        self.metadata = metadata
+        self.etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakeS3:
+    """
+    Holds the state of all of the fake buckets in a single region. Methods can be
+    called from multiple threads like a real boto3 client. requests counts the calls to
+    each method.
+    """
+
+    def __init__(self) -> None:
+        self.buckets: Dict[str, Dict[str, _FakeS3Object]] = {}
+        self.requests: Dict[str, int] = {}
+        self._multipart_uploads: Dict[str, Dict[str, Any]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def client(self, service_name: str, region_name: Optional[str] = None) -> Any:
+        assert service_name == "s3"
+        return self
+
+    def _count(self, method: str) -> None:
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def _get(self, Bucket: str, Key: str) -> _FakeS3Object:
+        if Key not in self.buckets[Bucket]:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return self.buckets[Bucket][Key]
+
+    def list_buckets(self) -> Dict[str, Any]:
+        self._count("list_buckets")
+        return {"Buckets": [{"Name": name} for name in self.buckets]}
+
+    def create_bucket(self, Bucket: str, **kwargs: Any) -> None:
+        self.buckets[Bucket] = {}
+
+    def put_bucket_lifecycle_configuration(self, **kwargs: Any) -> None:
+        pass
+
+    def head_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        self._count("head_object")
+        obj = self._get(Bucket, Key)
+        return {
+            "ContentLength": len(obj.body),
+            "ETag": obj.etag,
+            "Metadata": obj.metadata,
+        }
+
+    def put_object(
+        self, Bucket: str, Key: str, Body: Any, Metadata: Optional[Dict] = None
+    ) -> None:
+        self._count("put_object")
+        if not isinstance(Body, bytes):
+            Body = Body.read()
+        self.buckets[Bucket][Key] = _FakeS3Object(Body, Metadata or {})
+
+    def get_object(
+        self,
+        Bucket: str,
+        Key: str,
+        Range: Optional[str] = None,
+        IfMatch: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        self._count("get_object")
+        obj = self._get(Bucket, Key)
+        if IfMatch is not None and IfMatch != obj.etag:
+            raise ClientError({"Error": {"Code": "412"}}, "GetObject")
+        body = obj.body
+        if Range is not None:
+            start, end = Range[len("bytes=") :].split("-")
+            body = body[int(start) : int(end) + 1]
+        return {"Body": io.BytesIO(body)}
+
+    def create_multipart_upload(
+        self, Bucket: str, Key: str, Metadata: Dict[str, str]
+    ) -> Dict[str, Any]:
+        self._count("create_multipart_upload")
+        upload_id = str(next(self._ids))
+        self._multipart_uploads[upload_id] = {"metadata": Metadata, "parts": {}}
+        return {"UploadId": upload_id}
+
+    def upload_part(
+        self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes
+    ) -> Dict[str, Any]:
+        self._count("upload_part")
+        etag = f"etag-{PartNumber}"
+        with self._lock:
+            self._multipart_uploads[UploadId]["parts"][PartNumber] = (etag, Body)
+        return {"ETag": etag}
+
+    def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload: Dict[str, Any]
+    ) -> None:
+        upload = self._multipart_uploads.pop(UploadId)
+        body = b""
+        for part in MultipartUpload["Parts"]:
+            etag, part_body = upload["parts"][part["PartNumber"]]
+            assert etag == part["ETag"]
+            body += part_body
+        self.buckets[Bucket][Key] = _FakeS3Object(body, upload["metadata"])
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str) -> None:
+        self._multipart_uploads.pop(UploadId)
+
+    def get_paginator(self, operation_name: str) -> Any:
+        assert operation_name == "list_objects_v2"
+        self._count(operation_name)
+        fake_s3 = self
+
+        class _Paginator:
+            def paginate(self, Bucket: str, Prefix: str) -> List[Dict[str, Any]]:
+                return [
+                    {
+                        "Contents": [
+                            {"Key": key, "LastModified": obj.last_modified}
+                            for key, obj in fake_s3.buckets[Bucket].items()
+                            if key.startswith(Prefix)
+                        ]
+                    }
+                ]
+
+        return _Paginator()
@@ -0,0 +1,121 @@
+"""
+Tests for the entity group transaction ($batch) support in azure_storage_api.py. These
+only test building the request and parsing the response, so they run offline.
+"""
+
+import json
+
+import pytest
+
+from meadowrun.azure_integration.mgmt_functions.azure.azure_exceptions import (
+    ResourceExistsError,
+    ResourceModifiedError,
+)
+from meadowrun.azure_integration.mgmt_functions.azure.azure_storage_api import (
+    StorageAccount,
+    TableBatchOperation,
+    _get_table_batch_body,
+    _get_table_batch_results,
+    table_key_url,
+)
+
+
+def _response(*sub_responses):
+    """Mimics the body of a $batch response, sub_responses are (status line, body)"""
+    lines = ["--batchresponse_1", "Content-Type: multipart/mixed; boundary=cs_1", ""]
+    for i, (status_line, body) in enumerate(sub_responses):
+        lines.extend(
+            [
+                "--cs_1",
+                "Content-Type: application/http",
+                "Content-Transfer-Encoding: binary",
+                "",
+                status_line,
+                f"Content-ID: {i + 1}",
+                "X-Content-Type-Options: nosniff",
+                "DataServiceVersion: 1.0;",
+                f"ETag: W/\"datetime'2022-06-01T00%3A00%3A0{i}Z'\"",
+                "",
+                body,
+            ]
+        )
+    lines.extend(["--cs_1--", "--batchresponse_1--", ""])
+    return "\r\n".join(lines)
+
+
+def test_get_table_batch_body():
+    body = _get_table_batch_body(
+        StorageAccount("account", "", None),
+        [
+            TableBatchOperation(
+                "POST",
+                "table",
+                {"PartitionKey": "p", "RowKey": "job1", "x": 1},
+                {"Prefer": "return-no-content"},
+            ),
+            TableBatchOperation(
+                "DELETE",
+                table_key_url("table", "p", "job2"),
+                additional_headers={"If-Match": "*"},
+            ),
+        ],
+        "batch_1",
+        "changeset_1",
+    )
+    lines = body.split("\r\n")
+
+    assert lines[:2] == [
+        "--batch_1",
+        "Content-Type: multipart/mixed; boundary=changeset_1",
+    ]
+    assert lines.count("--changeset_1") == 2
+    assert lines[-3:] == ["--changeset_1--", "--batch_1--", ""]
+
+    insert_start = lines.index(
+        "POST https://account.table.core.windows.net/table HTTP/1.1"
+    )
+    insert_end = lines.index("", insert_start)
+    assert "Prefer: return-no-content" in lines[insert_start:insert_end]
+    assert json.loads(lines[insert_end + 1]) == {
+        "PartitionKey": "p",
+        "RowKey": "job1",
+        "x": 1,
+    }
+
+    delete_start = lines.index(
+        "DELETE https://account.table.core.windows.net/"
+        "table(PartitionKey='p',RowKey='job2') HTTP/1.1"
+    )
+    assert "If-Match: *" in lines[delete_start : lines.index("", delete_start)]
+
+
+def test_get_table_batch_results():
+    assert _get_table_batch_results(
+        _response(("HTTP/1.1 204 No Content", ""), ("HTTP/1.1 204 No Content", "")),
+        2,
+    ) == [
+        "W/\"datetime'2022-06-01T00%3A00%3A00Z'\"",
+        "W/\"datetime'2022-06-01T00%3A00%3A01Z'\"",
+    ]
+
+    # if an operation fails, we only get the response for that operation
+    with pytest.raises(ResourceModifiedError):
+        _get_table_batch_results(
+            _response(
+                (
+                    "HTTP/1.1 412 Precondition Failed",
+                    json.dumps(
+                        {
+                            "odata.error": {
+                                "code": "UpdateConditionNotSatisfied",
+                                "message": {"lang": "en-US", "value": "1:..."},
+                            }
+                        }
+                    ),
+                )
+            ),
+            2,
+        )
+    # falls back to the status if we don't recognize the code
+    with pytest.raises(ResourceExistsError):
+        _get_table_batch_results(_response(("HTTP/1.1 409 Conflict", "")), 2)
@@ -147,3 +147,183 @@ def test_it():
 
     path = sys.path, sys.prefix, sys.exec_prefix, sys.base_prefix, sys.base_exec_prefix
     print(path)
+
+
+async def _create_environment(args, env_overrides):
+    """Stands in for conda._run when creating environments"""
+    prefix = args[args.index("--prefix") + 1]
+    os.makedirs(os.path.join(prefix, "bin"))
+    assert env_overrides["CONDA_PKGS_DIRS"] == os.path.join(
+        os.path.dirname(prefix), "pkgs"
+    )
+    return "", ""
+
+
+@pytest.mark.asyncio
+async def test_get_cached_environment(mocker: MockerFixture, tmp_path):
+    _run_conda = mocker.patch(_CONDA_RUN_NAME, side_effect=_create_environment)
+    spec_path = os.path.join(tmp_path, "env.yml")
+    with open(spec_path, "w") as f:
+        f.write("dependencies:\n  - python=3.9\n")
+
+    interpreter = await conda.get_cached_environment(spec_path, "ab" * 64, tmp_path)
+    assert interpreter.startswith(os.path.join(tmp_path, "ab" * 16))
+    assert _run_conda.call_count == 1
+
+    # the second time we just reuse the environment
+    assert (
+        await conda.get_cached_environment(spec_path, "ab" * 64, tmp_path)
+        == interpreter
+    )
+    assert _run_conda.call_count == 1
+
+    # an environment that wasn't completed gets recreated
+    os.makedirs(os.path.join(tmp_path, "cd" * 16))
+    await conda.get_cached_environment(spec_path, "cd" * 64, tmp_path)
+    assert _run_conda.call_count == 2
+
+
+def test_spec_hash_ignores_name_and_prefix(tmp_path):
+    from meadowrun.deployment_manager import _get_path_and_hash
+    from meadowrun.meadowrun_pb2 import EnvironmentSpec
+
+    def get_hash(spec):
+        return _get_path_and_hash(EnvironmentSpec(spec=spec), str(tmp_path))[1]
+
+    dependencies = "dependencies:\n  - python=3.9\n"
+    assert get_hash(f"name: env1\n{dependencies}prefix: /home/a/env1\n") == get_hash(
+        f"name: env2\r\n{dependencies}\nprefix: /opt/env2\n"
+    )
+    assert get_hash(dependencies) != get_hash("dependencies:\n  - python=3.10\n")
+
+    # comments in explicit specs are ignored
+    assert get_hash(_EXPLICIT_SPEC) == get_hash(
+        "\n".join(
+            line for line in _EXPLICIT_SPEC.splitlines() if not line.startswith("#")
+        )
+    )
+
+
+_EXPLICIT_SPEC = """# This file may be used to create an environment using:
+# $ conda create --name <env> --file <this file>
+# platform: linux-64
+@EXPLICIT
+https://conda.anaconda.org/conda-forge/linux-64/python-3.9.13-h2660328_0_cpython.tar.bz2#a1
+"""
+
+
+@pytest.mark.asyncio
+async def test_conda_env_export_explicit(mocker: MockerFixture):
+    mocker.patch.dict(os.environ, {"CONDA_PREFIX": "/home/user/anaconda/envs/abc"})
+    _run_conda = mocker.patch(_CONDA_RUN_NAME)
+    _run_conda.side_effect = [
+        (json.dumps([{"name": "python", "channel": "conda-forge"}]), ""),
+        (_EXPLICIT_SPEC, ""),
+    ]
+    result = await conda.env_export(explicit=True)
+    assert result == _EXPLICIT_SPEC
+    assert conda.is_explicit_spec(result)
+
+    # explicit specs can't include pip packages
+    _run_conda.side_effect = [
+        (json.dumps([{"name": "requests", "channel": "pypi"}]), ""),
+        ("some yaml", ""),
+    ]
+    result = await conda.env_export(explicit=True)
+    assert result == "some yaml"
+    assert not conda.is_explicit_spec(result)
+
+
+@pytest.mark.asyncio
+async def test_get_cached_environment_explicit(mocker: MockerFixture, tmp_path):
+    _run_conda = mocker.patch(_CONDA_RUN_NAME, side_effect=_create_environment)
+    spec_path = os.path.join(tmp_path, "explicit.txt")
+    with open(spec_path, "w") as f:
+        f.write(_EXPLICIT_SPEC)
+
+    await conda.get_cached_environment(spec_path, "ab" * 64, tmp_path)
+    # explicit specs are installed with conda create rather than conda env create
+    assert _run_conda.call_args[0][0][0] == "create"
+    assert "env" not in _run_conda.call_args[0][0]
+
+
+@pytest.mark.asyncio
+async def test_get_cached_environment_incremental(mocker: MockerFixture, tmp_path):
+    calls = []
+
+    async def run_conda(args, env_overrides):
+        calls.append(args)
+        if args[0] == "create":
+            return await _create_environment(args, env_overrides)
+        elif args[0] == "install":
+            with open(args[args.index("--file") + 1]) as f:
+                calls[-1] = f.read().splitlines()
+        return "", ""
+
+    mocker.patch(_CONDA_RUN_NAME, side_effect=run_conda)
+
+    base_url = "https://conda.anaconda.org/conda-forge/linux-64/"
+    packages = [f"{base_url}{name}-1.0-0.tar.bz2" for name in "abcdefghij"]
+
+    async def get_environment(spec_hash, packages):
+        spec_path = os.path.join(tmp_path, f"{spec_hash}.txt")
+        with open(spec_path, "w") as f:
+            f.write("\n".join(["@EXPLICIT", *packages]))
+        calls.clear()
+        await conda.get_cached_environment(spec_path, spec_hash * 64, tmp_path)
+
+    # the first environment has to be created from scratch
+    await get_environment("ab", packages)
+    assert len(calls) == 1 and "--clone" not in calls[0]
+
+    # the second environment is cloned from the first and then only the differences
+    # are removed/installed
+    new_packages = packages[:8] + [
+        f"{base_url}h-2.0-0.tar.bz2",
+        f"{base_url}k-1.0-0.conda",
+    ]
+    await get_environment("cd", new_packages)
+    assert len(calls) == 3
+    assert calls[0][calls[0].index("--clone") + 1] == os.path.join(tmp_path, "ab" * 16)
+    assert calls[1][0] == "remove" and calls[1][-3:] == ["h", "i", "j"]
+    assert calls[2] == ["@EXPLICIT", new_packages[-2], new_packages[-1]]
+
+    # a completely different environment is created from scratch
+    await get_environment("ef", [f"{base_url}x-1.0-0.tar.bz2"])
+    assert len(calls) == 1 and "--clone" not in calls[0]
+
+
+def test_conda_docker_build_context(tmp_path):
+    from meadowrun.deployment_manager import _get_conda_docker_build_context
+
+    base_url = "https://conda.anaconda.org/conda-forge/linux-64/"
+    packages = [
+        f"{base_url}{name}-1.0-0.tar.bz2"
+        for name in ["openssl", "python", "six", "numpy", "requests"]
+    ]
+    assert conda.split_explicit_spec("\n".join(["@EXPLICIT", *packages])) == (
+        packages[:4],
+        packages[4:],
+    )
+
+    def get_context(spec):
+        spec_path = os.path.join(tmp_path, "explicit.txt")
+        with open(spec_path, "w") as f:
+            f.write(spec)
+        temp_folder = os.path.join(tmp_path, "temp")
+        os.makedirs(temp_folder, exist_ok=True)
+        files, buildargs = _get_conda_docker_build_context(spec_path, temp_folder)
+        assert buildargs == {"ENV_FILE": "explicit.txt"}
+        return {archive_path: local_path for local_path, archive_path in files}
+
+    files = get_context("\n".join(["@EXPLICIT", *packages]))
+    assert os.path.basename(files["Dockerfile"]) == "CondaLayeredDockerfile"
+    with open(files["base_explicit.txt"]) as f:
+        assert conda.get_explicit_packages(f.read()) == packages[:4]
+    with open(files["explicit.txt"]) as f:
+        assert conda.get_explicit_packages(f.read()) == packages[4:]
+
+    # without any base layer packages we just use a single layer
+    files = get_context("\n".join(["@EXPLICIT", packages[2], packages[4]]))
+    assert os.path.basename(files["Dockerfile"]) == "CondaExplicitDockerfile"
+    assert set(files) == {"Dockerfile", "explicit.txt"}
@@ -0,0 +1,128 @@
+"""Tests for the credentials cache in credentials.py"""
+
+import asyncio
+import os
+import stat
+import time
+
+import pytest
+
+import meadowrun.credentials
+from meadowrun.credentials import (
+    SshKey,
+    UsernamePassword,
+    get_cached_credentials,
+    get_matching_credentials,
+)
+from meadowrun.meadowrun_pb2 import AwsSecret, Credentials
+
+
+class _FakeSource:
+    """Returns a new password every time it is called"""
+
+    def __init__(self, expires_in_secs=None):
+        self.num_calls = 0
+        self.expires_in_secs = expires_in_secs
+
+    async def fetch(self):
+        self.num_calls += 1
+        if self.expires_in_secs is None:
+            expires_at = None
+        else:
+            expires_at = time.time() + self.expires_in_secs
+        return UsernamePassword("user", f"password{self.num_calls}"), expires_at
+
+
+async def _wait_for_refreshes():
+    await asyncio.gather(*meadowrun.credentials._REFRESHES.values())
+
+
+@pytest.mark.asyncio
+async def test_get_cached_credentials(tmp_path):
+    cache_folder = str(tmp_path / "credentials")
+    source = _FakeSource()
+
+    async def get(**kwargs):
+        return await get_cached_credentials(
+            "key", source.fetch, cache_folder=cache_folder, **kwargs
+        )
+
+    # concurrent callers only fetch once
+    results = await asyncio.gather(get(), get(), get())
+    assert results == [UsernamePassword("user", "password1")] * 3
+    assert source.num_calls == 1
+
+    # the cache is only accessible by the current user
+    assert stat.S_IMODE(os.stat(cache_folder).st_mode) == 0o700
+    (cache_file,) = [f for f in os.listdir(cache_folder) if f.endswith(".json")]
+    assert stat.S_IMODE(os.stat(os.path.join(cache_folder, cache_file)).st_mode) == (
+        0o600
+    )
+
+    # other processes will read the cache file
+    meadowrun.credentials._CACHED_CREDENTIALS.clear()
+    assert await get() == UsernamePassword("user", "password1")
+    assert source.num_calls == 1
+
+    # about to expire, so we get the cached credentials and refresh in the background
+    assert await get(refresh_ahead_secs=10 * 60) == UsernamePassword(
+        "user", "password1"
+    )
+    await _wait_for_refreshes()
+    assert source.num_calls == 2
+    assert await get() == UsernamePassword("user", "password2")
+
+    # expired, so we wait for new credentials
+    source.expires_in_secs = -1
+    assert await get(refresh_ahead_secs=10 * 60) == UsernamePassword(
+        "user", "password2"
+    )
+    await _wait_for_refreshes()
+    assert source.num_calls == 3
+    source.expires_in_secs = 60 * 60
+    assert await get() == UsernamePassword("user", "password4")
+    assert source.num_calls == 4
+    assert await get() == UsernamePassword("user", "password4")
+    assert source.num_calls == 4
+
+
+@pytest.mark.asyncio
+async def test_get_matching_credentials_cached(mocker, tmp_path):
+    mocker.patch.object(
+        meadowrun.credentials, "get_default_cache_folder", lambda: str(tmp_path)
+    )
+    num_calls = 0
+
+    async def get_credentials_from_source(source):
+        nonlocal num_calls
+        num_calls += 1
+        return SshKey(f"key for {source.secret_name}")
+
+    mocker.patch.object(
+        meadowrun.credentials,
+        "_get_credentials_from_source",
+        get_credentials_from_source,
+    )
+
+    credentials_dict = {
+        Credentials.Service.GIT: [
+            (
+                "git@github.com",
+                AwsSecret(
+                    credentials_type=Credentials.Type.SSH_KEY, secret_name="github"
+                ),
+            ),
+            (
+                "git@github.com:foo",
+                AwsSecret(credentials_type=Credentials.Type.SSH_KEY, secret_name="foo"),
+            ),
+        ]
+    }
+    for _ in range(2):
+        assert await get_matching_credentials(
+            Credentials.Service.GIT, "git@github.com:foo/bar", credentials_dict
+        ) == SshKey("key for foo")
+        assert await get_matching_credentials(
+            Credentials.Service.GIT, "git@github.com:baz/bar", credentials_dict
+        ) == SshKey("key for github")
+    assert num_calls == 2
@@ -0,0 +1,233 @@
+"""
+Tests for demand_forecast and prelaunching instances in adjust_ec2_instances. These run
+offline against synthetic demand histories and the in-memory EC2 stand-in.
+"""
+
+import datetime
+import math
+
+import botocore.exceptions
+import pytest
+
+import meadowrun.aws_integration.ec2_instance_allocation as ec2_instance_allocation
+import meadowrun.aws_integration.management_lambdas.adjust_ec2_instances as adjust
+from aws_stand_ins import FakeEc2
+from meadowrun.aws_integration.management_lambdas.demand_forecast import (
+    DailyScheduleForecaster,
+    DemandRecord,
+    ForecastEvaluation,
+    PlannedInstanceType,
+    evaluate_forecaster,
+)
+from meadowrun.run_job_core import AllocCloudInstancesInternal
+
+
+def _record(demand_key, start_time, num_workers=4):
+    return DemandRecord(
+        demand_key,
+        start_time,
+        600,
+        num_workers,
+        1,
+        2,
+        0,
+        [
+            PlannedInstanceType(
+                "c5.xlarge", "on_demand", 4, 8, 4, math.ceil(num_workers / 4)
+            )
+        ],
+        "ami-1",
+        ["sg-1"],
+        "meadowrun_ec2_alloc_role_instance_profile",
+        "meadowrun_id_rsa",
+    )
+
+
+def _daily_trace(num_days):
+    """A run_map that starts at around 9am every day"""
+    day0 = datetime.datetime(2022, 6, 1, 9)
+    return [
+        _record("daily", day0 + datetime.timedelta(days=i, minutes=(i % 3) * 2))
+        for i in range(num_days)
+    ]
+
+
+def test_demand_record_item():
+    record = _record("module.func", datetime.datetime(2022, 6, 1, 9, 0, 1, 5))
+    assert DemandRecord.from_item(record.to_item()) == record
+
+
+def test_daily_schedule_forecaster():
+    forecaster = DailyScheduleForecaster()
+    trace = _daily_trace(3)
+
+    # 3 minutes before the usual start time on the 4th day
+    forecasts = forecaster.forecast(trace, datetime.datetime(2022, 6, 4, 8, 57))
+    assert len(forecasts) == 1
+    assert forecasts[0].demand.demand_key == "daily"
+    assert (
+        datetime.timedelta(0)
+        < (forecasts[0].expected_start_time - datetime.datetime(2022, 6, 4, 8, 57))
+        <= datetime.timedelta(minutes=5)
+    )
+
+    # too early
+    assert forecaster.forecast(trace, datetime.datetime(2022, 6, 4, 8, 30)) == []
+    # not enough history
+    assert forecaster.forecast(trace[1:], datetime.datetime(2022, 6, 4, 8, 57)) == []
+    # already ran today
+    today = trace + [_record("daily", datetime.datetime(2022, 6, 4, 8, 56))]
+    assert forecaster.forecast(today, datetime.datetime(2022, 6, 4, 8, 58)) == []
+
+
+def test_evaluate_forecaster():
+    # one-off run_maps shouldn't cause any false alarms
+    trace = _daily_trace(10) + [
+        _record("one_off", datetime.datetime(2022, 6, 2, 14)),
+        _record("one_off", datetime.datetime(2022, 6, 6, 17)),
+    ]
+    # the first 3 days of the daily run_map can't be forecast
+    assert evaluate_forecaster(DailyScheduleForecaster(), trace) == ForecastEvaluation(
+        7, 5, 0
+    )
+
+    # if the daily run_map stops, we get false alarms on the following days (6/11 and
+    # 6/12) until it drops out of the lookback window
+    assert evaluate_forecaster(
+        DailyScheduleForecaster(),
+        trace + [_record("one_off", datetime.datetime(2022, 6, 12, 12))],
+    ) == ForecastEvaluation(7, 6, 2)
+
+
+def test_prelaunch_for_forecast_demand(mocker):
+    ec2 = FakeEc2()
+    mocker.patch.object(adjust.boto3, "resource", ec2.resource)
+    mocker.patch.object(adjust.boto3, "client", ec2.client)
+
+    history = _daily_trace(3) + [
+        _record("daily", datetime.datetime(2022, 6, 3, 9, 1), num_workers=12)
+    ]
+    mocker.patch.object(
+        adjust, "_get_demand_history", lambda region_name, since: history
+    )
+    # an existing instance with room for 2 workers
+    mocker.patch.object(
+        adjust, "_get_available_resources", lambda region_name: [[2.0, 5.0]]
+    )
+    registered = {}
+
+    def register(region_name, public_address, instance_type, hold_until):
+        registered[public_address] = hold_until
+
+    mocker.patch.object(adjust, "_register_prelaunched_instance", register)
+
+    now = datetime.datetime(2022, 6, 4, 8, 57)
+    adjust._prelaunch_for_forecast_demand(
+        "us-east-2",
+        DailyScheduleForecaster(),
+        datetime.timedelta(minutes=10),
+        now,
+    )
+
+    # we use the biggest recent demand (12 workers), 2 of which fit on the existing
+    # instance, and we replay the recorded instance type choice
+    assert len(ec2.instances) == 3
+    assert all(
+        instance.instance_type == "c5.xlarge" for instance in ec2.instances.values()
+    )
+    assert len(registered) == 3
+    assert all(
+        now + datetime.timedelta(minutes=10) < hold_until
+        for hold_until in registered.values()
+    )
+
+
+def test_prelaunch_registers_only_running_instances(mocker):
+    ec2 = FakeEc2()
+    mocker.patch.object(adjust.boto3, "resource", ec2.resource)
+    mocker.patch.object(adjust.boto3, "client", ec2.client)
+    history = _daily_trace(3) + [
+        _record("daily", datetime.datetime(2022, 6, 3, 9, 1), num_workers=12)
+    ]
+    mocker.patch.object(
+        adjust, "_get_demand_history", lambda region_name, since: history
+    )
+    mocker.patch.object(adjust, "_get_available_resources", lambda region_name: [])
+    registered = {}
+
+    def register(region_name, public_address, instance_type, hold_until):
+        registered[public_address] = hold_until
+
+    mocker.patch.object(adjust, "_register_prelaunched_instance", register)
+
+    waiter_configs = []
+
+    class _TimingOutWaiter:
+        def wait(self, InstanceIds, WaiterConfig):
+            waiter_configs.append(WaiterConfig)
+            # one of the instances doesn't start in time
+            ec2.instances[InstanceIds[0]].state = {"Name": "pending"}
+            raise botocore.exceptions.WaiterError(
+                "InstanceRunning", "Max attempts exceeded", {}
+            )
+
+    mocker.patch.object(
+        type(ec2.client("ec2")), "get_waiter", lambda self, name: _TimingOutWaiter()
+    )
+
+    adjust._prelaunch_for_forecast_demand(
+        "us-east-2",
+        DailyScheduleForecaster(),
+        datetime.timedelta(minutes=10),
+        datetime.datetime(2022, 6, 4, 8, 57),
+    )
+
+    # we never wait longer than _WAIT_FOR_PRELAUNCHED_INSTANCES, which is well under the
+    # lambda's timeout
+    assert len(waiter_configs) == 1
+    assert (
+        waiter_configs[0]["Delay"] * waiter_configs[0]["MaxAttempts"]
+        <= adjust._WAIT_FOR_PRELAUNCHED_INSTANCES.total_seconds()
+    )
+    # the instance that isn't running yet isn't registered
+    assert len(ec2.instances) == 3
+    assert len(registered) == 2
+    assert "" not in registered
+
+
+@pytest.mark.asyncio
+async def test_record_demand_only_if_table_exists(mocker):
+    tables_loaded = []
+
+    class _MissingTable:
+        def load(self):
+            tables_loaded.append(True)
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "ResourceNotFoundException"}}, "DescribeTable"
+            )
+
+        def put_item(self, Item):
+            raise AssertionError("Should not record demand")
+
+    class _FakeDynamoDb:
+        def Table(self, name):
+            return _MissingTable()
+
+    mocker.patch.object(
+        ec2_instance_allocation,
+        "_get_boto3_resource",
+        lambda service_name, region_name: _FakeDynamoDb(),
+    )
+    mocker.patch.object(ec2_instance_allocation, "_DEMAND_HISTORY_TABLE_EXISTS", {})
+
+    # prelaunching isn't enabled, so recording demand is a no-op, and we only check
+    # for the table once
+    for _ in range(2):
+        await ec2_instance_allocation.record_demand(
+            "us-east-2",
+            "daily",
+            AllocCloudInstancesInternal(1, 2, 0, 4, "us-east-2"),
+            datetime.datetime(2022, 6, 4, 9),
+            60,
+        )
+    assert len(tables_loaded) == 1
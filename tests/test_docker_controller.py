@@ -0,0 +1,374 @@
+"""
+Tests for the shared client, image metadata cache, single-flight pulls, and warm
+containers in docker_controller. These use a fake docker client, so they don't need
+docker.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import pickle
+import sys
+import uuid
+from typing import Any
+
+import pytest
+
+import meadowrun.docker_controller as docker_controller
+from meadowrun._vendor import aiodocker
+from meadowrun.config import MEADOWRUN_WARM_CONTAINER_IDLE_TIMEOUT_SECS
+from meadowrun.meadowrun_pb2 import (
+    Job,
+    ProcessState,
+    PyFunctionJob,
+    QualifiedFunctionName,
+    ServerAvailableContainer,
+    ServerAvailableFolder,
+)
+from meadowrun.run_job_local import run_local
+
+
+class _FakeImages:
+    def __init__(self):
+        self.images = {}
+        self.num_inspects = 0
+        self.num_pulls = 0
+
+    async def inspect(self, image):
+        self.num_inspects += 1
+        if image not in self.images:
+            raise aiodocker.DockerError(404, {"message": "No such image"})
+        return self.images[image]
+
+    async def pull(self, image, auth=None):
+        self.num_pulls += 1
+        # give the other coroutines a chance to try to pull at the same time
+        await asyncio.sleep(0.1)
+        self.images[image] = {"ContainerConfig": {"Env": ["PATH=/usr/bin"]}}
+        return []
+
+
+class _FakeContainer:
+    def __init__(self, containers, container_id, config):
+        self._containers = containers
+        self.id = container_id
+        self.config = config
+        self.exec_ids = []
+
+    def __getitem__(self, key):
+        return self.config[key]
+
+    async def show(self):
+        return {"ExecIDs": self.exec_ids}
+
+    async def delete(self, force=False):
+        del self._containers.containers[self.id]
+
+    async def exec(self, cmd, environment):
+        return _FakeHostExec(self.config["HostConfig"]["Binds"], cmd, environment)
+
+
+class _FakeExec:
+    def __init__(self, running):
+        self.running = running
+
+    async def inspect(self):
+        return {"Running": self.running}
+
+
+class _FakeMessage:
+    def __init__(self, data):
+        self.data = data
+
+
+class _FakeHostExec:
+    """
+    Runs the command on the host instead of in a container. Paths in the container are
+    translated to paths on the host based on the container's binds, so any files the
+    command needs that aren't bound into the container won't be found, like in a real
+    container.
+    """
+
+    def __init__(self, binds, cmd, environment):
+        # longest paths in the container first, so that nested binds take precedence
+        self._binds = sorted(
+            (bind.split(":") for bind in binds), key=lambda bind: -len(bind[1])
+        )
+        self._cmd = [sys.executable if cmd[0] == "python" else cmd[0]] + [
+            self._translate(arg) for arg in cmd[1:]
+        ]
+        self._environment = {
+            **os.environ,
+            **{
+                key: ":".join(self._translate(path) for path in value.split(":"))
+                for key, value in environment.items()
+            },
+        }
+        self._process: Any = None
+
+    def _translate(self, path):
+        for path_on_host, path_in_container in self._binds:
+            if path == path_in_container or path.startswith(path_in_container + "/"):
+                return path_on_host + path[len(path_in_container) :]
+        return path
+
+    def start(self, detach):
+        return self
+
+    async def __aenter__(self):
+        self._process = await asyncio.create_subprocess_exec(
+            *self._cmd,
+            env=self._environment,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+
+    async def read_out(self):
+        data = await self._process.stdout.read(1024)
+        if not data:
+            return None
+        return _FakeMessage(data)
+
+    async def close(self):
+        await self._process.wait()
+
+    async def inspect(self):
+        return {"ExitCode": self._process.returncode}
+
+
+class _FakeContainers:
+    def __init__(self):
+        self.containers = {}
+        self.execs = {}
+        self._ids = itertools.count()
+
+    async def list(self, filters, all=False):
+        (label,) = json.loads(filters)["label"]
+        key, _, value = label.partition("=")
+        return [
+            container
+            for container in self.containers.values()
+            if key in container["Labels"]
+            and (not value or container["Labels"][key] == value)
+        ]
+
+    async def run(self, config):
+        container_id = f"container{next(self._ids)}"
+        self.containers[container_id] = _FakeContainer(self, container_id, config)
+        return self.containers[container_id]
+
+    def exec(self, exec_id):
+        return self.execs[exec_id]
+
+
+class _FakeClient:
+    def __init__(self):
+        self.images = _FakeImages()
+        self.containers = _FakeContainers()
+        self.num_sweepers_started = 0
+
+
+@pytest.fixture
+def fake_client(mocker, tmp_path):
+    client = _FakeClient()
+    mocker.patch.object(docker_controller, "_get_client", lambda: client)
+
+    async def start_warm_container_sweeper(idle_timeout_secs):
+        client.num_sweepers_started += 1
+
+    mocker.patch.object(
+        docker_controller,
+        "_start_warm_container_sweeper",
+        start_warm_container_sweeper,
+    )
+    mocker.patch.object(
+        docker_controller, "get_default_cache_folder", lambda: str(tmp_path)
+    )
+    mocker.patch.dict(docker_controller._IMAGE_METADATA, clear=True)
+    return client
+
+
+class _FakeSession:
+    def __init__(self):
+        self.closed = False
+
+
+class _FakeDocker:
+    """Stands in for aiodocker.Docker so we can test _get_client"""
+
+    def __init__(self):
+        self.session = _FakeSession()
+
+    async def close(self):
+        self.session.closed = True
+
+
+def test_shared_client_lifecycle(mocker):
+    mocker.patch.object(docker_controller.aiodocker, "Docker", _FakeDocker)
+    mocker.patch.object(docker_controller, "_CLIENTS", {})
+    mocker.patch.object(docker_controller, "_CLIENT_SCOPES", {})
+
+    async def use_client_and_close():
+        client = docker_controller._get_client()
+        assert docker_controller._get_client() is client
+        await docker_controller.close_client()
+        assert client.session.closed
+        return client
+
+    # each event loop gets its own client, and close_client forgets it
+    assert asyncio.run(use_client_and_close()) is not asyncio.run(
+        use_client_and_close()
+    )
+    assert docker_controller._CLIENTS == {}
+
+    # if an event loop is closed without close_client, we don't keep it around
+    async def use_client():
+        docker_controller._get_client()
+
+    asyncio.run(use_client())
+    asyncio.run(use_client())
+    assert len(docker_controller._CLIENTS) == 1
+
+    async def use_client_in_scopes():
+        event = asyncio.Event()
+
+        async def job():
+            async with docker_controller.docker_client_scope():
+                client = docker_controller._get_client()
+                await event.wait()
+                return client
+
+        first_job = asyncio.create_task(job())
+        await asyncio.sleep(0)
+        async with docker_controller.docker_client_scope():
+            client = docker_controller._get_client()
+        # the other job is still using the client
+        assert not client.session.closed
+        event.set()
+        assert await first_job is client
+        assert client.session.closed
+
+    asyncio.run(use_client_in_scopes())
+
+
+@pytest.mark.asyncio
+async def test_single_flight_pull(fake_client):
+    image = "python@sha256:abc"
+    await asyncio.gather(*(docker_controller.pull_image(image, None) for _ in range(8)))
+    assert fake_client.images.num_pulls == 1
+
+    # metadata for images referenced by digest is cached
+    num_inspects = fake_client.images.num_inspects
+    assert await docker_controller.get_image_environment_variables(image) == [
+        "PATH=/usr/bin"
+    ]
+    await docker_controller.pull_image(image, None)
+    assert fake_client.images.num_inspects == num_inspects
+    assert fake_client.images.num_pulls == 1
+
+
+@pytest.mark.asyncio
+async def test_tag_metadata_expires(fake_client, mocker):
+    image = "python:3.9"
+    await docker_controller.pull_image(image, None)
+    num_inspects = fake_client.images.num_inspects
+
+    await docker_controller.get_image_environment_variables(image)
+    assert fake_client.images.num_inspects == num_inspects
+
+    # tags can be updated by other processes, so we inspect them again after a while
+    mocker.patch.object(
+        docker_controller.time,
+        "time",
+        lambda: 1e10,
+    )
+    await docker_controller.get_image_environment_variables(image)
+    assert fake_client.images.num_inspects == num_inspects + 1
+
+
+@pytest.mark.asyncio
+async def test_warm_containers(fake_client, tmp_path):
+    binds = [("/host/code", "/meadowrun/code0")]
+    first = await docker_controller.get_warm_container("python:3.9", binds)
+    # the same image and binds reuse the same container
+    assert await docker_controller.get_warm_container("python:3.9", binds) is first
+    other = await docker_controller.get_warm_container("python:3.9", [])
+    assert other is not first
+
+    fake_client.containers.execs["exec1"] = _FakeExec(True)
+    fake_client.containers.containers[first.id].exec_ids.append("exec1")
+    for container in (first, other):
+        os.utime(os.path.join(tmp_path, "warm_containers", container.id), (0, 0))
+
+    # other was just used, and first is still running a job
+    await docker_controller.release_warm_container(other.id, 60)
+    assert set(fake_client.containers.containers) == {first.id, other.id}
+    # something needs to remove the remaining warm containers once they're idle
+    assert fake_client.num_sweepers_started == 1
+
+    os.utime(os.path.join(tmp_path, "warm_containers", other.id), (0, 0))
+    await docker_controller.evict_idle_warm_containers(60)
+    assert set(fake_client.containers.containers) == {first.id}
+
+    fake_client.containers.execs["exec1"].running = False
+    await docker_controller.evict_idle_warm_containers(60)
+    assert not fake_client.containers.containers
+
+
+@pytest.mark.asyncio
+async def test_sweep_warm_containers(fake_client, tmp_path):
+    container = await docker_controller.get_warm_container("python:3.9", [])
+    fake_client.containers.execs["exec1"] = _FakeExec(True)
+    fake_client.containers.containers[container.id].exec_ids.append("exec1")
+    os.utime(os.path.join(tmp_path, "warm_containers", container.id), (0, 0))
+
+    sweep_task = asyncio.create_task(docker_controller._sweep_warm_containers(60, 0.01))
+    await asyncio.sleep(0.05)
+    # still running a job
+    assert not sweep_task.done()
+
+    # once the container is idle, the sweeper removes it even though no other jobs
+    # finish
+    fake_client.containers.execs["exec1"].running = False
+    await asyncio.wait_for(sweep_task, 1)
+    assert not fake_client.containers.containers
+
+
+@pytest.mark.asyncio
+async def test_py_function_in_warm_container(fake_client, tmp_path, mocker):
+    code_folder = tmp_path / "code"
+    code_folder.mkdir()
+    (code_folder / "example_module.py").write_text("def add(a, b):\n    return a + b\n")
+    fake_client.images.images["python:fake"] = {"ContainerConfig": {"Env": []}}
+    mocker.patch.dict(os.environ, {MEADOWRUN_WARM_CONTAINER_IDLE_TIMEOUT_SECS: "60"})
+
+    for _ in range(2):
+        job = Job(
+            job_id=str(uuid.uuid4()),
+            job_friendly_name="add",
+            server_available_folder=ServerAvailableFolder(
+                code_paths=[str(code_folder)]
+            ),
+            server_available_container=ServerAvailableContainer(
+                image_name="python:fake"
+            ),
+            py_function=PyFunctionJob(
+                qualified_function_name=QualifiedFunctionName(
+                    module_name="example_module", function_name="add"
+                ),
+                pickled_function_arguments=pickle.dumps(((1, 2), {})),
+            ),
+            result_highest_pickle_protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        initial_state, continuation = await run_local(job, str(tmp_path / "working"))
+        assert initial_state.state == ProcessState.ProcessStateEnum.RUNNING
+        assert continuation is not None
+        final_state = await continuation
+        assert final_state.state == ProcessState.ProcessStateEnum.SUCCEEDED, open(
+            final_state.log_file_name
+        ).read()
+        assert pickle.loads(final_state.pickled_result) == 3
+
+    # both jobs ran in the same warm container
+    assert len(fake_client.containers.containers) == 1
@@ -0,0 +1,182 @@
+"""
+Tests for creating local copies of git commits in deployment_manager against a local
+git repo
+"""
+
+import os
+import stat
+import subprocess
+
+import pytest
+
+import meadowrun.deployment_manager as deployment_manager
+from meadowrun.deployment_manager import _get_git_code_paths
+from meadowrun.meadowrun_pb2 import GitRepoBranch, GitRepoCommit
+from meadowrun.run_job import _resolve_git_branch
+
+
+def _git(cwd, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+def _write(path, contents, executable=False):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(contents)
+    if executable:
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+def _commit(repo, message):
+    _git(repo, "add", "-A")
+    _git(repo, "commit", "-m", message)
+    return subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=repo,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+@pytest.mark.asyncio
+async def test_git_local_copies(tmp_path):
+    repo = os.path.join(tmp_path, "repo")
+    os.makedirs(repo)
+    _git(repo, "init")
+    _write(os.path.join(repo, "src", "a.py"), "a = 1\n")
+    _write(os.path.join(repo, "src", "b.py"), "b = 1\n")
+    _write(os.path.join(repo, "run.sh"), "#!/bin/sh\n", executable=True)
+    os.symlink("src/a.py", os.path.join(repo, "link.py"))
+    commit1 = _commit(repo, "first")
+    _write(os.path.join(repo, "src", "b.py"), "b = 2\n")
+    commit2 = _commit(repo, "second")
+
+    git_repos = os.path.join(tmp_path, "git_repos")
+    local_copies = os.path.join(tmp_path, "local_copies")
+    os.makedirs(git_repos)
+    os.makedirs(local_copies)
+
+    # with no path_to_source, we get the whole repo
+    code_paths1, root1 = await _get_git_code_paths(
+        git_repos, local_copies, repo, commit1, "", None
+    )
+    code_paths2, root2 = await _get_git_code_paths(
+        git_repos, local_copies, repo, commit2, "", None
+    )
+    assert code_paths1 == [os.path.join(root1, "")]
+
+    for root, b in [(root1, "b = 1\n"), (root2, "b = 2\n")]:
+        assert not os.path.exists(os.path.join(root, ".git"))
+        with open(os.path.join(root, "src", "b.py")) as f:
+            assert f.read() == b
+        with open(os.path.join(root, "link.py")) as f:
+            assert f.read() == "a = 1\n"
+        assert os.stat(os.path.join(root, "run.sh")).st_mode & stat.S_IXUSR
+        assert not os.stat(os.path.join(root, "src", "a.py")).st_mode & stat.S_IXUSR
+
+    # unchanged files are stored once
+    assert os.path.samefile(
+        os.path.join(root1, "src", "a.py"), os.path.join(root2, "src", "a.py")
+    )
+    assert not os.path.samefile(
+        os.path.join(root1, "src", "b.py"), os.path.join(root2, "src", "b.py")
+    )
+
+    # the same commit reuses the existing local copy
+    assert await _get_git_code_paths(
+        git_repos, local_copies, repo, commit1, "", None
+    ) == (code_paths1, root1)
+
+
+@pytest.mark.asyncio
+async def test_git_partial_clone(tmp_path, mocker):
+    repo = os.path.join(tmp_path, "repo")
+    os.makedirs(repo)
+    _git(repo, "init", "-b", "main")
+    # needed for partial clones from a local repo
+    _git(repo, "config", "uploadpack.allowFilter", "true")
+    _git(repo, "config", "uploadpack.allowAnySHA1InWant", "true")
+    _write(os.path.join(repo, "src", "a.py"), "a = 1\n")
+    _write(os.path.join(repo, "envs", "env.yml"), "dependencies: []\n")
+    _write(os.path.join(repo, "big", "data.txt"), "x" * 10000)
+    commit1 = _commit(repo, "first")
+    repo_url = f"file://{repo}"
+
+    git_repos = os.path.join(tmp_path, "git_repos")
+    local_copies = os.path.join(tmp_path, "local_copies")
+    os.makedirs(git_repos)
+    os.makedirs(local_copies)
+
+    git_commands = []
+    original_run_git = deployment_manager._run_git
+
+    async def run_git(args, cwd, credentials):
+        git_commands.append(args[0] if args[0] != "-c" else args[2])
+        return await original_run_git(args, cwd, credentials)
+
+    mocker.patch.object(deployment_manager, "_run_git", run_git)
+
+    code_paths, root = await _get_git_code_paths(
+        git_repos, local_copies, repo_url, commit1, "src", None, ["envs/env.yml"]
+    )
+    # only path_to_source and the environment spec are in the local copy, and we never
+    # downloaded the other files
+    assert os.path.exists(os.path.join(root, "src", "a.py"))
+    assert os.path.exists(os.path.join(root, "envs", "env.yml"))
+    assert not os.path.exists(os.path.join(root, "big"))
+    local_clone = os.path.join(
+        git_repos, deployment_manager._get_git_repo_local_clone_name(repo_url)
+    )
+    missing = subprocess.run(
+        ["git", "rev-list", "--objects", "--no-walk", "--missing=print", commit1],
+        cwd=local_clone,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert (
+        "?"
+        + subprocess.run(
+            ["git", "rev-parse", f"{commit1}:big/data.txt"],
+            cwd=repo,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        in missing.splitlines()
+    )
+
+    # a commit we already have doesn't need a fetch
+    git_commands.clear()
+    await _get_git_code_paths(
+        git_repos, local_copies, repo_url, commit1, "", None, ["envs/env.yml"]
+    )
+    assert "fetch" in git_commands  # for the blobs in big/
+    git_commands.clear()
+    _write(os.path.join(repo, "src", "a.py"), "a = 2\n")
+    commit2 = _commit(repo, "second")
+    await _get_git_code_paths(git_repos, local_copies, repo_url, commit1, "", None)
+    assert git_commands == ["rev-parse"]
+    # but a new commit does
+    code_paths, root = await _get_git_code_paths(
+        git_repos, local_copies, repo_url, commit2, "src", None
+    )
+    assert git_commands.count("fetch") == 2
+    with open(os.path.join(root, "src", "a.py")) as f:
+        assert f.read() == "a = 2\n"
+
+    # branches are resolved on the client
+    resolved = await _resolve_git_branch(
+        GitRepoBranch(repo_url=repo_url, branch="main", path_to_source="src")
+    )
+    assert resolved == GitRepoCommit(
+        repo_url=repo_url, commit=commit2, path_to_source="src"
+    )
+    missing_branch = GitRepoBranch(repo_url=repo_url, branch="nope")
+    assert await _resolve_git_branch(missing_branch) == missing_branch
@@ -0,0 +1,324 @@
+"""
+Tests for instance_allocation that don't require any cloud resources. Uses an in-memory
+InstanceRegistrar.
+"""
+
+import asyncio
+import datetime
+import random
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pytest
+
+import meadowrun.instance_allocation
+from meadowrun.instance_allocation import (
+    InstanceRegistrar,
+    _choose_existing_instances,
+    _InstanceState,
+    allocate_jobs_to_instances_batched,
+)
+from meadowrun.instance_selection import CloudInstance, Resources
+from meadowrun.run_job_core import AllocCloudInstancesInternal
+
+
+class InMemoryInstanceRegistrar(InstanceRegistrar[_InstanceState]):
+    def __init__(self) -> None:
+        self.instances: Dict[str, _InstanceState] = {}
+        # how many times allocate_jobs_to_instance should fail before succeeding, to
+        # simulate optimistic concurrency failures
+        self.num_allocation_failures = 0
+        self.last_update_times: Dict[str, datetime.datetime] = {}
+        # the number of times get_registered_instances was called
+        self.num_full_reads = 0
+        # the number of times allocate_jobs_to_instance succeeded
+        self.num_allocations = 0
+        # if set, allocate_jobs_to_instance yields to the event loop first so that
+        # concurrent clients interleave
+        self.yield_on_allocate = False
+
+    async def __aenter__(self) -> "InMemoryInstanceRegistrar":
+        return self
+
+    async def __aexit__(self, exc_typ, exc_val, exc_tb) -> None:
+        pass
+
+    def get_region_name(self) -> str:
+        return "in-memory"
+
+    async def register_instance(
+        self,
+        public_address: str,
+        name: str,
+        resources_available: Resources,
+        running_jobs: List[Tuple[str, Resources]],
+    ) -> None:
+        self.instances[public_address] = _InstanceState(
+            public_address,
+            resources_available,
+            {
+                job_id: {
+                    "logical_cpu_allocated": resources.logical_cpu,
+                    "memory_gb_allocated": resources.memory_gb,
+                }
+                for job_id, resources in running_jobs
+            },
+        )
+        self.last_update_times[public_address] = datetime.datetime.utcnow()
+
+    def deregister_instance(self, public_address: str) -> None:
+        del self.instances[public_address]
+        del self.last_update_times[public_address]
+
+    @staticmethod
+    def _copy(instance: _InstanceState) -> _InstanceState:
+        return _InstanceState(
+            instance.public_address,
+            instance.available_resources,
+            dict(instance.get_running_jobs()),
+        )
+
+    async def get_registered_instances(
+        self, resources_required: Optional[Resources] = None
+    ) -> List[_InstanceState]:
+        self.num_full_reads += 1
+        return [
+            self._copy(instance)
+            for instance in self.instances.values()
+            if resources_required is None
+            or instance.get_available_resources().subtract(resources_required)
+            is not None
+        ]
+
+    async def get_registered_instances_changed_since(
+        self, since: datetime.datetime
+    ) -> Optional[List[_InstanceState]]:
+        return [
+            self._copy(instance)
+            for instance in self.instances.values()
+            if self.last_update_times[instance.public_address] >= since
+        ]
+
+    async def get_registered_instances_by_address(
+        self, public_addresses: Sequence[str]
+    ) -> List[_InstanceState]:
+        return [
+            self._copy(self.instances[public_address])
+            for public_address in public_addresses
+            if public_address in self.instances
+        ]
+
+    async def get_registered_instance(self, public_address: str) -> _InstanceState:
+        return self.instances[public_address]
+
+    async def allocate_jobs_to_instance(
+        self,
+        instance: _InstanceState,
+        resources_allocated_per_job: Resources,
+        new_job_ids: List[str],
+    ) -> bool:
+        if self.yield_on_allocate:
+            await asyncio.sleep(0)
+        if self.num_allocation_failures > 0:
+            self.num_allocation_failures -= 1
+            return False
+
+        if instance.public_address not in self.instances:
+            return False
+        stored = self.instances[instance.public_address]
+        if stored.available_resources != instance.available_resources:
+            return False
+
+        available = stored.get_available_resources()
+        for job_id in new_job_ids:
+            new_available = available.subtract(resources_allocated_per_job)
+            if new_available is None or job_id in stored.get_running_jobs():
+                return False
+            available = new_available
+
+        self.num_allocations += 1
+        stored.available_resources = available
+        self.last_update_times[instance.public_address] = datetime.datetime.utcnow()
+        for job_id in new_job_ids:
+            stored.get_running_jobs()[job_id] = {
+                "logical_cpu_allocated": resources_allocated_per_job.logical_cpu,
+                "memory_gb_allocated": resources_allocated_per_job.memory_gb,
+            }
+        return True
+
+    async def deallocate_job_from_instance(
+        self, instance: _InstanceState, job_id: str
+    ) -> bool:
+        stored = self.instances[instance.public_address]
+        job = stored.get_running_jobs().pop(job_id, None)
+        if job is None:
+            return False
+        stored.available_resources = stored.get_available_resources().add(
+            Resources(job["memory_gb_allocated"], job["logical_cpu_allocated"], {})
+        )
+        self.last_update_times[instance.public_address] = datetime.datetime.utcnow()
+        return True
+
+    async def launch_instances(
+        self, instances_spec: AllocCloudInstancesInternal
+    ) -> Sequence[CloudInstance]:
+        raise NotImplementedError()
+
+
+@pytest.fixture(autouse=True)
+def _clear_registered_instances_cache():
+    meadowrun.instance_allocation._REGISTERED_INSTANCES_CACHE.clear()
+
+
+async def _registrar_with_instances(
+    resources: Sequence[Tuple[float, int]]
+) -> InMemoryInstanceRegistrar:
+    registrar = InMemoryInstanceRegistrar()
+    for i, (memory_gb, logical_cpu) in enumerate(resources):
+        await registrar.register_instance(
+            f"instance{i}", f"instance{i}", Resources(memory_gb, logical_cpu, {}), []
+        )
+    return registrar
+
+
+@pytest.mark.asyncio
+async def test_choose_existing_instances_packs_tightly():
+    # a job requiring 2GB/1CPU should go to the smallest instance that fits it
+    registrar = await _registrar_with_instances([(8, 4), (2, 1), (1, 1)])
+    allocated = await _choose_existing_instances(registrar, Resources(2, 1, {}), 1)
+    assert {k: len(v) for k, v in allocated.items()} == {"instance1": 1}
+
+    # more jobs fill up the instances one at a time, and jobs that don't fit anywhere
+    # are left unallocated
+    registrar = await _registrar_with_instances([(8, 4), (2, 1), (1, 1), (4, 2)])
+    allocated = await _choose_existing_instances(registrar, Resources(2, 1, {}), 10)
+    assert {k: len(v) for k, v in allocated.items()} == {
+        "instance0": 4,
+        "instance1": 1,
+        "instance3": 2,
+    }
+    assert registrar.instances["instance0"].available_resources == Resources(0, 0, {})
+    assert registrar.instances["instance2"].available_resources == Resources(1, 1, {})
+
+
+@pytest.mark.asyncio
+async def test_choose_existing_instances_retries():
+    registrar = await _registrar_with_instances([(4, 2)])
+    registrar.num_allocation_failures = 4
+    allocated = await _choose_existing_instances(registrar, Resources(1, 1, {}), 2)
+    assert {k: len(v) for k, v in allocated.items()} == {"instance0": 2}
+    # retries only read the instance that failed
+    assert registrar.num_full_reads == 1
+
+    registrar = await _registrar_with_instances([(4, 2)])
+    registrar.num_allocation_failures = 5
+    allocated = await _choose_existing_instances(registrar, Resources(1, 1, {}), 2)
+    assert allocated == {}
+
+
+@pytest.mark.asyncio
+async def test_choose_existing_instances_contention():
+    # concurrent clients competing for the same instances should all get allocated,
+    # even though they start with the same (soon to be stale) view. Ties are broken
+    # randomly, so we seed random to make this deterministic
+    random.seed(0)
+    registrar = await _registrar_with_instances([(2, 1)] * 30)
+    registrar.yield_on_allocate = True
+    results = await asyncio.gather(
+        *(
+            _choose_existing_instances(registrar, Resources(2, 1, {}), 4)
+            for _ in range(5)
+        )
+    )
+    assert [sum(len(v) for v in result.values()) for result in results] == [4] * 5
+    assert registrar.num_allocations == 20
+    assert registrar.num_full_reads == 1
+
+
+@pytest.mark.asyncio
+async def test_choose_existing_instances_many():
+    registrar = await _registrar_with_instances(
+        [(4 * (1 + i % 8), 2 * (1 + i % 8)) for i in range(2000)]
+    )
+    t0 = time.perf_counter()
+    allocated = await _choose_existing_instances(registrar, Resources(2, 1, {}), 10_000)
+    elapsed = time.perf_counter() - t0
+    assert sum(len(jobs) for jobs in allocated.values()) == 10_000
+    # very generous, this should take well under a second
+    assert elapsed < 10
+
+
+@pytest.mark.asyncio
+async def test_choose_existing_instances_cached_view():
+    registrar = await _registrar_with_instances([(4, 2), (6, 3)])
+    for _ in range(2):
+        allocated = await _choose_existing_instances(registrar, Resources(2, 1, {}), 1)
+        assert {k: len(v) for k, v in allocated.items()} == {"instance0": 1}
+    # the second allocation only needed the changes since the first one
+    assert registrar.num_full_reads == 1
+
+    # our view picks up newly registered instances and deallocations
+    await registrar.register_instance("instance2", "instance2", Resources(2, 1, {}), [])
+    instance0 = await registrar.get_registered_instance("instance0")
+    for job_id in list(instance0.get_running_jobs()):
+        await registrar.deallocate_job_from_instance(instance0, job_id)
+    allocated = await _choose_existing_instances(registrar, Resources(2, 1, {}), 2)
+    assert {k: len(v) for k, v in allocated.items()} == {"instance2": 1, "instance0": 1}
+    assert registrar.num_full_reads == 1
+
+    # our view still has the deregistered instance, so the first attempt fails, and
+    # rereading just that instance removes it from our view
+    registrar.deregister_instance("instance0")
+    allocated = await _choose_existing_instances(registrar, Resources(2, 1, {}), 1)
+    assert {k: len(v) for k, v in allocated.items()} == {"instance1": 1}
+    assert registrar.num_full_reads == 1
+    assert (
+        "instance0"
+        not in next(
+            iter(meadowrun.instance_allocation._REGISTERED_INSTANCES_CACHE.values())
+        ).instances
+    )
+
+
+@pytest.mark.asyncio
+async def test_allocate_jobs_to_instances_batched():
+    registrar = await _registrar_with_instances([(8, 4)] * 3 + [(16, 8)])
+
+    small = AllocCloudInstancesInternal(1, 2, 0, 1, "in-memory")
+    # only fits on the last instance
+    large = AllocCloudInstancesInternal(8, 16, 0, 1, "in-memory")
+    results = await asyncio.gather(
+        *[allocate_jobs_to_instances_batched(registrar, small) for _ in range(10)],
+        allocate_jobs_to_instances_batched(registrar, large),
+    )
+
+    assert all(
+        sum(len(job_ids) for job_ids in result.values()) == 1 for result in results
+    )
+    job_ids = [job_id for result in results for v in result.values() for job_id in v]
+    assert len(set(job_ids)) == 11
+    # the small jobs were packed onto 3 instances as a single batch, and the large job
+    # was a separate batch
+    assert registrar.num_allocations == 4
+
+
+@pytest.mark.asyncio
+async def test_allocate_jobs_to_instances_batched_cancelled():
+    registrar = await _registrar_with_instances([(8, 4)])
+    small = AllocCloudInstancesInternal(1, 2, 0, 1, "in-memory")
+
+    request = asyncio.create_task(allocate_jobs_to_instances_batched(registrar, small))
+    # let the request start the batch, and let the batch start waiting for more
+    # requests
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    (batch_task,) = meadowrun.instance_allocation._ALLOCATION_BATCH_TASKS
+    batch_task.cancel()
+
+    # the caller gets an error rather than a CancelledError, and the cancelled batch
+    # doesn't stick around to swallow new requests
+    with pytest.raises(ValueError, match="cancelled"):
+        await request
+    assert not meadowrun.instance_allocation._ALLOCATION_BATCHES
+    result = await allocate_jobs_to_instances_batched(registrar, small)
+    assert sum(len(job_ids) for job_ids in result.values()) == 1
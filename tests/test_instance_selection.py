@@ -0,0 +1,101 @@
+import pytest
+
+from meadowrun.instance_selection import (
+    CloudInstanceType,
+    Resources,
+    choose_instance_types_for_job,
+)
+
+
+def _instance_types():
+    return [
+        CloudInstanceType("small", 2, 1, 0.05, 0, "on_demand"),
+        CloudInstanceType("medium", 8, 4, 0.17, 0, "on_demand"),
+        CloudInstanceType("large", 16, 8, 0.32, 0, "on_demand"),
+        CloudInstanceType("large_spot", 16, 8, 0.10, 20, "spot"),
+        CloudInstanceType("large_spot2", 16, 8, 0.10, 20, "spot"),
+    ]
+
+
+def _summarize(chosen):
+    return {
+        instance_type.instance_type.name: instance_type.num_instances
+        for instance_type in chosen
+    }
+
+
+def _cost(chosen):
+    return sum(
+        instance_type.instance_type.price * instance_type.num_instances
+        for instance_type in chosen
+    )
+
+
+def _num_workers(chosen):
+    return sum(
+        instance_type.workers_per_instance_full * instance_type.num_instances
+        for instance_type in chosen
+    )
+
+
+@pytest.mark.parametrize("solver", ["exact", "greedy"])
+def test_choose_instance_types_basic(solver):
+    instance_types = _instance_types()
+
+    # on-demand only
+    chosen = choose_instance_types_for_job(
+        Resources(2, 1, {}), 8, 0, instance_types, solver
+    )
+    assert _summarize(chosen) == {"large": 1}
+
+    # spot instances are cheaper and we diversify across equivalent instance types
+    chosen = choose_instance_types_for_job(
+        Resources(2, 1, {}), 16, 20, instance_types, solver
+    )
+    assert _summarize(chosen) == {"large_spot": 1, "large_spot2": 1}
+
+    # nothing can run this job
+    assert (
+        choose_instance_types_for_job(
+            Resources(32, 1, {}), 1, 100, instance_types, solver
+        )
+        == []
+    )
+
+    # no workers to allocate
+    assert (
+        choose_instance_types_for_job(
+            Resources(2, 1, {}), 0, 20, instance_types, solver
+        )
+        == []
+    )
+
+
+def test_choose_instance_types_exact_cheaper():
+    instance_types = _instance_types()
+    # the exact solver should never be more expensive than the greedy solver. E.g. for
+    # 16 workers, the greedy algorithm considers medium and large to be the same price
+    # per worker (within half a penny) and so diversifies to large + 2 mediums (0.66),
+    # whereas 2 larges (0.64) are cheaper
+    for num_workers in range(1, 40):
+        exact = choose_instance_types_for_job(
+            Resources(2, 1, {}), num_workers, 0, instance_types, "exact"
+        )
+        greedy = choose_instance_types_for_job(
+            Resources(2, 1, {}), num_workers, 0, instance_types, "greedy"
+        )
+        assert _num_workers(exact) >= num_workers
+        assert _cost(exact) <= _cost(greedy) + 1e-9
+
+    exact = choose_instance_types_for_job(
+        Resources(2, 1, {}), 16, 0, instance_types, "exact"
+    )
+    assert _summarize(exact) == {"large": 2}
+
+
+def test_choose_instance_types_exact_falls_back(mocker):
+    mocker.patch("meadowrun.instance_selection._EXACT_SOLVER_MAX_STEPS", 10)
+    chosen = choose_instance_types_for_job(
+        Resources(2, 1, {}), 100, 0, _instance_types(), "exact"
+    )
+    assert _num_workers(chosen) >= 100
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import meadowrun.instance_type_cache
+from meadowrun.instance_selection import CloudInstanceType
+from meadowrun.instance_type_cache import get_cached_instance_types
+
+
+class _FakeCatalog:
+    def __init__(self):
+        self.num_calls = 0
+
+    async def __call__(self):
+        self.num_calls += 1
+        return [
+            CloudInstanceType("small", 2, 1, 0.01 * self.num_calls, 0, "on_demand"),
+            CloudInstanceType("large", 16, 8, 0.1 * self.num_calls, 15.5, "spot"),
+        ]
+
+
+def _set_cache_age(cache_folder, cache_key, age_secs):
+    path = os.path.join(cache_folder, f"{cache_key}.json")
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data["updated"] -= age_secs
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+
+@pytest.mark.asyncio
+async def test_instance_type_cache(tmp_path):
+    cache_folder = str(tmp_path)
+    fetch = _FakeCatalog()
+
+    async def get():
+        return await get_cached_instance_types(
+            "test-region", fetch, 60, 600, cache_folder
+        )
+
+    # first call fetches, second call uses the cache
+    first = await get()
+    assert fetch.num_calls == 1
+    assert [instance_type.price for instance_type in first] == [0.01, 0.1]
+    assert await get() == first
+    assert fetch.num_calls == 1
+
+    # stale: we get the old catalog back immediately and a refresh happens in the
+    # background
+    _set_cache_age(cache_folder, "test-region", 120)
+    assert await get() == first
+    await asyncio.gather(*meadowrun.instance_type_cache._BACKGROUND_REFRESHES)
+    assert fetch.num_calls == 2
+    second = await get()
+    assert second != first
+    assert fetch.num_calls == 2
+
+    # too old, we wait for the refresh
+    _set_cache_age(cache_folder, "test-region", 6000)
+    third = await get()
+    assert fetch.num_calls == 3
+    assert third != second
+
+    # a corrupted cache file is just ignored
+    with open(os.path.join(cache_folder, "test-region.json"), "w") as f:
+        f.write("{not json")
+    await get()
+    assert fetch.num_calls == 4
+
+
+@pytest.mark.asyncio
+async def test_instance_type_cache_concurrent(tmp_path):
+    num_calls = 0
+
+    async def slow_fetch():
+        nonlocal num_calls
+        num_calls += 1
+        await asyncio.sleep(0.2)
+        return [CloudInstanceType("small", 2, 1, 0.01, 0, "on_demand")]
+
+    # concurrent callers in the same process wait for the first one's fetch rather
+    # than blocking the event loop on the file lock
+    results = await asyncio.gather(
+        *(
+            get_cached_instance_types("test-region", slow_fetch, 60, 600, str(tmp_path))
+            for _ in range(3)
+        )
+    )
+    assert all(result == results[0] for result in results)
+    assert num_calls == 1
+
+
+def test_instance_type_cache_multiple_event_loops(tmp_path):
+    num_calls = 0
+
+    async def slow_fetch():
+        nonlocal num_calls
+        num_calls += 1
+        await asyncio.sleep(0.1)
+        return [CloudInstanceType("small", 2, 1, 0.01, 0, "on_demand")]
+
+    async def get_concurrently():
+        await asyncio.gather(
+            *(
+                get_cached_instance_types(
+                    "test-region", slow_fetch, 60, 600, str(tmp_path)
+                )
+                for _ in range(3)
+            )
+        )
+
+    # the in-process locks can't be shared across event loops, e.g. if a process calls
+    # asyncio.run more than once
+    for i in range(2):
+        for file_name in os.listdir(tmp_path):
+            if file_name.endswith(".json"):
+                os.remove(os.path.join(tmp_path, file_name))
+        asyncio.run(get_concurrently())
+        assert num_calls == i + 1
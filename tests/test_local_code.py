@@ -1,4 +1,7 @@
+import importlib.machinery
+import importlib.util
 import os
+import sys
 import tempfile
 import zipfile
 
@@ -55,3 +58,177 @@ def test_zip_file():
                 ext = os.path.splitext(file.filename)[1]
                 assert ext == ".py"
                 assert any(zip_path in file.filename for zip_path in zip_paths)
+
+
+def _make_project(root):
+    os.makedirs(os.path.join(root, "pkg"))
+    for name, contents in [("a.py", "a = 1\n"), ("pkg/b.py", "b = 2\n")]:
+        with open(os.path.join(root, name), "w") as f:
+            f.write(contents)
+    with open(os.path.join(root, "ignored.txt"), "w") as f:
+        f.write("not code")
+
+
+def test_create_manifest(tmp_path, mocker):
+    project = os.path.join(tmp_path, "project")
+    _make_project(project)
+    hash_cache = os.path.join(tmp_path, "cache", "hashes.json")
+
+    hashed = []
+    original_hash_file = local_code.hash_file
+
+    def hash_file(path):
+        hashed.append(path)
+        return original_hash_file(path)
+
+    mocker.patch.object(local_code, "hash_file", hash_file)
+
+    def create():
+        return local_code.create_manifest(
+            str(tmp_path), False, [project], hash_cache_path=hash_cache
+        )
+
+    manifest_path, zip_paths = create()
+    assert zip_paths == ["project"]
+    assert len(hashed) == 2
+    files, sources = local_code.read_manifest(manifest_path)
+    assert sorted(files) == [
+        "project/a.py",
+        "project/pkg/b.py",
+    ]
+    for digest in files.values():
+        assert original_hash_file(sources[digest]) == digest
+
+    # unchanged files aren't read again, and the manifest doesn't change
+    hashed.clear()
+    assert create()[0] == manifest_path
+    assert hashed == []
+
+    # only the changed file is read
+    with open(os.path.join(project, "a.py"), "w") as f:
+        f.write("a = 100\n")
+    new_manifest_path = create()[0]
+    assert hashed == [os.path.join(os.path.realpath(project), "a.py")]
+    assert new_manifest_path != manifest_path
+
+
+@pytest.mark.asyncio
+async def test_assemble_manifest(tmp_path):
+    from meadowrun.deployment_manager import _get_zip_file_code_paths
+
+    project = os.path.join(tmp_path, "project")
+    _make_project(project)
+    manifest_path, zip_paths = local_code.create_manifest(
+        str(tmp_path),
+        False,
+        [project],
+        hash_cache_path=os.path.join(tmp_path, "hashes.json"),
+    )
+
+    local_copies = os.path.join(tmp_path, "local_copies")
+    os.makedirs(local_copies)
+    code_paths = await _get_zip_file_code_paths(
+        local_copies, f"file://{manifest_path}", zip_paths
+    )
+    assert len(code_paths) == 1
+    with open(os.path.join(code_paths[0], "pkg", "b.py")) as f:
+        assert f.read() == "b = 2\n"
+    assert not os.path.exists(os.path.join(code_paths[0], "ignored.txt"))
+
+    # the same manifest reuses the same folder
+    assert (
+        await _get_zip_file_code_paths(
+            local_copies, f"file://{manifest_path}", zip_paths
+        )
+        == code_paths
+    )
+
+
+@pytest.mark.asyncio
+async def test_manifest_from_windows(tmp_path, mocker):
+    from meadowrun.deployment_manager import _get_zip_file_code_paths
+
+    project = os.path.join(tmp_path, "project")
+    _make_project(project)
+
+    # pretend we're on Windows, where the paths in the "zip file" use backslashes
+    original_iter_files_to_zip = local_code._iter_files_to_zip
+
+    def iter_files_to_zip(real_paths_to_zip_paths, extensions):
+        for full, full_zip in original_iter_files_to_zip(
+            real_paths_to_zip_paths, extensions
+        ):
+            yield full, full_zip.replace("/", "\\")
+
+    mocker.patch.object(local_code, "_iter_files_to_zip", iter_files_to_zip)
+    mocker.patch.object(local_code.os, "sep", "\\")
+    manifest_path, zip_paths = local_code.create_manifest(
+        str(tmp_path),
+        False,
+        [project],
+        hash_cache_path=os.path.join(tmp_path, "cache", "hashes.json"),
+        include_bytecode=True,
+    )
+    mocker.stopall()
+
+    files, _ = local_code.read_manifest(manifest_path)
+    assert sorted(files) == [
+        f"project/__pycache__/a.{sys.implementation.cache_tag}.pyc",
+        "project/a.py",
+        f"project/pkg/__pycache__/b.{sys.implementation.cache_tag}.pyc",
+        "project/pkg/b.py",
+    ]
+
+    local_copies = os.path.join(tmp_path, "local_copies")
+    os.makedirs(local_copies)
+    (code_path,) = await _get_zip_file_code_paths(
+        local_copies, f"file://{manifest_path}", zip_paths
+    )
+    with open(os.path.join(code_path, "pkg", "b.py")) as f:
+        assert f.read() == "b = 2\n"
+
+
+@pytest.mark.asyncio
+async def test_manifest_bytecode(tmp_path):
+    from meadowrun.deployment_manager import _get_zip_file_code_paths
+
+    project = os.path.join(tmp_path, "project")
+    _make_project(project)
+    with open(os.path.join(project, "broken.py"), "w") as f:
+        f.write("def (:\n")
+    manifest_path, zip_paths = local_code.create_manifest(
+        str(tmp_path),
+        False,
+        [project],
+        hash_cache_path=os.path.join(tmp_path, "cache", "hashes.json"),
+        include_bytecode=True,
+    )
+    files, _ = local_code.read_manifest(manifest_path)
+    # files with syntax errors don't get bytecode
+    assert sorted(os.path.basename(path) for path in files) == sorted(
+        [
+            "a.py",
+            "b.py",
+            "broken.py",
+            f"a.{sys.implementation.cache_tag}.pyc",
+            f"b.{sys.implementation.cache_tag}.pyc",
+        ]
+    )
+
+    local_copies = os.path.join(tmp_path, "local_copies")
+    os.makedirs(local_copies)
+    (code_path,) = await _get_zip_file_code_paths(
+        local_copies, f"file://{manifest_path}", zip_paths
+    )
+    # the remote side can use the precompiled bytecode regardless of modification
+    # times
+    os.utime(os.path.join(code_path, "pkg", "b.py"), (0, 0))
+    source_loader = importlib.machinery.SourceFileLoader(
+        "b", os.path.join(code_path, "pkg", "b.py")
+    )
+    bytecode_path = importlib.util.cache_from_source(source_loader.path)
+    with open(bytecode_path, "rb") as f:
+        bytecode = f.read()
+    source_loader.get_code("b")
+    with open(bytecode_path, "rb") as f:
+        assert f.read() == bytecode
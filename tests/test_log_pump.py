@@ -0,0 +1,46 @@
+import gzip
+import os
+
+import pytest
+
+import meadowrun.log_pump
+from meadowrun.log_pump import LogPump
+
+
+@pytest.mark.asyncio
+async def test_log_pump(tmp_path, capfd):
+    lines = [f"line {i}\n".encode("utf-8") for i in range(100_000)]
+
+    log_file_name = os.path.join(tmp_path, "job.log.gz")
+    async with LogPump(log_file_name) as log_pump:
+        for line in lines:
+            await log_pump.write(line)
+
+    # everything goes to the compressed log file and the console
+    with gzip.open(log_file_name, "rb") as f:
+        assert f.read() == b"".join(lines)
+    assert capfd.readouterr().out.encode("utf-8") == b"".join(lines)
+
+
+@pytest.mark.asyncio
+async def test_log_pump_console_rate_limit(tmp_path, capfd, mocker):
+    now = [0.0]
+    mocker.patch.object(meadowrun.log_pump.time, "monotonic", lambda: now[0])
+
+    log_file_name = os.path.join(tmp_path, "job.log")
+    async with LogPump(log_file_name, console_max_bytes_per_sec=100) as log_pump:
+        # the first 10 writes fit in the first second, then we skip until the next
+        # second
+        for _ in range(20):
+            await log_pump.write(b"x" * 9 + b"\n")
+        now[0] = 1.0
+        await log_pump.write(b"after\n")
+
+    with open(log_file_name, "rb") as f:
+        assert f.read() == (b"x" * 9 + b"\n") * 20 + b"after\n"
+    console = capfd.readouterr().out
+    assert console == (
+        "xxxxxxxxx\n" * 10
+        + f"\n[100 bytes of output not shown, see {log_file_name}]\n"
+        + "after\n"
+    )
@@ -0,0 +1,64 @@
+import importlib
+import mmap
+import os
+import pickle
+import sys
+
+import pytest
+
+from meadowrun.run_job_local import _load_result
+
+_func_worker = importlib.import_module("meadowrun.func_worker.__meadowrun_func_worker")
+
+
+class _Array:
+    """Like a numpy array, pickles its data as an out-of-band buffer"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        return _Array, (pickle.PickleBuffer(self.data),)
+
+
+@pytest.mark.parametrize("platform", [sys.platform, "win32"])
+def test_result_buffers(tmp_path, mocker, platform):
+    # Windows can't delete mapped files, so _load_result reads the file instead, which
+    # we can test anywhere
+    mocker.patch.object(sys, "platform", platform)
+
+    result = {
+        "big": _Array(bytearray(b"a" * 1_000_000)),
+        "small": _Array(bytearray(b"b" * 100)),
+        "other": [1, 2, 3],
+    }
+    result_path = os.path.join(tmp_path, "job.result")
+    buffers_path = os.path.join(tmp_path, "job.result_buffers")
+    with open(result_path, "wb") as f:
+        _func_worker._dump_with_out_of_band_buffers(result, f, 5, buffers_path)
+
+    # only the big buffer is written out of band
+    with open(result_path, "rb") as f:
+        pickled_result = f.read()
+    assert len(pickled_result) < 10_000
+    assert os.path.getsize(buffers_path) >= 1_000_000
+
+    loaded = _load_result(pickled_result, buffers_path)
+    assert not os.path.exists(buffers_path)
+    assert loaded["other"] == [1, 2, 3]
+    assert loaded["small"].data == b"b" * 100
+    # the big buffer refers directly to the mapped file
+    if platform == "win32":
+        assert isinstance(loaded["big"].data.obj, bytearray)
+    else:
+        assert isinstance(loaded["big"].data.obj, mmap.mmap)
+    assert loaded["big"].data == b"a" * 1_000_000
+    # and can be modified
+    loaded["big"].data[0] = ord("c")
+
+    # results without large buffers don't get a buffers file at all
+    with open(result_path, "wb") as f:
+        _func_worker._dump_with_out_of_band_buffers([1, 2], f, 5, buffers_path)
+    assert not os.path.exists(buffers_path)
+    with open(result_path, "rb") as f:
+        assert _load_result(f.read(), buffers_path) == [1, 2]
@@ -0,0 +1,122 @@
+"""
+Tests for uploading and downloading artifacts in s3.py against the in-memory S3
+stand-in
+"""
+
+import asyncio
+import os
+import threading
+
+import pytest
+
+import meadowrun.aws_integration.aws_core as aws_core
+import meadowrun.aws_integration.s3 as s3
+from aws_stand_ins import FakeS3
+from meadowrun.local_code import create_manifest, hash_file
+
+
+@pytest.fixture
+def fake_s3(mocker):
+    fake = FakeS3()
+    mocker.patch.object(aws_core.boto3, "client", fake.client)
+    mocker.patch.object(aws_core, "_BOTO3_CLIENTS", {})
+    mocker.patch.object(s3, "_BUCKET_NAMES", {})
+    mocker.patch.object(s3, "_BLOB_LAST_MODIFIED", {})
+    # small parts so that we can test multipart transfers with small files
+    mocker.patch.object(s3, "_MULTIPART_THRESHOLD", 100)
+    mocker.patch.object(s3, "_PART_SIZE", 30)
+    return fake
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [0, 50, 95, 100, 101, 250])
+async def test_upload_and_download(fake_s3, tmp_path, size):
+    source = os.path.join(tmp_path, "source")
+    with open(source, "wb") as f:
+        f.write(os.urandom(size))
+
+    bucket_name, key = await s3.ensure_uploaded(source, "us-east-2")
+    assert key == hash_file(source)
+    # the second upload is just a head_object, and the bucket name is cached
+    assert await s3.ensure_uploaded(source, "us-east-2") == (bucket_name, key)
+    assert fake_s3.requests["list_buckets"] == 1
+    if size > 100:
+        assert fake_s3.requests["upload_part"] == -(-size // 30)
+    else:
+        assert fake_s3.requests["put_object"] == 1
+
+    destination = os.path.join(tmp_path, "destination")
+    await s3.download_file(bucket_name, key, destination, "us-east-2")
+    with open(source, "rb") as f1, open(destination, "rb") as f2:
+        assert f1.read() == f2.read()
+    assert fake_s3.requests.get("get_object", 0) == -(-size // 30)
+
+
+@pytest.mark.asyncio
+async def test_download_verifies_contents(fake_s3, tmp_path):
+    source = os.path.join(tmp_path, "source")
+    with open(source, "wb") as f:
+        f.write(b"x" * 200)
+    bucket_name, key = await s3.ensure_uploaded(source, "us-east-2")
+
+    # corrupt the object but keep the original metadata
+    fake_s3.buckets[bucket_name][key].body = b"y" * 200
+
+    destination = os.path.join(tmp_path, "destination")
+    with pytest.raises(ValueError):
+        await s3.download_file(bucket_name, key, destination, "us-east-2")
+    assert os.listdir(tmp_path) == ["source"]
+
+
+@pytest.mark.asyncio
+async def test_s3_calls_do_not_block_event_loop(fake_s3, mocker, tmp_path):
+    loop_thread = threading.get_ident()
+    threads = set()
+    head_object = fake_s3.head_object
+
+    def record_thread(**kwargs):
+        threads.add(threading.get_ident())
+        return head_object(**kwargs)
+
+    mocker.patch.object(fake_s3, "head_object", record_thread)
+
+    sources = []
+    for i in range(4):
+        source = os.path.join(tmp_path, f"source{i}")
+        with open(source, "wb") as f:
+            f.write(os.urandom(50))
+        sources.append(source)
+
+    await asyncio.gather(
+        *(s3.ensure_uploaded(source, "us-east-2") for source in sources)
+    )
+    assert threads and loop_thread not in threads
+    # all of the uploads share one client
+    assert list(aws_core._BOTO3_CLIENTS) == [("s3", "us-east-2")]
+
+
+@pytest.mark.asyncio
+async def test_ensure_manifest_uploaded(fake_s3, tmp_path):
+    project = os.path.join(tmp_path, "project")
+    os.makedirs(project)
+    for name in ("a.py", "b.py"):
+        with open(os.path.join(project, name), "w") as f:
+            f.write(f"# {name}\n")
+
+    def create():
+        return create_manifest(
+            str(tmp_path),
+            False,
+            [project],
+            hash_cache_path=os.path.join(tmp_path, "hashes.json"),
+        )[0]
+
+    await s3.ensure_manifest_uploaded(create(), "us-east-2")
+    assert fake_s3.requests["put_object"] == 3
+
+    # only the changed file is uploaded, and we don't list the bucket again
+    with open(os.path.join(project, "a.py"), "w") as f:
+        f.write("a = 1\n")
+    await s3.ensure_manifest_uploaded(create(), "us-east-2")
+    assert fake_s3.requests["put_object"] == 5
+    assert fake_s3.requests["list_objects_v2"] == 1
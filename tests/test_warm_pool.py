@@ -0,0 +1,257 @@
+"""
+Tests for WarmPoolPolicy in adjust_ec2_instances and restarting stopped instances in
+launch_ec2_instances. Uses the in-memory EC2 stand-in rather than real AWS resources.
+"""
+
+import datetime
+import threading
+
+import pytest
+
+import meadowrun.aws_integration.aws_core as aws_core
+import meadowrun.aws_integration.management_lambdas.adjust_ec2_instances as adjust
+from aws_stand_ins import FakeEc2
+from meadowrun.aws_integration.ec2 import launch_ec2_instances
+from meadowrun.aws_integration.management_lambdas.ec2_alloc_stub import (
+    _EC2_ALLOC_STOPPED_TIME_TAG,
+    _EC2_ALLOC_TAG,
+    _EC2_ALLOC_TAG_VALUE,
+    WarmPoolPolicy,
+)
+from meadowrun.instance_selection import CloudInstanceType
+
+_TAGS = {_EC2_ALLOC_TAG: _EC2_ALLOC_TAG_VALUE}
+
+
+def _fake_ec2_with_registrar(mocker, instances):
+    """
+    instances is a list of (instance_type, instance_lifecycle, idle_for_secs). All of
+    the instances will be running and registered with no jobs.
+    """
+    ec2 = FakeEc2()
+    mocker.patch.object(adjust.boto3, "resource", ec2.resource)
+
+    now = datetime.datetime.utcnow()
+    registered = {}
+    for instance_type, instance_lifecycle, idle_for_secs in instances:
+        instance = ec2.add_instance(instance_type, "running", _TAGS, instance_lifecycle)
+        registered[instance.public_dns_name] = (
+            now - datetime.timedelta(seconds=idle_for_secs),
+            0,
+        )
+
+    mocker.patch.object(
+        adjust, "_get_registered_ec2_instances", lambda region_name: dict(registered)
+    )
+
+    def deregister(public_address, require_no_running_jobs, region_name):
+        registered.pop(public_address)
+        return True
+
+    mocker.patch.object(adjust, "_deregister_ec2_instance", deregister)
+    return ec2
+
+
+def _states(ec2):
+    return [instance.state["Name"] for instance in ec2.instances.values()]
+
+
+def test_warm_pool_policy_json():
+    policy = WarmPoolPolicy(
+        datetime.timedelta(minutes=5),
+        {"c5.large": datetime.timedelta(minutes=10)},
+        2,
+        True,
+        datetime.timedelta(hours=3),
+    )
+    assert WarmPoolPolicy.from_json(policy.to_json()) == policy
+    assert WarmPoolPolicy.from_json("{}") == WarmPoolPolicy()
+    assert WarmPoolPolicy.from_json('{"min_warm_instances": 1}') == WarmPoolPolicy(
+        min_warm_instances=1
+    )
+
+
+def test_default_policy_terminates_idle(mocker):
+    ec2 = _fake_ec2_with_registrar(
+        mocker, [("c5.large", None, 60), ("c5.large", None, 10)]
+    )
+    adjust._deregister_and_terminate_instances(
+        "us-east-2", datetime.timedelta(seconds=30)
+    )
+    assert _states(ec2) == ["terminated", "running"]
+
+
+def test_idle_timeout_per_instance_type(mocker):
+    ec2 = _fake_ec2_with_registrar(
+        mocker, [("c5.large", None, 120), ("m5.large", None, 120)]
+    )
+    policy = WarmPoolPolicy(
+        datetime.timedelta(seconds=60),
+        {"m5.large": datetime.timedelta(minutes=10)},
+    )
+    adjust._deregister_and_terminate_instances(
+        "us-east-2", datetime.timedelta(seconds=30), warm_pool_policy=policy
+    )
+    assert _states(ec2) == ["terminated", "running"]
+
+
+def test_min_warm_instances(mocker):
+    # the instances that have been idle the longest are shut down first
+    ec2 = _fake_ec2_with_registrar(
+        mocker,
+        [("c5.large", None, 100), ("c5.large", None, 300), ("c5.large", None, 200)],
+    )
+    adjust._deregister_and_terminate_instances(
+        "us-east-2",
+        datetime.timedelta(seconds=30),
+        warm_pool_policy=WarmPoolPolicy(min_warm_instances=1),
+    )
+    assert _states(ec2) == ["running", "terminated", "terminated"]
+
+
+def test_stop_instead_of_terminate(mocker):
+    ec2 = _fake_ec2_with_registrar(
+        mocker, [("c5.large", None, 60), ("c5.large", "spot", 60)]
+    )
+    policy = WarmPoolPolicy(stop_instead_of_terminate=True)
+    adjust._deregister_and_terminate_instances(
+        "us-east-2", datetime.timedelta(seconds=30), warm_pool_policy=policy
+    )
+    # spot instances can't be stopped
+    assert _states(ec2) == ["stopped", "terminated"]
+    stopped = next(iter(ec2.instances.values()))
+    assert _EC2_ALLOC_STOPPED_TIME_TAG in stopped.get_tags()
+
+    # stopped instances aren't treated as "running but not registered"
+    adjust._deregister_and_terminate_instances(
+        "us-east-2",
+        datetime.timedelta(seconds=30),
+        datetime.timedelta.min,
+        warm_pool_policy=policy,
+    )
+    assert _states(ec2) == ["stopped", "terminated"]
+
+    # until they've been stopped for too long
+    stopped.create_tags(
+        Tags=[
+            {
+                "Key": _EC2_ALLOC_STOPPED_TIME_TAG,
+                "Value": (
+                    datetime.datetime.utcnow() - datetime.timedelta(days=2)
+                ).isoformat(),
+            }
+        ]
+    )
+    adjust._deregister_and_terminate_instances(
+        "us-east-2", datetime.timedelta(seconds=30), warm_pool_policy=policy
+    )
+    assert _states(ec2) == ["terminated", "terminated"]
+
+
+def _patch_launch_ec2_instances(mocker):
+    ec2 = FakeEc2()
+    mocker.patch.object(aws_core.boto3, "resource", ec2.resource)
+    mocker.patch.object(aws_core.boto3, "client", ec2.client)
+    mocker.patch.object(aws_core, "_BOTO3_CLIENTS", {})
+    mocker.patch.object(aws_core, "_BOTO3_RESOURCES", threading.local())
+
+    async def get_instance_types(region_name):
+        return [
+            CloudInstanceType("c5.large", 4, 2, 0.085, 0, "on_demand"),
+            CloudInstanceType("c5.xlarge", 8, 4, 0.2, 0, "on_demand"),
+            CloudInstanceType("c5.large", 4, 2, 0.03, 10, "spot"),
+        ]
+
+    mocker.patch(
+        "meadowrun.aws_integration.ec2.get_cached_ec2_instance_types",
+        get_instance_types,
+    )
+    return ec2
+
+
+@pytest.mark.asyncio
+async def test_launch_restarts_stopped_instances(mocker):
+    ec2 = _patch_launch_ec2_instances(mocker)
+
+    stopped_tags = dict(_TAGS)
+    stopped_tags[_EC2_ALLOC_STOPPED_TIME_TAG] = datetime.datetime.utcnow().isoformat()
+    for instance_type in ["c5.large", "c5.xlarge", "c5.large"]:
+        ec2.add_instance(instance_type, "stopped", stopped_tags)
+    # not launched by meadowrun, so shouldn't be restarted
+    ec2.add_instance("c5.large", "stopped", {_EC2_ALLOC_STOPPED_TIME_TAG: "x"})
+
+    # 4 jobs fit on the two c5.larges, which are cheaper per job than the c5.xlarge, so
+    # we don't need to launch anything
+    instances = await launch_ec2_instances(
+        1, 2, 4, 0, "ami-1", "us-east-2", tags=_TAGS, reuse_stopped_instances=True
+    )
+    assert len(instances) == 2
+    assert {instance.instance_type.instance_type.name for instance in instances} == {
+        "c5.large"
+    }
+    assert _states(ec2) == ["running", "stopped", "running", "stopped"]
+    assert all(
+        _EC2_ALLOC_STOPPED_TIME_TAG not in instance.get_tags()
+        for instance in ec2.instances.values()
+        if instance.state["Name"] == "running"
+    )
+
+    # now we restart the c5.xlarge, and launch a new instance for the remaining job
+    instances = await launch_ec2_instances(
+        1, 2, 5, 0, "ami-1", "us-east-2", tags=_TAGS, reuse_stopped_instances=True
+    )
+    assert sorted(
+        instance.instance_type.instance_type.name for instance in instances
+    ) == ["c5.large", "c5.xlarge"]
+    assert len(ec2.instances) == 5
+    assert _states(ec2) == ["running", "running", "running", "stopped", "running"]
+
+
+@pytest.mark.asyncio
+async def test_launch_does_not_reuse_instances_restarted_by_another_client(mocker):
+    ec2 = _patch_launch_ec2_instances(mocker)
+
+    stopped_tags = dict(_TAGS)
+    stopped_tags[_EC2_ALLOC_STOPPED_TIME_TAG] = datetime.datetime.utcnow().isoformat()
+    stopped_instance = ec2.add_instance("c5.large", "stopped", stopped_tags)
+
+    # another client restarts the same stopped instance after we've chosen it but
+    # before we start it
+    ec2_client = ec2.client("ec2")
+    start_instances = ec2_client.start_instances
+
+    def start_instances_after_other_client(InstanceIds):
+        start_instances(InstanceIds=[stopped_instance.id])
+        return start_instances(InstanceIds=InstanceIds)
+
+    ec2_client.start_instances = start_instances_after_other_client
+    mocker.patch.object(aws_core.boto3, "client", lambda *args, **kwargs: ec2_client)
+
+    instances = await launch_ec2_instances(
+        1, 2, 2, 0, "ami-1", "us-east-2", tags=_TAGS, reuse_stopped_instances=True
+    )
+    # we launch a new instance rather than using the other client's instance
+    assert len(instances) == 1
+    assert instances[0].public_dns_name != stopped_instance.public_dns_name
+    assert len(ec2.instances) == 2
+    # and we leave it to the other client to remove the stopped time tag
+    assert _EC2_ALLOC_STOPPED_TIME_TAG in stopped_instance.get_tags()
+
+
+@pytest.mark.asyncio
+async def test_launch_terminates_instances_on_failure(mocker):
+    ec2 = _patch_launch_ec2_instances(mocker)
+
+    async def wait_for_public_dns_names(region_name, instance_ids):
+        raise ValueError("Timed out waiting for instances")
+
+    mocker.patch(
+        "meadowrun.aws_integration.ec2._wait_for_public_dns_names",
+        wait_for_public_dns_names,
+    )
+
+    with pytest.raises(ValueError, match="Timed out"):
+        await launch_ec2_instances(1, 2, 4, 0, "ami-1", "us-east-2", tags=_TAGS)
+    # the instances we launched don't get left running
+    assert ec2.instances
+    assert set(_states(ec2)) == {"terminated"}